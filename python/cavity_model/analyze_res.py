@@ -16,7 +16,7 @@ def rd_data_1(file_name):
             x.append(float(x1))
             xp.append(float(xp1))
             y.append(float(y1))
-            yp.append(float(xp1))
+            yp.append(float(yp1))
             z.append(float(z1))
             zp.append(float(zp1))
     inf.close()
@@ -1,12 +1,35 @@
 
-from ._internal import Machine
-from ._internal import GLPSPrinter, _GLPSParse
+from ._internal import Machine, Config, LinacContext
+from ._internal import GLPSPrinter, _GLPSParse, _TLMLoad
 
 class GLPSParser(object):
     def parse(self, s):
         return _GLPSParse(s)
 
+def load_tlm(path, config=None, number_names=True):
+    """Read a TLM flat file
+
+    >>> M = Machine(load_tlm('LS1.dat', {'IonEs':931.49432e6}))
+
+    Elements are translated as by cavity_model/get_lat.py, without the intermediate GLPS file,
+    except that:
+
+    - ebend columns follow the layout in the get_lat.py header.  The hor/ver flag is kept as 'ver',
+      and 'x_frng', 'y_frng', 'asym_fac' come from the next three columns (get_lat.py reads them one column early).
+    - ebend and equad names get "_<n>" only with number_names, as for other elements.
+      get_lat.py always numbers them, and adds a second, incorrect, suffix.
+
+    :param path: Name of the flat file.
+    :param config: A dict of top level values (eg. 'sim_type', or defaults for all elements).
+    :param number_names: Append "_<n>" to each element name to make them unique.
+    :returns: A Config
+    """
+    return _TLMLoad(path, config, number_names)
+
 __all__ = ['Machine',
+    'Config',
+    'LinacContext',
     'GLPSPrinter',
     'GLPSParser',
+    'load_tlm',
 ]
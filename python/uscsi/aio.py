@@ -0,0 +1,75 @@
+"""asyncio support (python 3 only)
+
+Propagation runs on a pool of worker threads with the GIL released,
+so the event loop stays responsive and several States can be propagated at once.
+
+>>> obs = await M.propagate_async(S, observe=[10, 20])
+>>> results = await M.propagate_many_async([S1, S2, S3], observe=[10])
+
+Cancelling the awaitable (eg. with asyncio.wait_for()) stops the propagation
+before the next element.  The State is then left partly propagated,
+and may be in use by the worker until that element has finished.
+
+A Machine must not be reconfigure()'d while propagations are in progress.
+"""
+from __future__ import print_function
+
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['propagate_async', 'propagate_many_async']
+
+_executor = None
+
+def _default_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _executor
+
+def _loop():
+    try:
+        return asyncio.get_running_loop()
+    except (AttributeError, RuntimeError): # py < 3.7, or no running loop
+        return asyncio.get_event_loop()
+
+def propagate_async(machine, state, start=0, max=-1, observe=None, executor=None):
+    """Propagate 'state' through 'machine' on a worker thread
+
+    :param machine: A Machine
+    :param state: A State, which must not be used elsewhere until the returned awaitable completes.
+    :param start: As for Machine.propagate()
+    :param max: As for Machine.propagate()
+    :param observe: A list of element indicies after which a copy of the State is recorded.
+    :param executor: A concurrent.futures.Executor.  Default is a shared thread pool with one
+                     thread for each CPU.
+    :returns: An awaitable resolving to [(index, State), ...] if 'observe' is given, or None.
+    """
+    if observe is not None:
+        observe = list(observe)
+    cancel = bytearray(1)
+
+    def run():
+        obs, _cancelled = machine.propagate_nogil(state, start, max, observe, cancel)
+        return obs if observe is not None else None
+
+    fut = _loop().run_in_executor(executor or _default_executor(), run)
+
+    def done(F):
+        if F.cancelled():
+            cancel[0] = 1
+    fut.add_done_callback(done)
+    return fut
+
+def propagate_many_async(machine, states, start=0, max=-1, observe=None, executor=None):
+    """Propagate several States concurrently
+
+    Arguments are as for propagate_async(), with a list of States.
+
+    :returns: An awaitable resolving to a list of the results of propagate_async(), one for each State.
+              Cancelling it cancels all propagations.
+    """
+    if observe is not None:
+        observe = list(observe)
+    return asyncio.gather(*[propagate_async(machine, S, start, max, observe, executor) for S in states])
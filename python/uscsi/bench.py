@@ -0,0 +1,352 @@
+"""Performance benchmarks
+
+Time the hot paths (lattice parsing, Machine construction, allocState(),
+propagate(), observed propagate(), and reconfigure()) over the bundled
+lattices and over synthetic lattices of 10^3 to 10^6 elements.
+
+$ python -m uscsi.bench -o results.json
+$ python -m uscsi.bench -b baseline.json  # exit code 1 on regression
+
+>>> from uscsi.bench import run, compare
+>>> R = run(match='synthetic', max_elements=10000)
+>>> R['results']['synthetic_1000/propagate']['median'] # [s]
+>>> compare(R, baseline)
+"""
+from __future__ import print_function
+
+import sys, os, time, json, platform
+from timeit import default_timer as timer
+
+import numpy
+
+from . import Machine, GLPSParser
+
+__all__ = ['run', 'compare', 'synthetic_lattice', 'synthetic_glps', 'cases']
+
+# increment when the meaning of results changes
+VERSION = 1
+
+_testdir = os.path.join(os.path.dirname(__file__), 'test')
+# src/data in a source tree.  Not installed.
+_tracydir = os.path.join(os.path.dirname(__file__), '..', '..', 'src', 'data')
+
+AMU = 931.49432e6 # [eV/u]
+
+def synthetic_lattice(n, sim_type='MomentMatrix'):
+    """Build a dict lattice of 'n' elements.
+
+    A source followed by repeating cells of drift, quadrupole, drift, solenoid
+    with alternating quadrupole polarity.
+    """
+    IonEk = 0.5e6
+    elements = [{'name':'S', 'type':'source', 'initial':numpy.identity(7)*1e-3,
+                 'IonZ':0.138, 'IonEs':AMU, 'IonEk':IonEk, 'IonW':AMU+IonEk}]
+    for i in range(1, n):
+        k = (i-1)%4
+        if k==1:
+            elements.append({'name':'q%d'%i, 'type':'quadrupole', 'L':0.1,
+                             'K':1.0 if (i-1)%8==1 else -1.0})
+        elif k==3:
+            elements.append({'name':'s%d'%i, 'type':'solenoid', 'L':0.1, 'B':1.0, 'K':0.5})
+        else:
+            elements.append({'name':'d%d'%i, 'type':'drift', 'L':0.2})
+    return {'sim_type':sim_type, 'elements':elements}
+
+def synthetic_glps(n, sim_type='MomentMatrix'):
+    """Lattice file text equivalent to synthetic_lattice(n)
+
+    Each element is defined separately, as in generated lattice files.
+    """
+    lines = ['sim_type = "%s";'%sim_type,
+             'S: source, initial = [%s], IonZ = 0.138, IonEs = %g, IonEk = 0.5e6, IonW = %g;'%(
+                 ', '.join(['%g'%V for V in (numpy.identity(7)*1e-3).flat]), AMU, AMU+0.5e6)]
+    names = ['S']
+    L = synthetic_lattice(9)['elements'] # two cells
+    for i in range(1, n):
+        E = L[(i-1)%8+1]
+        name = '%s%d'%(E['name'][0], i)
+        params = ', '.join(['%s = %g'%(K, E[K]) for K in sorted(E) if K not in ('name', 'type')])
+        lines.append('%s: %s, %s;'%(name, E['type'], params))
+        names.append(name)
+    lines.append('cell: LINE = (%s);'%', '.join(names))
+    lines.append('USE: cell;')
+    return '\n'.join(lines).encode('ascii')
+
+class Case(object):
+    """A lattice to benchmark, and the operations which apply to it.
+
+    'ops' is a subset of 'parse', 'build', 'allocState', 'propagate', 'observe',
+    'reconfigure', 'match', and 'ensemble'.
+    """
+    def __init__(self, name, text=None, conf=None, ops=('parse', 'build', 'allocState', 'propagate',
+                                                       'observe', 'reconfigure')):
+        self.name, self._text, self._conf, self.ops = name, text, conf, ops
+
+    @property
+    def text(self):
+        if callable(self._text):
+            self._text = self._text()
+        return self._text
+
+    def conf(self):
+        if self._conf is None:
+            return GLPSParser().parse(self.text)
+        elif callable(self._conf):
+            return self._conf()
+        return self._conf
+
+def _readfile(fname):
+    def read():
+        with open(fname, 'rb') as F:
+            return F.read()
+    return read
+
+def cases(sizes=(1000, 10000, 100000, 1000000), tracydir=None):
+    """List the available benchmark Cases
+
+    :param sizes: Element counts of synthetic lattices.
+    :param tracydir: Directory with tracy_*.lat files (parse only).  Default is src/data of a source tree.
+                     Skipped if missing.
+    """
+    ret = []
+    for name, fname in (('IMP', 'latticeout_IMP_withPV_consolidate.lat'),
+                        ('moment_jb_2', 'moment_jb_2.lat')):
+        ops = ('parse', 'build', 'allocState', 'propagate', 'observe', 'reconfigure')
+        ops += ('ensemble',) if name=='IMP' else ('match',)
+        ret.append(Case(name, text=_readfile(os.path.join(_testdir, fname)), ops=ops))
+
+    tracydir = tracydir or _tracydir
+    for n in (1, 2):
+        fname = os.path.join(tracydir, 'tracy_%d.lat'%n)
+        if os.path.isfile(fname):
+            # element types are not known to Machine
+            ret.append(Case('tracy_%d'%n, text=_readfile(fname), ops=('parse',)))
+
+    for n in sizes:
+        ret.append(Case('synthetic_%d'%n, text=lambda n=n:synthetic_glps(n),
+                        conf=lambda n=n:synthetic_lattice(n)))
+    return ret
+
+def _time(fn, repeat, maxtime, setup=None):
+    """Call fn() up to 'repeat' times, stopping early once 'maxtime' seconds are spent.
+
+    :returns: a list of the time of each call [s]
+    """
+    T = []
+    total = 0.0
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        T0 = timer()
+        fn()
+        T.append(timer()-T0)
+        total += T[-1]
+        if total>=maxtime:
+            break
+    return T
+
+def _summary(T, count, **extra):
+    T = numpy.asarray(T)
+    R = {'repeat':len(T), 'min':float(T.min()), 'median':float(numpy.median(T)),
+         'mean':float(T.mean()), 'count':count, 'per_count':float(numpy.median(T))/count}
+    R.update(extra)
+    return R
+
+def _run_case(C, repeat, maxtime):
+    R = {}
+    if 'parse' in C.ops:
+        text = C.text
+        P = GLPSParser()
+        count = len(P.parse(text)['elements'])
+        R['parse'] = _summary(_time(lambda:P.parse(text), repeat, maxtime), count, bytes=len(text))
+    if C.ops==('parse',):
+        return R
+
+    conf = C.conf()
+    M = Machine(conf)
+    N = len(M)
+    if 'build' in C.ops:
+        R['build'] = _summary(_time(lambda:Machine(conf), repeat, maxtime), N)
+    del conf
+
+    if 'allocState' in C.ops:
+        R['allocState'] = _summary(_time(lambda:M.allocState({}), repeat, maxtime), 1)
+
+    S0, S = M.allocState({}), M.allocState({})
+    reset = lambda:S.assign(S0)
+    if 'propagate' in C.ops:
+        R['propagate'] = _summary(_time(lambda:M.propagate(S), repeat, maxtime, setup=reset), N)
+
+    if 'observe' in C.ops:
+        # at most 10000 observed States kept at once
+        observe = list(range(0, N, max(1, N//10000)))
+        R['observe'] = _summary(_time(lambda:M.propagate(S, observe=observe), repeat, maxtime,
+                                      setup=reset), N, observed=len(observe))
+
+    if 'reconfigure' in C.ops:
+        elements = M.conf()['elements']
+        idx = [i for i, E in enumerate(elements) if 'L' in E]
+        idx = idx[::max(1, len(idx)//100)]
+        params = [(i, {'L':elements[i]['L']}) for i in idx] # unchanged values
+        def reconf():
+            for i, P in params:
+                M.reconfigure(i, P)
+        R['reconfigure'] = _summary(_time(reconf, repeat, maxtime), len(params))
+
+    if 'match' in C.ops:
+        R['match'] = _bench_match(M, repeat, maxtime)
+
+    if 'ensemble' in C.ops:
+        R['ensemble'] = _bench_ensemble(C, repeat, maxtime)
+
+    return R
+
+def _bench_match(M, repeat, maxtime):
+    """Fit solenoid strengths to recover the envelope at the end of the lattice
+    """
+    elements = M.conf()['elements']
+    sols = [i for i, E in enumerate(elements) if E['type']=='solenoid']
+    knobs = [(i, 'K') for i in sols]
+    last = len(M)-1
+
+    orig = [elements[i].get('K', 0.0) for i in sols]
+    goal = numpy.linspace(0.8, 1.2, len(sols))
+    for i, K in zip(sols, goal):
+        M.reconfigure(i, {'K':K})
+    S = M.allocState({})
+    M.propagate(S)
+    targets = [(last, (0,0), S.state[0,0]), (last, (2,2), S.state[2,2]),
+               (last, (0,1), S.state[0,1]), (last, (2,3), S.state[2,3])]
+
+    def reset():
+        for i, K in zip(sols, goal*0.9):
+            M.reconfigure(i, {'K':K})
+    result = []
+    T = _time(lambda:result.append(M.match(M.allocState({}), knobs, targets)), repeat, maxtime, setup=reset)
+
+    for i, K in zip(sols, orig):
+        M.reconfigure(i, {'K':K})
+    return _summary(T, 1, iterations=int(result[-1]['iterations']))
+
+def _bench_ensemble(C, repeat, maxtime, count=10000):
+    conf = C.conf()
+    conf['sim_type'] = 'Ensemble'
+    M = Machine(conf)
+    P = numpy.random.RandomState(0).randn(count, 7)
+    P[:,6] = 1.0
+    S0 = M.allocState({'particles':P})
+    S = M.allocState({'particles':P})
+    T = _time(lambda:M.propagate(S), repeat, maxtime, setup=lambda:S.assign(S0))
+    return _summary(T, len(M)*count, particles=count)
+
+def run(match=None, repeat=10, maxtime=5.0, max_elements=100000, tracydir=None, verbose=False):
+    """Run benchmarks
+
+    :param match: Only run cases whose name contains this string.
+    :param repeat: Maximum number of times each operation is timed.
+    :param maxtime: Stop repeating an operation after this many seconds.
+    :param max_elements: Skip synthetic lattices larger than this.
+    :param tracydir: Directory with tracy_*.lat.  See cases()
+    :param verbose: Print each result as it is completed
+    :returns: A dict with entries
+
+              * 'version' of the result format
+              * 'host' a dict describing the host and software versions
+              * 'results' a dict keyed by "<case>/<operation>".  Each entry is a dict
+                of 'min', 'median', and 'mean' time [s], 'repeat' count, and 'per_count' which is
+                'median' divided by 'count' (eg. time per element).
+
+              Suitable for json.dump()
+    """
+    sizes = [n for n in (1000, 10000, 100000, 1000000) if n<=max_elements]
+    results = {}
+    for C in cases(sizes=sizes, tracydir=tracydir):
+        if match and match not in C.name:
+            continue
+        for op, R in sorted(_run_case(C, repeat, maxtime).items()):
+            key = '%s/%s'%(C.name, op)
+            results[key] = R
+            if verbose:
+                print('%-32s %12.6f s  %6d  %12.3g s/count'%(key, R['median'], R['repeat'], R['per_count']))
+                sys.stdout.flush()
+
+    return {
+        'version':VERSION,
+        'host':{
+            'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'node':platform.node(),
+            'machine':platform.machine(),
+            'python':platform.python_version(),
+            'numpy':numpy.__version__,
+        },
+        'results':results,
+    }
+
+def compare(results, baseline, threshold=0.1, stat='median'):
+    """Compare results from run() with a baseline
+
+    :param results: As returned by run(), or loaded from JSON.
+    :param baseline: As for 'results'.
+    :param threshold: Fractional slowdown counted as a regression.
+    :param stat: Which timing to compare.  'median' or 'min'.
+    :returns: A list of (key, baseline, new, ratio, status) sorted by key,
+              where 'status' is 'regression', 'improvement', 'ok', 'new', or 'missing'.
+    """
+    if results.get('version')!=baseline.get('version'):
+        raise ValueError("Result version %s differs from baseline version %s"%(
+                         results.get('version'), baseline.get('version')))
+    new, old = results['results'], baseline['results']
+
+    ret = []
+    for key in sorted(set(new)|set(old)):
+        if key not in old:
+            ret.append((key, None, new[key][stat], None, 'new'))
+        elif key not in new:
+            ret.append((key, old[key][stat], None, None, 'missing'))
+        else:
+            B, N = old[key][stat], new[key][stat]
+            ratio = N/B if B>0 else float('inf')
+            if ratio>1.0+threshold:
+                status = 'regression'
+            elif ratio<1.0/(1.0+threshold):
+                status = 'improvement'
+            else:
+                status = 'ok'
+            ret.append((key, B, N, ratio, status))
+    return ret
+
+def main(args=None):
+    from optparse import OptionParser
+    P = OptionParser(usage='%prog [options]')
+    P.add_option('-k', '--match', metavar='NAME', help='Only run cases with names containing NAME')
+    P.add_option('-r', '--repeat', type='int', default=10, help='Maximum repetitions of each operation')
+    P.add_option('-t', '--maxtime', type='float', default=5.0, help='Maximum seconds spent repeating each operation')
+    P.add_option('-N', '--max-elements', type='int', default=100000, help='Largest synthetic lattice')
+    P.add_option('--tracy', metavar='DIR', help='Directory containing tracy_*.lat')
+    P.add_option('-o', '--output', metavar='FILE', help='Write results as JSON')
+    P.add_option('-b', '--baseline', metavar='FILE', help='Compare with results previously written with -o')
+    P.add_option('--threshold', type='float', default=0.1, help='Fractional slowdown counted as a regression')
+    opts, args = P.parse_args(args)
+
+    R = run(match=opts.match, repeat=opts.repeat, maxtime=opts.maxtime,
+            max_elements=opts.max_elements, tracydir=opts.tracy, verbose=True)
+
+    if opts.output:
+        with open(opts.output, 'w') as F:
+            json.dump(R, F, indent=1, sort_keys=True)
+
+    if opts.baseline:
+        with open(opts.baseline, 'r') as F:
+            B = json.load(F)
+        failed = False
+        print('%-32s %12s %12s %8s'%('', 'baseline', 'new', 'ratio'))
+        for key, old, new, ratio, status in compare(R, B, threshold=opts.threshold):
+            fmt = lambda V:'%12.6f'%V if V is not None else '%12s'%'-'
+            print('%-32s %s %s %8s %s'%(key, fmt(old), fmt(new),
+                                        '%.2f'%ratio if ratio is not None else '-', status))
+            failed |= status=='regression'
+        if failed:
+            sys.exit(1)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,225 @@
+"""Compare simulation results with a reference
+
+>>> from uscsi.compare import compare_files, compare_many
+>>> R = compare_files('CenofChg.out', 'MCSModelCenVec.txt')
+>>> R['columns']
+('x', 'xp', 'y', 'yp', 'z', 'zp')
+>>> R['max'], R['rms'] # deviation of each column
+>>> L = compare_many([('CenofChg.out', 'MCSModelCenVec.txt'),
+...                   ('BeamRMS.out', 'MCSModelRmsVec.txt'),
+...                   ('long_tab.out', 'MCSModelRf.txt', 'long_tab', 'long')])
+
+Or from the command line
+
+$ python -m uscsi.compare -t 1e-6 CenofChg.out MCSModelCenVec.txt BeamRMS.out MCSModelRmsVec.txt
+
+Replaces python/cavity_model/analyze_res.py.
+Files are read in bulk, and .npy files are memory mapped.
+"""
+from __future__ import print_function
+
+import sys
+import multiprocessing
+
+import numpy
+
+__all__ = ['FORMATS', 'load', 'align', 'compare', 'compare_files', 'compare_many']
+
+# format name -> (columns used, or None for all; column names).  s is always first.
+FORMATS = {
+    # CenofChg.out, BeamRMS.out, MCSModelCenVec.txt, MCSModelRmsVec.txt
+    'moment':(None, ('s', 'x', 'xp', 'y', 'yp', 'z', 'zp')),
+    # long_tab.out, which begins with element type and name
+    'long_tab':((2, 3, 4), ('s', 'Ek', 'phi')),
+    # MCSModelRf.txt
+    'long':(None, ('s', 'Ek', 'phi')),
+}
+
+def load(fname, format='moment'):
+    """Read a result file.
+
+    Text files are whitespace separated columns.  Blank lines and lines beginning with '#' are skipped.
+    .npy files contain a 2-d array of the selected columns, and are memory mapped.
+
+    :param fname: File name
+    :param format: A key of FORMATS
+    :returns: A 2-d array [N, ncolumns] with s in the first column.
+    """
+    usecols, names = FORMATS[format]
+    if fname.endswith('.npy'):
+        A = numpy.load(fname, mmap_mode='r')
+        if A.ndim!=2 or A.shape[1]!=len(names):
+            raise ValueError("%s: expected shape [N, %d] not %s"%(fname, len(names), A.shape))
+        return A
+
+    with open(fname, 'rb') as F:
+        lines = [L for L in F.read().splitlines() if L.strip() and not L.lstrip().startswith(b'#')]
+    if len(lines)==0:
+        return numpy.zeros((0, len(names)))
+
+    ncol = len(lines[0].split())
+    tokens = numpy.asarray(b' '.join(lines).split())
+    if tokens.shape[0]%ncol:
+        raise ValueError("%s: lines do not all have %d columns"%(fname, ncol))
+    tokens = tokens.reshape((-1, ncol))
+    if usecols is not None:
+        tokens = tokens[:, usecols]
+    elif ncol!=len(names):
+        raise ValueError("%s: expected %d columns not %d"%(fname, len(names), ncol))
+    try:
+        return tokens.astype(numpy.float64)
+    except ValueError as e:
+        raise ValueError("%s: %s"%(fname, e))
+
+def align(model, reference, atol=1e-9):
+    """Sample reference at the s positions of model
+
+    If both have the same s positions they are returned unchanged.
+    Otherwise model is restricted to the s range of reference,
+    and reference is linearly interpolated (all columns at once).
+
+    :returns: (model, reference) with equal shapes
+    """
+    model, reference = numpy.asarray(model), numpy.asarray(reference)
+    sm, sr = model[:,0], reference[:,0]
+    if sm.shape==sr.shape and numpy.allclose(sm, sr, rtol=0, atol=atol):
+        return model, reference
+    if len(sr)<2:
+        raise ValueError("reference needs at least two points to interpolate")
+    if numpy.any(numpy.diff(sr)<0):
+        raise ValueError("reference s positions must not decrease")
+
+    model = model[(sm>=sr[0]-atol) & (sm<=sr[-1]+atol)]
+    s = model[:,0]
+
+    # index of the reference interval containing each s.
+    # with repeated s (zero length elements) the last point is used
+    i = numpy.clip(numpy.searchsorted(sr, s, side='right')-1, 0, len(sr)-2)
+    ds = sr[i+1]-sr[i]
+    w = numpy.clip(numpy.where(ds>0, (s-sr[i])/numpy.where(ds>0, ds, 1.0), 0.0), 0.0, 1.0)[:,None]
+
+    R = reference[i]*(1.0-w) + reference[i+1]*w
+    R[:,0] = s
+    return model, R
+
+def compare(model, reference, columns=None, atol=1e-9):
+    """Deviation of reference from model
+
+    :param model: 2-d array [N, ncolumns] with s in the first column
+    :param reference: 2-d array [M, ncolumns] with s in the first column
+    :param columns: Names of the columns after s
+    :returns: A dict with entries
+
+              * 's' s positions compared
+              * 'delta' reference-model [N, ncolumns-1]
+              * 'max' largest absolute deviation of each column
+              * 'smax' s position of the largest deviation of each column
+              * 'rms' RMS deviation of each column
+              * 'columns' names of the columns (excluding s)
+    """
+    model, reference = align(model, reference, atol=atol)
+    delta = reference[:,1:]-model[:,1:]
+    if columns is None:
+        columns = tuple('c%d'%i for i in range(1, model.shape[1]))
+
+    if delta.shape[0]:
+        A = numpy.abs(delta)
+        imax = numpy.argmax(A, axis=0)
+        dmax = A[imax, numpy.arange(A.shape[1])]
+        smax = model[imax, 0]
+        rms = numpy.sqrt(numpy.mean(delta**2, axis=0))
+    else:
+        dmax = smax = rms = numpy.zeros(delta.shape[1])
+
+    return {'s':model[:,0], 'delta':delta, 'max':dmax, 'smax':smax, 'rms':rms, 'columns':tuple(columns)}
+
+def compare_files(model, reference, format='moment', reference_format=None):
+    """Load and compare two result files
+
+    :param model: File name of simulation result
+    :param reference: File name of reference result
+    :param format: FORMATS key of model
+    :param reference_format: FORMATS key of reference.  Default is the same as model.
+    :returns: As compare(), with 'model' and 'reference' file names added
+    """
+    if reference_format is None:
+        reference_format = format
+    names = FORMATS[format][1]
+    if FORMATS[reference_format][1]!=names:
+        raise ValueError("Can't compare formats '%s' and '%s'"%(format, reference_format))
+
+    R = compare(load(model, format), load(reference, reference_format), columns=names[1:])
+    R['model'], R['reference'] = model, reference
+    return R
+
+def _compare_task(args):
+    return compare_files(*args)
+
+def compare_many(pairs, processes=None):
+    """Compare many result files in parallel
+
+    :param pairs: A list of tuples of arguments to compare_files(), eg. [(model, reference), ...]
+    :param processes: Number of worker processes.  Default is the number of CPUs.  0 compares in this process.
+    :returns: A list of the results of compare_files(), in the same order as pairs
+    """
+    pairs = [tuple(P) for P in pairs]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(pairs))
+    if processes<=1:
+        return [_compare_task(P) for P in pairs]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_compare_task, pairs)
+    finally:
+        pool.terminate()
+
+def main(args=None):
+    from optparse import OptionParser
+    P = OptionParser(usage='%prog [options] <model> <reference> [<model> <reference> ...]')
+    P.add_option('-f', '--format', default='moment',
+                 help='Format of the model files (%s)'%', '.join(sorted(FORMATS)))
+    P.add_option('-F', '--reference-format', help='Format of the reference files.  Default same as --format')
+    P.add_option('-l', '--list', metavar='FILE',
+                 help='Read pairs from FILE, one per line as "<model> <reference> [<format> [<reference format>]]"')
+    P.add_option('-j', '--processes', type='int', help='Number of worker processes')
+    P.add_option('-t', '--threshold', type='float', help='Fail if any deviation is larger')
+    P.add_option('-o', '--output', metavar='FILE', help='Write the differences as text, as analyze_res.py')
+    opts, args = P.parse_args(args)
+
+    if len(args)%2:
+        P.error('Files must be given in pairs')
+    pairs = [(args[i], args[i+1], opts.format, opts.reference_format) for i in range(0, len(args), 2)]
+    if opts.list:
+        with open(opts.list, 'r') as F:
+            for L in F:
+                L = L.split()
+                if len(L)==0 or L[0].startswith('#'):
+                    continue
+                if len(L)<2:
+                    P.error('%s: expected "<model> <reference> ..."'%opts.list)
+                pairs.append((L[0], L[1], L[2] if len(L)>2 else opts.format,
+                              L[3] if len(L)>3 else opts.reference_format))
+    if len(pairs)==0:
+        P.error('No files to compare')
+    if opts.output and len(pairs)!=1:
+        P.error('--output needs exactly one pair')
+
+    failed = False
+    for R in compare_many(pairs, processes=opts.processes):
+        print('%s vs. %s (%d points)'%(R['model'], R['reference'], len(R['s'])))
+        print('  %-8s %12s %12s %12s'%('', 'max', 'at s', 'rms'))
+        for name, dmax, smax, rms in zip(R['columns'], R['max'], R['smax'], R['rms']):
+            bad = opts.threshold is not None and dmax>opts.threshold
+            failed |= bad
+            print('  %-8s %12.5e %12.5f %12.5e%s'%(name, dmax, smax, rms, ' FAIL' if bad else ''))
+
+        if opts.output:
+            numpy.savetxt(opts.output, numpy.column_stack((R['s'], R['delta'])), fmt='%23.15e', delimiter='')
+
+    if failed:
+        sys.exit(1)
+
+if __name__=='__main__':
+    main()
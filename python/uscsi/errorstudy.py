@@ -0,0 +1,78 @@
+"""Monte Carlo studies of element errors
+
+>>> from uscsi.errorstudy import error_study
+>>> R = error_study(lattice, [('quad1', 'K', 0.01, 'normal', True),
+...                           (5, 'K', 0.001)],
+...                 nseeds=1000, observe=[10, 20])
+>>> R['rms'].shape
+(2, 1000, 6)
+>>> R['percentiles'].shape
+(3, 2, 6)
+"""
+from __future__ import print_function
+
+import multiprocessing
+
+import numpy
+
+from .scan import _machine, _resolve
+
+__all__ = ['error_study']
+
+def error_study(lattice, errors, nseeds, observe=None, config={}, seed=0,
+                threads=None, percentiles=(5, 50, 95)):
+    """Propagate through many copies of a Machine with random element errors
+
+    :param lattice: A Machine, Config, dict, or lattice file text.  sim_type must be MomentMatrix.
+    :param errors: A list of (index, param, sigma[, dist[, relative]]).
+                   'index' is an element index, an element name, or a list of either.
+                   'dist' is 'normal' (default) or 'uniform' in [-sigma, sigma].
+                   When 'relative' is True, sigma is a fraction of the parameter value.
+    :param nseeds: Number of random Machines.
+    :param observe: A list of element indicies after which the State is recorded.  Default is the last element.
+    :param config: Passed to Machine.allocState() to create the initial State.
+    :param seed: Seed of the random number generator.
+    :param threads: Number of threads.  Default is the number of CPUs.
+    :param percentiles: Percentiles of RMS sizes to compute.
+    :returns: A dict with entries
+
+              * 'observe' Element indicies
+              * 'state' [len(observe), nseeds, 7, 7] and 'moment0' [len(observe), nseeds, 7]
+              * 'deltas' The parameter changes [nseeds, number of errors]
+              * 'rms' RMS sizes sqrt(diag(state)) [len(observe), nseeds, 6]
+              * 'mean' and 'std' of 'rms' over seeds [len(observe), 6]
+              * 'percentiles' of 'rms' over seeds [len(percentiles), len(observe), 6]
+              * 'centroid' mean of moment0 over seeds [len(observe), 7]
+    """
+    M = _machine(lattice)
+
+    errs = []
+    for E in errors:
+        for index in _resolve(M, E[0]):
+            errs.append((index,)+tuple(E[1:]))
+
+    if observe is None:
+        observe = [len(M)-1]
+    observe = sorted(set(_resolve(M, observe)))
+
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+
+    S = M.allocState(config)
+    state, moment0, deltas = M.propagate_errors(S, errs, nseeds, observe=observe,
+                                                seed=seed, threads=threads)
+
+    diag = numpy.diagonal(state, axis1=2, axis2=3)[..., :6]
+    rms = numpy.sqrt(numpy.maximum(diag, 0.0))
+
+    return {
+        'observe':observe,
+        'state':state,
+        'moment0':moment0,
+        'deltas':deltas,
+        'rms':rms,
+        'mean':rms.mean(axis=1),
+        'std':rms.std(axis=1),
+        'percentiles':numpy.percentile(rms, percentiles, axis=1),
+        'centroid':moment0.mean(axis=1),
+    }
@@ -0,0 +1,46 @@
+"""Reading of State history dumps
+
+>>> M.set_history(1000, check_finite=True, dump='/tmp/history.dat')
+>>> M.propagate(S)  # raises FloatingPointError
+>>> from uscsi.history import load_history
+>>> H = load_history('/tmp/history.dat')
+>>> H['index'][-1]  # element which produced NaN or Inf
+>>> H['state'][-2]  # State before that element
+"""
+from __future__ import print_function
+
+import struct
+
+import numpy
+
+__all__ = ['load_history']
+
+def load_history(fname):
+    """Read a file written by Machine.dump_history() or Machine.set_history(dump=...)
+
+    :param fname: File name
+    :returns: A structured array, oldest record first, as returned by Machine.history()
+    """
+    with open(fname, 'rb') as F:
+        raw = F.read()
+
+    if raw[:8]!=b'USCSIHST':
+        raise ValueError("%s is not a State history dump"%fname)
+    version, nfields, count, _total = struct.unpack_from('=IIQQ', raw, 8)
+    if version!=1:
+        raise ValueError("%s has unsupported version %d"%(fname, version))
+    pos = 8+struct.calcsize('=IIQQ')
+
+    spec = [('index', 'u8')]
+    for n in range(nfields):
+        namelen, = struct.unpack_from('=I', raw, pos)
+        pos += 4
+        name = raw[pos:pos+namelen].decode('ascii')
+        pos += namelen
+        ndim, = struct.unpack_from('=I', raw, pos)
+        pos += 4
+        dim = struct.unpack_from('=%dI'%ndim, raw, pos)
+        pos += 4*ndim
+        spec.append((name, 'f8', dim) if ndim else (name, 'f8'))
+
+    return numpy.frombuffer(raw, dtype=numpy.dtype(spec), count=count, offset=pos).copy()
@@ -1,8 +1,13 @@
 
 #include <list>
+#include <map>
 #include <sstream>
+#include <string.h>
+
+#include <boost/cstdint.hpp>
 
 #include "scsi/base.h"
+#include "scsi/tlm.h"
 
 #include "pyscsi.h"
 
@@ -10,87 +15,178 @@
 #define PY_ARRAY_UNIQUE_SYMBOL USCSI_PyArray_API
 #include <numpy/ndarrayobject.h>
 
-/** Translate python dict to Config
- *
- *  {}      -> Config
- *    float   -> double
- *    str     -> string
- *    [{}]    -> vector<Config>  (recurse)
- *    ndarray -> vector<double>
- *    TODO: [0.0]   -> vector<double>
- */
-void Dict2Config(Config& ret, PyObject *dict, unsigned depth)
+namespace {
+// Fetch the content of a python string
+std::string pystr(PyObject *obj)
 {
-    if(depth>3)
-        throw std::runtime_error("too deep for Dict2Config");
-
-    PyObject *key, *value;
-    Py_ssize_t pos = 0;
-
-    while(PyDict_Next(dict, &pos, &key, &value)) {
 #if PY_MAJOR_VERSION >= 3
-        PyRef<> ascii(PyUnicode_AsASCIIString(key));
-        const char *kname = PyBytes_AsString(ascii.py());
+    PyRef<> ascii(PyUnicode_AsASCIIString(obj));
+    return PyBytes_AsString(ascii.py());
 #else
-        const char *kname = PyString_AsString(key);
+    const char *val = PyString_AsString(obj);
+    if(!val)
+        throw std::invalid_argument("Must be a string");
+    return val;
 #endif
+}
 
-        if(!kname)
-            throw std::invalid_argument("dict() keys must be string");
+// Copy the content of a numeric buffer.
+// Contiguous float64 buffers are copied in one pass.  Anything else is converted by numpy.
+void Buffer2Vector(std::vector<double>& out, PyObject *value)
+{
+    Py_buffer buf;
+    if(PyObject_GetBuffer(value, &buf, PyBUF_C_CONTIGUOUS|PyBUF_FORMAT)==0) {
+        const char *fmt = buf.format ? buf.format : "B";
+        if(fmt[0]=='@' || fmt[0]=='=' ||
+#ifdef WORDS_BIGENDIAN
+                fmt[0]=='>' || fmt[0]=='!'
+#else
+                fmt[0]=='<'
+#endif
+                )
+            fmt++;
+        bool isdouble = fmt[0]=='d' && fmt[1]=='\0' && buf.itemsize==sizeof(double);
+
+        if(isdouble) {
+            const double *ptr = (const double*)buf.buf;
+            out.assign(ptr, ptr+buf.len/sizeof(double));
+            PyBuffer_Release(&buf);
+            return;
+        }
+        PyBuffer_Release(&buf);
+    } else {
+        PyErr_Clear(); // not contiguous, let numpy sort it out
+    }
 
-        PyTypeObject *valuetype = (PyTypeObject*)PyObject_Type(value);
-        if(valuetype==&PyFloat_Type) { // scalar double
-            double val = PyFloat_AsDouble(value);
-            ret.set<double>(kname, val);
+    PyRef<> arr(PyArray_ContiguousFromAny(value, NPY_DOUBLE, 0, 2));
+    const double *ptr = (const double*)PyArray_DATA(arr.py());
+    out.assign(ptr, ptr+PyArray_SIZE(arr.py()));
+}
 
-        } else if(valuetype==&PyInt_Type) { // scalar integer (treated as double)
-            long val = PyInt_AsLong(value);
-            ret.set<double>(kname, val);
+bool isnumber(PyObject *value)
+{
+    return PyFloat_Check(value) || PyInt_Check(value) || PyLong_Check(value)
+            || PyArray_IsScalar(value, Number);
+}
 
-        } else if(PyString_Check(value)) { // string
-#if PY_MAJOR_VERSION >= 3
-            PyRef<> kascii(PyUnicode_AsASCIIString(value));
-            const char *val = PyBytes_AsString(kascii.py());
-#else
-            const char *val = PyString_AsString(value);
-#endif
+/* Translate a sequence of dict/Config to vector<Config>,
+ * or a sequence of numbers to vector<double>.
+ */
+void Seq2Config(Config& ret, const std::string& kname, PyObject *value, unsigned depth)
+{
+    PyRef<> seq(PySequence_Fast(value, "Not a sequence"));
+    Py_ssize_t N = PySequence_Fast_GET_SIZE(seq.py());
+    PyObject **items = PySequence_Fast_ITEMS(seq.py());
+
+    if(N>0 && isnumber(items[0])) {
+        std::vector<double> temp(N);
+
+        for(Py_ssize_t i=0; i<N; i++) {
+            PyObject *elem = items[i];
+            if(PyFloat_CheckExact(elem)) {
+                temp[i] = PyFloat_AS_DOUBLE(elem);
+            } else if(isnumber(elem)) {
+                temp[i] = PyFloat_AsDouble(elem);
+                if(temp[i]==-1.0 && PyErr_Occurred())
+                    throw std::invalid_argument("Can't convert list element to float");
+            } else {
+                throw std::invalid_argument("lists must contain only dict()s or only numbers");
+            }
+        }
 
-            ret.set<std::string>(kname, val);
+        ret.swap<std::vector<double> >(kname, temp);
+        return;
+    }
 
-        } else if(PyArray_Check(value)) { // array (ndarray)
-            PyRef<> arr(PyArray_ContiguousFromAny(value, NPY_DOUBLE, 0, 2));
-            double *buf = (double*)PyArray_DATA(arr.py());
-            std::vector<double> temp(PyArray_SIZE(arr.py()));
-            std::copy(buf, buf+temp.size(), temp.begin());
+    Config::vector_t output(N);
 
-            ret.swap<std::vector<double> >(kname, temp);
+    for(Py_ssize_t i=0; i<N; i++) {
+        PyObject *elem = items[i];
 
-        } else if(PySequence_Check(value)) { // list of dict
-            Py_ssize_t N = PySequence_Size(value);
+        if(const Config *other = unwrapconfig(elem)) {
+            output[i] = *other;
 
-            Config::vector_t output;
-            output.reserve(N);
+        } else if(PyDict_Check(elem)) {
+            //output.push_back(ret.new_scope()); // TODO: can't use scoping here since iteration order of PyDict_Next() is not stable
+            Dict2Config(output[i], elem, depth+1); // inheirt parent scope
 
-            for(Py_ssize_t i=0; i<N; i++) {
-                PyObject *elem = PySequence_GetItem(value, i);
-                assert(elem);
+        } else {
+            throw std::invalid_argument("lists must contain only dict()s or only numbers");
+        }
+    }
 
-                if(!PyDict_Check(elem))
-                    throw std::invalid_argument("lists must contain only dict()s");
+    ret.swap<Config::vector_t>(kname, output);
+}
+}
 
-                //output.push_back(ret.new_scope()); // TODO: can't use scoping here since iteration order of PyDict_Next() is not stable
-                output.push_back(Config());
+/** Translate python value to Config entry
+ *
+ *    float   -> double
+ *    int     -> double
+ *    str     -> string
+ *    [{}]    -> vector<Config>  (recurse)
+ *    [Config]-> vector<Config>
+ *    ndarray -> vector<double>
+ *    buffer  -> vector<double>  (any object exposing the buffer protocol)
+ *    [0.0]   -> vector<double>
+ */
+void Value2Config(Config& ret, const std::string& kname, PyObject *value, unsigned depth)
+{
+    // test for exact types first as these are the common cases
+    if(PyFloat_CheckExact(value)) { // scalar double
+        ret.set<double>(kname, PyFloat_AS_DOUBLE(value));
+
+    } else if(PyInt_CheckExact(value) || PyLong_Check(value)) { // scalar integer (treated as double)
+        double val = PyFloat_AsDouble(value);
+        if(val==-1.0 && PyErr_Occurred())
+            throw std::invalid_argument("Integer out of range");
+        ret.set<double>(kname, val);
+
+    } else if(PyString_Check(value)) { // string
+        ret.set<std::string>(kname, pystr(value));
+
+    } else if(PyList_CheckExact(value) || PyTuple_CheckExact(value)) { // list of dict, or list of numbers
+        Seq2Config(ret, kname, value, depth);
+
+    } else if(PyFloat_Check(value)) { // sub-class of float (eg. numpy.float64)
+        ret.set<double>(kname, PyFloat_AsDouble(value));
+
+    } else if(PyArray_IsScalar(value, Number)) { // other numpy scalars, which are also buffers
+        double val = PyFloat_AsDouble(value);
+        if(val==-1.0 && PyErr_Occurred())
+            throw std::invalid_argument("Can't convert numpy scalar");
+        ret.set<double>(kname, val);
+
+    } else if(PyObject_CheckBuffer(value) && !PyBytes_Check(value)) { // array (ndarray or other buffer)
+        std::vector<double> temp;
+        Buffer2Vector(temp, value);
+        ret.swap<std::vector<double> >(kname, temp);
+
+    } else if(PySequence_Check(value) && !PyBytes_Check(value)) { // other sequences
+        Seq2Config(ret, kname, value, depth);
+
+    } else {
+        std::ostringstream msg;
+        msg<<"Must be a dict, not "<<Py_TYPE(value)->tp_name;
+        throw std::invalid_argument(msg.str());
+    }
+}
 
-                Dict2Config(output.back(), elem, depth+1); // inheirt parent scope
-            }
+/** Translate python dict to Config
+ *
+ *  {}      -> Config
+ *  See Value2Config() for value types
+ */
+void Dict2Config(Config& ret, PyObject *dict, unsigned depth)
+{
+    if(depth>3)
+        throw std::runtime_error("too deep for Dict2Config");
 
-            ret.set<Config::vector_t>(kname, output);
+    PyObject *key, *value;
+    Py_ssize_t pos = 0;
 
-        } else {
-            std::ostringstream msg;
-            msg<<"Must be a dict, not "<<valuetype->tp_name;
-            throw std::invalid_argument(msg.str());
-        }
+    while(PyDict_Next(dict, &pos, &key, &value)) {
+        Value2Config(ret, pystr(key), value, depth);
     }
 }
 
@@ -141,9 +237,8 @@ PyObject* conf2dict(const Config *conf)
     for(Config::const_iterator it=conf->begin(), end=conf->end();
         it!=end; ++it)
     {
-        if(PyDict_SetItemString(ret.py(), it->first.c_str(),
-                                boost::apply_visitor(confval(), it->second)
-                                ))
+        PyRef<> val(boost::apply_visitor(confval(), it->second));
+        if(PyDict_SetItemString(ret.py(), it->first.c_str(), val.py()))
             throw std::runtime_error("Failed to insert into dictionary from conf2dict");
     }
 
@@ -152,6 +247,637 @@ PyObject* conf2dict(const Config *conf)
 
 } // namespace
 
+
+/* Compact binary encoding of a Config, used for pickling.
+ *
+ * Native byte order.  Intended for IPC, not archival.
+ *
+ *   header: "uSCSIcf" version(u8=1) byteorder-check(u32=0x01020304)
+ *   Config: count(u32) then count*(key:str type:u8 value)
+ *   str: index(u32) into table of strings already seen.
+ *        An index equal to the table size is followed by len(u32) bytes[len]
+ *        and is added to the table.
+ *   value:
+ *     0 double:  f64
+ *     1 vector:  count(u32) f64[count]
+ *     2 string:  str
+ *     3 Configs: count(u32) then count*(inherit:u8 Config)
+ *
+ * Only the inner most scope of each Config is stored.
+ * List entries with inherit!=0 are restored in a new scope of the enclosing Config,
+ * as the lattice file parser does.  Non-list entries are stored before lists so that
+ * the enclosing Config is complete when its lists are restored.
+ */
+namespace {
+const char confmagic[] = "uSCSIcf\x01";
+const boost::uint32_t confbyteorder = 0x01020304;
+
+struct ConfEncoder : public boost::static_visitor<void>
+{
+    std::string& out;
+    typedef std::map<std::string, boost::uint32_t> strtab_t;
+    strtab_t strtab;
+    ConfEncoder(std::string& out) :out(out) {}
+
+    template<typename T>
+    void put(const T& v) { out.append((const char*)&v, sizeof(v)); }
+
+    void putstr(const std::string& v) {
+        strtab_t::const_iterator it = strtab.find(v);
+        if(it!=strtab.end()) {
+            put(it->second);
+        } else {
+            boost::uint32_t idx = strtab.size();
+            put(idx);
+            put<boost::uint32_t>(v.size());
+            out.append(v);
+            strtab[v] = idx;
+        }
+    }
+
+    void operator()(double v) { put<boost::uint8_t>(0); put(v); }
+    void operator()(const std::vector<double>& v) {
+        put<boost::uint8_t>(1);
+        put<boost::uint32_t>(v.size());
+        if(!v.empty())
+            out.append((const char*)&v[0], v.size()*sizeof(double));
+    }
+    void operator()(const std::string& v) { put<boost::uint8_t>(2); putstr(v); }
+    void operator()(const Config::vector_t& v) {
+        put<boost::uint8_t>(3);
+        put<boost::uint32_t>(v.size());
+        for(size_t i=0; i<v.size(); i++) {
+            put<boost::uint8_t>(v[i].depth()>1);
+            conf(v[i]);
+        }
+    }
+
+    void conf(const Config& C) {
+        put<boost::uint32_t>(std::distance(C.begin(), C.end()));
+        for(int pass=0; pass<2; pass++) {
+            for(Config::const_iterator it=C.begin(), end=C.end(); it!=end; ++it) {
+                bool islist = it->second.which()==3;
+                if(islist!=(pass==1))
+                    continue;
+                putstr(it->first);
+                boost::apply_visitor(*this, it->second);
+            }
+        }
+    }
+};
+
+struct ConfDecoder
+{
+    const char *pos, *end;
+    std::vector<std::string> strtab;
+    ConfDecoder(const char *buf, size_t len) :pos(buf), end(buf+len) {}
+
+    void need(size_t n) {
+        if(size_t(end-pos)<n)
+            throw std::invalid_argument("Truncated Config encoding");
+    }
+    template<typename T>
+    T get() {
+        T ret;
+        need(sizeof(ret));
+        memcpy(&ret, pos, sizeof(ret));
+        pos += sizeof(ret);
+        return ret;
+    }
+    const std::string& getstr() {
+        boost::uint32_t idx = get<boost::uint32_t>();
+        if(idx<strtab.size())
+            return strtab[idx];
+        else if(idx>strtab.size())
+            throw std::invalid_argument("Invalid string in Config encoding");
+        boost::uint32_t len = get<boost::uint32_t>();
+        need(len);
+        strtab.push_back(std::string(pos, len));
+        pos += len;
+        return strtab.back();
+    }
+
+    void conf(Config& C) {
+        boost::uint32_t N = get<boost::uint32_t>();
+        for(boost::uint32_t i=0; i<N; i++) {
+            std::string key(getstr());
+            switch(get<boost::uint8_t>()) {
+            case 0:
+                C.set<double>(key, get<double>());
+                break;
+            case 1: {
+                boost::uint32_t cnt = get<boost::uint32_t>();
+                need(size_t(cnt)*sizeof(double));
+                std::vector<double> V(cnt);
+                if(cnt)
+                    memcpy(&V[0], pos, cnt*sizeof(double));
+                pos += cnt*sizeof(double);
+                C.swap<std::vector<double> >(key, V);
+            }
+                break;
+            case 2:
+                C.set<std::string>(key, getstr());
+                break;
+            case 3: {
+                boost::uint32_t cnt = get<boost::uint32_t>();
+                need(cnt); // at least one byte each
+                Config::vector_t V(cnt);
+                for(boost::uint32_t j=0; j<cnt; j++) {
+                    if(get<boost::uint8_t>()) {
+                        Config next(C.new_scope());
+                        V[j].swap(next);
+                    }
+                    conf(V[j]);
+                }
+                C.swap<Config::vector_t>(key, V);
+            }
+                break;
+            default:
+                throw std::invalid_argument("Invalid type in Config encoding");
+            }
+        }
+    }
+};
+} // namespace
+
+static
+void Config2Bytes(std::string& out, const Config& C)
+{
+    out.clear();
+    out.append(confmagic, sizeof(confmagic)-1);
+    ConfEncoder E(out);
+    E.put(confbyteorder);
+    E.conf(C);
+}
+
+static
+Config* Bytes2Config(const char *buf, size_t len)
+{
+    ConfDecoder D(buf, len);
+    D.need(sizeof(confmagic)-1);
+    if(memcmp(buf, confmagic, sizeof(confmagic)-1)!=0)
+        throw std::invalid_argument("Not a Config encoding");
+    D.pos += sizeof(confmagic)-1;
+    if(D.get<boost::uint32_t>()!=confbyteorder)
+        throw std::invalid_argument("Config encoding has foreign byte order");
+
+    std::auto_ptr<Config> ret(new Config);
+    D.conf(*ret);
+    if(D.pos!=D.end)
+        throw std::invalid_argument("Trailing bytes after Config encoding");
+    return ret.release();
+}
+
+#define TRY PyConf *conf = (PyConf*)raw; try
+
+namespace {
+
+/* Python wrapper around a Config.
+ *
+ * A top level Config owns its Config.
+ * The Config elements of a list (eg. "elements") are accessed through
+ * the PyConf which holds the list, so that changes are made in place.
+ */
+struct PyConf {
+    PyObject_HEAD
+
+    PyObject *weak;
+    Config *conf; // owned.  NULL for list elements
+    PyObject *parent; // PyConf holding our list
+    PyObject *key; // name of our list in parent
+    size_t index; // our position in the list
+};
+
+static PyTypeObject PyConfType = {
+#if PY_MAJOR_VERSION >= 3
+    PyVarObject_HEAD_INIT(NULL, 0)
+#else
+    PyObject_HEAD_INIT(NULL)
+    0,
+#endif
+    "uscsi._internal.Config",
+    sizeof(PyConf),
+};
+
+static
+const Config& PyConf_ref(PyConf *conf)
+{
+    if(conf->conf)
+        return *conf->conf;
+
+    const Config& parent = PyConf_ref((PyConf*)conf->parent);
+    const Config::vector_t& list = parent.get<Config::vector_t>(pystr(conf->key));
+    if(conf->index>=list.size())
+        throw std::out_of_range("Config list element no longer exists");
+    return list[conf->index];
+}
+
+//! Replace a value, either in our Config or in our parent's list
+static
+void PyConf_swap(PyConf *conf, const std::string& name, Config::value_t& val)
+{
+    if(conf->conf) {
+        conf->conf->swapAny(name, val);
+        return;
+    }
+
+    std::string lname(pystr(conf->key));
+    PyConf *parent = (PyConf*)conf->parent;
+
+    // move the list out of the parent, update, and move it back
+    Config::value_t list;
+    PyConf_swap(parent, lname, list);
+    try{
+        Config::vector_t& L = boost::get<Config::vector_t>(list);
+        if(conf->index>=L.size())
+            throw std::out_of_range("Config list element no longer exists");
+        L[conf->index].swapAny(name, val);
+    }catch(...){
+        PyConf_swap(parent, lname, list);
+        throw;
+    }
+    PyConf_swap(parent, lname, list);
+}
+
+static
+PyObject* PyConf_child(PyObject *parent, PyObject *key, size_t index)
+{
+    PyRef<PyConf> ret((PyConf*)PyConfType.tp_alloc(&PyConfType, 0));
+
+    Py_INCREF(parent);
+    ret->parent = parent;
+    Py_INCREF(key);
+    ret->key = key;
+    ret->index = index;
+
+    return ret.releasePy();
+}
+
+static
+int PyConf_init(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *obj = NULL;
+        const char *pnames[] = {"config", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "|O", (char**)pnames, &obj))
+            return -1;
+
+        std::auto_ptr<Config> C;
+        Py_buffer buf;
+
+        if(!obj || obj==Py_None) {
+            C.reset(new Config);
+
+        } else if(PyDict_Check(obj)) {
+            C.reset(dict2conf(obj));
+
+        } else if(const Config *other = unwrapconfig(obj)) {
+            C.reset(new Config(*other));
+
+        } else if(!PyObject_GetBuffer(obj, &buf, PyBUF_SIMPLE)) {
+            try{
+                GLPSParser parser;
+                C.reset(parser.parse((const char*)buf.buf, buf.len));
+            }catch(...){
+                PyBuffer_Release(&buf);
+                throw;
+            }
+            PyBuffer_Release(&buf);
+
+        } else {
+            throw std::invalid_argument("'config' must be dict, Config, or byte buffer");
+        }
+
+        if(conf->parent)
+            throw std::runtime_error("Can't re-initialize a list element");
+
+        delete conf->conf;
+        conf->conf = C.release();
+
+        return 0;
+    } CATCH3(key_error, KeyError, -1)
+      CATCH3(std::invalid_argument, ValueError, -1)
+      CATCH3(std::exception, RuntimeError, -1)
+}
+
+static
+void PyConf_free(PyObject *raw)
+{
+    TRY {
+        std::auto_ptr<Config> C(conf->conf);
+        conf->conf = NULL;
+
+        if(conf->weak)
+            PyObject_ClearWeakRefs(raw);
+
+        Py_CLEAR(conf->parent);
+        Py_CLEAR(conf->key);
+
+        Py_TYPE(raw)->tp_free(raw);
+    } CATCH2V(std::exception, RuntimeError)
+}
+
+static
+PyObject* PyConf_str(PyObject *raw)
+{
+    TRY {
+        std::ostringstream strm;
+        PyConf_ref(conf).show(strm);
+        return PyString_FromString(strm.str().c_str());
+    } CATCH()
+}
+
+static
+Py_ssize_t PyConf_len(PyObject *raw)
+{
+    TRY {
+        const Config& C = PyConf_ref(conf);
+        return std::distance(C.begin(), C.end());
+    } CATCH1(-1)
+}
+
+static
+PyObject* PyConf_lookup(PyObject *raw, PyObject *key, const Config::value_t& val)
+{
+    if(const Config::vector_t *list = boost::get<Config::vector_t>(&val)) {
+        // a tuple, as adding or replacing entries would not change this Config
+        PyRef<> ret(PyTuple_New(list->size()));
+
+        for(size_t i=0, N=list->size(); i<N; i++)
+            PyTuple_SET_ITEM(ret.py(), i, PyConf_child(raw, key, i));
+
+        return ret.release();
+    }
+    return boost::apply_visitor(confval(), val);
+}
+
+static
+PyObject* PyConf_getitem(PyObject *raw, PyObject *key)
+{
+    TRY {
+        const Config::value_t& val = PyConf_ref(conf).getAny(pystr(key));
+        return PyConf_lookup(raw, key, val);
+    } CATCH2(key_error, KeyError)
+      CATCH2(std::out_of_range, IndexError)
+      CATCH()
+}
+
+static
+int PyConf_setitem(PyObject *raw, PyObject *key, PyObject *value)
+{
+    TRY {
+        if(!value) {
+            PyErr_SetString(PyExc_TypeError, "Config entries can't be removed");
+            return -1;
+        }
+
+        std::string name(pystr(key));
+
+        Config temp;
+        Value2Config(temp, name, value, 0);
+
+        Config::value_t val;
+        temp.swapAny(name, val);
+
+        PyConf_swap(conf, name, val);
+
+        return 0;
+    } CATCH3(std::invalid_argument, ValueError, -1)
+      CATCH3(std::out_of_range, IndexError, -1)
+      CATCH3(std::exception, RuntimeError, -1)
+}
+
+static
+int PyConf_contains(PyObject *raw, PyObject *key)
+{
+    TRY {
+        PyConf_ref(conf).getAny(pystr(key));
+        return 1;
+    } catch(key_error&) {
+        return 0;
+    } CATCH3(std::exception, RuntimeError, -1)
+}
+
+static
+PyObject* PyConf_keys(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        const Config& C = PyConf_ref(conf);
+        PyRef<> ret(PyList_New(0));
+
+        for(Config::const_iterator it=C.begin(), end=C.end(); it!=end; ++it)
+        {
+            PyRef<> key(PyString_FromString(it->first.c_str()));
+            if(PyList_Append(ret.py(), key.py()))
+                return NULL;
+        }
+        return ret.release();
+    } CATCH()
+}
+
+static
+PyObject* PyConf_iter(PyObject *raw)
+{
+    PyRef<> keys(PyConf_keys(raw, NULL));
+    return PyObject_GetIter(keys.py());
+}
+
+static
+PyObject* PyConf_items(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        const Config& C = PyConf_ref(conf);
+        PyRef<> ret(PyList_New(0));
+
+        for(Config::const_iterator it=C.begin(), end=C.end(); it!=end; ++it)
+        {
+            PyRef<> key(PyString_FromString(it->first.c_str()));
+            PyRef<> val(PyConf_lookup(raw, key.py(), it->second));
+            PyRef<> tuple(PyTuple_Pack(2, key.py(), val.py()));
+            if(PyList_Append(ret.py(), tuple.py()))
+                return NULL;
+        }
+        return ret.release();
+    } CATCH()
+}
+
+static
+PyObject* PyConf_get(PyObject *raw, PyObject *args)
+{
+    TRY {
+        PyObject *key, *def = Py_None;
+        if(!PyArg_ParseTuple(args, "O|O", &key, &def))
+            return NULL;
+
+        try {
+            const Config::value_t& val = PyConf_ref(conf).getAny(pystr(key));
+            return PyConf_lookup(raw, key, val);
+        } catch(key_error&) {
+            Py_INCREF(def);
+            return def;
+        }
+    } CATCH2(std::out_of_range, IndexError)
+      CATCH()
+}
+
+static
+PyObject* PyConf_todict(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        return conf2dict(&PyConf_ref(conf));
+    } CATCH2(std::out_of_range, IndexError)
+      CATCH()
+}
+
+static
+PyObject* PyConf_copy(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        std::auto_ptr<Config> C(new Config(PyConf_ref(conf)));
+        return wrapconfig(C.release());
+    } CATCH2(std::out_of_range, IndexError)
+      CATCH()
+}
+
+static
+PyObject* PyConf_getstate(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        std::string buf;
+        Config2Bytes(buf, PyConf_ref(conf));
+        return PyBytes_FromStringAndSize(buf.c_str(), buf.size());
+    } CATCH2(std::out_of_range, IndexError)
+      CATCH()
+}
+
+static
+PyObject* PyConf_setstate(PyObject *raw, PyObject *args)
+{
+    TRY {
+        const char *buf;
+        Py_ssize_t blen;
+        if(!PyArg_ParseTuple(args, "s#", &buf, &blen))
+            return NULL;
+
+        if(conf->parent)
+            return PyErr_Format(PyExc_TypeError, "Can't replace a list element");
+
+        std::auto_ptr<Config> C(Bytes2Config(buf, blen));
+        delete conf->conf;
+        conf->conf = C.release();
+
+        Py_RETURN_NONE;
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static
+PyObject* PyConf_reduce(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        PyRef<> state(PyConf_getstate((PyObject*)conf, NULL));
+        return Py_BuildValue("(O()O)", (PyObject*)&PyConfType, state.py());
+    } CATCH()
+}
+
+static PyMethodDef PyConf_methods[] = {
+    {"keys", (PyCFunction)&PyConf_keys, METH_NOARGS,
+     "List the names of values set in this (inner most) scope"},
+    {"items", (PyCFunction)&PyConf_items, METH_NOARGS,
+     "List the (name, value) pairs set in this (inner most) scope"},
+    {"get", (PyCFunction)&PyConf_get, METH_VARARGS,
+     "get(name, default=None)\n"
+     "Lookup a value in this or any enclosing scope"},
+    {"todict", (PyCFunction)&PyConf_todict, METH_NOARGS,
+     "Convert to a dict (recursively)"},
+    {"__getstate__", (PyCFunction)&PyConf_getstate, METH_NOARGS,
+     "Compact binary encoding (bytes) of this Config"},
+    {"__setstate__", (PyCFunction)&PyConf_setstate, METH_VARARGS,
+     "Replace content from __getstate__() encoding"},
+    {"__reduce__", (PyCFunction)&PyConf_reduce, METH_NOARGS,
+     "Pickle support"},
+    {"__copy__", (PyCFunction)&PyConf_copy, METH_NOARGS,
+     "Copy into a new top level Config.  Storage is shared until either is changed"},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyMappingMethods PyConf_mapping = {
+    &PyConf_len,
+    &PyConf_getitem,
+    &PyConf_setitem,
+};
+
+static PySequenceMethods PyConf_seq;
+
+} // namespace
+
+static const char pyconfdoc[] =
+        "Config(config=None)\n"
+        "\n"
+        "Simulation configuration.\n"
+        "\n"
+        "Wraps the configuration used internally by a Machine, which may\n"
+        "be passed to Machine() without conversion.\n"
+        "'config' may be a dict, another Config, or a byte buffer containing\n"
+        "lattice file text.\n"
+        "\n"
+        "Provides dict-like access.  Values are converted to python types\n"
+        "as they are accessed.  Lists of Config (eg. 'elements') are\n"
+        "returned as tuples of Config.  Each Config may be modified in place,\n"
+        "but entries can't be added or replaced, except by assigning a new list.\n"
+        "keys() and iteration include only values set directly on this Config,\n"
+        "and not those inherited from an enclosing scope (eg. lattice file globals).\n"
+        ;
+
+const Config* unwrapconfig(PyObject *raw)
+{
+    if(!PyObject_TypeCheck(raw, &PyConfType))
+        return NULL;
+    return &PyConf_ref((PyConf*)raw);
+}
+
+PyObject* wrapconfig(Config* C)
+{
+    std::auto_ptr<Config> owned(C);
+    PyRef<PyConf> ret((PyConf*)PyConfType.tp_alloc(&PyConfType, 0));
+
+    ret->conf = owned.release();
+
+    return ret.releasePy();
+}
+
+int registerModConfig(PyObject *mod)
+{
+    PyConfType.tp_doc = pyconfdoc;
+    PyConfType.tp_str = &PyConf_str;
+
+    PyConfType.tp_new = &PyType_GenericNew;
+    PyConfType.tp_init = &PyConf_init;
+    PyConfType.tp_dealloc = &PyConf_free;
+
+    PyConfType.tp_weaklistoffset = offsetof(PyConf, weak);
+
+    PyConfType.tp_flags = Py_TPFLAGS_DEFAULT|Py_TPFLAGS_BASETYPE;
+    PyConfType.tp_methods = PyConf_methods;
+    PyConfType.tp_as_mapping = &PyConf_mapping;
+    PyConf_seq.sq_contains = &PyConf_contains;
+    PyConfType.tp_as_sequence = &PyConf_seq;
+    PyConfType.tp_iter = &PyConf_iter;
+
+    if(PyType_Ready(&PyConfType))
+        return -1;
+
+    Py_INCREF(&PyConfType);
+    if(PyModule_AddObject(mod, "Config", (PyObject*)&PyConfType)) {
+        Py_DECREF(&PyConfType);
+        return -1;
+    }
+
+    return 0;
+}
+
+#undef TRY
+
 Config* dict2conf(PyObject *dict)
 {
     if(!PyDict_Check(dict))
@@ -165,11 +891,16 @@ PyObject* PyGLPSPrint(PyObject *, PyObject *args)
 {
     try {
         PyObject *dict;
-        if(!PyArg_ParseTuple(args, "O!", &PyDict_Type, &dict))
+        if(!PyArg_ParseTuple(args, "O", &dict))
             return NULL;
 
         Config conf;
-        Dict2Config(conf, dict);
+        if(const Config *other = unwrapconfig(dict))
+            conf = *other;
+        else if(PyDict_Check(dict))
+            Dict2Config(conf, dict);
+        else
+            return PyErr_Format(PyExc_TypeError, "Must be a dict or Config");
         std::ostringstream strm;
         GLPSPrint(strm, conf);
         return PyString_FromString(strm.str().c_str());
@@ -194,3 +925,31 @@ PyObject* PyGLPSParse(PyObject *, PyObject *args)
 
     }CATCH()
 }
+
+PyObject* PyTLMLoad(PyObject *, PyObject *args, PyObject *kws)
+{
+    try{
+        const char *fname;
+        PyObject *vars = Py_None, *number = Py_True;
+        const char *pnames[] = {"filename", "vars", "number_names", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "s|OO", (char**)pnames, &fname, &vars, &number))
+            return NULL;
+
+        int N = PyObject_IsTrue(number);
+        if(N<0)
+            return NULL;
+
+        TLMParser parser;
+        parser.number_names = N;
+
+        if(vars!=Py_None) {
+            std::auto_ptr<Config> V(dict2conf(vars));
+            for(Config::const_iterator it=V->begin(), end=V->end(); it!=end; ++it)
+                parser.setVar(it->first, it->second);
+        }
+
+        return wrapconfig(parser.parse_file(fname));
+
+    }CATCH2(std::invalid_argument, ValueError)
+     CATCH()
+}
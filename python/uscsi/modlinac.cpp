@@ -0,0 +1,328 @@
+#include <algorithm>
+
+#include "scsi/linac.h"
+#include "pyscsi.h"
+
+#define NO_IMPORT_ARRAY
+#define PY_ARRAY_UNIQUE_SYMBOL USCSI_PyArray_API
+#include <numpy/ndarrayobject.h>
+
+#define TRY PyLinac *linac = (PyLinac*)raw; try
+
+namespace {
+
+struct PyLinac {
+    PyObject_HEAD
+
+    PyObject *weak;
+    LinacContext *ctx;
+    bool busy;
+};
+
+// Only one thread at a time may use a LinacContext.  Acquire with the GIL held
+struct LinacBusy {
+    PyLinac *linac;
+    LinacBusy(PyLinac *linac) :linac(linac) {
+        if(linac->busy)
+            throw std::runtime_error("LinacContext is in use by another thread");
+        linac->busy = true;
+    }
+    ~LinacBusy() { linac->busy = false; }
+};
+
+PyObject *vec2array(const std::vector<double>& V)
+{
+    npy_intp dims[] = {(npy_intp)V.size()};
+    PyObject *arr = PyArray_ZEROS(1, dims, NPY_DOUBLE, 0);
+    if(arr)
+        std::copy(V.begin(), V.end(), (double*)PyArray_DATA((PyArrayObject*)arr));
+    return arr;
+}
+
+// str or bytes -> std::string
+std::string py2string(PyObject *obj)
+{
+    if(PyBytes_Check(obj))
+        return std::string(PyBytes_AS_STRING(obj), PyBytes_GET_SIZE(obj));
+    if(PyUnicode_Check(obj)) {
+        PyRef<> bytes(PyUnicode_AsUTF8String(obj));
+        return std::string(PyBytes_AS_STRING(bytes.py()), PyBytes_GET_SIZE(bytes.py()));
+    }
+    throw std::invalid_argument("Expected str or bytes");
+}
+
+static
+int PyLinac_init(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        const char *datadir = NULL;
+        int mpole = 2;
+        PyObject *growth = Py_False;
+        const char *pnames[] = {"datadir", "mpole_level", "emit_growth", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "|ziO", (char**)pnames, &datadir, &mpole, &growth))
+            return -1;
+
+        int G = PyObject_IsTrue(growth);
+        if(G<0)
+            return -1;
+
+        std::auto_ptr<LinacContext> ctx(new LinacContext);
+        ctx->MpoleLevel = mpole;
+        ctx->EmitGrowth = G;
+        if(datadir)
+            ctx->loadData(datadir);
+
+        delete linac->ctx;
+        linac->ctx = ctx.release();
+        return 0;
+    } CATCH3(std::invalid_argument, ValueError, -1)
+      CATCH3(std::exception, RuntimeError, -1)
+}
+
+static
+void PyLinac_free(PyObject *raw)
+{
+    TRY {
+        std::auto_ptr<LinacContext> S(linac->ctx);
+        linac->ctx = NULL;
+
+        if(linac->weak)
+            PyObject_ClearWeakRefs(raw);
+
+        Py_TYPE(raw)->tp_free(raw);
+    } CATCH2V(std::exception, RuntimeError)
+}
+
+static
+PyObject *PyLinac_setCavity(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        const char *cavtype;
+        PyObject *pymap, *pytlm;
+        const char *pnames[] = {"cavtype", "fieldmap", "thinlens", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "sOO", (char**)pnames, &cavtype, &pymap, &pytlm))
+            return NULL;
+
+        CavityFieldMap map;
+        py2fieldmap(map, pymap);
+
+        CavityThinLens tlm;
+        {
+            std::istringstream strm(py2string(pytlm));
+            tlm.read(strm);
+        }
+
+        LinacBusy B(linac);
+        linac->ctx->setCavity(cavtype, map, tlm);
+
+        Py_RETURN_NONE;
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static
+PyObject *PyLinac_initLong(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *pymachine;
+        double IonZ;
+        const char *pnames[] = {"machine", "IonZ", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "Od", (char**)pnames, &pymachine, &IonZ))
+            return NULL;
+
+        const Machine *M = unwrapmachine(pymachine);
+
+        LinacBusy B(linac);
+        {
+            PyUnlock U;
+            linac->ctx->initLong(*M, IonZ);
+        }
+
+        const LongTab& T = linac->ctx->longTab;
+        PyRef<> s(vec2array(T.s)), Ek(vec2array(T.Ek)), FyAbs(vec2array(T.FyAbs)),
+                beta(vec2array(T.Beta)), gamma(vec2array(T.Gamma)),
+                phase(vec2array(linac->ctx->CavPhases));
+
+        return Py_BuildValue("{sOsOsOsOsOsO}", "s", s.py(), "Ek", Ek.py(), "FyAbs", FyAbs.py(),
+                             "beta", beta.py(), "gamma", gamma.py(), "phase", phase.py());
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static
+PyObject *PyLinac_propagate(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *pymachines, *pyZ, *pyN, *pym0, *pym2;
+        const char *pnames[] = {"machines", "IonZ", "NChg", "moment0", "state", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "OOOOO", (char**)pnames,
+                                        &pymachines, &pyZ, &pyN, &pym0, &pym2))
+            return NULL;
+
+        // holds references to the Machines until propagation is done
+        PyRef<> seq(PySequence_Fast(pymachines, "machines must be a sequence"));
+        std::vector<Machine*> machines(PySequence_Fast_GET_SIZE(seq.py()));
+        for(size_t i=0; i<machines.size(); i++)
+            machines[i] = unwrapmachine(PySequence_Fast_GET_ITEM(seq.py(), i));
+        const size_t nstates = machines.size();
+
+        PyRef<> Z(PyArray_FromAny(pyZ, PyArray_DescrFromType(NPY_DOUBLE), 1, 1, NPY_ARRAY_CARRAY_RO, NULL)),
+                NC(PyArray_FromAny(pyN, PyArray_DescrFromType(NPY_DOUBLE), 1, 1, NPY_ARRAY_CARRAY_RO, NULL)),
+                M0(PyArray_FromAny(pym0, PyArray_DescrFromType(NPY_DOUBLE), 2, 2, NPY_ARRAY_CARRAY_RO, NULL)),
+                M2(PyArray_FromAny(pym2, PyArray_DescrFromType(NPY_DOUBLE), 3, 3, NPY_ARRAY_CARRAY_RO, NULL));
+        PyArrayObject *aM0 = (PyArrayObject*)M0.py(),
+                      *aM2 = (PyArrayObject*)M2.py();
+
+        const size_t m = PyArray_DIM(aM0, 1);
+        if((size_t)PyArray_DIM((PyArrayObject*)Z.py(), 0)!=nstates
+                || (size_t)PyArray_DIM((PyArrayObject*)NC.py(), 0)!=nstates
+                || (size_t)PyArray_DIM(aM0, 0)!=nstates || (size_t)PyArray_DIM(aM2, 0)!=nstates)
+            return PyErr_Format(PyExc_ValueError, "machines, IonZ, NChg, moment0, and state must have the same length");
+        if(m>MomentState::maxsize || (size_t)PyArray_DIM(aM2, 1)!=m || (size_t)PyArray_DIM(aM2, 2)!=m)
+            return PyErr_Format(PyExc_ValueError, "moment0 must have shape [N, M] and state [N, M, M] with M<=%d",
+                                (int)MomentState::maxsize);
+
+        std::vector<double> IonZ((const double*)PyArray_DATA((PyArrayObject*)Z.py()),
+                                 (const double*)PyArray_DATA((PyArrayObject*)Z.py())+nstates),
+                            NChg((const double*)PyArray_DATA((PyArrayObject*)NC.py()),
+                                 (const double*)PyArray_DATA((PyArrayObject*)NC.py())+nstates);
+
+        // zero padded to 7
+        std::vector<MomentState::vector_t> mom1(nstates);
+        std::vector<MomentState::matrix_t> mom2(nstates);
+        {
+            const double *m0 = (const double*)PyArray_DATA(aM0),
+                         *m2 = (const double*)PyArray_DATA(aM2);
+            for(size_t k=0; k<nstates; k++) {
+                mom1[k] = boost::numeric::ublas::zero_vector<double>(MomentState::maxsize);
+                mom2[k] = boost::numeric::ublas::zero_matrix<double>(MomentState::maxsize, MomentState::maxsize);
+                for(size_t i=0; i<m; i++) {
+                    mom1[k][i] = m0[k*m+i];
+                    for(size_t j=0; j<m; j++)
+                        mom2[k](i, j) = m2[(k*m+i)*m+j];
+                }
+            }
+        }
+
+        LinacTrack track;
+        LinacBusy B(linac);
+        {
+            PyUnlock U;
+            linac->ctx->propagate(machines, IonZ, NChg, mom1, mom2, track);
+        }
+
+        const size_t npoints = track.s.size(), D = MomentState::maxsize;
+        npy_intp cdims[] = {(npy_intp)npoints, (npy_intp)D},
+                 rdims[] = {(npy_intp)npoints, (npy_intp)D-1},
+                 mdims[] = {(npy_intp)npoints, (npy_intp)D, (npy_intp)D};
+        PyRef<> s(vec2array(track.s)),
+                cen(PyArray_ZEROS(2, cdims, NPY_DOUBLE, 0)),
+                rms(PyArray_ZEROS(2, rdims, NPY_DOUBLE, 0)),
+                mom(PyArray_ZEROS(3, mdims, NPY_DOUBLE, 0));
+        {
+            double *C = (double*)PyArray_DATA((PyArrayObject*)cen.py()),
+                   *R = (double*)PyArray_DATA((PyArrayObject*)rms.py()),
+                   *M = (double*)PyArray_DATA((PyArrayObject*)mom.py());
+            std::copy(track.CenofChg.begin(), track.CenofChg.end(), C);
+            std::copy(track.BeamRMS.begin(), track.BeamRMS.end(), M);
+            for(size_t n=0; n<npoints; n++) {
+                for(size_t i=0; i<D; i++) {
+                    double& diag = M[(n*D+i)*D+i];
+                    if(i<D-1)
+                        R[n*(D-1)+i] = diag;
+                    diag *= diag; // BeamRMS has RMS on the diagonal
+                }
+            }
+        }
+
+        PyRef<> states(PyList_New(nstates));
+        for(size_t k=0; k<nstates; k++) {
+            std::auto_ptr<StateBase> S(track.states[k]->clone());
+            PyObject *pystate = wrapstate(S.get(), "MomentMatrix");
+            S.release();
+            PyList_SET_ITEM(states.py(), k, pystate);
+        }
+
+        return Py_BuildValue("{sOsOsOsOsO}", "s", s.py(), "centroid", cen.py(), "rms", rms.py(),
+                             "moment2", mom.py(), "states", states.py());
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static PyMethodDef PyLinac_methods[] = {
+    {"set_cavity", (PyCFunction)&PyLinac_setCavity, METH_VARARGS|METH_KEYWORDS,
+     "set_cavity(cavtype, fieldmap, thinlens)\n"
+     "Set the on axis field, an [N,2] array of (s [mm], Elong [V/m]),\n"
+     "and the thin lens model (text, as thinlenlon_41.txt) of a cavity type (\"0.041QWR\" or \"0.085QWR\")."},
+    {"init_long", (PyCFunction)&PyLinac_initLong, METH_VARARGS|METH_KEYWORDS,
+     "init_long(machine, IonZ) -> dict\n"
+     "Longitudinal initialization of the reference particle, taken from the first element of 'machine'.\n"
+     "Finds the phase of each rfcavity.  Returns arrays 's' [m], 'Ek' [MeV/u], 'FyAbs' [rad],\n"
+     "'beta', and 'gamma' after each element, and 'phase' the phase of each rfcavity [rad].\n"
+     "The GIL is released."},
+    {"propagate", (PyCFunction)&PyLinac_propagate, METH_VARARGS|METH_KEYWORDS,
+     "propagate(machines, IonZ, NChg, moment0, state) -> dict\n"
+     "Propagate several charge states, with one Machine for each (eg. from Machine.clone()).\n"
+     "Each Machine is reconfigured for its charge state, and must not be used elsewhere meanwhile.\n"
+     "'IonZ' and 'NChg' are the charge to mass ratio and charge amount of each state.\n"
+     "'moment0' [nstates, M] and 'state' [nstates, M, M] are the initial moments,\n"
+     "[mm, rad, mm, rad, rad, MeV/u], with M<=7.  init_long() must be called first.\n"
+     "Returns arrays 's' [N], 'centroid' [N, 7], 'rms' [N, 6], and 'moment2' [N, 7, 7],\n"
+     "the charge weighted statistics of all states after each element (excluding the first),\n"
+     "and 'states' the final State of each charge state.\n"
+     "The GIL is released."},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject PyLinacType = {
+#if PY_MAJOR_VERSION >= 3
+    PyVarObject_HEAD_INIT(NULL, 0)
+#else
+    PyObject_HEAD_INIT(NULL)
+    0,
+#endif
+    "uscsi._internal.LinacContext",
+    sizeof(PyLinac),
+};
+
+} // namespace
+
+static const char pyldoc[] =
+        "Full linac (TLM) simulation of several charge states.\n"
+        "\n"
+        "LinacContext(datadir=None, mpole_level=2, emit_growth=False)\n"
+        "\n"
+        "Holds the cavity field maps and thin lens models, and the reference particle\n"
+        "and cavity phases found by init_long().  If 'datadir' is given,\n"
+        "cavity data is read from 'datadir'/data/ as by the 'main' executable.\n"
+        "Otherwise see set_cavity().\n"
+        "\n"
+        "Nothing is shared between instances, so independent simulations\n"
+        "(eg. different lattices or ion species) can run concurrently in different threads,\n"
+        "with one LinacContext each.\n"
+        ;
+
+int registerModLinac(PyObject *mod)
+{
+    PyLinacType.tp_doc = pyldoc;
+
+    PyLinacType.tp_new = &PyType_GenericNew;
+    PyLinacType.tp_init = &PyLinac_init;
+    PyLinacType.tp_dealloc = &PyLinac_free;
+
+    PyLinacType.tp_weaklistoffset = offsetof(PyLinac, weak);
+
+    PyLinacType.tp_flags = Py_TPFLAGS_DEFAULT|Py_TPFLAGS_BASETYPE;
+    PyLinacType.tp_methods = PyLinac_methods;
+
+    if(PyType_Ready(&PyLinacType))
+        return -1;
+
+    Py_INCREF(&PyLinacType);
+    if(PyModule_AddObject(mod, "LinacContext", (PyObject*)&PyLinacType)) {
+        Py_DECREF(&PyLinacType);
+        return -1;
+    }
+
+    return 0;
+}
@@ -1,7 +1,15 @@
 
+#include <algorithm>
+#include <map>
 #include <sstream>
 
+#include <stdio.h>
+#include <string.h>
+
 #include "scsi/base.h"
+#include "scsi/moment.h"
+#include "scsi/ensemble.h"
+#include "scsi/rfcavity.h"
 #include "pyscsi.h"
 
 #define NO_IMPORT_ARRAY
@@ -23,17 +31,28 @@ static
 int PyMachine_init(PyObject *raw, PyObject *args, PyObject *kws)
 {
     TRY {
-        PyObject *conf = NULL;
-        const char *pnames[] = {"config", NULL};
-        if(!PyArg_ParseTupleAndKeywords(args, kws, "O|", (char**)pnames, &conf))
+        PyObject *conf = NULL, *lazy = Py_False;
+        unsigned nthreads = 0;
+        const char *pnames[] = {"config", "lazy", "nthreads", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "O|OI", (char**)pnames, &conf, &lazy, &nthreads))
             return -1;
 
         assert(!machine->weak);
 
+        int L = PyObject_IsTrue(lazy);
+        if(L<0)
+            return -1;
+        Machine::build_mode_t mode = L ? Machine::BuildLazy : Machine::BuildEager;
+
         Py_buffer buf;
         std::auto_ptr<Config> C;
 
-        if(PyDict_Check(conf)) {
+        if(const Config *other = unwrapconfig(conf)) {
+            // no copy needed
+            machine->machine = new Machine(*other, mode, nthreads);
+            return 0;
+
+        } else if(PyDict_Check(conf)) {
             C.reset(dict2conf(conf));
 
         } else if(!PyObject_GetBuffer(conf, &buf, PyBUF_SIMPLE)) {
@@ -42,10 +61,10 @@ int PyMachine_init(PyObject *raw, PyObject *args, PyObject *kws)
 
             PyBuffer_Release(&buf);
         } else {
-            throw std::invalid_argument("'config' must be dict or byte buffer");
+            throw std::invalid_argument("'config' must be dict, Config, or byte buffer");
         }
 
-        machine->machine = new Machine(*C);
+        machine->machine = new Machine(*C, mode, nthreads);
 
         return 0;
     } CATCH3(key_error, KeyError, -1)
@@ -86,26 +105,60 @@ PyObject *PyMachine_allocState(PyObject *raw, PyObject *args, PyObject *kws)
         if(!PyArg_ParseTupleAndKeywords(args, kws, "O|", (char**)pnames, &d))
             return NULL;
 
-        std::auto_ptr<Config> C(dict2conf(d));
-        std::auto_ptr<StateBase> state(machine->machine->allocState(*C));
-        PyObject *ret = wrapstate(state.get());
+        std::auto_ptr<StateBase> state;
+        if(const Config *other = unwrapconfig(d)) {
+            state.reset(machine->machine->allocState(*other));
+        } else {
+            std::auto_ptr<Config> C(dict2conf(d));
+            state.reset(machine->machine->allocState(*C));
+        }
+        PyObject *ret = wrapstate(state.get(), machine->machine->simtype());
         state.release();
         return ret;
     } CATCH()
 }
 
+static
+PyObject *PyMachine_statePool(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        unsigned long count;
+        PyObject *d = NULL;
+        const char *pnames[] = {"count", "config", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "k|O", (char**)pnames, &count, &d))
+            return NULL;
+
+        std::auto_ptr<StateBase> state;
+        if(!d) {
+            Config empty;
+            state.reset(machine->machine->allocState(empty));
+        } else if(const Config *other = unwrapconfig(d)) {
+            state.reset(machine->machine->allocState(*other));
+        } else {
+            std::auto_ptr<Config> C(dict2conf(d));
+            state.reset(machine->machine->allocState(*C));
+        }
+        PyRef<> initial(wrapstate(state.get(), machine->machine->simtype()));
+        state.release();
+
+        return wrapstatepool(initial.py(), count);
+    } CATCH()
+}
+
 struct PyStoreObserver : public Observer
 {
     PyRef<> list;
-    PyStoreObserver()
+    PyRef<> simtype;
+    PyStoreObserver(const std::string& simtype)
         :list(PyList_New(0))
+        ,simtype(PyString_FromString(simtype.c_str()))
     {}
     virtual ~PyStoreObserver() {}
     virtual void view(const ElementVoid* elem, const StateBase* state)
     {
         PyRef<> tuple(PyTuple_New(2));
         std::auto_ptr<StateBase> tmpstate(state->clone());
-        PyRef<> statecopy(wrapstate(tmpstate.get()));
+        PyRef<> statecopy(wrapstate(tmpstate.get(), simtype.py()));
         tmpstate.release();
 
         PyTuple_SET_ITEM(tuple.py(), 0, PyInt_FromSize_t(elem->index));
@@ -122,7 +175,7 @@ struct PyScopedObserver
     PyScopedObserver(Machine *m) : machine(m) {}
     ~PyScopedObserver() {
         for(size_t i=0; i<observed.size(); i++) {
-            (*machine)[i]->set_observer(NULL);
+            (*machine)[observed[i]]->set_observer(NULL);
         }
     }
     void observe(size_t i, Observer *o)
@@ -147,7 +200,7 @@ PyObject *PyMachine_propagate(PyObject *raw, PyObject *args, PyObject *kws)
         if(!PyArg_ParseTupleAndKeywords(args, kws, "O|kkO", (char**)pnames, &state, &start, &max, &toobserv))
             return NULL;
 
-        PyStoreObserver observer;
+        PyStoreObserver observer(machine->machine->simtype());
         PyScopedObserver observing(machine->machine);
 
         if(toobserv) {
@@ -163,16 +216,809 @@ PyObject *PyMachine_propagate(PyObject *raw, PyObject *args, PyObject *kws)
             }
         }
 
-        machine->machine->propagate(unwrapstate(state), start, max);
+        StateBase *S = unwrapstate(state);
+        if(EnsembleState *ES = dynamic_cast<EnsembleState*>(S))
+            propagateEnsemble(*machine->machine, *ES, start, max);
+        else
+            machine->machine->propagate(S, start, max);
         if(toobserv) {
             return observer.list.release();
         } else {
             Py_RETURN_NONE;
         }
+    } CATCH2(nonfinite_error, FloatingPointError)
+    CATCH2(std::invalid_argument, ValueError)
+    CATCH()
+}
+
+namespace {
+// States copied while the GIL is released
+struct StateCopies {
+    std::vector<std::pair<size_t, StateBase*> > states;
+    ~StateCopies() {
+        for(size_t i=0; i<states.size(); i++)
+            delete states[i].second;
+    }
+};
+
+struct BufferGuard {
+    Py_buffer view;
+    bool held;
+    BufferGuard() :held(false) {}
+    ~BufferGuard() { if(held) PyBuffer_Release(&view); }
+};
+}
+
+static
+PyObject *PyMachine_propagateNoGIL(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *state, *toobserv = Py_None, *pycancel = Py_None;
+        unsigned long start = 0, max = (unsigned long)-1;
+        const char *pnames[] = {"state", "start", "max", "observe", "cancel", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "O|kkOO", (char**)pnames, &state, &start, &max, &toobserv, &pycancel))
+            return NULL;
+
+        const Machine& M = *machine->machine;
+        const size_t nelem = M.size();
+
+        std::vector<char> observe(nelem, 0);
+        if(toobserv!=Py_None) {
+            PyRef<> iter(PyObject_GetIter(toobserv)), item;
+
+            while(item.reset(PyIter_Next(iter.py()), PyRef<>::allow_null())) {
+                Py_ssize_t num = PyNumber_AsSsize_t(item.py(), PyExc_ValueError);
+                if(PyErr_Occurred())
+                    throw std::runtime_error(""); // caller will get active python exception
+                if(num<0 || (size_t)num>=nelem)
+                    return PyErr_Format(PyExc_ValueError, "invalid element index %ld", (long)num);
+                observe[num] = 1;
+            }
+            if(PyErr_Occurred())
+                return NULL;
+        }
+
+        BufferGuard cancel;
+        if(pycancel!=Py_None) {
+            if(PyObject_GetBuffer(pycancel, &cancel.view, PyBUF_WRITABLE))
+                return NULL;
+            cancel.held = true;
+            if(cancel.view.len<1)
+                return PyErr_Format(PyExc_ValueError, "cancel must be a writable buffer of at least one byte");
+        }
+        const volatile char *flag = cancel.held ? (const char*)cancel.view.buf : NULL;
+
+        StateBase *S = unwrapstate(state);
+        EnsembleState *ES = dynamic_cast<EnsembleState*>(S);
+        StateCopies copies;
+        bool cancelled = false;
+        {
+            PyUnlock U;
+
+            M.materialize(start, max);
+
+            S->next_elem = start;
+            for(size_t i=0; S->next_elem<nelem && i<max; ) {
+                if(flag && *flag) {
+                    cancelled = true;
+                    break;
+                }
+                const size_t idx = S->next_elem;
+                size_t last = idx;
+
+                if(ES) {
+                    // keep the combined transfer matrices of propagateEnsemble(),
+                    // stopping only at observed elements.  Observers are not called.
+                    size_t n = 1;
+                    while(idx+n<nelem && i+n<max && !observe[idx+n-1])
+                        n++;
+                    propagateEnsemble(M, *ES, idx, n, false);
+                    i += n;
+                    last = idx+n-1;
+                } else {
+                    // Observers are not called, so other threads may propagate at the same time
+                    S->next_elem++;
+                    M[idx]->advance(*S);
+                    i++;
+                }
+
+                if(observe[last]) {
+                    copies.states.push_back(std::make_pair(last, (StateBase*)NULL));
+                    copies.states.back().second = S->clone();
+                }
+            }
+        }
+
+        PyRef<> simtype(PyString_FromString(M.simtype().c_str()));
+        PyRef<> list(PyList_New(copies.states.size()));
+        for(size_t i=0; i<copies.states.size(); i++) {
+            PyRef<> statecopy(wrapstate(copies.states[i].second, simtype.py()));
+            copies.states[i].second = NULL; // owned by statecopy
+            PyObject *tuple = Py_BuildValue("(kO)", (unsigned long)copies.states[i].first, statecopy.py());
+            if(!tuple)
+                return NULL;
+            PyList_SET_ITEM(list.py(), i, tuple);
+        }
+
+        return Py_BuildValue("(ON)", list.py(), PyBool_FromLong(cancelled));
     } CATCH2(std::invalid_argument, ValueError)
     CATCH()
 }
 
+// Call a function of uscsi.aio with this Machine as the first argument
+static
+PyObject *PyMachine_aio(PyObject *raw, PyObject *args, PyObject *kws, const char *name)
+{
+    try {
+        PyRef<> mod(PyImport_ImportModule("uscsi.aio"));
+        PyRef<> fn(PyObject_GetAttrString(mod.py(), name));
+
+        Py_ssize_t nargs = PyTuple_GET_SIZE(args);
+        PyRef<> fargs(PyTuple_New(nargs+1));
+        Py_INCREF(raw);
+        PyTuple_SET_ITEM(fargs.py(), 0, raw);
+        for(Py_ssize_t i=0; i<nargs; i++) {
+            PyObject *arg = PyTuple_GET_ITEM(args, i);
+            Py_INCREF(arg);
+            PyTuple_SET_ITEM(fargs.py(), i+1, arg);
+        }
+        return PyObject_Call(fn.py(), fargs.py(), kws);
+    } CATCH()
+}
+
+static
+PyObject *PyMachine_propagateAsync(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    return PyMachine_aio(raw, args, kws, "propagate_async");
+}
+
+static
+PyObject *PyMachine_propagateManyAsync(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    return PyMachine_aio(raw, args, kws, "propagate_many_async");
+}
+
+static
+PyObject *PyMachine_sensitivity(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *state, *pyknobs, *toobserv = NULL;
+        const char *pnames[] = {"state", "knobs", "observe", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "OO|O", (char**)pnames, &state, &pyknobs, &toobserv))
+            return NULL;
+
+        MomentState *S = dynamic_cast<MomentState*>(unwrapstate(state));
+        if(!S)
+            return PyErr_Format(PyExc_ValueError, "sensitivity() requires a MomentMatrix State");
+
+        std::vector<SensitivityKnob> knobs;
+        {
+            PyRef<> iter(PyObject_GetIter(pyknobs)), item;
+            while(item.reset(PyIter_Next(iter.py()), PyRef<>::allow_null())) {
+                unsigned long idx;
+                const char *param;
+                if(!PyArg_ParseTuple(item.py(), "ks;knobs must be a sequence of (index, 'param')", &idx, &param))
+                    return NULL;
+                knobs.push_back(SensitivityKnob(idx, param));
+            }
+            if(PyErr_Occurred())
+                return NULL;
+        }
+
+        std::vector<size_t> observe;
+        if(toobserv) {
+            PyRef<> iter(PyObject_GetIter(toobserv)), item;
+            while(item.reset(PyIter_Next(iter.py()), PyRef<>::allow_null())) {
+                Py_ssize_t num = PyNumber_AsSsize_t(item.py(), PyExc_ValueError);
+                if(PyErr_Occurred())
+                    return NULL;
+                observe.push_back(num);
+            }
+            if(PyErr_Occurred())
+                return NULL;
+        } else if(machine->machine->size()>0) {
+            observe.push_back(machine->machine->size()-1);
+        }
+
+        std::vector<MomentState::matrix_t> dstate;
+        std::vector<MomentState::vector_t> dmoment0;
+
+        propagateSensitivity(*machine->machine, *S, knobs, observe, dstate, dmoment0);
+
+        const npy_intp N = MomentState::maxsize;
+        npy_intp sdims[] = {(npy_intp)observe.size(), (npy_intp)knobs.size(), N, N},
+                 mdims[] = {(npy_intp)observe.size(), (npy_intp)knobs.size(), N};
+        PyRef<> pystate(PyArray_ZEROS(4, sdims, NPY_DOUBLE, 0)),
+                pymoment(PyArray_ZEROS(3, mdims, NPY_DOUBLE, 0));
+
+        double *sout = (double*)PyArray_DATA((PyArrayObject*)pystate.py()),
+               *mout = (double*)PyArray_DATA((PyArrayObject*)pymoment.py());
+        for(size_t i=0; i<dstate.size(); i++) {
+            std::copy(dstate[i].data().begin(), dstate[i].data().begin()+N*N, sout+i*N*N);
+            std::copy(dmoment0[i].data().begin(), dmoment0[i].data().begin()+N, mout+i*N);
+        }
+
+        return Py_BuildValue("(OO)", pystate.py(), pymoment.py());
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static
+PyObject *PyMachine_match(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *state, *pyknobs, *pytargets, *pyweights = Py_None;
+        unsigned long maxiter = 100;
+        double tol = 1e-10;
+        const char *pnames[] = {"state", "knobs", "targets", "weights", "maxiter", "tol", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "OOO|Okd", (char**)pnames,
+                                        &state, &pyknobs, &pytargets, &pyweights, &maxiter, &tol))
+            return NULL;
+
+        MomentState *S = dynamic_cast<MomentState*>(unwrapstate(state));
+        if(!S)
+            return PyErr_Format(PyExc_ValueError, "match() requires a MomentMatrix State");
+
+        std::vector<SensitivityKnob> knobs;
+        {
+            PyRef<> iter(PyObject_GetIter(pyknobs)), item;
+            while(item.reset(PyIter_Next(iter.py()), PyRef<>::allow_null())) {
+                unsigned long idx;
+                const char *param;
+                if(!PyArg_ParseTuple(item.py(), "ks;knobs must be a sequence of (index, 'param')", &idx, &param))
+                    return NULL;
+                knobs.push_back(SensitivityKnob(idx, param));
+            }
+            if(PyErr_Occurred())
+                return NULL;
+        }
+
+        std::vector<MatchTarget> targets;
+        {
+            PyRef<> iter(PyObject_GetIter(pytargets)), item;
+            while(item.reset(PyIter_Next(iter.py()), PyRef<>::allow_null())) {
+                unsigned long idx;
+                PyObject *pos;
+                MatchTarget T;
+                if(!PyArg_ParseTuple(item.py(), "kOd;targets must be a sequence of (index, (row, col) or row, value)",
+                                     &idx, &pos, &T.value))
+                    return NULL;
+                T.index = idx;
+                if(PyTuple_Check(pos)) {
+                    if(!PyArg_ParseTuple(pos, "II;target position must be (row, col) or row", &T.row, &T.col))
+                        return NULL;
+                } else {
+                    Py_ssize_t row = PyNumber_AsSsize_t(pos, PyExc_ValueError);
+                    if(PyErr_Occurred())
+                        return NULL;
+                    T.row = row;
+                    T.moment0 = true;
+                }
+                targets.push_back(T);
+            }
+            if(PyErr_Occurred())
+                return NULL;
+        }
+
+        if(pyweights!=Py_None) {
+            PyRef<> W(PyArray_FromAny(pyweights, PyArray_DescrFromType(NPY_DOUBLE), 1, 1,
+                                      NPY_ARRAY_CARRAY_RO, NULL));
+            if((size_t)PyArray_DIM((PyArrayObject*)W.py(), 0)!=targets.size())
+                return PyErr_Format(PyExc_ValueError, "weights must have one entry for each target");
+            const double *w = (const double*)PyArray_DATA((PyArrayObject*)W.py());
+            for(size_t k=0; k<targets.size(); k++)
+                targets[k].weight = w[k];
+        }
+
+        std::vector<double> values;
+        unsigned niter = 0;
+        double cost = matchMoments(*machine->machine, *S, knobs, targets, values, maxiter, tol, &niter);
+
+        npy_intp dims[] = {(npy_intp)values.size()};
+        PyRef<> pyx(PyArray_SimpleNew(1, dims, NPY_DOUBLE));
+        std::copy(values.begin(), values.end(), (double*)PyArray_DATA((PyArrayObject*)pyx.py()));
+
+        return Py_BuildValue("{sOsdsI}", "x", pyx.py(), "cost", cost, "iterations", niter);
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static
+PyObject *PyMachine_propagateErrors(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *state, *pyerrors, *toobserv = NULL;
+        unsigned long nseeds, seed = 0;
+        unsigned threads = 1;
+        const char *pnames[] = {"state", "errors", "nseeds", "observe", "seed", "threads", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "OOk|OkI", (char**)pnames,
+                                        &state, &pyerrors, &nseeds, &toobserv, &seed, &threads))
+            return NULL;
+
+        MomentState *S = dynamic_cast<MomentState*>(unwrapstate(state));
+        if(!S)
+            return PyErr_Format(PyExc_ValueError, "propagate_errors() requires a MomentMatrix State");
+
+        std::vector<ElementError> errors;
+        {
+            PyRef<> iter(PyObject_GetIter(pyerrors)), item;
+            while(item.reset(PyIter_Next(iter.py()), PyRef<>::allow_null())) {
+                unsigned long idx;
+                const char *param, *dist = "normal";
+                int relative = 0;
+                ElementError err;
+                if(!PyArg_ParseTuple(item.py(), "ksd|si;errors must be a sequence of (index, 'param', sigma[, 'normal'|'uniform'[, relative]])",
+                                     &idx, &param, &err.sigma, &dist, &relative))
+                    return NULL;
+                err.index = idx;
+                err.param = param;
+                err.relative = relative!=0;
+                if(strcmp(dist, "normal")==0)
+                    err.dist = ElementError::Normal;
+                else if(strcmp(dist, "uniform")==0)
+                    err.dist = ElementError::Uniform;
+                else
+                    return PyErr_Format(PyExc_ValueError, "Unknown distribution '%s'", dist);
+                errors.push_back(err);
+            }
+            if(PyErr_Occurred())
+                return NULL;
+        }
+
+        std::vector<size_t> observe;
+        if(toobserv) {
+            PyRef<> iter(PyObject_GetIter(toobserv)), item;
+            while(item.reset(PyIter_Next(iter.py()), PyRef<>::allow_null())) {
+                Py_ssize_t num = PyNumber_AsSsize_t(item.py(), PyExc_ValueError);
+                if(PyErr_Occurred())
+                    return NULL;
+                observe.push_back(num);
+            }
+            if(PyErr_Occurred())
+                return NULL;
+        } else if(machine->machine->size()>0) {
+            observe.push_back(machine->machine->size()-1);
+        }
+
+        std::vector<MomentState::matrix_t> ostate;
+        std::vector<MomentState::vector_t> omoment0;
+        std::vector<double> deltas;
+
+        propagateErrors(*machine->machine, *S, errors, nseeds, seed, observe,
+                        ostate, omoment0, &deltas, threads);
+
+        const npy_intp N = MomentState::maxsize;
+        npy_intp sdims[] = {(npy_intp)observe.size(), (npy_intp)nseeds, N, N},
+                 mdims[] = {(npy_intp)observe.size(), (npy_intp)nseeds, N},
+                 ddims[] = {(npy_intp)nseeds, (npy_intp)errors.size()};
+        PyRef<> pystate(PyArray_ZEROS(4, sdims, NPY_DOUBLE, 0)),
+                pymoment(PyArray_ZEROS(3, mdims, NPY_DOUBLE, 0)),
+                pydelta(PyArray_ZEROS(2, ddims, NPY_DOUBLE, 0));
+
+        double *sout = (double*)PyArray_DATA((PyArrayObject*)pystate.py()),
+               *mout = (double*)PyArray_DATA((PyArrayObject*)pymoment.py());
+        for(size_t i=0; i<ostate.size(); i++) {
+            std::copy(ostate[i].data().begin(), ostate[i].data().begin()+N*N, sout+i*N*N);
+            std::copy(omoment0[i].data().begin(), omoment0[i].data().begin()+N, mout+i*N);
+        }
+        std::copy(deltas.begin(), deltas.end(), (double*)PyArray_DATA((PyArrayObject*)pydelta.py()));
+
+        return Py_BuildValue("(OOO)", pystate.py(), pymoment.py(), pydelta.py());
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static
+PyObject *PyMachine_phaseCavities(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *state, *pymaps;
+        unsigned nphase = 360;
+        const char *pnames[] = {"state", "fieldmaps", "nphase", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "OO!|I", (char**)pnames,
+                                        &state, &PyDict_Type, &pymaps, &nphase))
+            return NULL;
+
+        const StateBase *S = unwrapstate(state);
+
+        std::map<std::string, CavityFieldMap> maps;
+        {
+            PyObject *key, *value;
+            Py_ssize_t pos = 0;
+            while(PyDict_Next(pymaps, &pos, &key, &value)) {
+                PyRef<> keystr(PyObject_Str(key));
+#if PY_MAJOR_VERSION >= 3
+                PyRef<> keybytes(PyUnicode_AsUTF8String(keystr.py()));
+                const char *name = PyBytes_AsString(keybytes.py());
+#else
+                const char *name = PyString_AsString(keystr.py());
+#endif
+                if(!name)
+                    return NULL;
+                py2fieldmap(maps[name], value);
+            }
+        }
+
+        std::vector<CavityPhase> phases;
+        phaseCavities(*machine->machine, *S, maps, phases, nphase);
+
+        npy_intp dims[] = {(npy_intp)phases.size()};
+        PyRef<> index(PyArray_ZEROS(1, dims, NPY_INTP, 0)),
+                phase(PyArray_ZEROS(1, dims, NPY_DOUBLE, 0)),
+                crest(PyArray_ZEROS(1, dims, NPY_DOUBLE, 0)),
+                FyAbs(PyArray_ZEROS(1, dims, NPY_DOUBLE, 0)),
+                Win(PyArray_ZEROS(1, dims, NPY_DOUBLE, 0)),
+                Wout(PyArray_ZEROS(1, dims, NPY_DOUBLE, 0));
+
+        for(size_t i=0; i<phases.size(); i++) {
+            ((npy_intp*)PyArray_DATA((PyArrayObject*)index.py()))[i] = phases[i].index;
+            ((double*)PyArray_DATA((PyArrayObject*)phase.py()))[i] = phases[i].phase;
+            ((double*)PyArray_DATA((PyArrayObject*)crest.py()))[i] = phases[i].crest;
+            ((double*)PyArray_DATA((PyArrayObject*)FyAbs.py()))[i] = phases[i].FyAbs;
+            ((double*)PyArray_DATA((PyArrayObject*)Win.py()))[i] = phases[i].IonW_in;
+            ((double*)PyArray_DATA((PyArrayObject*)Wout.py()))[i] = phases[i].IonW_out;
+        }
+
+        return Py_BuildValue("{sOsOsOsOsOsO}", "index", index.py(), "phase", phase.py(),
+                             "crest", crest.py(), "FyAbs", FyAbs.py(),
+                             "IonW_in", Win.py(), "IonW_out", Wout.py());
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+namespace {
+// An output array from 'out', or a new one
+PyObject *statsArray(PyObject *out, const char *name, int nd, npy_intp *dims)
+{
+    PyObject *arr = out ? PyDict_GetItemString(out, name) : NULL; // borrowed
+    if(!arr)
+        return PyArray_ZEROS(nd, dims, NPY_DOUBLE, 0);
+    if(!PyArray_Check(arr) || PyArray_TYPE((PyArrayObject*)arr)!=NPY_DOUBLE
+            || !PyArray_ISCARRAY((PyArrayObject*)arr) || PyArray_NDIM((PyArrayObject*)arr)!=nd
+            || !PyArray_CompareLists(PyArray_DIMS((PyArrayObject*)arr), dims, nd))
+        return PyErr_Format(PyExc_ValueError, "out['%s'] must be a writable, contiguous, float64 array of the result shape", name);
+    Py_INCREF(arr);
+    return arr;
+}
+}
+
+static
+PyObject *PyMachine_beamStats(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *pystates, *pyweights = Py_None, *toobserv = Py_None, *out = NULL;
+        const char *pnames[] = {"states", "weights", "observe", "out", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "O|OOO!", (char**)pnames,
+                                        &pystates, &pyweights, &toobserv, &PyDict_Type, &out))
+            return NULL;
+
+        // holds references to the States until propagation is done
+        PyRef<> seq(PySequence_Fast(pystates, "states must be a sequence of State"));
+        std::vector<MomentState*> states(PySequence_Fast_GET_SIZE(seq.py()));
+        for(size_t i=0; i<states.size(); i++) {
+            states[i] = dynamic_cast<MomentState*>(unwrapstate(PySequence_Fast_GET_ITEM(seq.py(), i)));
+            if(!states[i])
+                return PyErr_Format(PyExc_ValueError, "beam_stats() requires MomentMatrix States");
+        }
+
+        std::vector<double> weights(states.size(), 1.0);
+        if(pyweights!=Py_None) {
+            PyRef<> W(PyArray_FromAny(pyweights, PyArray_DescrFromType(NPY_DOUBLE), 1, 1,
+                                      NPY_ARRAY_CARRAY_RO, NULL));
+            if((size_t)PyArray_DIM((PyArrayObject*)W.py(), 0)!=states.size())
+                return PyErr_Format(PyExc_ValueError, "weights must have one entry for each state");
+            const double *w = (const double*)PyArray_DATA((PyArrayObject*)W.py());
+            std::copy(w, w+states.size(), weights.begin());
+        }
+
+        std::vector<size_t> observe;
+        if(toobserv!=Py_None) {
+            PyRef<> iter(PyObject_GetIter(toobserv)), item;
+            while(item.reset(PyIter_Next(iter.py()), PyRef<>::allow_null())) {
+                Py_ssize_t num = PyNumber_AsSsize_t(item.py(), PyExc_ValueError);
+                if(PyErr_Occurred())
+                    return NULL;
+                if((size_t)num>=machine->machine->size())
+                    return PyErr_Format(PyExc_ValueError, "element index out of range");
+                observe.push_back(num);
+            }
+            if(PyErr_Occurred())
+                return NULL;
+        } else if(machine->machine->size()>0) {
+            observe.push_back(machine->machine->size()-1);
+        }
+
+        const npy_intp N = MomentStatsObserver::ncoord;
+        npy_intp cdims[] = {(npy_intp)observe.size(), N},
+                 mdims[] = {(npy_intp)observe.size(), N, N},
+                 rdims[] = {(npy_intp)observe.size(), MomentStatsObserver::nrms},
+                 edims[] = {(npy_intp)observe.size(), MomentStatsObserver::nplane};
+        PyRef<> centroid(statsArray(out, "centroid", 2, cdims)),
+                moment2(statsArray(out, "moment2", 3, mdims)),
+                rms(statsArray(out, "rms", 2, rdims)),
+                emittance(statsArray(out, "emittance", 2, edims));
+
+        MomentStatsObserver observer(observe,
+                                     (double*)PyArray_DATA((PyArrayObject*)centroid.py()),
+                                     (double*)PyArray_DATA((PyArrayObject*)moment2.py()),
+                                     (double*)PyArray_DATA((PyArrayObject*)rms.py()),
+                                     (double*)PyArray_DATA((PyArrayObject*)emittance.py()));
+        {
+            PyScopedObserver observing(machine->machine);
+            for(size_t i=0; i<observe.size(); i++)
+                observing.observe(observe[i], &observer);
+
+            for(size_t i=0; i<states.size(); i++) {
+                observer.weight = weights[i];
+                machine->machine->propagate(states[i]);
+            }
+        }
+        observer.finish();
+
+        return Py_BuildValue("{sOsOsOsO}", "centroid", centroid.py(), "moment2", moment2.py(),
+                             "rms", rms.py(), "emittance", emittance.py());
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static
+PyObject *PyMachine_sample(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *state, *pyspos = Py_None, *out = NULL;
+        double step = 0.0;
+        const char *pnames[] = {"state", "s", "step", "out", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "O|OdO!", (char**)pnames,
+                                        &state, &pyspos, &step, &PyDict_Type, &out))
+            return NULL;
+
+        MomentState *S = dynamic_cast<MomentState*>(unwrapstate(state));
+        if(!S)
+            return PyErr_Format(PyExc_ValueError, "sample() requires a MomentMatrix State");
+
+        std::vector<double> spos;
+        if(pyspos!=Py_None) {
+            if(step!=0.0)
+                return PyErr_Format(PyExc_ValueError, "Only one of 's' or 'step' may be given");
+            PyRef<> P(PyArray_FromAny(pyspos, PyArray_DescrFromType(NPY_DOUBLE), 0, 1,
+                                      NPY_ARRAY_CARRAY_RO, NULL));
+            const double *p = (const double*)PyArray_DATA((PyArrayObject*)P.py());
+            spos.assign(p, p+PyArray_SIZE((PyArrayObject*)P.py()));
+        } else if(step>0.0) {
+            // 0, step, 2*step, ... and the end
+            const double total = machineLength(*machine->machine);
+            for(size_t k=0; k*step<total; k++)
+                spos.push_back(k*step);
+            spos.push_back(total);
+        } else {
+            return PyErr_Format(PyExc_ValueError, "Either 's' or 'step'>0 must be given");
+        }
+
+        const npy_intp N = MomentState::maxsize;
+        npy_intp sdims[] = {(npy_intp)spos.size()},
+                 mdims[] = {(npy_intp)spos.size(), N},
+                 tdims[] = {(npy_intp)spos.size(), N, N};
+        PyRef<> pymoment(statsArray(out, "moment0", 2, mdims)),
+                pystate(statsArray(out, "state", 3, tdims)),
+                pyindex(PyArray_ZEROS(1, sdims, NPY_INTP, 0));
+
+        std::vector<size_t> index(spos.size());
+        propagateSampled(*machine->machine, *S, spos,
+                         (double*)PyArray_DATA((PyArrayObject*)pymoment.py()),
+                         (double*)PyArray_DATA((PyArrayObject*)pystate.py()),
+                         index.empty() ? NULL : &index[0]);
+
+        PyRef<> pyspos2(PyArray_ZEROS(1, sdims, NPY_DOUBLE, 0));
+        std::copy(spos.begin(), spos.end(), (double*)PyArray_DATA((PyArrayObject*)pyspos2.py()));
+        std::copy(index.begin(), index.end(), (npy_intp*)PyArray_DATA((PyArrayObject*)pyindex.py()));
+
+        return Py_BuildValue("{sOsOsOsO}", "s", pyspos2.py(), "index", pyindex.py(),
+                             "moment0", pymoment.py(), "state", pystate.py());
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+namespace {
+// numpy dtype for a str field of width 'len'
+PyObject *strField(const char *name, size_t len)
+{
+    char fmt[32];
+#if PY_MAJOR_VERSION >= 3
+    snprintf(fmt, sizeof(fmt), "U%lu", (unsigned long)std::max(len, (size_t)1u));
+#else
+    snprintf(fmt, sizeof(fmt), "S%lu", (unsigned long)std::max(len, (size_t)1u));
+#endif
+    return Py_BuildValue("(ss)", name, fmt);
+}
+
+// list of tuples -> structured array
+PyObject *structArray(PyObject *spec, PyObject *rows)
+{
+    PyArray_Descr *descr = NULL;
+    if(!PyArray_DescrConverter(spec, &descr))
+        return NULL;
+    return PyArray_FromAny(rows, descr, 1, 1, NPY_ARRAY_DEFAULT, NULL); // steals descr
+}
+
+struct TypeTotal {
+    unsigned long long elements, calls, nsec, builds;
+    TypeTotal() :elements(0), calls(0), nsec(0), builds(0) {}
+};
+}
+
+static
+PyObject *PyMachine_setProfile(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *enable = Py_True;
+        const char *pnames[] = {"enable", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "|O", (char**)pnames, &enable))
+            return NULL;
+        int E = PyObject_IsTrue(enable);
+        if(E<0)
+            return NULL;
+        machine->machine->set_profile(E);
+        Py_RETURN_NONE;
+    } CATCH()
+}
+
+static
+PyObject *PyMachine_resetProfile(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        machine->machine->reset_profile();
+        Py_RETURN_NONE;
+    } CATCH()
+}
+
+static
+PyObject *PyMachine_profile(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        const char *by = "element";
+        const char *pnames[] = {"by", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "|s", (char**)pnames, &by))
+            return NULL;
+
+        const Machine& M = *machine->machine;
+        const Machine::Profile *P = M.profile();
+        if(!P)
+            Py_RETURN_NONE;
+
+        if(strcmp(by, "element")==0) {
+            size_t nlen = 0, tlen = 0;
+            for(size_t i=0; i<M.size(); i++) {
+                nlen = std::max(nlen, M[i]->name.size());
+                tlen = std::max(tlen, strlen(M[i]->type_name()));
+            }
+            PyRef<> name(strField("name", nlen)), type(strField("type", tlen));
+            PyRef<> spec(Py_BuildValue("[(ss)OO(ss)(ss)(ss)]", "index", "u8", name.py(), type.py(),
+                                       "calls", "u8", "nsec", "u8", "builds", "u8"));
+
+            PyRef<> rows(PyList_New(M.size()));
+            for(size_t i=0; i<M.size(); i++) {
+                PyObject *row = Py_BuildValue("(kssKKK)", (unsigned long)i, M[i]->name.c_str(), M[i]->type_name(),
+                                              P->calls[i], P->nsec[i], P->builds[i]);
+                if(!row)
+                    return NULL;
+                PyList_SET_ITEM(rows.py(), i, row);
+            }
+            return structArray(spec.py(), rows.py());
+
+        } else if(strcmp(by, "type")==0) {
+            typedef std::map<std::string, TypeTotal> totals_t;
+            totals_t totals;
+            size_t tlen = 0;
+            for(size_t i=0; i<M.size(); i++) {
+                TypeTotal& T = totals[M[i]->type_name()];
+                T.elements++;
+                T.calls += P->calls[i];
+                T.nsec += P->nsec[i];
+                T.builds += P->builds[i];
+                tlen = std::max(tlen, strlen(M[i]->type_name()));
+            }
+
+            // most time first
+            std::vector<std::pair<unsigned long long, std::string> > order;
+            for(totals_t::const_iterator it=totals.begin(); it!=totals.end(); ++it)
+                order.push_back(std::make_pair(it->second.nsec, it->first));
+            std::stable_sort(order.rbegin(), order.rend());
+
+            PyRef<> type(strField("type", tlen));
+            PyRef<> spec(Py_BuildValue("[O(ss)(ss)(ss)(ss)]", type.py(),
+                                       "elements", "u8", "calls", "u8", "nsec", "u8", "builds", "u8"));
+
+            PyRef<> rows(PyList_New(order.size()));
+            for(size_t i=0; i<order.size(); i++) {
+                const TypeTotal& T = totals[order[i].second];
+                PyObject *row = Py_BuildValue("(sKKKK)", order[i].second.c_str(),
+                                              T.elements, T.calls, T.nsec, T.builds);
+                if(!row)
+                    return NULL;
+                PyList_SET_ITEM(rows.py(), i, row);
+            }
+            return structArray(spec.py(), rows.py());
+
+        } else if(strcmp(by, "machine")==0) {
+            unsigned long long nsec = 0;
+            for(size_t i=0; i<M.size(); i++)
+                nsec += P->nsec[i];
+            PyRef<> spec(Py_BuildValue("[(ss)(ss)(ss)(ss)]", "propagations", "u8", "states", "u8",
+                                       "elements", "u8", "nsec", "u8")),
+                    rows(Py_BuildValue("[(KKKK)]", P->propagations, P->states, P->elements, nsec));
+            return structArray(spec.py(), rows.py());
+
+        } else {
+            return PyErr_Format(PyExc_ValueError, "by= must be 'element', 'type', or 'machine'");
+        }
+    } CATCH()
+}
+
+static
+PyObject *PyMachine_setHistory(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        unsigned long depth = 1000;
+        PyObject *check = Py_False;
+        const char *dump = NULL;
+        const char *pnames[] = {"depth", "check_finite", "dump", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "|kOz", (char**)pnames, &depth, &check, &dump))
+            return NULL;
+        int C = PyObject_IsTrue(check);
+        if(C<0)
+            return NULL;
+        machine->machine->set_history(depth, C, dump ? dump : "");
+        Py_RETURN_NONE;
+    } CATCH()
+}
+
+static
+PyObject *PyMachine_history(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        const StateHistory *H = machine->machine->history();
+        if(!H)
+            Py_RETURN_NONE;
+
+        const StateHistory::fields_t& fields = H->fields();
+        PyRef<> spec(Py_BuildValue("[(ss)]", "index", "u8"));
+        for(size_t f=0; f<fields.size(); f++) {
+            const StateHistory::Field& F = fields[f];
+            PyRef<> shape(PyTuple_New(F.dim.size()));
+            for(size_t d=0; d<F.dim.size(); d++)
+                PyTuple_SET_ITEM(shape.py(), d, PyInt_FromSize_t(F.dim[d]));
+            PyRef<> field(F.dim.empty() ? Py_BuildValue("(ss)", F.name.c_str(), "f8")
+                                        : Py_BuildValue("(ssO)", F.name.c_str(), "f8", shape.py()));
+            if(PyList_Append(spec.py(), field.py()))
+                return NULL;
+        }
+
+        PyArray_Descr *descr = NULL;
+        if(!PyArray_DescrConverter(spec.py(), &descr))
+            return NULL;
+        npy_intp dim = H->size();
+        PyRef<> ret(PyArray_Zeros(1, &dim, descr, 0)); // steals descr
+        H->copy(PyArray_DATA((PyArrayObject*)ret.py()));
+        return ret.release();
+    } CATCH()
+}
+
+static
+PyObject *PyMachine_dumpHistory(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        const char *fname;
+        const char *pnames[] = {"filename", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "s", (char**)pnames, &fname))
+            return NULL;
+        const StateHistory *H = machine->machine->history();
+        if(!H)
+            return PyErr_Format(PyExc_ValueError, "History is not being recorded.  See set_history()");
+        H->dump(fname);
+        Py_RETURN_NONE;
+    } CATCH()
+}
+
 static
 PyObject *PyMachine_reconfigure(PyObject *raw, PyObject *args, PyObject *kws)
 {
@@ -180,17 +1026,26 @@ PyObject *PyMachine_reconfigure(PyObject *raw, PyObject *args, PyObject *kws)
         unsigned long idx;
         PyObject *conf;
         const char *pnames[] = {"index", "config", NULL};
-        if(!PyArg_ParseTupleAndKeywords(args, kws, "kO!|", (char**)pnames, &idx, &PyDict_Type, &conf))
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "kO|", (char**)pnames, &idx, &conf))
             return NULL;
 
+        const Config *other = unwrapconfig(conf);
+        if(!other && !PyDict_Check(conf))
+            return PyErr_Format(PyExc_TypeError, "config must be a dict or Config");
+
         if(idx>=machine->machine->size())
             return PyErr_Format(PyExc_ValueError, "invalid element index %lu", idx);
 
         // TODO: only allow existing elements to be changed.
         //       allow unassign
-        Config newconf((*machine->machine)[idx]->conf());
+        Config newconf(machine->machine->elementConf(idx));
 
-        Dict2Config(newconf, conf, 3); // set depth=3 to prevent recursion
+        if(other) {
+            for(Config::const_iterator it=other->begin(), end=other->end(); it!=end; ++it)
+                newconf.setAny(it->first, it->second);
+        } else {
+            Dict2Config(newconf, conf, 3); // set depth=3 to prevent recursion
+        }
 
         machine->machine->reconfigure(idx, newconf);
 
@@ -199,6 +1054,40 @@ PyObject *PyMachine_reconfigure(PyObject *raw, PyObject *args, PyObject *kws)
     CATCH()
 }
 
+static
+PyObject *PyMachine_is_built(PyObject *raw, PyObject *args)
+{
+    TRY{
+        unsigned long idx;
+        if(!PyArg_ParseTuple(args, "k", &idx))
+            return NULL;
+        return PyBool_FromLong(machine->machine->isBuilt(idx));
+    } CATCH2(std::invalid_argument, ValueError)
+    CATCH()
+}
+
+static
+PyObject *PyMachine_clone(PyObject *raw, PyObject *unused)
+{
+    TRY{
+        PyTypeObject *type = Py_TYPE(raw);
+        PyRef<PyMachine> ret((PyMachine*)type->tp_alloc(type, 0));
+
+        ret->machine = machine->machine->clone();
+
+        return ret.releasePy();
+    } CATCH()
+}
+
+static
+PyObject *PyMachine_deepcopy(PyObject *raw, PyObject *args)
+{
+    PyObject *memo;
+    if(!PyArg_ParseTuple(args, "O", &memo))
+        return NULL;
+    return PyMachine_clone(raw, NULL);
+}
+
 static
 Py_ssize_t PyMachine_len(PyObject *raw)
 {
@@ -207,13 +1096,155 @@ Py_ssize_t PyMachine_len(PyObject *raw)
     }CATCH1(-1)
 }
 
+static
+PyObject *PyMachine_conf(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        const Machine& M = *machine->machine;
+        std::auto_ptr<Config> C(new Config(M.conf()));
+
+        // current element configurations, which may have been changed by reconfigure()
+        Config::vector_t elements(M.size());
+        for(size_t i=0, N=M.size(); i<N; i++)
+            elements[i] = M.elementConf(i); // doesn't build a lazy Element
+        C->swap<Config::vector_t>("elements", elements);
+
+        return wrapconfig(C.release());
+    } CATCH()
+}
+
+static
+PyObject *PyMachine_reduce(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        PyRef<> conf(PyMachine_conf((PyObject*)machine, NULL));
+        return Py_BuildValue("(O(O))", (PyObject*)Py_TYPE(machine), conf.py());
+    } CATCH()
+}
+
 static PyMethodDef PyMachine_methods[] = {
+    {"conf", (PyCFunction)&PyMachine_conf, METH_NOARGS,
+     "Return the Config of this Machine, including changes made by reconfigure()"},
+    {"__reduce__", (PyCFunction)&PyMachine_reduce, METH_NOARGS,
+     "Pickle support.  The Machine is re-created from conf()"},
     {"allocState", (PyCFunction)&PyMachine_allocState, METH_VARARGS|METH_KEYWORDS,
      "Allocate a new State based on this Machine's configuration"},
+    {"state_pool", (PyCFunction)&PyMachine_statePool, METH_VARARGS|METH_KEYWORDS,
+     "state_pool(count, config={})\n"
+     "Allocate 'count' States for re-use.\n"
+     "pool.get() returns a State with the initial values given by 'config'.\n"
+     "pool.put(state) makes a State available to be returned by a later get()."},
     {"propagate", (PyCFunction)&PyMachine_propagate, METH_VARARGS|METH_KEYWORDS,
      "Propagate the provided State through the simulation"},
+    {"match", (PyCFunction)&PyMachine_match, METH_VARARGS|METH_KEYWORDS,
+     "match(state, knobs, targets, weights=None, maxiter=100, tol=1e-10) -> dict\n"
+     "Adjust element parameters so that propagating 'state' gives the target moments.\n"
+     "'knobs' is a sequence of (index, 'param').  Starting values are the current element parameters.\n"
+     "'targets' is a sequence of (index, (row, col), value) for the state matrix\n"
+     "or (index, row, value) for moment0, taken after element 'index'.\n"
+     "The residual of each target is weights[k]*(actual-value).\n"
+     "Uses the Levenberg-Marquardt method with derivatives from sensitivity().\n"
+     "The Machine is left reconfigured with the best values found, 'state' is not changed.\n"
+     "Returns {'x':values, 'cost':sum(residual**2), 'iterations':N}"},
+    {"propagate_errors", (PyCFunction)&PyMachine_propagateErrors, METH_VARARGS|METH_KEYWORDS,
+     "propagate_errors(state, errors, nseeds, observe=None, seed=0, threads=1) -> (state, moment0, deltas)\n"
+     "Propagate a MomentMatrix State through 'nseeds' copies of this Machine with random errors.\n"
+     "'errors' is a sequence of (index, 'param', sigma[, 'normal'|'uniform'[, relative]]).\n"
+     "A 'uniform' error is in [-sigma, sigma].  A relative error is scaled by the parameter value.\n"
+     "'observe' is a list of element indicies after which the state is recorded,\n"
+     "by default the last element.  Seeds are divided between 'threads' threads.\n"
+     "Returns arrays of shape [len(observe), nseeds, 7, 7], [len(observe), nseeds, 7],\n"
+     "and the parameter changes [nseeds, len(errors)].  This Machine is not changed."},
+    {"set_profile", (PyCFunction)&PyMachine_setProfile, METH_VARARGS|METH_KEYWORDS,
+     "set_profile(enable=True)\n"
+     "Enable (and reset) or disable counting and timing of each element by propagate()."},
+    {"reset_profile", (PyCFunction)&PyMachine_resetProfile, METH_NOARGS,
+     "Zero the profiling counters"},
+    {"profile", (PyCFunction)&PyMachine_profile, METH_VARARGS|METH_KEYWORDS,
+     "profile(by='element') -> numpy.ndarray\n"
+     "Profiling counters as a structured array, or None if profiling is not enabled.\n"
+     "by='element' has one row for each element, with fields\n"
+     "'index', 'name', 'type', 'calls', 'nsec', and 'builds' (re-builds by reconfigure()).\n"
+     "by='type' has one row for each element type, most time first,\n"
+     "with fields 'type', 'elements', 'calls', 'nsec', and 'builds'.\n"
+     "by='machine' has one row with 'propagations', 'states' (allocated by allocState()),\n"
+     "'elements' (built by buildElement()), and 'nsec'."},
+    {"set_history", (PyCFunction)&PyMachine_setHistory, METH_VARARGS|METH_KEYWORDS,
+     "set_history(depth=1000, check_finite=False, dump=None)\n"
+     "Record the 'depth' most recent States of propagate() in a ring buffer.  depth=0 stops recording.\n"
+     "With check_finite=True, propagate() raises FloatingPointError after the first element\n"
+     "which leaves a NaN or Inf in the State.\n"
+     "If 'dump' is a file name, the history is written to it when propagate() raises an exception.\n"
+     "See uscsi.history.load_history()."},
+    {"history", (PyCFunction)&PyMachine_history, METH_NOARGS,
+     "history() -> numpy.ndarray\n"
+     "The recorded history, oldest first, as a structured array, or None if not recording.\n"
+     "Fields are 'index' (the element index) and State values (eg. 'IonEk', 'moment0', 'state')."},
+    {"dump_history", (PyCFunction)&PyMachine_dumpHistory, METH_VARARGS|METH_KEYWORDS,
+     "dump_history(filename)\n"
+     "Write the recorded history to a binary file.  See uscsi.history.load_history()."},
+    {"beam_stats", (PyCFunction)&PyMachine_beamStats, METH_VARARGS|METH_KEYWORDS,
+     "beam_stats(states, weights=None, observe=None, out=None) -> dict\n"
+     "Propagate each MomentMatrix State (eg. one for each charge state) and compute\n"
+     "weighted statistics of all states after each element in 'observe' (default the last element).\n"
+     "'weights' is the charge of each state (default 1).\n"
+     "Returns arrays 'centroid' [len(observe), 7], 'moment2' [len(observe), 7, 7],\n"
+     "'rms' [len(observe), 6], and 'emittance' [len(observe), 3].\n"
+     "If 'out' is a dict holding arrays of these shapes, they are filled in instead of allocated."},
+    {"sample", (PyCFunction)&PyMachine_sample, METH_VARARGS|METH_KEYWORDS,
+     "sample(state, s=None, step=None, out=None) -> dict\n"
+     "Propagate a MomentMatrix State through the whole Machine, and record it at positions along the lattice,\n"
+     "either the array 's' [m] (in increasing order), or every 'step' [m] from 0 to the end.\n"
+     "Inside drift, sbend, quadrupole, and solenoid elements the state is computed\n"
+     "with the transfer matrix of the partial length, so thick elements need not be sliced.\n"
+     "Inside other elements the sample is taken at the element exit.\n"
+     "Returns arrays 's' (actual positions) [N], 'index' (element containing each position) [N],\n"
+     "'moment0' [N, 7], and 'state' [N, 7, 7].\n"
+     "If 'out' is a dict holding 'moment0' and/or 'state' arrays of these shapes, they are filled in instead of allocated."},
+    {"phase_cavities", (PyCFunction)&PyMachine_phaseCavities, METH_VARARGS|METH_KEYWORDS,
+     "phase_cavities(state, fieldmaps, nphase=360) -> dict\n"
+     "Find the phase setting of each rfcavity, in order, for the reference particle of 'state'\n"
+     "(IonZ, IonEs, IonW at the entrance of the first element).\n"
+     "'fieldmaps' maps each \"cavtype\" to an [N,2] array of (s [mm], Elong [V/m]).\n"
+     "Each cavity is scanned over 'nphase' input phases to find the crest,\n"
+     "and set to \"phi\" [deg] from the crest.\n"
+     "Returns arrays 'index', 'phase' (setting) [rad], 'crest' [rad], 'FyAbs' (arrival phase) [rad],\n"
+     "'IonW_in' and 'IonW_out' [eV/u], one entry for each cavity.  This Machine is not changed."},
+    {"propagate_nogil", (PyCFunction)&PyMachine_propagateNoGIL, METH_VARARGS|METH_KEYWORDS,
+     "propagate_nogil(state, start=0, max=-1, observe=None, cancel=None) -> ([(index, State), ...], cancelled)\n"
+     "As propagate(), with the GIL released so that other threads may run, including other\n"
+     "propagate_nogil() calls on this Machine with different States.\n"
+     "Observers, profiling, and history are not used.  'observe' is a list of element indicies.\n"
+     "If 'cancel' is a writable buffer (eg. bytearray(1)), propagation stops before the next element\n"
+     "once its first byte is made non-zero, and 'cancelled' is True.\n"
+     "An Ensemble State is only checked for cancellation at observed elements.\n"
+     "See uscsi.aio for asyncio coroutines."},
+    {"propagate_async", (PyCFunction)&PyMachine_propagateAsync, METH_VARARGS|METH_KEYWORDS,
+     "propagate_async(state, start=0, max=-1, observe=None, executor=None) -> awaitable\n"
+     "asyncio version of propagate().  See uscsi.aio.propagate_async()"},
+    {"propagate_many_async", (PyCFunction)&PyMachine_propagateManyAsync, METH_VARARGS|METH_KEYWORDS,
+     "propagate_many_async(states, start=0, max=-1, observe=None, executor=None) -> awaitable\n"
+     "Propagate several States concurrently.  See uscsi.aio.propagate_many_async()"},
+    {"sensitivity", (PyCFunction)&PyMachine_sensitivity, METH_VARARGS|METH_KEYWORDS,
+     "sensitivity(state, knobs, observe=None) -> (dstate, dmoment0)\n"
+     "Propagate a MomentMatrix State, and return derivatives of the state\n"
+     "and moment0 with respect to element parameters.\n"
+     "'knobs' is a list of (element index, parameter name).\n"
+     "'observe' is a list of element indicies after which derivatives are recorded,\n"
+     "by default the last element.\n"
+     "dstate has shape [len(observe), len(knobs), 7, 7], and dmoment0 [len(observe), len(knobs), 7]"},
     {"reconfigure", (PyCFunction)&PyMachine_reconfigure, METH_VARARGS|METH_KEYWORDS,
      "Change the configuration of an element."},
+    {"is_built", (PyCFunction)&PyMachine_is_built, METH_VARARGS,
+     "is_built(index) -> bool\n"
+     "Whether an element has been built.  Always True unless constructed with lazy=True."},
+    {"clone", (PyCFunction)&PyMachine_clone, METH_NOARGS,
+     "Return an independent copy of this Machine.\n"
+     "Elements are copied directly instead of being rebuilt from their Config."},
+    {"__copy__", (PyCFunction)&PyMachine_clone, METH_NOARGS,
+     "Same as clone()"},
+    {"__deepcopy__", (PyCFunction)&PyMachine_deepcopy, METH_VARARGS,
+     "Same as clone()"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -241,8 +1272,24 @@ static const char pymdoc[] =
         "based on a Config provided when it was constructed.\n"
         "\n"
         "See the allocState and propagate methods.\n"
+        "\n"
+        "Machine(config, lazy=False, nthreads=0)\n"
+        "\n"
+        "With lazy=True, each element is built when first used (eg. by propagate()),\n"
+        "so propagating through part of a long lattice only builds that part.\n"
+        "Otherwise all elements are built immediately, by 'nthreads' threads.\n"
+        "The default (0) selects a number of threads based on the lattice length\n"
+        "and number of CPUs.\n"
         ;
 
+Machine* unwrapmachine(PyObject *raw)
+{
+    if(!PyObject_TypeCheck(raw, &PyMachineType))
+        throw std::invalid_argument("Argument is not a Machine");
+    PyMachine *machine = (PyMachine*)raw;
+    return machine->machine;
+}
+
 int registerModMachine(PyObject *mod)
 {
     PyMachineType.tp_doc = pymdoc;
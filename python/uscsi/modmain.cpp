@@ -15,6 +15,18 @@ PyMethodDef modmethods[] = {
      "Parse a GLPS lattice file to AST form"},
     {"GLPSPrinter", (PyCFunction)&PyGLPSPrint, METH_VARARGS,
      "Print a GLPS AST to string"},
+    {"_TLMLoad", (PyCFunction)&PyTLMLoad, METH_VARARGS|METH_KEYWORDS,
+     "_TLMLoad(filename, vars=None, number_names=True) -> Config\n"
+     "Read a TLM flat file"},
+    {"_StateLoad", (PyCFunction)&PyStateLoad, METH_VARARGS,
+     "Re-create a pickled State"},
+    {"_cavity_boost", (PyCFunction)&PyCavityBoost, METH_VARARGS|METH_KEYWORDS,
+     "_cavity_boost(fieldmap, f, IonZ, IonEs, IonW, phase, scale) -> (IonW, IonFy)\n"
+     "Energy gain and exit phase of a RF cavity for each input phase and field scale"},
+    {"_stripper", (PyCFunction)&PyStripper, METH_VARARGS|METH_KEYWORDS,
+     "_stripper(config, IonEs, IonEk, thickness, variation) -> dict\n"
+     "Evaluate the charge stripper model for each (IonEk, thickness, variation).\n"
+     "thickness and variation may be None to use the values from config."},
     {NULL, NULL, 0, NULL}
 };
 
@@ -40,6 +52,11 @@ init_internal(void)
         if (_import_array() < 0)
             throw std::runtime_error("Failed to import numpy");
 
+#if PY_VERSION_HEX < 0x03070000
+        // Machine.propagate_nogil() releases the GIL.  (always initialized from 3.7)
+        PyEval_InitThreads();
+#endif
+
 #if PY_MAJOR_VERSION >= 3
         // w/ py3 we own the module object and return NULL on import failure
         PyRef<> modref(PyModule_Create(&module));
@@ -50,10 +67,14 @@ init_internal(void)
         PyObject *mod = Py_InitModule("uscsi._internal", modmethods);
 #endif
 
+        if(registerModConfig(mod))
+            throw std::runtime_error("Failed to initialize Config");
         if(registerModMachine(mod))
             throw std::runtime_error("Failed to initialize Machine");
         if(registerModState(mod))
             throw std::runtime_error("Failed to initialize State");
+        if(registerModLinac(mod))
+            throw std::runtime_error("Failed to initialize LinacContext");
 
         // add States and Elements
         registerLinear();
@@ -0,0 +1,61 @@
+#include <algorithm>
+
+#include "scsi/rfcavity.h"
+#include "pyscsi.h"
+
+#define NO_IMPORT_ARRAY
+#define PY_ARRAY_UNIQUE_SYMBOL USCSI_PyArray_API
+#include <numpy/ndarrayobject.h>
+
+void py2fieldmap(CavityFieldMap& map, PyObject *obj)
+{
+    PyRef<> arr(PyArray_FromAny(obj, PyArray_DescrFromType(NPY_DOUBLE), 2, 2,
+                                NPY_ARRAY_CARRAY_RO, NULL));
+    PyArrayObject *A = (PyArrayObject*)arr.py();
+    if(PyArray_DIM(A, 1)!=2 || PyArray_DIM(A, 0)<2)
+        throw std::invalid_argument("Field map must have shape [N,2] with N>=2");
+
+    const size_t N = PyArray_DIM(A, 0);
+    const double *data = (const double*)PyArray_DATA(A);
+    map.s.resize(N);
+    map.Elong.resize(N);
+    for(size_t i=0; i<N; i++) {
+        map.s[i] = data[2*i];
+        map.Elong[i] = data[2*i+1];
+    }
+}
+
+PyObject* PyCavityBoost(PyObject *, PyObject *args, PyObject *kws)
+{
+    try {
+        PyObject *pymap, *pyphase, *pyscale;
+        double fRF, IonZ, IonEs, IonW;
+        const char *pnames[] = {"fieldmap", "f", "IonZ", "IonEs", "IonW", "phase", "scale", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "OddddOO", (char**)pnames,
+                                        &pymap, &fRF, &IonZ, &IonEs, &IonW, &pyphase, &pyscale))
+            return NULL;
+
+        CavityFieldMap map;
+        py2fieldmap(map, pymap);
+
+        PyRef<> phase(PyArray_FromAny(pyphase, PyArray_DescrFromType(NPY_DOUBLE), 1, 1,
+                                      NPY_ARRAY_CARRAY_RO, NULL)),
+                scale(PyArray_FromAny(pyscale, PyArray_DescrFromType(NPY_DOUBLE), 1, 1,
+                                      NPY_ARRAY_CARRAY_RO, NULL));
+        npy_intp dims[] = {PyArray_DIM((PyArrayObject*)phase.py(), 0)};
+        if(PyArray_DIM((PyArrayObject*)scale.py(), 0)!=dims[0])
+            return PyErr_Format(PyExc_ValueError, "phase and scale must have the same length");
+
+        PyRef<> W(PyArray_ZEROS(1, dims, NPY_DOUBLE, 0)),
+                Fy(PyArray_ZEROS(1, dims, NPY_DOUBLE, 0));
+
+        cavityBoost(map, fRF, IonZ, IonEs, IonW, dims[0],
+                    (const double*)PyArray_DATA((PyArrayObject*)phase.py()),
+                    (const double*)PyArray_DATA((PyArrayObject*)scale.py()),
+                    (double*)PyArray_DATA((PyArrayObject*)W.py()),
+                    (double*)PyArray_DATA((PyArrayObject*)Fy.py()));
+
+        return Py_BuildValue("(OO)", W.py(), Fy.py());
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
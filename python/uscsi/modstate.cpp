@@ -1,8 +1,11 @@
 
 #include <string>
 #include <sstream>
+#include <vector>
+#include <typeinfo>
 
 #include "scsi/base.h"
+#include "scsi/ensemble.h"
 #include "pyscsi.h"
 
 #define NO_IMPORT_ARRAY
@@ -25,15 +28,39 @@ struct PyState {
     PyObject_HEAD
     PyObject *dict, *weak; //  __dict__ and __weakref__
     PyObject *attrs; // lookup name to attribute index (for StateBase)
+    PyObject *views; // list of cached ndarray for each attribute index, or None
+    PyObject *simtype; // name of simulation type (str)
+    PyObject *owner; // capsule which owns 'state', and is the base of the ndarray views
     StateBase *state;
+    // attribute information for each index.
+    // StateBase guarantees that storage is stable.
+    std::vector<StateBase::ArrayInfo> *infos;
+    size_t npacked; // number of double in packed representation
+    std::vector<double> *packed; // storage for buffer protocol, re-used when not exported
+    unsigned nexports; // number of buffers exported from 'packed'
 };
 
+#define OWNER_NAME "uscsi.StateBase"
+
+static
+void PyState_owner_free(PyObject *cap)
+{
+    delete (StateBase*)PyCapsule_GetPointer(cap, OWNER_NAME);
+}
+
+static
+void PyState_packed_free(PyObject *cap)
+{
+    delete (std::vector<double>*)PyCapsule_GetPointer(cap, NULL);
+}
+
 static
 int PyState_traverse(PyObject *raw, visitproc visit, void *arg)
 {
     PyState *state = (PyState*)raw;
     Py_VISIT(state->attrs);
     Py_VISIT(state->dict);
+    Py_VISIT(state->views);
     return 0;
 }
 
@@ -43,6 +70,7 @@ int PyState_clear(PyObject *raw)
     PyState *state = (PyState*)raw;
     Py_CLEAR(state->dict);
     Py_CLEAR(state->attrs);
+    Py_CLEAR(state->views);
     return 0;
 }
 
@@ -50,13 +78,21 @@ static
 void PyState_free(PyObject *raw)
 {
     TRY {
-        std::auto_ptr<StateBase> S(state->state);
+        // the StateBase is deleted with the owner, once no views remain
         state->state = NULL;
+        std::auto_ptr<std::vector<StateBase::ArrayInfo> > I(state->infos);
+        state->infos = NULL;
+        std::auto_ptr<std::vector<double> > P(state->packed);
+        state->packed = NULL;
+        Py_CLEAR(state->simtype);
+
+        PyObject_GC_UnTrack(raw);
 
         if(state->weak)
             PyObject_ClearWeakRefs(raw);
 
         PyState_clear(raw);
+        Py_CLEAR(state->owner);
 
         Py_TYPE(raw)->tp_free(raw);
     } CATCH2V(std::exception, RuntimeError)
@@ -68,14 +104,16 @@ PyObject *PyState_getattro(PyObject *raw, PyObject *attr)
     TRY {
         PyObject *idx = PyDict_GetItem(state->attrs, attr);
         if(!idx)
-            return NULL;
-        int i = PyInt_AsLong(idx);
+            return PyObject_GenericGetAttr(raw, attr);
+        Py_ssize_t i = PyInt_AsLong(idx);
 
+        PyObject *cached = PyList_GET_ITEM(state->views, i);
+        if(cached!=Py_None) {
+            Py_INCREF(cached);
+            return cached;
+        }
 
-        StateBase::ArrayInfo info;
-
-        if(!state->state->getArray(i, info))
-            return PyErr_Format(PyExc_AttributeError, "invalid attribute name");
+        const StateBase::ArrayInfo& info = (*state->infos)[i];
 
         if(info.ndim==0) { // Scalar
             switch(info.type) {
@@ -96,12 +134,17 @@ PyObject *PyState_getattro(PyObject *raw, PyObject *attr)
         }
 
         npy_intp dims[5];
-        memcpy(dims, info.dim, sizeof(dims));
+        std::copy(info.dim, info.dim+info.ndim, dims);
 
         PyRef<> obj(PyArray_SimpleNewFromData(info.ndim, dims, pytype, info.ptr));
 
-        Py_INCREF(state);
-        PyArray_BASE(obj.py()) = (PyObject*)state;
+        // the view keeps the storage alive, but not this State
+        Py_INCREF(state->owner);
+        PyArray_BASE(obj.py()) = state->owner;
+
+        // cache the view for subsequent access
+        Py_INCREF(obj.py());
+        PyList_SetItem(state->views, i, obj.py());
 
         return obj.releasePy();
     } CATCH()
@@ -113,15 +156,10 @@ int PyState_setattro(PyObject *raw, PyObject *attr, PyObject *val)
     TRY {
         PyObject *idx = PyDict_GetItem(state->attrs, attr);
         if(!idx)
-            return -1;
-        int i = PyInt_AsLong(idx);
-
-        StateBase::ArrayInfo info;
+            return PyObject_GenericSetAttr(raw, attr, val);
+        Py_ssize_t i = PyInt_AsLong(idx);
 
-        if(!state->state->getArray(i, info)) {
-            PyErr_SetString(PyExc_AttributeError, "invalid attribute name");
-            return -1;
-        }
+        const StateBase::ArrayInfo& info = (*state->infos)[i];
 
         if(info.ndim!=0) {
             PyErr_SetString(PyExc_NotImplementedError, "Can't set array attributes (hint, use state.attr[:] = ...)");
@@ -171,10 +209,277 @@ PyObject* PyState_str(PyObject *raw)
     } CATCH()
 }
 
+static
+size_t infocount(const StateBase::ArrayInfo& info)
+{
+    size_t N = 1;
+    for(int d=0; d<info.ndim; d++)
+        N *= info.dim[d];
+    return N;
+}
+
+// Copy all double attributes to/from a packed array
+static
+void PyState_pack(PyState *state, double *out)
+{
+    for(size_t i=0, N=state->infos->size(); i<N; i++) {
+        const StateBase::ArrayInfo& info = (*state->infos)[i];
+        if(info.type!=StateBase::ArrayInfo::Double)
+            continue;
+        const double *ptr = (const double*)info.ptr;
+        size_t cnt = infocount(info);
+        std::copy(ptr, ptr+cnt, out);
+        out += cnt;
+    }
+}
+
+static
+void PyState_unpack(PyState *state, const double *in)
+{
+    for(size_t i=0, N=state->infos->size(); i<N; i++) {
+        const StateBase::ArrayInfo& info = (*state->infos)[i];
+        if(info.type!=StateBase::ArrayInfo::Double)
+            continue;
+        size_t cnt = infocount(info);
+        std::copy(in, in+cnt, (double*)info.ptr);
+        in += cnt;
+    }
+}
+
+static
+int PyState_getbuffer(PyObject *raw, Py_buffer *view, int flags)
+{
+    TRY {
+        if(flags&PyBUF_WRITABLE) {
+            PyErr_SetString(PyExc_BufferError, "State buffer is a read-only copy.  Use from_array() to change");
+            return -1;
+        }
+
+        // A snapshot of the current values.  Re-use our storage unless an earlier
+        // export still refers to it, in which case the snapshot gets its own owner.
+        PyRef<> owner;
+        std::vector<double> *packed;
+        if(state->nexports==0) {
+            if(!state->packed)
+                state->packed = new std::vector<double>(state->npacked);
+            packed = state->packed;
+            Py_INCREF(raw);
+            owner.reset(raw);
+        } else {
+            std::auto_ptr<std::vector<double> > P(new std::vector<double>(state->npacked));
+            owner.reset(PyCapsule_New(P.get(), NULL, &PyState_packed_free));
+            packed = P.release();
+        }
+        double *buf = packed->empty() ? NULL : &(*packed)[0];
+        PyState_pack(state, buf);
+
+        if(PyBuffer_FillInfo(view, owner.py(), buf, state->npacked*sizeof(double), 1, flags))
+            return -1;
+        if(owner.py()==raw)
+            state->nexports++;
+        if(flags&PyBUF_FORMAT)
+            view->format = (char*)"d";
+        view->itemsize = sizeof(double);
+        if(flags&PyBUF_ND)
+            view->shape = (Py_ssize_t*)&state->npacked; // size_t and Py_ssize_t have the same size
+
+        return 0;
+    } CATCH3(std::exception, BufferError, -1)
+}
+
+static
+void PyState_releasebuffer(PyObject *raw, Py_buffer *view)
+{
+    PyState *state = (PyState*)raw;
+    state->nexports--;
+}
+
+// fetch a contiguous double array of the packed size
+static
+PyObject* PyState_packarray(PyState *state, PyObject *arr, bool writable)
+{
+    int flags = NPY_ARRAY_C_CONTIGUOUS|NPY_ARRAY_ALIGNED;
+    if(writable)
+        flags |= NPY_ARRAY_WRITEABLE;
+    if(!PyArray_Check(arr) || PyArray_TYPE((PyArrayObject*)arr)!=NPY_DOUBLE
+            || !PyArray_CHKFLAGS((PyArrayObject*)arr, flags))
+    {
+        if(writable)
+            return PyErr_Format(PyExc_ValueError, "out= must be a writable, contiguous, float64 ndarray");
+        arr = PyArray_FROMANY(arr, NPY_DOUBLE, 0, 0, flags);
+        if(!arr)
+            return NULL;
+    } else {
+        Py_INCREF(arr);
+    }
+    PyRef<> ret(arr);
+
+    if((size_t)PyArray_SIZE((PyArrayObject*)arr)!=state->npacked)
+        return PyErr_Format(PyExc_ValueError, "array size %lu must be %lu",
+                            (unsigned long)PyArray_SIZE((PyArrayObject*)arr),
+                            (unsigned long)state->npacked);
+    return ret.release();
+}
+
+static
+PyObject* PyState_to_array(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *out = Py_None;
+        const char *pnames[] = {"out", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "|O", (char**)pnames, &out))
+            return NULL;
+
+        PyRef<> arr;
+        if(out==Py_None) {
+            npy_intp dims[] = {(npy_intp)state->npacked};
+            arr.reset(PyArray_SimpleNew(1, dims, NPY_DOUBLE));
+        } else {
+            arr.reset(PyState_packarray(state, out, true));
+        }
+
+        PyState_pack(state, (double*)PyArray_DATA((PyArrayObject*)arr.py()));
+
+        return arr.release();
+    } CATCH()
+}
+
+static
+PyObject* PyState_from_array(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *in;
+        const char *pnames[] = {"array", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "O", (char**)pnames, &in))
+            return NULL;
+
+        PyRef<> arr(PyState_packarray(state, in, false));
+
+        PyState_unpack(state, (const double*)PyArray_DATA((PyArrayObject*)arr.py()));
+
+        Py_RETURN_NONE;
+    } CATCH()
+}
+
+static
+PyObject* PyState_array_layout(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        PyRef<> ret(PyList_New(0));
+        size_t offset = 0;
+
+        for(size_t i=0, N=state->infos->size(); i<N; i++) {
+            const StateBase::ArrayInfo& info = (*state->infos)[i];
+            if(info.type!=StateBase::ArrayInfo::Double)
+                continue;
+
+            PyRef<> shape(PyTuple_New(info.ndim));
+            for(int d=0; d<info.ndim; d++)
+                PyTuple_SET_ITEM(shape.py(), d, PyInt_FromSize_t(info.dim[d]));
+
+            PyRef<> ent(Py_BuildValue("(skO)", info.name.c_str(), (unsigned long)offset, shape.py()));
+            if(PyList_Append(ret.py(), ent.py()))
+                return NULL;
+
+            offset += infocount(info);
+        }
+
+        return ret.release();
+    } CATCH()
+}
+
+static
+PyObject* PyState_assign(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *other;
+        const char *pnames[] = {"other", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "O", (char**)pnames, &other))
+            return NULL;
+
+        state->state->assign(*unwrapstate(other));
+
+        Py_RETURN_NONE;
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static
+PyObject* PyState_reset(PyObject *raw, PyObject *args, PyObject *kws)
+{
+    TRY {
+        PyObject *conf;
+        const char *pnames[] = {"config", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "O", (char**)pnames, &conf))
+            return NULL;
+
+        if(const Config *other = unwrapconfig(conf)) {
+            state->state->reset(*other);
+        } else {
+            std::auto_ptr<Config> C(dict2conf(conf));
+            state->state->reset(*C);
+        }
+
+        Py_RETURN_NONE;
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static
+PyObject* PyState_getstate(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        PyRef<> ret(PyBytes_FromStringAndSize(NULL, state->npacked*sizeof(double)));
+        PyState_pack(state, (double*)PyBytes_AS_STRING(ret.py()));
+        return ret.release();
+    } CATCH()
+}
+
+static
+PyObject* PyState_reduce(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        PyRef<> mod(PyImport_ImportModule("uscsi._internal"));
+        PyRef<> load(PyObject_GetAttrString(mod.py(), "_StateLoad"));
+        PyRef<> data(PyState_getstate(raw, NULL));
+
+        // the number of particles must be known before the data can be restored
+        if(EnsembleState *ES = dynamic_cast<EnsembleState*>(state->state))
+            return Py_BuildValue("(O(OO{sd}))", load.py(), state->simtype, data.py(),
+                                 "count", (double)ES->count());
+
+        return Py_BuildValue("(O(OO))", load.py(), state->simtype, data.py());
+    } CATCH()
+}
+
 static PyMethodDef PyState_methods[] = {
+    {"__getstate__", (PyCFunction)&PyState_getstate, METH_NOARGS,
+     "Values of all float attributes as bytes (see array_layout() )"},
+    {"__reduce__", (PyCFunction)&PyState_reduce, METH_NOARGS,
+     "Pickle support"},
+    {"assign", (PyCFunction)&PyState_assign, METH_VARARGS|METH_KEYWORDS,
+     "assign(other)\n"
+     "Copy the values of another State of the same type into this State"},
+    {"reset", (PyCFunction)&PyState_reset, METH_VARARGS|METH_KEYWORDS,
+     "reset(config)\n"
+     "Re-initialize from a dict or Config, as if newly allocated by Machine.allocState()"},
+    {"to_array", (PyCFunction)&PyState_to_array, METH_VARARGS|METH_KEYWORDS,
+     "to_array(out=None)\n"
+     "Copy all float attributes into a 1-d array, which is returned.\n"
+     "If 'out' is given, it must be a contiguous float64 ndarray of the correct size.\n"
+     "See array_layout()."},
+    {"from_array", (PyCFunction)&PyState_from_array, METH_VARARGS|METH_KEYWORDS,
+     "from_array(array)\n"
+     "Copy all float attributes from a 1-d array (inverse of to_array() )"},
+    {"array_layout", (PyCFunction)&PyState_array_layout, METH_NOARGS,
+     "array_layout() -> [(name, offset, shape), ...]\n"
+     "Describe where each float attribute is placed by to_array().\n"
+     "This is also the layout of the buffer interface."},
     {NULL, NULL, 0, NULL}
 };
 
+static PyBufferProcs PyState_buffer;
+
 static PyTypeObject PyStateType = {
 #if PY_MAJOR_VERSION >= 3
     PyVarObject_HEAD_INIT(NULL, 0)
@@ -186,16 +491,169 @@ static PyTypeObject PyStateType = {
     sizeof(PyState),
 };
 
+#undef TRY
+#define TRY PyStatePool *pool = (PyStatePool*)raw; try
+
+/* A list of States which are re-initialized from an initial State when re-used
+ */
+struct PyStatePool {
+    PyObject_HEAD
+    PyObject *initial; // State copied into each State handed out
+    PyObject *free; // list of States available for re-use
+};
+
+static
+int PyStatePool_traverse(PyObject *raw, visitproc visit, void *arg)
+{
+    PyStatePool *pool = (PyStatePool*)raw;
+    Py_VISIT(pool->initial);
+    Py_VISIT(pool->free);
+    return 0;
+}
+
+static
+int PyStatePool_clear(PyObject *raw)
+{
+    PyStatePool *pool = (PyStatePool*)raw;
+    Py_CLEAR(pool->initial);
+    Py_CLEAR(pool->free);
+    return 0;
+}
+
+static
+void PyStatePool_free(PyObject *raw)
+{
+    PyObject_GC_UnTrack(raw);
+    PyStatePool_clear(raw);
+    Py_TYPE(raw)->tp_free(raw);
+}
+
+static
+PyObject* PyStatePool_clone(PyStatePool *pool)
+{
+    std::auto_ptr<StateBase> S(unwrapstate(pool->initial)->clone());
+    PyObject *ret = wrapstate(S.get(), ((PyState*)pool->initial)->simtype);
+    if(ret)
+        S.release();
+    return ret;
+}
+
+static
+PyObject* PyStatePool_get(PyObject *raw, PyObject *unused)
+{
+    TRY {
+        Py_ssize_t N = PyList_GET_SIZE(pool->free);
+        if(N==0)
+            return PyStatePool_clone(pool);
+
+        PyRef<> ret(PyList_GET_ITEM(pool->free, N-1));
+        Py_INCREF(ret.py());
+        if(PyList_SetSlice(pool->free, N-1, N, NULL))
+            return NULL;
+
+        unwrapstate(ret.py())->assign(*unwrapstate(pool->initial));
+
+        return ret.release();
+    } CATCH()
+}
+
+static
+PyObject* PyStatePool_put(PyObject *raw, PyObject *args)
+{
+    TRY {
+        PyObject *S;
+        if(!PyArg_ParseTuple(args, "O", &S))
+            return NULL;
+
+        if(typeid(*unwrapstate(S))!=typeid(*unwrapstate(pool->initial)))
+            return PyErr_Format(PyExc_ValueError, "State type does not match this pool");
+
+        if(PyList_Append(pool->free, S))
+            return NULL;
+
+        Py_RETURN_NONE;
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
+
+static
+Py_ssize_t PyStatePool_len(PyObject *raw)
+{
+    PyStatePool *pool = (PyStatePool*)raw;
+    return PyList_GET_SIZE(pool->free);
+}
+
+static PyMethodDef PyStatePool_methods[] = {
+    {"get", (PyCFunction)&PyStatePool_get, METH_NOARGS,
+     "Return a State with initial values, re-using a State returned by put() if possible."},
+    {"put", (PyCFunction)&PyStatePool_put, METH_VARARGS,
+     "put(state)\n"
+     "Return a State to the pool for re-use.  It must not be used after this."},
+    {NULL, NULL, 0, NULL}
+};
+
+static PySequenceMethods PyStatePool_seq;
+
+static PyTypeObject PyStatePoolType = {
+#if PY_MAJOR_VERSION >= 3
+    PyVarObject_HEAD_INIT(NULL, 0)
+#else
+    PyObject_HEAD_INIT(NULL)
+    0,
+#endif
+    "uscsi._internal.StatePool",
+    sizeof(PyStatePool),
+};
+
+#undef TRY
+#define TRY PyState *state = (PyState*)raw; try
+
 } // namespace
 
-PyObject* wrapstate(StateBase* b)
+PyObject* wrapstatepool(PyObject *initial, size_t count)
+{
+    try {
+        unwrapstate(initial);
+
+        PyRef<PyStatePool> pool((PyStatePool*)PyStatePoolType.tp_alloc(&PyStatePoolType, 0));
+
+        Py_INCREF(initial);
+        pool->initial = initial;
+        pool->free = PyList_New(0);
+        if(!pool->free)
+            return NULL;
+
+        for(size_t i=0; i<count; i++) {
+            PyRef<> S(PyStatePool_clone(pool.as<PyStatePool>()));
+            if(PyList_Append(pool->free, S.py()))
+                return NULL;
+        }
+
+        return pool.releasePy();
+    } CATCH()
+}
+
+PyObject* wrapstate(StateBase* b, PyObject *simtype)
 {
     try {
 
         PyRef<PyState> state((PyState*)PyStateType.tp_alloc(&PyStateType, 0));
 
+        state->attrs = state->weak = state->dict = state->views = state->owner = 0;
+        state->state = NULL;
+        Py_INCREF(simtype);
+        state->simtype = simtype;
+        state->infos = NULL;
+        state->packed = NULL;
+        state->npacked = 0;
+        state->nexports = 0;
+
+        state->owner = PyCapsule_New(b, OWNER_NAME, &PyState_owner_free);
+        if(!state->owner)
+            return NULL;
         state->state = b;
-        state->attrs = state->weak = state->dict = 0;
+
+        state->infos = new std::vector<StateBase::ArrayInfo>();
 
         state->attrs = PyDict_New();
         if(!state->attrs)
@@ -212,6 +670,18 @@ PyObject* wrapstate(StateBase* b)
             if(PyDict_SetItemString(state->attrs, info.name.c_str(), name.py()))
                 throw std::runtime_error("Failed to insert into Dict");
 
+            if(info.type==StateBase::ArrayInfo::Double)
+                state->npacked += infocount(info);
+
+            state->infos->push_back(info);
+        }
+
+        state->views = PyList_New(state->infos->size());
+        if(!state->views)
+            return NULL;
+        for(size_t i=0, N=state->infos->size(); i<N; i++) {
+            Py_INCREF(Py_None);
+            PyList_SET_ITEM(state->views, i, Py_None);
         }
 
         return state.releasePy();
@@ -219,6 +689,45 @@ PyObject* wrapstate(StateBase* b)
 }
 
 
+PyObject* wrapstate(StateBase* b, const std::string& simtype)
+{
+    try {
+        PyRef<> name(PyString_FromString(simtype.c_str()));
+        return wrapstate(b, name.py());
+    } CATCH()
+}
+
+PyObject* PyStateLoad(PyObject *, PyObject *args)
+{
+    try {
+        const char *simtype, *buf;
+        Py_ssize_t blen;
+        PyObject *pyconf = NULL;
+        if(!PyArg_ParseTuple(args, "ss#|O!", &simtype, &buf, &blen, &PyDict_Type, &pyconf))
+            return NULL;
+
+        Config conf;
+        if(pyconf)
+            Dict2Config(conf, pyconf);
+        std::auto_ptr<StateBase> S(Machine::allocState(simtype, conf));
+        PyRef<> ret(wrapstate(S.get(), simtype));
+        S.release();
+
+        PyState *state = ret.as<PyState>();
+        if(size_t(blen)!=state->npacked*sizeof(double))
+            return PyErr_Format(PyExc_ValueError, "State data has wrong size");
+
+        // copy as 'buf' may not be aligned
+        std::vector<double> temp(state->npacked);
+        if(blen)
+            memcpy(&temp[0], buf, blen);
+        PyState_unpack(state, temp.empty() ? NULL : &temp[0]);
+
+        return ret.release();
+    } CATCH2(key_error, KeyError)
+      CATCH()
+}
+
 StateBase* unwrapstate(PyObject* raw)
 {
     if(!PyObject_TypeCheck(raw, &PyStateType))
@@ -242,8 +751,15 @@ int registerModState(PyObject *mod)
     PyStateType.tp_setattro = &PyState_setattro;
 
     PyStateType.tp_flags = Py_TPFLAGS_DEFAULT|Py_TPFLAGS_BASETYPE|Py_TPFLAGS_HAVE_GC;
+#if PY_MAJOR_VERSION < 3
+    PyStateType.tp_flags |= Py_TPFLAGS_HAVE_NEWBUFFER;
+#endif
     PyStateType.tp_methods = PyState_methods;
 
+    PyState_buffer.bf_getbuffer = &PyState_getbuffer;
+    PyState_buffer.bf_releasebuffer = &PyState_releasebuffer;
+    PyStateType.tp_as_buffer = &PyState_buffer;
+
     if(PyType_Ready(&PyStateType))
         return -1;
 
@@ -253,5 +769,23 @@ int registerModState(PyObject *mod)
         return -1;
     }
 
+    PyStatePoolType.tp_doc = "Re-usable States.  See Machine.state_pool()";
+    PyStatePoolType.tp_dealloc = &PyStatePool_free;
+    PyStatePoolType.tp_traverse = &PyStatePool_traverse;
+    PyStatePoolType.tp_clear = &PyStatePool_clear;
+    PyStatePoolType.tp_flags = Py_TPFLAGS_DEFAULT|Py_TPFLAGS_HAVE_GC;
+    PyStatePoolType.tp_methods = PyStatePool_methods;
+    PyStatePool_seq.sq_length = &PyStatePool_len;
+    PyStatePoolType.tp_as_sequence = &PyStatePool_seq;
+
+    if(PyType_Ready(&PyStatePoolType))
+        return -1;
+
+    Py_INCREF(&PyStatePoolType);
+    if(PyModule_AddObject(mod, "StatePool", (PyObject*)&PyStatePoolType)) {
+        Py_DECREF(&PyStatePoolType);
+        return -1;
+    }
+
     return 0;
 }
@@ -0,0 +1,58 @@
+#include <memory>
+
+#include "scsi/config.h"
+#include "scsi/stripper.h"
+#include "pyscsi.h"
+
+#define NO_IMPORT_ARRAY
+#define PY_ARRAY_UNIQUE_SYMBOL USCSI_PyArray_API
+#include <numpy/ndarrayobject.h>
+
+PyObject* PyStripper(PyObject *, PyObject *args, PyObject *kws)
+{
+    try {
+        PyObject *pyconf, *pyEk, *pythick, *pyvar;
+        double IonEs;
+        const char *pnames[] = {"config", "IonEs", "IonEk", "thickness", "variation", NULL};
+        if(!PyArg_ParseTupleAndKeywords(args, kws, "O!dOOO", (char**)pnames,
+                                        &PyDict_Type, &pyconf, &IonEs, &pyEk, &pythick, &pyvar))
+            return NULL;
+
+        std::auto_ptr<Config> conf(dict2conf(pyconf));
+        StripperModel model(*conf);
+
+        PyRef<> Ek(PyArray_FromAny(pyEk, PyArray_DescrFromType(NPY_DOUBLE), 1, 1,
+                                   NPY_ARRAY_CARRAY_RO, NULL)), thick, var;
+        npy_intp n = PyArray_DIM((PyArrayObject*)Ek.py(), 0);
+        // None selects the value from 'config'
+        if(pythick!=Py_None)
+            thick.reset(PyArray_FromAny(pythick, PyArray_DescrFromType(NPY_DOUBLE), 1, 1,
+                                        NPY_ARRAY_CARRAY_RO, NULL));
+        if(pyvar!=Py_None)
+            var.reset(PyArray_FromAny(pyvar, PyArray_DescrFromType(NPY_DOUBLE), 1, 1,
+                                      NPY_ARRAY_CARRAY_RO, NULL));
+        if((thick.py() && PyArray_DIM((PyArrayObject*)thick.py(), 0)!=n) ||
+           (var.py() && PyArray_DIM((PyArrayObject*)var.py(), 0)!=n))
+            return PyErr_Format(PyExc_ValueError, "IonEk, thickness, and variation must have the same length");
+
+        npy_intp dims[] = {n, (npy_intp)model.IonChargeStates.size()};
+        PyRef<> Ekout(PyArray_ZEROS(1, dims, NPY_DOUBLE, 0)),
+                sigma(PyArray_ZEROS(1, dims, NPY_DOUBLE, 0)),
+                frac(PyArray_ZEROS(2, dims, NPY_DOUBLE, 0)),
+                charges(PyArray_ZEROS(1, dims+1, NPY_DOUBLE, 0));
+
+        model.evaluate(n, IonEs,
+                       (const double*)PyArray_DATA((PyArrayObject*)Ek.py()),
+                       thick.py() ? (const double*)PyArray_DATA((PyArrayObject*)thick.py()) : NULL,
+                       var.py() ? (const double*)PyArray_DATA((PyArrayObject*)var.py()) : NULL,
+                       (double*)PyArray_DATA((PyArrayObject*)Ekout.py()),
+                       (double*)PyArray_DATA((PyArrayObject*)sigma.py()),
+                       (double*)PyArray_DATA((PyArrayObject*)frac.py()));
+        std::copy(model.IonChargeStates.begin(), model.IonChargeStates.end(),
+                  (double*)PyArray_DATA((PyArrayObject*)charges.py()));
+
+        return Py_BuildValue("{sOsOsOsOsd}", "IonEk", Ekout.py(), "sigma", sigma.py(),
+                             "fractions", frac.py(), "charges", charges.py(), "IonZ", model.IonZ);
+    } CATCH2(std::invalid_argument, ValueError)
+      CATCH()
+}
@@ -1,4 +1,5 @@
 #include <exception>
+#include <string>
 
 #ifndef PYSCSI_H
 #define PYSCSI_H
@@ -7,18 +8,36 @@
 
 struct Config;
 struct StateBase;
+struct Machine;
+struct CavityFieldMap;
 
 Config* dict2conf(PyObject *dict);
 void Dict2Config(Config& ret, PyObject *dict, unsigned depth=0);
+void Value2Config(Config& ret, const std::string& name, PyObject *value, unsigned depth=0);
 
-PyObject* wrapstate(StateBase*); // takes ownership of argument from caller
+PyObject* wrapconfig(Config*); // takes ownership of argument from caller
+const Config* unwrapconfig(PyObject*); // NULL if not a Config.  ownership remains with argument
+
+PyObject* wrapstate(StateBase*, const std::string& simtype); // takes ownership of argument from caller
+PyObject* wrapstate(StateBase*, PyObject *simtype); // simtype is a str, which is borrowed
 StateBase* unwrapstate(PyObject*); // ownership of returned pointer remains with argument
+PyObject* wrapstatepool(PyObject *initial, size_t count); // 'count' copies of State 'initial'
+
+Machine* unwrapmachine(PyObject*); // ownership remains with argument.  throws std::invalid_argument if not a Machine
 
 PyObject* PyGLPSPrint(PyObject *, PyObject *args);
 PyObject* PyGLPSParse(PyObject *, PyObject *args);
+PyObject* PyTLMLoad(PyObject *, PyObject *args, PyObject *kws);
+PyObject* PyStateLoad(PyObject *, PyObject *args);
+PyObject* PyCavityBoost(PyObject *, PyObject *args, PyObject *kws);
+PyObject* PyStripper(PyObject *, PyObject *args, PyObject *kws);
+
+void py2fieldmap(CavityFieldMap& map, PyObject *obj); // [N,2] array of (s, Elong)
 
+int registerModConfig(PyObject *mod);
 int registerModMachine(PyObject *mod);
 int registerModState(PyObject *mod);
+int registerModLinac(PyObject *mod);
 
 #define CATCH2V(CXX, PYEXC) catch(CXX& e) { if(!PyErr_Occurred()) PyErr_SetString(PyExc_##PYEXC, e.what()); return; }
 #define CATCH3(CXX, PYEXC, RET) catch(CXX& e) { if(!PyErr_Occurred()) PyErr_SetString(PyExc_##PYEXC, e.what()); return RET; }
@@ -29,6 +48,7 @@ int registerModState(PyObject *mod);
 #if PY_MAJOR_VERSION >= 3
 #define PyInt_Type PyLong_Type
 #define PyInt_Check PyLong_Check
+#define PyInt_CheckExact PyLong_CheckExact
 #define PyInt_FromLong PyLong_FromLong
 #define PyInt_FromSize_t PyLong_FromSize_t
 #define PyInt_AsLong PyLong_AsLong
@@ -93,4 +113,14 @@ private:
     PyRef& operator =(const PyRef&);
 };
 
+//! Release the GIL for the lifetime of this object
+struct PyUnlock {
+    PyThreadState *save;
+    PyUnlock() :save(PyEval_SaveThread()) {}
+    ~PyUnlock() { PyEval_RestoreThread(save); }
+private:
+    PyUnlock(const PyUnlock&);
+    PyUnlock& operator =(const PyUnlock&);
+};
+
 #endif // PYSCSI_H
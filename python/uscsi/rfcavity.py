@@ -0,0 +1,96 @@
+"""RF cavity phasing
+
+>>> from uscsi.rfcavity import load_fieldmap, cavity_boost, phase_cavities
+>>> maps = {'0.041QWR':load_fieldmap('axisData_41.txt'),
+...         '0.085QWR':load_fieldmap('axisData_85.txt')}
+>>> W, Fy = cavity_boost(maps['0.041QWR'], 80.5e6, numpy.linspace(-numpy.pi, numpy.pi, 361),
+...                      IonZ=0.138, IonEs=931.49432e6, IonW=931.49432e6+0.5e6)
+>>> R = phase_cavities(lattice, maps)
+>>> R['phase'] # phase setting of each cavity [rad]
+"""
+from __future__ import print_function
+
+import numpy
+
+from ._internal import _cavity_boost
+from .scan import _machine
+
+__all__ = ['load_fieldmap', 'cavity_boost', 'phase_cavities']
+
+def load_fieldmap(fname):
+    """Read a two column text file of on axis field (s [mm], Elong [V/m])
+
+    :returns: An array of shape [N,2]
+    """
+    return numpy.loadtxt(fname, dtype=numpy.float64, usecols=(0, 1), ndmin=2)
+
+def cavity_boost(fieldmap, f, phase, scale=1.0, IonZ=None, IonEs=None, IonW=None, state=None):
+    """Energy gain and exit phase of a RF cavity, for many input phases and field scales
+
+    All points are computed in a single pass over the field map.
+
+    :param fieldmap: An [N,2] array of (s [mm], Elong [V/m]), or a file name.
+    :param f: RF frequency [Hz]
+    :param phase: Input phase(s) [rad]
+    :param scale: Field scale factor(s) (aka. "scl_fac").  Broadcast with 'phase'.
+    :param IonZ: Charge to mass ratio.
+    :param IonEs: Rest energy [eV/u]
+    :param IonW: Total energy at the cavity entrance [eV/u]
+    :param state: IonZ, IonEs, and IonW are taken from this State when not given.
+    :returns: (IonW, IonFy), the total energy [eV/u] and phase [rad] at the exit,
+              with the broadcast shape of 'phase' and 'scale'.
+    """
+    if isinstance(fieldmap, (str, bytes)):
+        fieldmap = load_fieldmap(fieldmap)
+    if state is not None:
+        IonZ = state.IonZ if IonZ is None else IonZ
+        IonEs = state.IonEs if IonEs is None else IonEs
+        IonW = state.IonW if IonW is None else IonW
+    if None in (IonZ, IonEs, IonW):
+        raise ValueError("IonZ, IonEs, and IonW are required")
+
+    phase, scale = numpy.broadcast_arrays(numpy.asarray(phase, dtype=numpy.float64),
+                                          numpy.asarray(scale, dtype=numpy.float64))
+    shape = phase.shape
+    W, Fy = _cavity_boost(fieldmap, f, IonZ, IonEs, IonW,
+                          numpy.ascontiguousarray(phase).reshape(-1),
+                          numpy.ascontiguousarray(scale).reshape(-1))
+    return W.reshape(shape), Fy.reshape(shape)
+
+def phase_cavities(lattice, fieldmaps, config={}, nphase=360, IonZ=None):
+    """Phase all RF cavities of a lattice in order
+
+    The reference particle is taken from the source (the first element),
+    and propagated through each cavity once it is phased.
+
+    :param lattice: A Machine, Config, dict, or lattice file text.
+    :param fieldmaps: A dict of cavity type to field map, an [N,2] array or a file name.
+    :param config: Passed to Machine.allocState() to create the initial State.
+    :param nphase: Number of input phases scanned to find the crest of each cavity.
+    :param IonZ: Charge to mass ratio of the reference particle, if not set by the source.
+    :returns: A dict of arrays with one entry for each cavity
+
+              * 'index' and 'name' of the cavity element
+              * 'phase' The cavity phase setting [rad]
+              * 'crest' The input phase of maximum energy gain [rad]
+              * 'FyAbs' Absolute phase of the reference particle at the entrance [rad]
+              * 'IonW_in', 'IonW_out' Reference particle total energy [eV/u]
+    """
+    M = _machine(lattice)
+
+    maps = {}
+    for cavtype, fmap in fieldmaps.items():
+        if isinstance(fmap, (str, bytes)):
+            fmap = load_fieldmap(fmap)
+        maps[cavtype] = fmap
+
+    S = M.allocState(config)
+    elements = M.conf()['elements']
+    if len(elements) and elements[0]['type']=='source':
+        M.propagate(S, 0, 1)
+    if IonZ is not None:
+        S.IonZ = IonZ
+
+    R = M.phase_cavities(S, maps, nphase=nphase)
+    R['name'] = [elements[i]['name'] for i in R['index']]
+    return R
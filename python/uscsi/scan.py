@@ -0,0 +1,166 @@
+"""Parameter scans over a process pool
+
+>>> from uscsi.scan import scan
+>>> R = scan(lattice, [(5, 'phi', numpy.linspace(-180, 180, 37)),
+...                    ('quad1', 'B2', numpy.linspace(0.5, 1.5, 11))],
+...          observe=[10, 20])
+>>> R.shape
+(37, 11, 2, 7, 7)
+"""
+from __future__ import print_function
+
+import sys, time
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy
+
+from . import Machine
+
+__all__ = ['scan']
+
+def _machine(lattice):
+    if isinstance(lattice, Machine):
+        return lattice
+    elif isinstance(lattice, str) and not isinstance(lattice, bytes):
+        lattice = lattice.encode('ascii') # py3 str of lattice text
+    return Machine(lattice)
+
+def _resolve(M, index):
+    """Element index, name, or list of either -> list of element index
+    """
+    if isinstance(index, (list, tuple)):
+        ret = []
+        for I in index:
+            ret.extend(_resolve(M, I))
+        return ret
+    elif isinstance(index, (str, bytes)):
+        if isinstance(index, bytes):
+            index = index.decode('ascii')
+        ret = [i for i, E in enumerate(M.conf()['elements']) if E['name']==index]
+        if len(ret)==0:
+            raise KeyError("No element named '%s'"%index)
+        return ret
+    return [int(index)]
+
+class _Worker(object):
+    """State of a scan worker process.  One Machine is kept for each scan.
+    """
+    def __init__(self, M, axes, observe, config, attr, raw, shape):
+        self.M, self.axes, self.observe, self.attr = M, axes, observe, attr
+        self.result = numpy.frombuffer(raw, dtype=numpy.float64).reshape(shape)
+        self.gshape = shape[:len(axes)]
+        self.S = M.allocState(config)
+        self.initial = M.allocState(config)
+        self.last = [None]*len(axes)
+
+    def run(self, first, last):
+        M, S = self.M, self.S
+        for n in range(first, last):
+            point = numpy.unravel_index(n, self.gshape)
+
+            for A, (elems, param, values) in enumerate(self.axes):
+                if self.last[A]==point[A]:
+                    continue # unchanged since the previous point
+                for E in elems:
+                    M.reconfigure(E, {param:float(values[point[A]])})
+                self.last[A] = point[A]
+
+            S.assign(self.initial)
+            out = self.result[point]
+
+            # propagate in segments, to copy out observed states without allocation
+            start = 0
+            for i, E in enumerate(self.observe):
+                M.propagate(S, start, E+1-start)
+                out[i] = getattr(S, self.attr)
+                start = E+1
+
+        return last-first
+
+_worker = None
+
+def _init(*args):
+    global _worker
+    _worker = _Worker(*args)
+
+def _run(task):
+    return _worker.run(*task)
+
+def _stderr_progress(done, total, elapsed):
+    sys.stderr.write('scan %d/%d points, %.1f points/s\n'%(done, total, done/max(elapsed, 1e-9)))
+
+def scan(lattice, grid, observe=None, config={}, attr='state',
+         processes=None, chunksize=None, progress=None):
+    """Propagate through a Machine at each point of a grid of element parameters
+
+    :param lattice: A Machine, Config, dict, or lattice file text.
+    :param grid: A list of (index, param, values).  Each entry is an axis of the scan grid.
+                 'index' is an element index, an element name, or a list of either.
+                 'param' is the name of the element parameter to be set to each value in 'values'.
+    :param observe: A list of element indicies after which the State is recorded.  Default is the last element.
+    :param config: Passed to Machine.allocState() to create the initial State.
+    :param attr: The State attribute to record.
+    :param processes: Number of worker processes.  Default is the number of CPUs.
+                      With zero the scan is run in this process.
+    :param chunksize: Number of grid points in each task.
+    :param progress: Called with (done, total, elapsed) as the scan progresses.
+                     If True, progress and throughput are printed to stderr.
+    :returns: An array of shape [len(values0), ..., len(observe)] + shape of 'attr'.
+              The array is held in shared memory.
+    """
+    M = _machine(lattice)
+
+    axes = [(_resolve(M, index), param, numpy.asarray(values, dtype=numpy.float64))
+            for index, param, values in grid]
+    gshape = tuple(len(values) for _elems, _param, values in axes)
+
+    if observe is None:
+        observe = [len(M)-1]
+    observe = sorted(set(_resolve(M, observe)))
+
+    S = M.allocState(config)
+    ashape = numpy.shape(getattr(S, attr))
+
+    shape = gshape + (len(observe),) + ashape
+    raw = RawArray('d', int(numpy.prod(shape)))
+    result = numpy.frombuffer(raw, dtype=numpy.float64).reshape(shape)
+
+    if progress is True:
+        progress = _stderr_progress
+
+    total = int(numpy.prod(gshape))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if chunksize is None:
+        # a few tasks for each worker to balance load
+        chunksize = max(1, total//(4*max(1, processes)))
+    tasks = [(first, min(total, first+chunksize)) for first in range(0, total, chunksize)]
+
+    initargs = (M, axes, observe, config, attr, raw, shape)
+    T0, done = time.time(), 0
+
+    if processes==0:
+        # the Machine is copied as reconfigure() is used
+        W = _Worker(M.clone(), *initargs[1:])
+        results = (W.run(*task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init, initargs=initargs)
+        results = pool.imap_unordered(_run, tasks)
+
+    try:
+        for N in results:
+            done += N
+            if progress:
+                progress(done, total, time.time()-T0)
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return result
@@ -0,0 +1,521 @@
+"""Simulation daemon keeping prebuilt Machines
+
+A Server holds named Machines, built once, and answers propagate(),
+reconfigure(), and scan() requests from any number of local clients.
+
+$ python -m uscsi.server -S /tmp/uscsi.sock imp=latticeout_IMP_withPV_consolidate.lat
+
+>>> from uscsi.server import Client
+>>> C = Client('/tmp/uscsi.sock')
+>>> C.machines()
+{'imp': {'sim_type': 'MomentMatrix', 'elements': 1261}}
+>>> S = C.propagate('imp')          # a State, as from Machine.propagate()
+>>> S, obs = C.propagate('imp', observe=[10, 20])
+>>> C.reconfigure('imp', 'ls1_bts_qh_d1942', {'B2':1.2})
+>>> R = C.scan('imp', [(5, 'phi', numpy.linspace(-180, 180, 37))])
+
+Protocol
+
+Each message is a frame of
+@code
+  char magic[4] = "USCS"
+  uint32 hlen    // big endian
+  uint32 nbuf
+  char header[hlen]  // JSON (UTF-8)
+  nbuf times:
+    uint64 blen
+    char buf[blen]
+@endcode
+numpy arrays are sent as raw buffers.  The header refers to buffer 'i' as
+{"$array": i, "dtype": "<f8", "shape": [...]}.
+
+A request header is {"id": 1, "op": "propagate", "args": {...}}.
+The reply is {"id": 1, "result": ...} or {"id": 1, "error": "ValueError", "message": "..."}.
+Requests are processed concurrently by a pool of worker threads,
+so replies on one connection may arrive out of order.
+propagate requests release the GIL (see Machine.propagate_nogil()),
+so several may run at once.
+"""
+from __future__ import print_function
+
+import sys, os, struct, json, socket, threading, tempfile, errno
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+import numpy
+
+from . import Machine
+from ._internal import _StateLoad
+from .scan import scan, _machine, _resolve
+
+__all__ = ['Server', 'Client', 'RemoteError', 'default_socket']
+
+_MAGIC = b'USCS'
+_HEAD = struct.Struct('!4sII')
+_BLEN = struct.Struct('!Q')
+
+def default_socket():
+    """Default socket path.  $USCSI_SOCKET, or uscsi-<uid>.sock in $XDG_RUNTIME_DIR or the temp. directory.
+    """
+    path = os.environ.get('USCSI_SOCKET')
+    if path:
+        return path
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                        'uscsi-%d.sock'%os.getuid())
+
+class RemoteError(RuntimeError):
+    """An error raised by the Server while processing a request
+
+    'type' is the name of the exception type (eg. 'ValueError').
+    """
+    def __init__(self, type, message):
+        RuntimeError.__init__(self, '%s: %s'%(type, message))
+        self.type = type
+
+def _encode(obj):
+    """-> (header bytes, [buffers])
+    """
+    bufs = []
+    def enc(V):
+        if isinstance(V, numpy.ndarray):
+            V = numpy.ascontiguousarray(V)
+            bufs.append(V.tobytes())
+            return {'$array':len(bufs)-1, 'dtype':V.dtype.str, 'shape':V.shape}
+        elif isinstance(V, bytes) and not isinstance(V, str):
+            return V.decode('latin-1') # py3 lattice text
+        elif isinstance(V, dict):
+            return dict((K, enc(E)) for K, E in V.items())
+        elif isinstance(V, (list, tuple)):
+            return [enc(E) for E in V]
+        elif isinstance(V, numpy.generic):
+            return V.item()
+        elif hasattr(V, 'todict'): # Config
+            return enc(V.todict())
+        return V
+    return json.dumps(enc(obj)).encode('utf-8'), bufs
+
+def _decode(header, bufs):
+    def dec(V):
+        if isinstance(V, dict):
+            if '$array' in V:
+                return numpy.frombuffer(bufs[V['$array']], dtype=V['dtype']).reshape(V['shape'])
+            return dict((str(K), dec(E)) for K, E in V.items())
+        elif isinstance(V, list):
+            return [dec(E) for E in V]
+        elif sys.version_info[0]<3 and isinstance(V, unicode):
+            return V.encode('utf-8')
+        return V
+    return dec(json.loads(header.decode('utf-8')))
+
+def _recvall(sock, N):
+    buf = bytearray(N)
+    view, pos = memoryview(buf), 0
+    while pos<N:
+        n = sock.recv_into(view[pos:], N-pos)
+        if n==0:
+            raise EOFError()
+        pos += n
+    return buf
+
+def _send(sock, obj):
+    _sendmsg(sock, _encode(obj))
+
+def _sendmsg(sock, msg):
+    header, bufs = msg
+    parts = [_HEAD.pack(_MAGIC, len(header), len(bufs)), header]
+    for B in bufs:
+        parts.append(_BLEN.pack(len(B)))
+        parts.append(B)
+    sock.sendall(b''.join(parts))
+
+def _recv(sock):
+    magic, hlen, nbuf = _HEAD.unpack(bytes(_recvall(sock, _HEAD.size)))
+    if magic!=_MAGIC:
+        raise IOError("Protocol error")
+    header = bytes(_recvall(sock, hlen))
+    bufs = []
+    for i in range(nbuf):
+        blen, = _BLEN.unpack(bytes(_recvall(sock, _BLEN.size)))
+        bufs.append(_recvall(sock, blen))
+    return _decode(header, bufs)
+
+class _Connection(object):
+    """A client connection, shared by its reader and the workers answering its requests.
+
+    The socket is closed once the client has gone (or the Server is closed) and all replies are sent.
+    """
+    def __init__(self, sock):
+        self.sock, self.lock = sock, threading.Lock()
+        self.pending, self.reading = 0, True
+
+    def queued(self):
+        with self.lock:
+            self.pending += 1
+
+    def reply(self, msg):
+        with self.lock:
+            self.pending -= 1
+            try:
+                if self.sock is not None:
+                    _sendmsg(self.sock, msg)
+            finally:
+                self._check()
+
+    def eof(self):
+        with self.lock:
+            self.reading = False
+            self._check()
+
+    def shutdown(self):
+        "Wake up the reader"
+        with self.lock:
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def _check(self):
+        if not self.reading and self.pending==0 and self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class _Entry(object):
+    """A named Machine, and idle clones of it.
+
+    propagate() uses a clone, so that several requests may run at once.
+    reconfigure() changes the master copy and discards the clones.
+    """
+    def __init__(self, M):
+        self.M, self.lock = M, threading.Lock()
+        self.simtype = M.conf()['sim_type']
+        self.idle, self.generation = [], 0
+
+    def acquire(self):
+        with self.lock:
+            while self.idle:
+                gen, C = self.idle.pop()
+                if gen==self.generation:
+                    return gen, C
+            return self.generation, self.M.clone()
+
+    def release(self, gen, C):
+        with self.lock:
+            if gen==self.generation:
+                self.idle.append((gen, C))
+
+    def reconfigure(self, index, config):
+        with self.lock:
+            for i in _resolve(self.M, index):
+                self.M.reconfigure(i, config)
+            self.generation += 1
+            self.idle = []
+
+class Server(object):
+    """Serve requests on a Unix socket
+
+    >>> S = Server('/tmp/uscsi.sock', machines={'imp':open('imp.lat','rb').read()})
+    >>> S.serve_forever()
+
+    :param path: Socket file name.  Default from default_socket().  An existing socket file is replaced.
+    :param machines: A dict of name to Machine, Config, dict, or lattice text.
+    :param workers: Number of worker threads.  Default is the number of CPUs.
+    """
+    def __init__(self, path=None, machines={}, workers=None):
+        import multiprocessing
+        self.path = path or default_socket()
+        self._machines, self._lock = {}, threading.Lock()
+        for name, lattice in machines.items():
+            self.load(name, lattice)
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(16)
+
+        self._queue = Queue()
+        self._running = True
+        self._conns = set()
+        self._workers = []
+        for i in range(workers or multiprocessing.cpu_count()):
+            T = threading.Thread(target=self._work, name='uscsi worker %d'%i)
+            T.daemon = True
+            T.start()
+            self._workers.append(T)
+
+    def load(self, name, lattice):
+        "Build and add (or replace) a named Machine"
+        M = _machine(lattice)
+        with self._lock:
+            self._machines[name] = _Entry(M)
+
+    def _entry(self, name):
+        with self._lock:
+            try:
+                return self._machines[name]
+            except KeyError:
+                raise KeyError("No Machine named '%s'"%name)
+
+    def serve_forever(self):
+        "Accept connections until shutdown()"
+        try:
+            while self._running:
+                try:
+                    conn, _addr = self._sock.accept()
+                except socket.error as e:
+                    if not self._running:
+                        break
+                    elif e.args[0]==errno.EINTR:
+                        continue
+                    raise
+                C = _Connection(conn)
+                with self._lock:
+                    self._conns.add(C)
+                T = threading.Thread(target=self._read, args=(C,), name='uscsi connection')
+                T.daemon = True
+                T.start()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        "Stop serve_forever()"
+        self._running = False
+        try:
+            # wake up accept()
+            S = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            S.connect(self.path)
+            S.close()
+        except socket.error:
+            pass
+
+    def close(self):
+        self._running = False
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        with self._lock:
+            conns, self._conns = self._conns, set()
+        for C in conns:
+            C.shutdown()
+        for T in self._workers:
+            self._queue.put(None)
+        self._workers = []
+
+    def _read(self, conn):
+        "Read requests from one connection, and queue them for the workers"
+        try:
+            while self._running:
+                try:
+                    req = _recv(conn.sock)
+                except EOFError:
+                    break
+                conn.queued()
+                self._queue.put((conn, req))
+        except Exception as e:
+            if self._running:
+                print('uscsi.server connection error:', e, file=sys.stderr)
+        finally:
+            with self._lock:
+                self._conns.discard(conn)
+            conn.eof()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            conn, req = job
+            try:
+                op = getattr(self, '_op_'+str(req.get('op')), None)
+                if op is None:
+                    raise ValueError("Unknown operation '%s'"%req.get('op'))
+                reply = {'id':req.get('id'), 'result':op(**req.get('args', {}))}
+            except Exception as e:
+                reply = {'id':req.get('id'), 'error':type(e).__name__, 'message':str(e)}
+            try:
+                try:
+                    msg = _encode(reply)
+                except Exception as e:
+                    msg = _encode({'id':req.get('id'), 'error':type(e).__name__, 'message':str(e)})
+                conn.reply(msg)
+            except socket.error:
+                pass # client went away
+
+    # Operations.  Arguments and results are as for Client
+
+    def _op_ping(self):
+        return 'pong'
+
+    def _op_load(self, name, lattice):
+        self.load(name, lattice)
+        return len(self._entry(name).M)
+
+    def _op_unload(self, name):
+        with self._lock:
+            self._machines.pop(name, None)
+
+    def _op_machines(self):
+        with self._lock:
+            return dict((name, {'sim_type':E.simtype, 'elements':len(E.M)})
+                        for name, E in self._machines.items())
+
+    def _op_conf(self, name):
+        E = self._entry(name)
+        with E.lock:
+            return E.M.conf()
+
+    def _op_propagate(self, name, config={}, state=None, start=0, max=-1, observe=None):
+        E = self._entry(name)
+        gen, M = E.acquire()
+        try:
+            S = M.allocState(config)
+            if state is not None:
+                S.from_array(state)
+            if max<0:
+                max = len(M)
+            # releases the GIL, so other workers may run at the same time
+            obs, _cancelled = M.propagate_nogil(S, start, max, observe=observe)
+            if observe is not None:
+                obs = [(i, O.to_array()) for i, O in obs]
+            else:
+                obs = None
+        finally:
+            E.release(gen, M)
+        # the number of particles must be known before an Ensemble State can be restored
+        count = S.state.shape[0] if E.simtype=='Ensemble' else None
+        return {'simtype':E.simtype, 'state':S.to_array(), 'observed':obs, 'count':count}
+
+    def _op_reconfigure(self, name, index, config):
+        self._entry(name).reconfigure(index, config)
+
+    def _op_scan(self, name, grid, observe=None, config={}, attr='state', processes=0):
+        E = self._entry(name)
+        with E.lock:
+            M = E.M.clone()
+        return scan(M, grid, observe=observe, config=config, attr=attr, processes=processes)
+
+class Client(object):
+    """Connection to a Server
+
+    Methods block until the reply arrives.  A Client may be shared between threads,
+    though requests are then sent one at a time.
+
+    :param path: Socket file name.  Default from default_socket().
+    :param timeout: Socket timeout in seconds, or None to wait forever.
+    """
+    def __init__(self, path=None, timeout=None):
+        self.path = path or default_socket()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(self.path)
+        self._lock = threading.Lock()
+        self._id = 0
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def __enter__(self):
+        return self
+    def __exit__(self, A, B, C):
+        self.close()
+
+    def _call(self, op, **args):
+        with self._lock:
+            if self._sock is None:
+                raise RuntimeError("Client is closed")
+            self._id += 1
+            _send(self._sock, {'id':self._id, 'op':op, 'args':args})
+            reply = _recv(self._sock)
+        if 'error' in reply:
+            raise RemoteError(reply['error'], reply['message'])
+        return reply['result']
+
+    def ping(self):
+        return self._call('ping')
+
+    def load(self, name, lattice):
+        """Build (or replace) a named Machine on the server
+
+        :param lattice: lattice file text, or a dict
+        :returns: The number of elements
+        """
+        if isinstance(lattice, Machine):
+            lattice = lattice.conf()
+        return self._call('load', name=name, lattice=lattice)
+
+    def unload(self, name):
+        self._call('unload', name=name)
+
+    def machines(self):
+        "-> {name: {'sim_type':..., 'elements':N}}"
+        return self._call('machines')
+
+    def conf(self, name):
+        "Current Config of a Machine as a dict, including changes made by reconfigure()"
+        return self._call('conf', name=name)
+
+    def propagate(self, name, config={}, state=None, start=0, max=-1, observe=None):
+        """Propagate a new State, as for Machine.propagate()
+
+        :param config: Passed to Machine.allocState() on the server.
+        :param state: A State giving the initial values.
+        :param observe: A list of element indicies.
+        :returns: The final State, or (State, [(index, State), ...]) when 'observe' is given.
+        """
+        args = {'name':name, 'config':config, 'start':start, 'max':max}
+        if state is not None:
+            args['state'] = state.to_array()
+        if observe is not None:
+            args['observe'] = list(observe)
+        R = self._call('propagate', **args)
+        conf = {} if R.get('count') is None else {'count':float(R['count'])}
+        S = _StateLoad(R['simtype'], R['state'].tobytes(), conf)
+        if observe is None:
+            return S
+        return S, [(i, _StateLoad(R['simtype'], O.tobytes(), conf)) for i, O in R['observed']]
+
+    def reconfigure(self, name, index, config):
+        """Change parameters of elements of a Machine on the server
+
+        :param index: An element index, name, or a list of either.
+        :param config: A dict of parameters to change.
+        """
+        self._call('reconfigure', name=name, index=index, config=config)
+
+    def scan(self, name, grid, observe=None, config={}, attr='state', processes=0):
+        "As uscsi.scan.scan(), run by the server.  'processes' defaults to zero (one server worker)."
+        return self._call('scan', name=name, grid=grid, observe=observe, config=config,
+                          attr=attr, processes=processes)
+
+def main(args=None):
+    from optparse import OptionParser
+    P = OptionParser(usage='%prog [options] [name=lattice.lat ...]')
+    P.add_option('-S', '--socket', metavar='PATH', help='Socket file.  Default %s'%default_socket())
+    P.add_option('-W', '--workers', type='int', help='Number of worker threads')
+    opts, args = P.parse_args(args)
+
+    machines = {}
+    for arg in args:
+        name, _sep, fname = arg.partition('=')
+        if not fname:
+            P.error("Expected name=lattice, not '%s'"%arg)
+        with open(fname, 'rb') as F:
+            machines[name] = F.read()
+
+    S = Server(opts.socket, machines=machines, workers=opts.workers)
+    print('Serving %d Machines on %s'%(len(machines), S.path))
+    try:
+        S.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__=='__main__':
+    main()
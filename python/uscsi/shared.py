@@ -0,0 +1,71 @@
+"""Transport State values between processes through shared memory
+"""
+from __future__ import print_function
+
+from multiprocessing.sharedctypes import RawArray
+
+import numpy
+
+__all__ = ['SharedStates']
+
+class SharedStates(object):
+    """Values of 'count' States stored in shared memory
+
+    >>> S = SharedStates(machine, 1000)
+
+    Each row of S.array holds the float values of one State,
+    in the layout of State.to_array() .
+    Copying to/from a State does not allocate.
+
+    >>> S.store(i, state)  # copy state -> row i
+    >>> S.load(i, state)   # copy row i -> state
+
+    A SharedStates must be given to worker processes when they are created,
+    eg. with multiprocessing.Pool(initializer=..., initargs=(S,)) .
+    Tasks then need only pass row indices.
+    """
+    def __init__(self, template, count, config={}):
+        """SharedStates(template, count, config={})
+
+        'template' is a State, or a Machine from which a State is allocated with 'config'.
+        """
+        if hasattr(template, 'allocState'):
+            template = template.allocState(config)
+        self.layout = template.array_layout()
+        width = template.to_array().shape[0]
+
+        self._raw = RawArray('d', count*width)
+        self._setup((count, width))
+
+    def _setup(self, shape):
+        self.array = numpy.frombuffer(self._raw, dtype=numpy.float64).reshape(shape)
+
+    def __getstate__(self):
+        # RawArray may only be pickled while starting a new process
+        return {'raw':self._raw, 'shape':self.array.shape, 'layout':self.layout}
+
+    def __setstate__(self, state):
+        self._raw, self.layout = state['raw'], state['layout']
+        self._setup(state['shape'])
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def store(self, i, state):
+        "Copy values from State 'state' into row 'i'"
+        state.to_array(out=self.array[i])
+
+    def load(self, i, state):
+        "Copy values from row 'i' into State 'state'"
+        state.from_array(self.array[i])
+
+    def view(self, i, name):
+        """Return a view of one attribute of the State in row 'i'.
+
+        >>> S.view(i, 'state') # eg. array of shape [7,7] for MomentMatrix
+        """
+        for aname, offset, shape in self.layout:
+            if aname==name:
+                N = int(numpy.prod(shape))
+                return self.array[i, offset:offset+N].reshape(shape)
+        raise KeyError(name)
@@ -0,0 +1,108 @@
+"""Charge stripper
+
+>>> from uscsi.stripper import charge_distribution, propagate_charge_states
+>>> R = charge_distribution(16.6e6, thickness=numpy.linspace(1, 5, 41)[:,None],
+...                         variation=[10, 20, 30])
+>>> R['fractions'].shape # [thickness, variation, charge state]
+(41, 3, 5)
+>>> C = propagate_charge_states(lattice)
+>>> C['states'] # one State for each charge state after the stripper
+"""
+from __future__ import print_function
+
+import numpy
+
+from ._internal import _stripper
+from .scan import _machine, _resolve
+
+__all__ = ['charge_distribution', 'propagate_charge_states']
+
+AMU = 931.49432e6 # [eV/u]
+
+def charge_distribution(IonEk, thickness=None, variation=None, config={}, IonEs=AMU):
+    """Evaluate the charge stripper model for many foils and energies at once
+
+    :param IonEk: Kinetic energy of the incoming ions [eV/u]
+    :param thickness: Foil thickness [um].  Default from 'config'.
+    :param variation: Thickness variation [%].  Default from 'config'.
+    :param config: Stripper parameters (eg. "Stripper_IonChargeStates"), as for the stripper element.
+    :param IonEs: Rest energy [eV/u]
+    :returns: A dict with entries
+
+              * 'IonEk' outgoing kinetic energy [eV/u]
+              * 'sigma' RMS energy spread from thickness variation [eV/u]
+              * 'fractions' fraction of each charge state, with a trailing dimension of len(charges)
+              * 'charges' charge to mass ratio of each charge state
+              * 'IonZ' charge to mass ratio of the state which continues through the lattice
+
+              IonEk, thickness, and variation are broadcast together to give the shape of each result.
+    """
+    args = [numpy.asarray(IonEk, dtype=numpy.float64)]
+    for A in (thickness, variation):
+        if A is not None:
+            args.append(numpy.asarray(A, dtype=numpy.float64))
+    shape = numpy.broadcast(*args).shape if len(args)>1 else args[0].shape
+
+    def flat(A):
+        if A is None:
+            return None
+        return numpy.ascontiguousarray(numpy.broadcast_to(A, shape), dtype=numpy.float64).reshape(-1)
+
+    R = _stripper(dict(config), IonEs, flat(IonEk), flat(thickness), flat(variation))
+    R['IonEk'] = R['IonEk'].reshape(shape)
+    R['sigma'] = R['sigma'].reshape(shape)
+    R['fractions'] = R['fractions'].reshape(shape+(-1,))
+    return R
+
+def propagate_charge_states(lattice, config={}, stripper=None):
+    """Propagate each charge state from a stripper to the end of a lattice
+
+    The stripper element must set "charge_model" (eg. "foil: stripper, charge_model = 1;").
+    The State is propagated up to, and through, the stripper.
+    A copy is then propagated through the rest of the lattice for each charge state
+    of the stripper, with IonZ set to that charge state.
+
+    :param lattice: A Machine, Config, dict, or lattice file text.  sim_type must be MomentMatrix.
+    :param config: Passed to Machine.allocState() to create the initial State.
+    :param stripper: Index or name of the stripper element.  Default is the first stripper.
+    :returns: A dict with entries
+
+              * 'index' The stripper element index
+              * 'charges' charge to mass ratio of each charge state
+              * 'fractions' fraction of the beam in each charge state
+              * 'states' a State at the end of the lattice for each charge state
+    """
+    M = _machine(lattice)
+    conf = M.conf()
+    elements = conf['elements']
+
+    if stripper is None:
+        idx = [i for i, E in enumerate(elements) if E['type']=='stripper']
+        if len(idx)==0:
+            raise ValueError("lattice has no stripper")
+        idx = idx[0]
+    else:
+        idx = _resolve(M, stripper)[0]
+
+    # element parameters, with defaults from the lattice
+    params = dict((K, V) for K, V in conf.items() if K!='elements')
+    params.update(elements[idx])
+    if not params.get('charge_model', 0):
+        raise ValueError("stripper element %d does not set charge_model"%idx)
+
+    S = M.allocState(config)
+    M.propagate(S, 0, idx)
+    IonEk = S.IonEk
+    M.propagate(S, idx, 1)
+
+    R = _stripper(params, S.IonEs, [IonEk], None, None)
+
+    states = []
+    for Z in R['charges']:
+        C = M.allocState(config)
+        C.assign(S)
+        C.IonZ = Z
+        M.propagate(C, idx+1)
+        states.append(C)
+
+    return {'index':idx, 'charges':R['charges'], 'fractions':R['fractions'][0], 'states':states}
@@ -0,0 +1,6 @@
+
+class BadBool(object):
+  "A flag argument whose truth test raises ZeroDivisionError"
+  def __bool__(self):
+    raise ZeroDivisionError()
+  __nonzero__ = __bool__
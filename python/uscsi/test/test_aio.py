@@ -0,0 +1,140 @@
+from __future__ import print_function
+
+import unittest
+import sys, os
+import threading
+import numpy
+from numpy import testing as NT
+
+from .. import Machine
+
+datadir = os.path.dirname(__file__)
+
+def drifts(n):
+  return {'sim_type':'MomentMatrix', 'elements':
+          [{'name':'S', 'type':'source', 'initial':numpy.identity(7)}]+
+          [{'name':'d%d'%i, 'type':'drift', 'L':0.1} for i in range(n)]}
+
+class TestNoGIL(unittest.TestCase):
+  def setUp(self):
+    with open(os.path.join(datadir, 'moment_jb_2.lat'), 'rb') as F:
+      self.M = Machine(F.read())
+
+  def test_same(self):
+    M = self.M
+    S1, S2 = M.allocState({}), M.allocState({})
+    obs1 = M.propagate(S1, observe=[3, 7, len(M)-1])
+    obs2, cancelled = M.propagate_nogil(S2, observe=[3, 7, len(M)-1])
+    self.assertFalse(cancelled)
+    NT.assert_equal(S2.state, S1.state)
+    self.assertEqual([i for i, _S in obs2], [3, 7, len(M)-1])
+    for (_i, A), (_j, B) in zip(obs1, obs2):
+      NT.assert_equal(B.state, A.state)
+      NT.assert_equal(B.moment0, A.moment0)
+
+    S1, S2 = M.allocState({}), M.allocState({})
+    M.propagate(S1, 2, 5)
+    self.assertEqual(M.propagate_nogil(S2, 2, 5), ([], False))
+    NT.assert_equal(S2.state, S1.state)
+    self.assertEqual(S2.next_elem, 7)
+
+    self.assertRaises(ValueError, M.propagate_nogil, S2, observe=[len(M)])
+
+  def test_cancel(self):
+    S = self.M.allocState({})
+    obs, cancelled = self.M.propagate_nogil(S, 2, observe=[5], cancel=bytearray(b'\x01'))
+    self.assertTrue(cancelled)
+    self.assertEqual(obs, [])
+    self.assertEqual(S.next_elem, 2)
+    self.assertRaises((TypeError, BufferError), self.M.propagate_nogil, S, cancel=b'\x00') # read-only
+
+  def test_ensemble(self):
+    with open(os.path.join(datadir, 'latticeout_IMP_withPV_consolidate.lat'), 'rb') as F:
+      conf = Machine(F.read()).conf()
+    conf['sim_type'] = 'Ensemble'
+    M = Machine(conf)
+    P = numpy.random.RandomState(1).randn(100, 7)
+    S1, S2 = M.allocState({'particles':P}), M.allocState({'particles':P})
+    obs1 = M.propagate(S1, observe=[100, 500])
+    obs2, _cancelled = M.propagate_nogil(S2, observe=[100, 500])
+    NT.assert_allclose(S2.state, S1.state)
+    NT.assert_allclose(obs2[1][1].state, obs1[1][1].state)
+
+  def test_ensemble_observers(self):
+    "Observers attached by propagate() in another thread are not called without the GIL"
+    conf = drifts(200)
+    conf['sim_type'] = 'Ensemble'
+    M = Machine(conf)
+    P = numpy.random.RandomState(1).randn(1000, 7)
+    expect = M.allocState({'particles':P})
+    M.propagate(expect)
+
+    done = threading.Event()
+    def observe():
+      S = M.allocState({'particles':P})
+      while not done.is_set():
+        M.propagate(S, observe=range(201))
+    T = threading.Thread(target=observe)
+    T.start()
+    try:
+      for _i in range(50):
+        S = M.allocState({'particles':P})
+        obs, _cancelled = M.propagate_nogil(S)
+        self.assertEqual(obs, [])
+        NT.assert_array_equal(S.state, expect.state)
+    finally:
+      done.set()
+      T.join()
+
+@unittest.skipIf(sys.version_info<(3, 4), "asyncio needs python 3")
+class TestAsync(unittest.TestCase):
+  def setUp(self):
+    import asyncio
+    self.loop = asyncio.new_event_loop()
+    with open(os.path.join(datadir, 'moment_jb_2.lat'), 'rb') as F:
+      self.M = Machine(F.read())
+
+  def tearDown(self):
+    self.loop.close()
+
+  def test_propagate(self):
+    M = self.M
+    S1, S2 = M.allocState({}), M.allocState({})
+    obs1 = M.propagate(S1, observe=[4, 8])
+
+    async def run():
+      return await M.propagate_async(S2, observe=[4, 8])
+    obs2 = self.loop.run_until_complete(run())
+    NT.assert_equal(S2.state, S1.state)
+    NT.assert_equal(obs2[1][1].state, obs1[1][1].state)
+
+    S3 = M.allocState({})
+    async def run():
+      return await M.propagate_async(S3, max=4)
+    self.assertIsNone(self.loop.run_until_complete(run()))
+    self.assertEqual(S3.next_elem, 4)
+
+  def test_many(self):
+    M = self.M
+    S = M.allocState({})
+    M.propagate(S)
+
+    states = [M.allocState({}) for i in range(5)]
+    async def run():
+      return await M.propagate_many_async(states)
+    self.assertEqual(self.loop.run_until_complete(run()), [None]*5)
+    for R in states:
+      NT.assert_equal(R.state, S.state)
+
+  def test_cancel(self):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    M = Machine(drifts(200000))
+    S = M.allocState({})
+    pool = ThreadPoolExecutor(1)
+
+    async def run():
+      await asyncio.wait_for(M.propagate_async(S, executor=pool), 0.001)
+    self.assertRaises(asyncio.TimeoutError, self.loop.run_until_complete, run())
+    pool.shutdown(wait=True)
+    self.assertLess(S.next_elem, len(M))
@@ -0,0 +1,50 @@
+from __future__ import print_function
+
+import unittest
+import json
+import numpy
+from numpy import testing as NT
+
+from .. import Machine, GLPSParser
+from ..bench import run, compare, synthetic_lattice, synthetic_glps
+
+class TestSynthetic(unittest.TestCase):
+  def test_equivalent(self):
+    L = synthetic_lattice(21)
+    C = GLPSParser().parse(synthetic_glps(21))
+    self.assertEqual(len(C['elements']), 21)
+    self.assertEqual([E['type'] for E in C['elements']], [E['type'] for E in L['elements']])
+
+    S1, S2 = Machine(L).allocState({}), Machine(C).allocState({})
+    Machine(L).propagate(S1)
+    Machine(C).propagate(S2)
+    NT.assert_allclose(S1.state, S2.state)
+
+  def test_large(self):
+    "more entries than the default parser stack depth"
+    C = GLPSParser().parse(synthetic_glps(20001))
+    self.assertEqual(len(C['elements']), 20001)
+
+class TestRun(unittest.TestCase):
+  def test_run(self):
+    R = run(match='synthetic_1000', repeat=2, max_elements=1000)
+    R = json.loads(json.dumps(R))
+    self.assertEqual(sorted(R['results']), ['synthetic_1000/%s'%op for op in
+                     ('allocState', 'build', 'observe', 'parse', 'propagate', 'reconfigure')])
+    P = R['results']['synthetic_1000/propagate']
+    self.assertEqual(P['count'], 1000)
+    self.assertEqual(P['repeat'], 2)
+    self.assertTrue(0<P['min']<=P['median'])
+
+  def test_compare(self):
+    B = {'version':1, 'results':{'a/x':{'median':1.0}, 'a/y':{'median':1.0},
+                                 'a/z':{'median':1.0}, 'b/x':{'median':1.0}}}
+    R = {'version':1, 'results':{'a/x':{'median':1.05}, 'a/y':{'median':1.5},
+                                 'a/z':{'median':0.5}, 'c/x':{'median':1.0}}}
+    self.assertEqual([(K, S) for K, _B, _N, _R, S in compare(R, B)],
+                     [('a/x', 'ok'), ('a/y', 'regression'), ('a/z', 'improvement'),
+                      ('b/x', 'missing'), ('c/x', 'new')])
+    self.assertEqual(compare(R, B, threshold=0.6)[1][4], 'ok')
+    self.assertAlmostEqual(compare(R, B)[1][3], 1.5)
+
+    self.assertRaises(ValueError, compare, R, {'version':0, 'results':{}})
@@ -0,0 +1,97 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from numpy import testing as NT
+
+from ..compare import load, align, compare, compare_files, compare_many, main
+
+class TestCompare(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.s = numpy.linspace(0, 2, 21)
+    self.model = numpy.column_stack([self.s]+[self.s*k for k in range(1, 7)])
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def write(self, name, A, header='# s x xp y yp z zp\n'):
+    name = os.path.join(self.dir, name)
+    with open(name, 'w') as F:
+      F.write(header)
+      for row in A:
+        F.write(''.join('%23.15e'%V for V in row)+'\n')
+      F.write('\n')
+    return name
+
+  def test_load(self):
+    A = load(self.write('CenofChg.out', self.model))
+    NT.assert_allclose(A, self.model, rtol=1e-14)
+    # all columns are kept distinct (analyze_res.py read xp as yp)
+    NT.assert_allclose(A[:,4], self.s*4, rtol=1e-14)
+
+    npy = os.path.join(self.dir, 'model.npy')
+    numpy.save(npy, self.model)
+    B = load(npy)
+    self.assertIsInstance(B, numpy.memmap)
+    NT.assert_array_equal(B, self.model)
+
+  def test_long_tab(self):
+    name = os.path.join(self.dir, 'long_tab.out')
+    with open(name, 'w') as F:
+      F.write('drift          D1                        1.0e+00  2.0e+00  3.0e+00  0.1 1.0\n')
+      F.write('rfcavity       ls1_ca01_cav1_d1127_1     1.5e+00  2.5e+00  3.5e+00  0.1 1.0\n')
+    NT.assert_array_equal(load(name, 'long_tab'), [[1.0, 2.0, 3.0], [1.5, 2.5, 3.5]])
+
+  def test_errors(self):
+    name = os.path.join(self.dir, 'bad.out')
+    with open(name, 'w') as F:
+      F.write('1 2 3\n4 5\n')
+    self.assertRaises(ValueError, load, name, 'long')
+    self.assertRaises(ValueError, load, self.write('short.out', self.model[:,:3]))
+    self.assertRaises(ValueError, compare_files, name, name, 'moment', 'long')
+
+  def test_same(self):
+    ref = self.model.copy()
+    ref[5,4] += 1e-3
+    ref[7,1] -= 2e-3
+    R = compare(self.model, ref)
+    NT.assert_array_equal(R['s'], self.s)
+    self.assertEqual(R['delta'].shape, (21, 6))
+    NT.assert_allclose(R['max'], [2e-3, 0, 0, 1e-3, 0, 0], atol=1e-12)
+    NT.assert_allclose(R['smax'][[0,3]], [self.s[7], self.s[5]])
+    NT.assert_allclose(R['rms'][3], 1e-3/numpy.sqrt(21), rtol=1e-6)
+
+  def test_interp(self):
+    "reference sampled more finely, and over a shorter range"
+    s = numpy.linspace(0.05, 1.55, 31)
+    ref = numpy.column_stack([s]+[s*k for k in range(1, 7)])
+    M, R = align(self.model, ref)
+    NT.assert_array_equal(M[:,0], self.s[1:16])
+    NT.assert_allclose(R, M, atol=1e-12)
+    NT.assert_allclose(compare(self.model, ref)['max'], 0, atol=1e-12)
+
+  def test_many(self):
+    ref = self.model.copy()
+    ref[:,2] += 0.5
+    a, b = self.write('a.out', self.model), self.write('b.out', ref)
+    for procs in (0, 2):
+      L = compare_many([(a, b), (b, a), (a, a, 'moment', 'moment')], processes=procs)
+      self.assertEqual([(R['model'], R['reference']) for R in L], [(a, b), (b, a), (a, a)])
+      NT.assert_allclose(L[0]['max'], [0, 0.5, 0, 0, 0, 0], atol=1e-12)
+      NT.assert_allclose(L[1]['rms'], [0, 0.5, 0, 0, 0, 0], atol=1e-12)
+      NT.assert_allclose(L[2]['max'], 0)
+
+  def test_main(self):
+    ref = self.model.copy()
+    ref[:,1] += 1e-3
+    a, b = self.write('a.out', self.model), self.write('b.out', ref)
+    out = os.path.join(self.dir, 'delta.dat')
+    main(['-j', '0', '-t', '1e-2', '-o', out, a, b])
+    D = numpy.loadtxt(out)
+    NT.assert_allclose(D[:,0], self.s)
+    NT.assert_allclose(D[:,1], 1e-3, rtol=1e-9)
+    self.assertRaises(SystemExit, main, ['-j', '0', '-t', '1e-4', a, b])
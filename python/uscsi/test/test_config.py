@@ -186,3 +186,143 @@ foo: LINE = (x1, x1);
 
         assert_array_equal(C['hello'], asarray([1,2,3,4]))
         assert_array_equal(C['elements'][0]['extra'], asarray([1,3,5]))
+
+class TestConfig(unittest.TestCase):
+    lattice = b"""
+sim_type = "Vector";
+x1: drift, L=4;
+x2: drift, L=2;
+foo: LINE = (x1, x2);
+"""
+
+    def test_parse(self):
+        from .. import Config
+        C = Config(self.lattice)
+
+        self.assertEqual(len(C), 3)
+        self.assertEqual(set(C.keys()), set(['sim_type', 'name', 'elements']))
+        self.assertIn('sim_type', C)
+        self.assertNotIn('missing', C)
+        self.assertEqual(C['sim_type'], 'Vector')
+        self.assertEqual(C.get('missing', 42), 42)
+        self.assertRaises(KeyError, lambda:C['missing'])
+
+        E = C['elements']
+        self.assertEqual(len(E), 2)
+        self.assertEqual(E[1]['L'], 2.0)
+        # globals are visible from elements
+        self.assertEqual(E[1]['sim_type'], 'Vector')
+
+        self.assertEqual(C.todict(), _GLPSParse(self.lattice))
+        self.assertEqual(C.todict(), Config(C).todict())
+
+    def test_dict(self):
+        from .. import Config
+        D = {
+            'sim_type':'Vector',
+            'elements':[
+                {'name':'x1', 'type':'drift', 'L':4.0},
+            ],
+        }
+        C = Config(D)
+        self.assertEqual(C.todict(), D)
+        self.assertEqual(dictshow(C), dictshow(D))
+
+    def test_modify(self):
+        from .. import Config
+        C = Config(self.lattice)
+        orig = Config(C)
+
+        E = C['elements'][0]
+        E['L'] = 1.5
+        E['extra'] = asarray([1.0, 2.0])
+
+        self.assertEqual(C['elements'][0]['L'], 1.5)
+        assert_array_equal(C['elements'][0]['extra'], asarray([1, 2]))
+        # copies are not changed
+        self.assertEqual(orig['elements'][0]['L'], 4.0)
+
+        def delit():
+            del C['name']
+        self.assertRaises(TypeError, delit)
+
+        # the list of elements can only be replaced as a whole
+        def setit():
+            C['elements'][0] = {'name':'x', 'type':'marker'}
+        self.assertRaises(TypeError, setit)
+        self.assertIsInstance(C['elements'], tuple)
+        C['elements'] = [{'name':'x', 'type':'marker'}]
+        self.assertEqual(C['elements'][0]['type'], 'marker')
+
+    def test_machine(self):
+        from .. import Config, Machine
+        from numpy import ones
+        C = Config(self.lattice)
+        C['elements'][1]['L'] = 3.0
+
+        D = _GLPSParse(self.lattice)
+        D['elements'][1]['L'] = 3.0
+
+        M1, M2 = Machine(C), Machine(D)
+
+        S1, S2 = M1.allocState({}), M2.allocState({})
+        S1.state[:] = ones(6)
+        S2.state[:] = ones(6)
+        M1.propagate(S1)
+        M2.propagate(S2)
+
+        assert_array_equal(S1.state, S2.state)
+
+        M1.reconfigure(1, Config({'L':1.0}))
+        M2.reconfigure(1, {'L':1.0})
+        self.assertEqual(str(M1), str(M2))
+
+class TestDict2Config(unittest.TestCase):
+    def test_numbers(self):
+        from .. import Config
+        import array
+        from numpy import arange, float32, float64
+
+        C = Config({
+            'list':[1.0, 2, 3.5],
+            'tuple':(4, 5),
+            'arr':array.array('d', [1.0, 2.0]),
+            'iarr':array.array('i', [3, 4]),
+            'view':memoryview(arange(4.0)),
+            'strided':arange(6.0)[::2],
+            'f32':arange(2, dtype=float32),
+            'scalar':float32(1.5),
+            'scalar64':float64(2.5),
+        })
+
+        assert_array_equal(C['list'], asarray([1.0, 2.0, 3.5]))
+        assert_array_equal(C['tuple'], asarray([4.0, 5.0]))
+        assert_array_equal(C['arr'], asarray([1.0, 2.0]))
+        assert_array_equal(C['iarr'], asarray([3.0, 4.0]))
+        assert_array_equal(C['view'], asarray([0.0, 1.0, 2.0, 3.0]))
+        assert_array_equal(C['strided'], asarray([0.0, 2.0, 4.0]))
+        assert_array_equal(C['f32'], asarray([0.0, 1.0]))
+        self.assertIsInstance(C['scalar'], float)
+        self.assertEqual(C['scalar'], 1.5)
+        self.assertIsInstance(C['scalar64'], float)
+        self.assertEqual(C['scalar64'], 2.5)
+
+    def test_mixed(self):
+        from .. import Config
+        self.assertRaises(ValueError, Config, {'list':[1.0, {}]})
+        self.assertRaises(ValueError, Config, {'list':[{}, 1.0]})
+
+    def test_elements(self):
+        from .. import Config
+        D = {'name':'x', 'type':'drift', 'L':1.0}
+        C = Config({'elements':[D]*1000 + [{'name':'y', 'type':'drift', 'L':2.0}]})
+
+        E = C['elements']
+        self.assertEqual(len(E), 1001)
+        self.assertEqual(E[999].todict(), D)
+        self.assertEqual(E[1000]['name'], 'y')
+
+        # elements built from the same dict are changed independently
+        E[0]['L'] = 3.0
+        self.assertEqual(E[0]['L'], 3.0)
+        self.assertEqual(E[1]['L'], 1.0)
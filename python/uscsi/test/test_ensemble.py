@@ -0,0 +1,142 @@
+from __future__ import print_function
+
+import unittest, pickle
+import numpy
+from numpy import testing as NT
+
+from .. import Machine
+
+class TestEnsemble(unittest.TestCase):
+  lattice = {
+    'elements':[
+      {'name':'S', 'type':'source'},
+      {'name':'d1', 'type':'drift', 'L':0.1},
+      {'name':'q1', 'type':'quadrupole', 'L':0.2, 'K':2.0},
+      {'name':'d2', 'type':'drift', 'L':0.3},
+      {'name':'q2', 'type':'quadrupole', 'L':0.2, 'K':-3.0},
+      {'name':'s1', 'type':'solenoid', 'L':0.1, 'B':1.0, 'K':0.5},
+      {'name':'d3', 'type':'drift', 'L':0.2},
+    ],
+  }
+
+  def machine(self, sim_type):
+    conf = dict(self.lattice)
+    conf['sim_type'] = sim_type
+    return Machine(conf)
+
+  def particles(self, N):
+    P = numpy.random.RandomState(42).randn(N, 7)
+    P[:,6] = 1.0
+    return P
+
+  def expect(self, P):
+    "Propagate with TransferMatrix for comparison"
+    M = self.machine('TransferMatrix')
+    S = M.allocState({})
+    M.propagate(S)
+    R = P.copy()
+    R[:,:6] = P[:,:6].dot(S.state.T)
+    return R
+
+  def test_alloc(self):
+    M = self.machine('Ensemble')
+
+    S = M.allocState({'count':5})
+    self.assertEqual(S.state.shape, (5, 7))
+    self.assertTrue((S.state==0).all())
+
+    P = self.particles(10)
+    S = M.allocState({'particles':P})
+    NT.assert_array_equal(S.state, P)
+
+    # in-place access
+    S.state[2,0] = 42.0
+    self.assertEqual(S.state[2,0], 42.0)
+    self.assertEqual(S.to_array()[S.array_layout()[0][1]+2*7], 42.0)
+
+    self.assertRaises(RuntimeError, M.allocState, {'particles':numpy.ones(10)})
+
+  def test_propagate(self):
+    M = self.machine('Ensemble')
+    P = self.particles(100)
+    R = self.expect(P)
+
+    S = M.allocState({'particles':P})
+    M.propagate(S)
+    self.assertEqual(S.next_elem, len(M))
+    NT.assert_allclose(S.state, R, rtol=1e-12)
+
+    # one element at a time
+    S = M.allocState({'particles':P})
+    for i in range(len(M)):
+      M.propagate(S, i, 1)
+    NT.assert_allclose(S.state, R, rtol=1e-12)
+
+  def test_observe(self):
+    M = self.machine('Ensemble')
+    P = self.particles(10)
+
+    S = M.allocState({'particles':P})
+    obs = M.propagate(S, observe=[3, 6])
+    self.assertEqual([i for i, _S in obs], [3, 6])
+    NT.assert_allclose(obs[1][1].state, S.state, rtol=1e-14)
+
+    S2 = M.allocState({'particles':P})
+    M.propagate(S2, 0, 4)
+    NT.assert_allclose(obs[0][1].state, S2.state, rtol=1e-14)
+
+  def test_threads(self):
+    M = self.machine('Ensemble')
+    P = self.particles(10000)
+    R = self.expect(P)
+
+    S = M.allocState({'particles':P, 'threads':4})
+    M.propagate(S)
+    NT.assert_allclose(S.state, R, rtol=1e-12)
+
+  def test_source(self):
+    P = self.particles(4)
+    conf = dict(self.lattice)
+    conf['sim_type'] = 'Ensemble'
+    conf['elements'] = [{'name':'S', 'type':'source', 'particles':P}]
+    M = Machine(conf)
+
+    # source replaces particles
+    S = M.allocState({'count':4})
+    M.propagate(S)
+    NT.assert_array_equal(S.state, P)
+
+    # also for a copy
+    S = M.allocState({'count':4})
+    M.clone().propagate(S)
+    NT.assert_array_equal(S.state, P)
+
+    # source without particles doesn't
+    M = self.machine('Ensemble')
+    S = M.allocState({'particles':P})
+    M.propagate(S, 0, 1)
+    NT.assert_array_equal(S.state, P)
+
+  def test_size(self):
+    M = self.machine('Ensemble')
+    S = M.allocState({'count':4})
+    self.assertRaises(ValueError, S.reset, {'count':5})
+    S.reset({'particles':self.particles(4)})
+    S.reset({})
+    self.assertEqual(S.state.shape, (4, 7))
+    self.assertTrue((S.state==0).all())
+
+    self.assertRaises(ValueError, S.assign, M.allocState({'count':3}))
+
+    # also when empty
+    S = M.allocState({})
+    self.assertRaises(ValueError, S.assign, M.allocState({'count':3}))
+    self.assertEqual(S.state.shape, (0, 7))
+    self.assertEqual(pickle.loads(pickle.dumps(S)).state.shape, (0, 7))
+
+  def test_pickle(self):
+    M = self.machine('Ensemble')
+    P = self.particles(6)
+    S = M.allocState({'particles':P})
+    S2 = pickle.loads(pickle.dumps(S))
+    NT.assert_array_equal(S2.state, P)
@@ -0,0 +1,85 @@
+from __future__ import print_function
+
+import unittest
+import numpy
+from numpy import testing as NT
+
+from .. import Machine
+from ..errorstudy import error_study
+
+class TestErrors(unittest.TestCase):
+  lattice = {
+    'sim_type':'MomentMatrix',
+    'elements':[
+      {'name':'S', 'type':'source', 'initial':numpy.identity(7)*1e-3+numpy.ones((7,7))*1e-4, 'moment0':numpy.arange(7.0)*1e-3},
+      {'name':'d1', 'type':'drift', 'L':0.1},
+      {'name':'q1', 'type':'quadrupole', 'L':0.2, 'K':2.0},
+      {'name':'d2', 'type':'drift', 'L':0.3},
+      {'name':'q2', 'type':'quadrupole', 'L':0.2, 'K':-3.0},
+      {'name':'s1', 'type':'solenoid', 'L':0.1, 'B':1.0, 'K':0.5},
+      {'name':'d3', 'type':'drift', 'L':0.2},
+    ],
+  }
+  errors = [(2, 'K', 0.01, 'normal', True), (4, 'K', 0.05, 'uniform'), (5, 'K', 0.02), (2, 'L', 0.001)]
+
+  def test_seeds(self):
+    "Each seed matches a Machine reconfigured with the same errors"
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    state, moment0, deltas = M.propagate_errors(S, self.errors, 5, observe=[3, 6], seed=1)
+    self.assertEqual(state.shape, (2, 5, 7, 7))
+    self.assertEqual(moment0.shape, (2, 5, 7))
+    self.assertEqual(deltas.shape, (5, 4))
+
+    self.assertTrue((numpy.abs(deltas[:,1])<=0.05).all())
+
+    for s in range(5):
+      M2 = Machine(self.lattice)
+      for (idx, param, _sigma), D in zip([E[:3] for E in self.errors], deltas[s]):
+        M2.reconfigure(idx, {param:M2.conf()['elements'][idx][param]+D})
+      S2 = M2.allocState({})
+      obs = M2.propagate(S2, observe=[3, 6])
+      for i in range(2):
+        NT.assert_allclose(state[i,s], obs[i][1].state, rtol=1e-12, atol=1e-15)
+        NT.assert_allclose(moment0[i,s], obs[i][1].moment0, rtol=1e-12, atol=1e-15)
+
+  def test_reproducible(self):
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    A = M.propagate_errors(S, self.errors, 8, seed=3, threads=1)
+    B = M.propagate_errors(S, self.errors, 8, seed=3, threads=3)
+    C = M.propagate_errors(S, self.errors, 4, seed=3)
+    for X, Y in zip(A, B):
+      NT.assert_array_equal(X, Y)
+    # the first seeds don't depend on the number of seeds
+    NT.assert_array_equal(A[0][:, :4], C[0])
+
+  def test_unchanged(self):
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    state, moment0, _D = M.propagate_errors(S, [], 2)
+    M.propagate(S)
+    NT.assert_array_equal(state[0,0], S.state)
+    NT.assert_array_equal(state[0,1], S.state)
+
+  def test_err(self):
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    self.assertRaises(ValueError, M.propagate_errors, S, [(0, 'K', 1.0)], 2)
+    self.assertRaises(ValueError, M.propagate_errors, S, [(100, 'K', 1.0)], 2)
+    self.assertRaises(ValueError, M.propagate_errors, S, [(2, 'K', 1.0, 'other')], 2)
+    self.assertRaises(ValueError, M.propagate_errors, S, [(2, 'k', 1.0)], 2)
+    self.assertRaises(ValueError, M.propagate_errors, S, [(2, 'name', 1.0)], 2)
+    self.assertRaises(ValueError, M.propagate_errors, S, [], 2, observe=[100])
+
+  def test_summary(self):
+    R = error_study(self.lattice, [('q1', 'K', 0.01, 'normal', True), ('s1', 'K', 0.02)],
+                    20, observe=['d2', 'd3'], threads=2)
+    self.assertEqual(R['observe'], [3, 6])
+    self.assertEqual(R['rms'].shape, (2, 20, 6))
+    self.assertEqual(R['mean'].shape, (2, 6))
+    self.assertEqual(R['percentiles'].shape, (3, 2, 6))
+    self.assertEqual(R['centroid'].shape, (2, 7))
+
+    NT.assert_allclose(R['rms'][1, 7, 0], numpy.sqrt(R['state'][1, 7, 0, 0]))
+    NT.assert_allclose(R['percentiles'][1], numpy.median(R['rms'], axis=1))
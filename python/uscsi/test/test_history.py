@@ -0,0 +1,100 @@
+from __future__ import print_function
+
+import unittest
+import os, tempfile
+import numpy
+from numpy import testing as NT
+
+from .. import Machine
+from ..history import load_history
+
+class TestHistory(unittest.TestCase):
+  def lattice(self, L=0.2):
+    return {
+      'sim_type':'MomentMatrix',
+      'elements':[
+        {'name':'S', 'type':'source', 'initial':numpy.identity(7)*1e-3, 'moment0':numpy.arange(7.0),
+         'IonEk':1e6},
+        {'name':'d1', 'type':'drift', 'L':0.1},
+        {'name':'d2', 'type':'drift', 'L':L},
+        {'name':'q1', 'type':'quadrupole', 'L':0.1, 'K':1.0},
+      ],
+    }
+
+  def setUp(self):
+    fd, self.fname = tempfile.mkstemp()
+    os.close(fd)
+    os.remove(self.fname)
+
+  def tearDown(self):
+    if os.path.exists(self.fname):
+      os.remove(self.fname)
+
+  def test_ring(self):
+    M = Machine(self.lattice())
+    self.assertIsNone(M.history())
+    self.assertRaises(ValueError, M.dump_history, self.fname)
+
+    M.set_history(6)
+    S = M.allocState({})
+    M.propagate(S)
+    H = M.history()
+    NT.assert_equal(H['index'], [0, 1, 2, 3])
+
+    M.propagate(S, 1)
+    H = M.history()
+    self.assertEqual(H.shape, (6,))
+    NT.assert_equal(H['index'], [1, 2, 3, 1, 2, 3])
+    self.assertEqual(H['state'].shape, (6, 7, 7))
+    self.assertEqual(H['moment0'].shape, (6, 7))
+    NT.assert_allclose(H['state'][-1], S.state)
+    NT.assert_allclose(H['moment0'][-1], S.moment0)
+    NT.assert_equal(H['IonEk'], 1e6)
+
+    M.dump_history(self.fname)
+    L = load_history(self.fname)
+    self.assertEqual(L.dtype, H.dtype)
+    NT.assert_equal(L, H)
+
+    M.set_history(0)
+    self.assertIsNone(M.history())
+
+  def test_new_states(self):
+    "Each State is recorded from its own arrays, even if allocated where a freed State was"
+    M = Machine(self.lattice())
+    M.set_history(4)
+    for k in range(5):
+      S = M.allocState({})
+      M.propagate(S, 0, 1)
+      S.moment0[:] = k
+      M.propagate(S, 1, 1)
+      expect = S.moment0.copy()
+      del S
+    NT.assert_equal(M.history()['moment0'][-1], expect)
+
+  def test_nonfinite(self):
+    M = Machine(self.lattice(L=float('nan')))
+    S = M.allocState({})
+
+    M.set_history(10) # no check
+    M.propagate(S)
+    self.assertTrue(numpy.isnan(S.state).any())
+
+    M.set_history(10, check_finite=True, dump=self.fname)
+    S = M.allocState({})
+    self.assertRaises(FloatingPointError, M.propagate, S)
+    self.assertEqual(S.next_elem, 3) # stopped after d2
+
+    H = M.history()
+    NT.assert_equal(H['index'], [0, 1, 2])
+    self.assertTrue(numpy.isfinite(H['state'][1]).all())
+    self.assertFalse(numpy.isfinite(H['state'][2]).all())
+
+    L = load_history(self.fname)
+    NT.assert_equal(L['index'], H['index'])
+    NT.assert_equal(L['state'], H['state'])
+
+  def test_badfile(self):
+    with open(self.fname, 'wb') as F:
+      F.write(b'not a history')
+    self.assertRaises(ValueError, load_history, self.fname)
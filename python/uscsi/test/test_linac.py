@@ -0,0 +1,175 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy
+from numpy import testing as NT
+
+from .. import Machine, LinacContext
+from . import BadBool
+
+IonEs = 931.49432e6
+
+def fieldmap():
+  # two gaps of opposite sign, as in a QWR.  s in [mm]
+  s = numpy.linspace(-120, 120, 241)
+  E = 3e6*(numpy.exp(-((s+40)/20)**2)-numpy.exp(-((s-40)/20)**2))
+  return numpy.column_stack((s, E))
+
+thinlens = """% thin lens model
+drift d1 70 20
+EFocus1 f1 0 20 0.01
+EDipole ed1 0 20 0.002
+EQuad eq1 0 20 0.003
+HMono hm1 0 20 0.001
+HDipole hd1 0 20 0.0005
+HQuad hq1 0 20 0.0007
+drift d2 10 20
+AccGap g1 0 20
+drift d3 10 20
+EFocus2 f2 0 20 0.01
+drift d4 60 20
+EFocus1 f3 0 20 0.01
+drift d5 10 20
+AccGap g2 0 20
+drift d6 10 20
+EFocus2 f4 0 20 0.01
+EDipole ed2 0 20 0.002
+EQuad eq2 0 20 0.003
+HMono hm2 0 20 0.001
+HDipole hd2 0 20 0.0005
+HQuad hq2 0 20 0.0007
+drift d7 70 20
+"""
+
+lattice = {
+  'sim_type':'MomentMatrix',
+  'elements':[
+    {'name':'S', 'type':'source', 'initial':numpy.identity(7),
+     'IonEs':IonEs, 'IonEk':0.5e6, 'IonW':IonEs+0.5e6},
+    {'name':'d1', 'type':'drift', 'L':0.072},
+    {'name':'cav1', 'type':'rfcavity', 'cavtype':'0.041QWR', 'L':0.24, 'f':80.5e6,
+     'phi':-35.0, 'scl_fac':0.64},
+    {'name':'d2', 'type':'drift', 'L':0.064},
+    {'name':'sol1', 'type':'solenoid', 'L':0.1, 'B':5.34},
+    {'name':'d3', 'type':'drift', 'L':0.076},
+    {'name':'cav2', 'type':'rfcavity', 'cavtype':'0.041QWR', 'L':0.24, 'f':80.5e6,
+     'phi':-35.0, 'scl_fac':0.7},
+    {'name':'d4', 'type':'drift', 'L':0.1},
+  ],
+}
+
+IonZ = numpy.asarray([33.0/238, 34.0/238])
+NChg = numpy.asarray([10111.0, 10531.0])
+M0 = numpy.asarray([[-0.0008, 1e-5, 0.0134, 6.7e-6, -0.0002, 0.0003],
+                    [0.0073, 1.5e-5, 0.0034, -7.4e-6, 0.023, 0.002]])
+S = numpy.asarray([numpy.diag([2.76, 3.8e-6, 2.36, 4.9e-6, 6.7e-4, 2.0e-6]),
+                   numpy.diag([2.79, 4.3e-6, 2.72, 4.4e-6, 1.1e-3, 1.7e-6])])
+
+def context():
+  ctx = LinacContext()
+  ctx.set_cavity('0.041QWR', fieldmap(), thinlens)
+  return ctx
+
+def run(ctx):
+  L = ctx.init_long(Machine(lattice), IonZ[0])
+  P = ctx.propagate([Machine(lattice), Machine(lattice)], IonZ, NChg, M0, S)
+  return L, P
+
+class TestLinac(unittest.TestCase):
+  def assertSame(self, A, B):
+    (LA, PA), (LB, PB) = A, B
+    for K in LA:
+      NT.assert_array_equal(LA[K], LB[K])
+    for K in ('s', 'centroid', 'rms', 'moment2'):
+      NT.assert_array_equal(PA[K], PB[K])
+
+  def test_run(self):
+    L, P = run(context())
+
+    self.assertEqual(L['s'].shape, (len(lattice['elements']),))
+    self.assertEqual(L['phase'].shape, (2,))
+    self.assertAlmostEqual(L['Ek'][0], 0.5, 9)
+    self.assertNotEqual(L['Ek'][-1], L['Ek'][0])
+    NT.assert_allclose(L['gamma'], 1+L['Ek']/(IonEs/1e6))
+
+    N = len(lattice['elements'])-1
+    self.assertEqual(P['s'].shape, (N,))
+    self.assertEqual(P['centroid'].shape, (N, 7))
+    self.assertEqual(P['rms'].shape, (N, 6))
+    self.assertEqual(P['moment2'].shape, (N, 7, 7))
+    NT.assert_allclose(P['rms']**2, numpy.diagonal(P['moment2'], axis1=1, axis2=2)[:,:6])
+    self.assertEqual(len(P['states']), 2)
+    self.assertTrue(numpy.all(numpy.isfinite(P['moment2'])))
+
+  def test_contexts(self):
+    # results don't depend on any other context
+    A = run(context())
+    ctx = LinacContext(mpole_level=0, emit_growth=True)
+    ctx.set_cavity('0.041QWR', fieldmap()*[1, 1.1], thinlens)
+    run(ctx)
+    self.assertSame(A, run(context()))
+
+  def test_emit_growth(self):
+    def ctx(growth):
+      ctx = LinacContext(emit_growth=growth)
+      ctx.set_cavity('0.041QWR', fieldmap(), thinlens)
+      return ctx
+    G = run(ctx(True))
+    self.assertSame(G, run(ctx(1)))
+    self.assertSame(run(context()), run(ctx([])))
+    self.assertFalse(numpy.array_equal(G[1]['moment2'], run(context())[1]['moment2']))
+    self.assertRaises(ZeroDivisionError, LinacContext, emit_growth=BadBool())
+
+  def test_generator(self):
+    "Machines which are only referenced by the argument"
+    ctx = context()
+    L, P = run(ctx)
+    G = ctx.propagate((Machine(lattice) for i in range(2)), IonZ, NChg, M0, S)
+    for K in ('s', 'centroid', 'rms', 'moment2'):
+      NT.assert_array_equal(G[K], P[K])
+
+  def test_threads(self):
+    serial = run(context())
+
+    R = [None]*4
+    def task(i):
+      R[i] = run(context())
+    T = [threading.Thread(target=task, args=(i,)) for i in range(len(R))]
+    [t.start() for t in T]
+    [t.join() for t in T]
+
+    for r in R:
+      self.assertSame(serial, r)
+
+  def test_datadir(self):
+    tmp = tempfile.mkdtemp()
+    try:
+      for n in ('41', '85'):
+        os.makedirs(os.path.join(tmp, 'data', 'Multipole'+n))
+        numpy.savetxt(os.path.join(tmp, 'data', 'axisData_%s.txt'%n), fieldmap())
+        with open(os.path.join(tmp, 'data', 'Multipole'+n, 'thinlenlon_%s.txt'%n), 'w') as F:
+          F.write(thinlens)
+
+      self.assertSame(run(context()), run(LinacContext(datadir=tmp)))
+    finally:
+      shutil.rmtree(tmp)
+
+  def test_errors(self):
+    ctx = LinacContext()
+    self.assertRaises(RuntimeError, LinacContext, datadir='/invalid/path')
+    self.assertRaises(ValueError, ctx.set_cavity, 'other', fieldmap(), thinlens)
+    self.assertRaises(RuntimeError, ctx.set_cavity, '0.041QWR', fieldmap(), 'unknown x 0 0\n')
+    self.assertRaises(ValueError, ctx.init_long, lattice, IonZ[0])
+    # no field map
+    self.assertRaises(RuntimeError, ctx.init_long, Machine(lattice), IonZ[0])
+
+    ctx = context()
+    ctx.init_long(Machine(lattice), IonZ[0])
+    self.assertRaises(ValueError, ctx.propagate, [Machine(lattice)], IonZ, NChg, M0, S)
+    self.assertRaises(ValueError, ctx.propagate, [Machine(lattice)]*2, IonZ, NChg, M0, S)
+    self.assertRaises(ValueError, ctx.propagate, [Machine(lattice), Machine(lattice)],
+                      IonZ, NChg, M0, S[:,:5,:5])
@@ -7,6 +7,7 @@ from numpy import testing as NT
 from numpy.testing import assert_array_almost_equal_nulp as assert_aequal
 
 from .. import Machine
+from . import BadBool
 
 class testBasic(unittest.TestCase):
   def setUp(self):
@@ -84,14 +85,13 @@ Transfer: [6,6]((1,1,0,0,0,0),(0,1,0,0,0,0),(0,0,1,1,0,0),(0,0,0,1,0,0),(0,0,0,0
     del S
     gc.collect()
 
-    # S should be kept alive by reference from state
-    self.assertIsNot(R(), None)
+    # state keeps the storage of S alive, but not S itself
+    self.assertIs(R(), None)
+    state[0] = 1.0
+    assert_aequal(state, [1.0, 0, 0, 0, 0, 0])
 
     del state
-
     gc.collect()
-    S = R()
-    self.assertIs(R(), None)
 
   def test_err(self):
     "Try to propagate the something which is not a State"
@@ -161,6 +161,60 @@ class TestObserve(unittest.TestCase):
         assert_aequal(results[3][1].state, [0, 0, 1.008, 1e-3, 0, 0])
         assert_aequal(results[4][1].state, [0, 0, 1.010, 1e-3, 0, 0])
 
+class TestClone(unittest.TestCase):
+    def setUp(self):
+        self.M = Machine(b"""
+        sim_type = "Vector";
+        L = 2.0e-3;
+        elem0: drift;
+        elem1: drift, L = 1.0e-3;
+        foo: LINE = (elem0, elem1);
+        """)
+
+    def test_clone(self):
+        import copy
+        for C in (self.M.clone(), copy.copy(self.M), copy.deepcopy(self.M)):
+            self.assertIsNot(C, self.M)
+            self.assertIsInstance(C, type(self.M))
+            self.assertEqual(len(C), 2)
+            self.assertEqual(str(C), str(self.M))
+
+            S = C.allocState({})
+            S.state[:] = [0, 0, 1, 1e-3, 0, 0]
+            C.propagate(S)
+            assert_aequal(S.state, [0, 0, 1.003, 1e-3, 0, 0])
+
+    def test_independent(self):
+        "Changes to a clone don't effect the original"
+        C = self.M.clone()
+        C.reconfigure(1, {'L':4.0e-3})
+
+        S = self.M.allocState({})
+        S.state[:] = [0, 0, 1, 1e-3, 0, 0]
+        self.M.propagate(S)
+        assert_aequal(S.state, [0, 0, 1.003, 1e-3, 0, 0])
+
+        S.state[:] = [0, 0, 1, 1e-3, 0, 0]
+        C.propagate(S)
+        assert_aequal(S.state, [0, 0, 1.006, 1e-3, 0, 0])
+
+    def test_source(self):
+        "Clone preserves the initial state of a source element"
+        T = numpy.asfarray([1, 0, 1, 0, 1, 0])
+        M = Machine({
+          'sim_type':'Vector',
+          'elements':[
+            {'name':'elem0', 'type':'source', 'initial':T},
+          ],
+        })
+        del self.M
+        C = M.clone()
+        del M
+
+        S = C.allocState({})
+        C.propagate(S)
+        assert_aequal(S.state, T)
+
 class TestGlobal(unittest.TestCase):
     def test_parse(self):
         "Test global scope when parsing"
@@ -303,3 +357,140 @@ class TestOptimze(unittest.TestCase):
 
         self.assertIn(ier, range(1,5)) # ier between 1 and 4 is success
         self.assertAlmostEqual(p1[0], self._expect_K, 6)
+
+class TestProfile(unittest.TestCase):
+  lattice = {
+    'sim_type':'Vector',
+    'elements':[
+      {'name':'d1', 'type':'drift', 'L':0.1},
+      {'name':'q1', 'type':'quadrupole', 'L':0.2, 'K':2.0},
+      {'name':'d2', 'type':'drift', 'L':0.3},
+    ],
+  }
+
+  def test_disabled(self):
+    M = Machine(self.lattice)
+    self.assertIsNone(M.profile())
+    M.reset_profile() # no-op
+
+  def test_counts(self):
+    M = Machine(self.lattice)
+    M.set_profile()
+    S = M.allocState({})
+    for i in range(3):
+      M.propagate(S)
+    M.propagate(S, 1, 1)
+    M.reconfigure(1, {'K':3.0})
+
+    P = M.profile()
+    self.assertEqual(P.dtype.names, ('index', 'name', 'type', 'calls', 'nsec', 'builds'))
+    NT.assert_equal(P['index'], [0, 1, 2])
+    self.assertEqual(list(P['name']), ['d1', 'q1', 'd2'])
+    self.assertEqual(list(P['type']), ['drift', 'quadrupole', 'drift'])
+    NT.assert_equal(P['calls'], [3, 4, 3])
+    NT.assert_equal(P['builds'], [0, 1, 0])
+    self.assertGreater(P['nsec'].sum(), 0)
+
+    T = M.profile(by='type')
+    self.assertEqual(sorted(T['type']), ['drift', 'quadrupole'])
+    D = T[T['type']=='drift'][0]
+    self.assertEqual(D['elements'], 2)
+    self.assertEqual(D['calls'], 6)
+    self.assertEqual(D['nsec'], P['nsec'][0]+P['nsec'][2])
+    self.assertGreaterEqual(T['nsec'][0], T['nsec'][1])
+
+    A = M.profile(by='machine')[0]
+    self.assertEqual(A['propagations'], 4)
+    self.assertEqual(A['states'], 1)
+    self.assertEqual(A['nsec'], P['nsec'].sum())
+
+    self.assertRaises(ValueError, M.profile, by='other')
+
+  def test_reset(self):
+    M = Machine(self.lattice)
+    M.set_profile(True)
+    M.propagate(M.allocState({}))
+    self.assertIsNone(M.clone().profile())
+
+    M.reset_profile()
+    P = M.profile()
+    NT.assert_equal(P['calls'], 0)
+    NT.assert_equal(P['nsec'], 0)
+
+    M.set_profile(False)
+    self.assertIsNone(M.profile())
+
+class TestLazy(unittest.TestCase):
+  lattice = {
+    'sim_type':'TransferMatrix',
+    'elements':[
+      {'name':'d1', 'type':'drift', 'L':0.1},
+      {'name':'q1', 'type':'quadrupole', 'L':0.2, 'K':2.0},
+      {'name':'d2', 'type':'drift', 'L':0.3},
+      {'name':'s1', 'type':'solenoid', 'L':0.1, 'B':2.0, 'K':1.0},
+    ],
+  }
+
+  def test_segment(self):
+    M, E = Machine(self.lattice, lazy=True), Machine(self.lattice)
+    self.assertEqual([M.is_built(i) for i in range(4)], [False]*4)
+    self.assertEqual([E.is_built(i) for i in range(4)], [True]*4)
+
+    # any truth value
+    self.assertFalse(Machine(self.lattice, lazy=1).is_built(0))
+    self.assertTrue(Machine(self.lattice, lazy=[]).is_built(0))
+    self.assertRaises(ZeroDivisionError, Machine, self.lattice, lazy=BadBool())
+
+    S, SE = M.allocState({}), E.allocState({})
+    M.propagate(S, 1, 2)
+    E.propagate(SE, 1, 2)
+    self.assertEqual([M.is_built(i) for i in range(4)], [False, True, True, False])
+    assert_aequal(S.state, SE.state)
+
+    # conf() doesn't build
+    self.assertEqual(M.conf()['elements'][3]['K'], 1.0)
+    self.assertFalse(M.is_built(3))
+
+    # unbuilt elements stay unbuilt in a copy
+    C = M.clone()
+    self.assertEqual([C.is_built(i) for i in range(4)], [False, True, True, False])
+
+    M.propagate(S)
+    E.propagate(SE)
+    assert_aequal(S.state, SE.state)
+    self.assertTrue(all(M.is_built(i) for i in range(4)))
+    self.assertRaises(ValueError, M.is_built, 4)
+
+  def test_reconfigure(self):
+    M = Machine(self.lattice, lazy=True)
+    M.reconfigure(1, {'K':3.0})
+    self.assertTrue(M.is_built(1))
+    self.assertEqual(M.conf()['elements'][1]['K'], 3.0)
+
+  def test_errors(self):
+    bad = {'sim_type':'TransferMatrix', 'elements':self.lattice['elements']+[{'name':'d3', 'type':'drift'}]}
+    # checked up front
+    self.assertRaises(KeyError, Machine, {'sim_type':'TransferMatrix', 'elements':[{'name':'x', 'type':'other'}]}, lazy=True)
+    self.assertRaises(KeyError, Machine, {'sim_type':'TransferMatrix', 'elements':[{'type':'drift', 'L':1.0}]}, lazy=True)
+    # found on first use
+    M = Machine(bad, lazy=True)
+    M.propagate(M.allocState({}), 0, 4)
+    self.assertRaisesRegexp(RuntimeError, "element 4 'd3' : missing required parameter 'L'", M.propagate, M.allocState({}))
+    # a bad element doesn't stop others being built
+    self.assertFalse(M.is_built(4))
+
+  def test_threads(self):
+    elements = [{'name':'d%d'%i, 'type':'drift', 'L':0.1} if i%2 else
+                {'name':'q%d'%i, 'type':'quadrupole', 'L':0.1, 'K':0.1} for i in range(1000)]
+    L = {'sim_type':'TransferMatrix', 'elements':elements}
+    M1, M4 = Machine(L, nthreads=1), Machine(L, nthreads=4)
+    S1, S4 = M1.allocState({}), M4.allocState({})
+    M1.propagate(S1)
+    M4.propagate(S4)
+    assert_aequal(S1.state, S4.state)
+    self.assertEqual([E['name'] for E in M4.conf()['elements']][:3], ['q0', 'd1', 'q2'])
+
+    # the first error is reported
+    elements[700] = {'name':'d700', 'type':'drift'}
+    elements[300] = {'name':'d300', 'type':'drift'}
+    self.assertRaisesRegexp(KeyError, "element 300 'd300'", Machine, L, nthreads=4)
@@ -56,3 +56,415 @@ class testBasic(unittest.TestCase):
 
     assert_aequal(S.moment0, self.expect0*5)
     assert_aequal(S.state, self.expect*25)
+
+class TestArray(unittest.TestCase):
+  def setUp(self):
+    self.M = Machine({
+      'sim_type':'MomentMatrix',
+      'elements':[
+        {'name':'elem0', 'type':'source', 'initial':numpy.identity(7), 'moment0':numpy.arange(7.0)},
+        {'name':'elem1', 'type':'generic', 'transfer':numpy.identity(7)*2.0},
+      ],
+    })
+
+  def test_cached(self):
+    S = self.M.allocState({})
+    A = S.state
+    self.assertIs(A, S.state)
+    self.assertIs(S.moment0, S.moment0)
+
+    self.M.propagate(S)
+    assert_aequal(A, numpy.identity(7)*4.0)
+
+    S.foo = 5 # regular attributes still work
+    self.assertEqual(S.foo, 5)
+    self.assertRaises(AttributeError, getattr, S, 'bar')
+
+  def test_gc(self):
+    import weakref, gc
+    S = self.M.allocState({})
+    S.state, S.moment0
+    R = weakref.ref(S)
+    gc.disable()
+    try:
+      del S
+      # no reference cycle with the cached views
+      self.assertIsNone(R())
+    finally:
+      gc.enable()
+
+    # a view keeps the storage alive, but not the State
+    S = self.M.allocState({})
+    S.state[0,0] = 42.0
+    A, B = S.state, S.moment0
+    R = weakref.ref(S)
+    del S
+    self.assertIsNone(R())
+    self.assertEqual(A[0,0], 42.0)
+    assert_aequal(B, numpy.zeros(7))
+    A[1,1] = 43.0
+    self.assertEqual(A[1,1], 43.0)
+
+  def test_array(self):
+    S = self.M.allocState({})
+    self.M.propagate(S)
+    layout = dict((name, (off, shape)) for name, off, shape in S.array_layout())
+    self.assertEqual(layout['state'], (0, (7,7)))
+    self.assertEqual(layout['moment0'], (49, (7,)))
+
+    A = S.to_array()
+    B = numpy.zeros_like(A)
+    self.assertIs(S.to_array(out=B), B)
+    assert_aequal(A, B)
+    assert_aequal(A[:49].reshape(7,7), numpy.identity(7)*4.0)
+    assert_aequal(A[49:56], numpy.arange(7.0)*2.0)
+
+    # buffer interface is a read-only copy with the same layout
+    V = memoryview(S)
+    self.assertTrue(V.readonly)
+    assert_aequal(numpy.frombuffer(S), A)
+
+    # while V is held, a new snapshot doesn't change it
+    S.state[:] = 3.0
+    W = memoryview(S)
+    assert_aequal(numpy.frombuffer(V), A)
+    assert_aequal(numpy.frombuffer(W)[:49], numpy.ones(49)*3.0)
+    del V, W
+    assert_aequal(numpy.frombuffer(S), S.to_array())
+
+    B[:49] = 2.0
+    S.from_array(B)
+    assert_aequal(S.state, numpy.ones((7,7))*2.0)
+    assert_aequal(S.moment0, numpy.arange(7.0)*2.0)
+
+    self.assertRaises(ValueError, S.to_array, out=numpy.zeros(3))
+    self.assertRaises(ValueError, S.from_array, numpy.zeros(3))
+
+class TestReuse(unittest.TestCase):
+  def setUp(self):
+    self.M = Machine({
+      'sim_type':'MomentMatrix',
+      'elements':[
+        {'name':'elem0', 'type':'generic', 'transfer':numpy.identity(7)*2.0},
+      ],
+    })
+
+  def test_assign(self):
+    S1 = self.M.allocState({'moment0':numpy.arange(7.0), 'IonZ':0.5})
+    S2 = self.M.allocState({})
+    self.M.propagate(S1)
+    S2.assign(S1)
+    assert_aequal(S2.state, S1.state)
+    assert_aequal(S2.moment0, numpy.arange(7.0)*2.0)
+    self.assertEqual(S2.IonZ, 0.5)
+
+    S1.state[0,0] = 42.0
+    self.assertNotEqual(S2.state[0,0], 42.0)
+
+  def test_reset(self):
+    S = self.M.allocState({'moment0':numpy.arange(7.0)})
+    A = S.state
+    self.M.propagate(S)
+    S.reset({'moment0':numpy.ones(7), 'IonEk':1.0})
+    assert_aequal(A, numpy.identity(7))
+    assert_aequal(S.moment0, numpy.ones(7))
+    self.assertEqual(S.IonEk, 1.0)
+
+  def test_pool(self):
+    P = self.M.state_pool(2, {'moment0':numpy.ones(7)})
+    self.assertEqual(len(P), 2)
+
+    S1, S2 = P.get(), P.get()
+    self.assertIsNot(S1, S2)
+    self.assertEqual(len(P), 0)
+
+    self.M.propagate(S1)
+    assert_aequal(S1.moment0, numpy.ones(7)*2.0)
+    P.put(S1)
+    self.assertEqual(len(P), 1)
+
+    S3 = P.get()
+    self.assertIs(S3, S1)
+    assert_aequal(S3.moment0, numpy.ones(7)) # initial values restored
+
+    S4 = P.get() # grows when empty
+    assert_aequal(S4.moment0, numpy.ones(7))
+
+class TestSensitivity(unittest.TestCase):
+  lattice = {
+    'sim_type':'MomentMatrix',
+    'elements':[
+      {'name':'S', 'type':'source', 'initial':numpy.identity(7)*1e-3+numpy.ones((7,7))*1e-4, 'moment0':numpy.arange(7.0)*1e-3},
+      {'name':'d1', 'type':'drift', 'L':0.1},
+      {'name':'q1', 'type':'quadrupole', 'L':0.2, 'K':2.0},
+      {'name':'d2', 'type':'drift', 'L':0.3},
+      {'name':'q2', 'type':'quadrupole', 'L':0.2, 'K':-3.0},
+      {'name':'s1', 'type':'solenoid', 'L':0.1, 'B':1.0, 'K':0.5},
+      {'name':'q3', 'type':'quadrupole', 'L':0.2, 'K':0.0},
+    ],
+  }
+  knobs = [(2, 'K'), (4, 'K'), (6, 'K'), (2, 'L'), (3, 'L'), (5, 'K')]
+
+  def numeric(self, observe):
+    M = Machine(self.lattice)
+    def run():
+      S = M.allocState({})
+      return [St for _i, St in M.propagate(S, observe=observe)]
+
+    J = numpy.zeros((len(observe), len(self.knobs), 7, 7))
+    Jm = numpy.zeros((len(observe), len(self.knobs), 7))
+    for j, (idx, param) in enumerate(self.knobs):
+      val = self.lattice['elements'][idx][param]
+      h = 1e-6*max(1.0, abs(val))
+      M.reconfigure(idx, {param:val+h})
+      P = run()
+      M.reconfigure(idx, {param:val-h})
+      N = run()
+      M.reconfigure(idx, {param:val})
+      for i in range(len(observe)):
+        J[i,j] = (P[i].state-N[i].state)/(2*h)
+        Jm[i,j] = (P[i].moment0-N[i].moment0)/(2*h)
+    return J, Jm
+
+  def test_jacobian(self):
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    dS, dm = M.sensitivity(S, self.knobs, observe=[3, 6])
+    self.assertEqual(dS.shape, (2, len(self.knobs), 7, 7))
+    self.assertEqual(dm.shape, (2, len(self.knobs), 7))
+
+    J, Jm = self.numeric([3, 6])
+    NT.assert_allclose(dS, J, rtol=1e-5, atol=1e-9)
+    NT.assert_allclose(dm, Jm, rtol=1e-5, atol=1e-9)
+
+    # knobs downstream of the observation point have no effect
+    self.assertTrue((dS[0, 1:3]==0).all())
+
+    # State is propagated as usual
+    S2 = M.allocState({})
+    M.propagate(S2)
+    assert_aequal(S.state, S2.state, 10)
+
+  def test_small_K(self):
+    "Quadrupole with |K|*L**2 < 1e-4, where d(transfer)/dK is a series expansion"
+    for K in [2.25e-3, -2.25e-3, 1e-6]:
+      lattice = {
+        'sim_type':'MomentMatrix',
+        'elements':[
+          {'name':'S', 'type':'source', 'initial':numpy.identity(7)+numpy.ones((7,7))*0.1},
+          {'name':'q1', 'type':'quadrupole', 'L':0.2, 'K':K},
+        ],
+      }
+      M = Machine(lattice)
+      dS, _dm = M.sensitivity(M.allocState({}), [(1, 'K')])
+
+      h = 1e-4
+      P, N = M.allocState({}), M.allocState({})
+      M.reconfigure(1, {'K':K+h})
+      M.propagate(P)
+      M.reconfigure(1, {'K':K-h})
+      M.propagate(N)
+      NT.assert_allclose(dS[0,0], (P.state-N.state)/(2*h), rtol=1e-8, atol=1e-7)
+
+  def test_err(self):
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    self.assertRaises(ValueError, M.sensitivity, S, [(0, 'K')])
+    self.assertRaises(ValueError, M.sensitivity, S, [(100, 'K')])
+
+class TestMatch(unittest.TestCase):
+  lattice = TestSensitivity.lattice
+
+  def test_recover(self):
+    "Recover known quadrupole strengths from the moments they produce"
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    (_i3, S3), (_i6, S6) = M.propagate(S, observe=[3, 6])
+
+    targets = [(6, (0,0), S6.state[0,0]),
+               (6, (2,2), S6.state[2,2]),
+               (3, (0,1), S3.state[0,1]),
+               (6, 0, S6.moment0[0])]
+
+    M.reconfigure(2, {'K':1.5})
+    M.reconfigure(4, {'K':-2.5})
+
+    S = M.allocState({})
+    R = M.match(S, [(2, 'K'), (4, 'K')], targets)
+
+    NT.assert_allclose(R['x'], [2.0, -3.0], rtol=1e-6)
+    self.assertLess(R['cost'], 1e-12)
+    self.assertGreater(R['iterations'], 0)
+
+    # Machine is left with the result
+    self.assertAlmostEqual(M.conf()['elements'][2]['K'], R['x'][0])
+    self.assertAlmostEqual(M.conf()['elements'][4]['K'], R['x'][1])
+
+  def test_weights(self):
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    R = M.match(S, [(2, 'K')], [(6, (0,0), 0.0)], weights=[2.0], maxiter=5)
+    self.assertLessEqual(R['iterations'], 5)
+
+    M.propagate(S)
+    self.assertAlmostEqual(R['cost'], (2.0*S.state[0,0])**2, 12)
+
+  def test_err(self):
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    self.assertRaises(ValueError, M.match, S, [], [(6, (0,0), 0.0)])
+    self.assertRaises(ValueError, M.match, S, [(2, 'K')], [])
+    self.assertRaises(ValueError, M.match, S, [(2, 'K')], [(6, (0,0), 0.0)], weights=[1.0, 2.0])
+    self.assertRaises(ValueError, M.match, S, [(2, 'K')], [(6, (9,0), 0.0)])
+
+class TestBeamStats(unittest.TestCase):
+  lattice = {
+    'sim_type':'MomentMatrix',
+    'elements':[
+      {'name':'S', 'type':'source', 'initial':numpy.identity(7)*1e-3},
+      {'name':'d1', 'type':'drift', 'L':0.1},
+      {'name':'q1', 'type':'quadrupole', 'L':0.2, 'K':2.0},
+      {'name':'d2', 'type':'drift', 'L':0.3},
+    ],
+  }
+
+  def states(self, M):
+    S1 = M.allocState({'initial':numpy.identity(7)*1e-3, 'moment0':numpy.arange(7.0)*1e-2})
+    S2 = M.allocState({'initial':numpy.ones((7,7))*1e-4+numpy.identity(7)*2e-3, 'moment0':-numpy.arange(7.0)*1e-2})
+    return S1, S2
+
+  def test_stats(self):
+    # start after the source
+    M2 = Machine(dict(self.lattice, elements=self.lattice['elements'][1:]))
+    S1, S2 = self.states(M2)
+    R = M2.beam_stats([S1, S2], weights=[1.0, 3.0], observe=[1, 2])
+
+    self.assertEqual(R['centroid'].shape, (2, 7))
+    self.assertEqual(R['moment2'].shape, (2, 7, 7))
+    self.assertEqual(R['rms'].shape, (2, 6))
+    self.assertEqual(R['emittance'].shape, (2, 3))
+
+    # states were propagated through the whole Machine
+    E1, E2 = self.states(M2)
+    L = M2.propagate(E1, observe=[2])[0][1]
+    NT.assert_allclose(S1.state, L.state)
+
+    for row, idx in enumerate([1, 2]):
+      E1, E2 = self.states(M2)
+      M2.propagate(E1, 0, idx+1)
+      M2.propagate(E2, 0, idx+1)
+      C = (E1.moment0+3*E2.moment0)/4
+      D1, D2 = E1.moment0-C, E2.moment0-C
+      M2nd = (E1.state+numpy.outer(D1, D1)+3*(E2.state+numpy.outer(D2, D2)))/4
+
+      NT.assert_allclose(R['centroid'][row], C, atol=1e-15)
+      NT.assert_allclose(R['moment2'][row], M2nd, rtol=1e-9, atol=1e-15)
+      NT.assert_allclose(R['rms'][row], numpy.sqrt(numpy.diag(M2nd)[:6]))
+      for p in range(3):
+        B = M2nd[2*p:2*p+2, 2*p:2*p+2]
+        self.assertAlmostEqual(R['emittance'][row,p], numpy.sqrt(numpy.linalg.det(B)), 12)
+
+  def test_generator(self):
+    "States which are only referenced by the argument"
+    M = Machine(self.lattice)
+    R = M.beam_stats(M.allocState({}) for i in range(3))
+    S = M.allocState({})
+    M.propagate(S)
+    NT.assert_allclose(R['moment2'][0], S.state, atol=1e-15)
+
+  def test_out(self):
+    M = Machine(self.lattice)
+    S1, S2 = self.states(M)
+    R = M.beam_stats([S1, S2])
+    out = dict((K, numpy.zeros_like(V)) for K, V in R.items())
+    S1, S2 = self.states(M)
+    R2 = M.beam_stats([S1, S2], out=out)
+    for K in R:
+      self.assertIs(R2[K], out[K])
+      NT.assert_allclose(out[K], R[K])
+
+    self.assertRaises(ValueError, M.beam_stats, [S1, S2], out={'rms':numpy.zeros(3)})
+    self.assertRaises(ValueError, M.beam_stats, [S1, S2], weights=[1.0])
+    self.assertRaises(ValueError, M.beam_stats, [S1], observe=[1, 1])
+
+class TestSample(unittest.TestCase):
+  elements = [
+    {'name':'S', 'type':'source', 'initial':numpy.identity(7)*1e-3+numpy.ones((7,7))*1e-4, 'moment0':numpy.arange(7.0)*1e-3},
+    {'name':'d1', 'type':'drift', 'L':0.4},
+    {'name':'q1', 'type':'quadrupole', 'L':0.3, 'K':2.0},
+    {'name':'m1', 'type':'marker'},
+    {'name':'q2', 'type':'quadrupole', 'L':0.2, 'K':-3.0},
+    {'name':'s1', 'type':'solenoid', 'L':0.2, 'B':1.0, 'K':0.5},
+    {'name':'b1', 'type':'sbend', 'L':0.3, 'phi':0.1, 'K':0.5},
+    {'name':'c1', 'type':'rfcavity', 'L':0.2, 'cavtype':'0.041QWR'},
+    {'name':'d2', 'type':'drift', 'L':0.1},
+  ]
+
+  def sliced(self, n):
+    "The same lattice, with each element divided into 'n' pieces"
+    E = [self.elements[0]]
+    for elem in self.elements[1:]:
+      if 'L' not in elem or elem['type']=='rfcavity':
+        E.append(elem)
+        continue
+      for i in range(n):
+        P = dict(elem, name='%s_%d'%(elem['name'], i), L=elem['L']/n)
+        if 'phi' in P:
+          P['phi'] = elem['phi']/n
+        E.append(P)
+    return Machine({'sim_type':'MomentMatrix', 'elements':E})
+
+  def test_sliced(self):
+    M, MS = Machine({'sim_type':'MomentMatrix', 'elements':self.elements}), self.sliced(4)
+    S = M.allocState({})
+    # element ends, and inside each element
+    spos = numpy.cumsum([0.0]+[E.get('L', 0.0)/4 for E in self.elements[1:] for _i in range(4)])
+    spos = numpy.unique(spos.round(12))
+    R = M.sample(S, s=spos)
+
+    self.assertEqual(R['moment0'].shape, (len(spos), 7))
+    self.assertEqual(R['state'].shape, (len(spos), 7, 7))
+
+    # compare with the sliced lattice at the same positions
+    SS = MS.allocState({})
+    Es = MS.conf()['elements']
+    Ls = numpy.cumsum([E.get('L', 0.0) for E in Es])
+    expect = {}
+    for idx, St in MS.propagate(SS, observe=range(len(Es))):
+      expect[round(Ls[idx], 12)] = St
+
+    inside_cav = (spos>1.4+1e-9) & (spos<1.6-1e-9)
+    NT.assert_allclose(R['s'][inside_cav], 1.6)
+    NT.assert_allclose(R['s'][~inside_cav], spos[~inside_cav])
+    NT.assert_equal(R['index'][spos==0.5], 2) # q1
+    NT.assert_equal(R['index'][-1], len(self.elements)-1)
+
+    for i, s in enumerate(R['s']):
+      St = expect[round(s, 12)]
+      NT.assert_allclose(R['moment0'][i], St.moment0, rtol=1e-9, atol=1e-15)
+      NT.assert_allclose(R['state'][i], St.state, rtol=1e-9, atol=1e-15)
+
+    # State is propagated as usual
+    NT.assert_allclose(S.state, SS.state, rtol=1e-9, atol=1e-15)
+
+  def test_step(self):
+    M = Machine({'sim_type':'MomentMatrix', 'elements':self.elements})
+    R = M.sample(M.allocState({}), step=0.25)
+    NT.assert_allclose(R['s'][:6], numpy.arange(6)*0.25)
+    self.assertAlmostEqual(R['s'][-1], 1.7)
+
+    out = {'moment0':numpy.zeros_like(R['moment0']), 'state':numpy.zeros_like(R['state'])}
+    R2 = M.sample(M.allocState({}), step=0.25, out=out)
+    self.assertIs(R2['state'], out['state'])
+    NT.assert_equal(out['state'], R['state'])
+    NT.assert_equal(out['moment0'], R['moment0'])
+
+  def test_err(self):
+    M = Machine({'sim_type':'MomentMatrix', 'elements':self.elements})
+    S = M.allocState({})
+    self.assertRaises(ValueError, M.sample, S)
+    self.assertRaises(ValueError, M.sample, S, s=[0.2, 0.1])
+    self.assertRaises(ValueError, M.sample, S, s=[-0.1])
+    self.assertRaises(ValueError, M.sample, S, s=[2.0])
+    self.assertRaises(ValueError, M.sample, S, s=[0.1], step=0.1)
+    self.assertRaises(ValueError, M.sample, S, step=0.5, out={'state':numpy.zeros(3)})
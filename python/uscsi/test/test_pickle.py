@@ -0,0 +1,111 @@
+from __future__ import print_function
+
+import unittest, os, pickle
+import numpy
+from numpy.testing import assert_array_almost_equal_nulp as assert_aequal
+
+from .. import Machine, Config, GLPSPrinter
+from ..shared import SharedStates
+
+datadir = os.path.dirname(__file__)
+
+def roundtrip(obj):
+    return pickle.loads(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+class TestPickle(unittest.TestCase):
+    lattice = b"""
+sim_type = "MomentMatrix";
+IonZ = 0.5;
+x1: drift, L=4, extra=[1,2,3];
+x2: drift, L=2;
+foo: LINE = (x1, x2, x1);
+"""
+
+    def test_config(self):
+        C = Config(self.lattice)
+        C2 = roundtrip(C)
+
+        self.assertEqual(GLPSPrinter(C2), GLPSPrinter(C))
+        # global scope still inherited by elements
+        self.assertEqual(C2['elements'][1]['IonZ'], 0.5)
+        self.assertNotIn('IonZ', C2['elements'][1].keys())
+
+        self.assertEqual(roundtrip(Config()).todict(), {})
+
+        C3 = Config()
+        self.assertRaises(ValueError, C3.__setstate__, b'junk')
+
+    def test_machine(self):
+        with open(os.path.join(datadir, 'moment_jb_2.lat'), 'rb') as F:
+            M = Machine(F.read())
+        M.reconfigure(2, {'L':0.5})
+
+        M2 = roundtrip(M)
+        self.assertEqual(str(M2), str(M))
+
+        S, S2 = M.allocState({}), M2.allocState({})
+        M.propagate(S)
+        M2.propagate(S2)
+        assert_aequal(S2.state, S.state)
+        assert_aequal(S2.moment0, S.moment0)
+
+    def test_state(self):
+        M = Machine(self.lattice)
+        S = M.allocState({'moment0':numpy.arange(7.0), 'IonEk':2.0})
+        S.state[1,2] = 42.0
+
+        S2 = roundtrip(S)
+        self.assertIsNot(S2, S)
+        assert_aequal(S2.state, S.state)
+        assert_aequal(S2.moment0, S.moment0)
+        self.assertEqual(S2.IonEk, 2.0)
+        self.assertLess(len(pickle.dumps(S, 2)), 600)
+
+_shared, _machine = None, None
+
+def _init(shared, machine):
+    global _shared, _machine
+    _shared, _machine = shared, machine
+
+def _work(i):
+    S = _machine.allocState({})
+    _shared.load(i, S)
+    _machine.propagate(S)
+    _shared.store(i, S)
+    return i
+
+class TestShared(unittest.TestCase):
+    def test_local(self):
+        M = Machine(TestPickle.lattice)
+        SS = SharedStates(M, 3)
+        self.assertEqual(len(SS), 3)
+
+        S = M.allocState({'moment0':numpy.ones(7)})
+        SS.store(1, S)
+        assert_aequal(SS.view(1, 'moment0'), numpy.ones(7))
+
+        S2 = M.allocState({})
+        SS.load(1, S2)
+        assert_aequal(S2.moment0, numpy.ones(7))
+
+    def test_pool(self):
+        import multiprocessing
+        M = Machine(TestPickle.lattice)
+        SS = SharedStates(M, 4)
+
+        S = M.allocState({})
+        for i in range(4):
+            S.moment0[:] = i
+            SS.store(i, S)
+
+        P = multiprocessing.Pool(2, initializer=_init, initargs=(SS, M))
+        try:
+            self.assertEqual(sorted(P.map(_work, range(4))), list(range(4)))
+        finally:
+            P.close()
+            P.join()
+
+        for i in range(4):
+            S.moment0[:] = i
+            M.propagate(S)
+            assert_aequal(SS.view(i, 'moment0'), S.moment0)
@@ -0,0 +1,98 @@
+from __future__ import print_function
+
+import unittest
+import numpy
+from numpy import testing as NT
+
+from .. import Machine
+from ..rfcavity import cavity_boost, phase_cavities
+
+C0 = 2.99792458e8
+IonEs = 931.49432e6
+
+def fieldmap():
+  # two gaps of opposite sign, as in a QWR.  s in [mm]
+  s = numpy.linspace(0, 240, 481)
+  E = 5e6*(numpy.exp(-((s-80)/20)**2)-numpy.exp(-((s-160)/20)**2))
+  return numpy.column_stack((s, E))
+
+def refboost(fmap, f, IonZ, IonEs, IonW, phase, scale):
+  "Transcription of GetCavBoost() from src/main.cpp, in [eV/u]"
+  s, E = fmap[:,0], fmap[:,1]
+  dz = (s[-1]-s[0])/(len(s)-1)
+  lam = C0/f*1e3
+  beta = numpy.sqrt(1-(IonEs/IonW)**2)
+  K, Fy, W = 2*numpy.pi/(beta*lam), phase, IonW
+  for k in range(len(s)-1):
+    last = Fy
+    Fy += K*dz
+    W += IonZ*scale*(E[k]+E[k+1])/2*numpy.cos((last+Fy)/2)*dz/1e3
+    beta = numpy.sqrt(1-(IonEs/W)**2)
+    K = 2*numpy.pi/(beta*lam)
+  return W, Fy
+
+class TestBoost(unittest.TestCase):
+  def test_reference(self):
+    F = fieldmap()
+    phases = numpy.linspace(-numpy.pi, numpy.pi, 7)
+    W, Fy = cavity_boost(F, 80.5e6, phases, 0.8, IonZ=0.138, IonEs=IonEs, IonW=IonEs+0.5e6)
+    for i, P in enumerate(phases):
+      Wr, Fyr = refboost(F, 80.5e6, 0.138, IonEs, IonEs+0.5e6, P, 0.8)
+      self.assertAlmostEqual(W[i], Wr, 4)
+      self.assertAlmostEqual(Fy[i], Fyr, 9)
+
+  def test_broadcast(self):
+    F = fieldmap()
+    phases = numpy.linspace(0, 2*numpy.pi, 5)
+    scales = numpy.asarray([0.0, 0.5, 1.0])[:,None]
+    W, Fy = cavity_boost(F, 80.5e6, phases, scales, IonZ=0.138, IonEs=IonEs, IonW=IonEs+0.5e6)
+    self.assertEqual(W.shape, (3, 5))
+    self.assertEqual(Fy.shape, (3, 5))
+    NT.assert_allclose(W[0], IonEs+0.5e6)
+    W1, _Fy1 = cavity_boost(F, 80.5e6, phases[2], 0.5, IonZ=0.138, IonEs=IonEs, IonW=IonEs+0.5e6)
+    self.assertAlmostEqual(W1, W[1,2], 4)
+
+  def test_badmap(self):
+    self.assertRaises(ValueError, cavity_boost, [[0.0, 1.0]], 80.5e6, 0.0,
+                      IonZ=0.138, IonEs=IonEs, IonW=IonEs+0.5e6)
+
+class TestPhasing(unittest.TestCase):
+  lattice = {
+    'sim_type':'MomentMatrix',
+    'elements':[
+      {'name':'S', 'type':'source', 'initial':numpy.identity(7), 'IonEs':IonEs, 'IonW':IonEs+0.5e6},
+      {'name':'d1', 'type':'drift', 'L':0.1},
+      {'name':'cav1', 'type':'rfcavity', 'cavtype':'test', 'L':0.24, 'f':80.5e6, 'phi':0.0, 'scl_fac':1.0},
+      {'name':'d2', 'type':'drift', 'L':0.3},
+      {'name':'cav2', 'type':'rfcavity', 'cavtype':'test', 'L':0.24, 'f':80.5e6, 'phi':-30.0, 'scl_fac':0.5},
+    ],
+  }
+
+  def test_phase(self):
+    F = fieldmap()
+    R = phase_cavities(self.lattice, {'test':F}, IonZ=0.138)
+    NT.assert_equal(R['index'], [2, 4])
+    self.assertEqual(R['name'], ['cav1', 'cav2'])
+
+    beta = numpy.sqrt(1-(IonEs/(IonEs+0.5e6))**2)
+    self.assertAlmostEqual(R['FyAbs'][0], 2*numpy.pi*80.5e6/(beta*C0)*0.1, 9)
+    self.assertEqual(R['IonW_in'][0], IonEs+0.5e6)
+    self.assertEqual(R['IonW_out'][0], R['IonW_in'][1])
+
+    for i, (phi, scl) in enumerate([(0.0, 1.0), (-30.0, 0.5)]):
+      crest = R['crest'][i]
+      W, _Fy = cavity_boost(F, 80.5e6, crest+numpy.asarray([-0.01, 0, 0.01]), scl,
+                            IonZ=0.138, IonEs=IonEs, IonW=R['IonW_in'][i])
+      self.assertTrue(W[1]>=W[0] and W[1]>=W[2], W)
+
+      W, _Fy = cavity_boost(F, 80.5e6, crest+numpy.deg2rad(phi), scl,
+                            IonZ=0.138, IonEs=IonEs, IonW=R['IonW_in'][i])
+      self.assertAlmostEqual(W, R['IonW_out'][i], 4)
+
+      P = numpy.angle(numpy.exp(1j*(crest+numpy.deg2rad(phi)-R['FyAbs'][i])))
+      self.assertAlmostEqual(numpy.cos(R['phase'][i]-P), 1.0, 9)
+
+    self.assertTrue(R['IonW_out'][1]>R['IonW_in'][1])
+
+  def test_nomap(self):
+    self.assertRaises(ValueError, phase_cavities, self.lattice, {'other':fieldmap()})
@@ -0,0 +1,52 @@
+from __future__ import print_function
+
+import unittest
+import numpy
+from numpy.testing import assert_array_almost_equal as assert_aequal
+
+from .. import Machine
+from ..scan import scan
+
+class TestScan(unittest.TestCase):
+    lattice = b"""
+sim_type = "MomentMatrix";
+S: source, initial=[1,0,0,0,0,0,0, 0,1,0,0,0,0,0, 0,0,1,0,0,0,0, 0,0,0,1,0,0,0, 0,0,0,0,1,0,0, 0,0,0,0,0,1,0, 0,0,0,0,0,0,1];
+d1: drift, L=0.1;
+q1: quadrupole, L=0.1, K=2;
+d2: drift, L=0.2;
+foo: LINE = (S, d1, q1, d2, q1);
+"""
+    Ks = [1.0, 2.0, 3.0]
+    Ls = [0.1, 0.3]
+
+    def expect(self):
+        M = Machine(self.lattice)
+        E = numpy.zeros((3, 2, 2, 7, 7))
+        for i, K in enumerate(self.Ks):
+            for q in (2, 4):
+                M.reconfigure(q, {'K':K})
+            for j, L in enumerate(self.Ls):
+                M.reconfigure(3, {'L':L})
+                S = M.allocState({})
+                for n, (idx, St) in enumerate(M.propagate(S, observe=[2, 4])):
+                    E[i,j,n] = St.state
+        return E
+
+    def test_local(self):
+        progress = []
+        R = scan(self.lattice, [('q1', 'K', self.Ks), (3, 'L', self.Ls)],
+                 observe=[2, 4], processes=0, chunksize=2,
+                 progress=lambda *args:progress.append(args))
+
+        self.assertEqual(R.shape, (3, 2, 2, 7, 7))
+        assert_aequal(R, self.expect())
+        self.assertEqual([P[:2] for P in progress], [(2,6), (4,6), (6,6)])
+
+    def test_pool(self):
+        R = scan(Machine(self.lattice), [('q1', 'K', self.Ks), (3, 'L', self.Ls)],
+                 observe=[4, 2], processes=2)
+        assert_aequal(R, self.expect())
+
+    def test_default(self):
+        R = scan(self.lattice, [(3, 'L', self.Ls)], processes=0)
+        self.assertEqual(R.shape, (2, 1, 7, 7))
@@ -0,0 +1,162 @@
+from __future__ import print_function
+
+import unittest
+import os, tempfile, threading, time
+import numpy
+from numpy import testing as NT
+
+from .. import Machine
+from ..scan import scan
+from ..server import Server, Client, RemoteError
+
+datadir = os.path.dirname(__file__)
+
+class TestServer(unittest.TestCase):
+  def setUp(self):
+    with open(os.path.join(datadir, 'moment_jb_2.lat'), 'rb') as F:
+      self.lattice = F.read()
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'uscsi.sock')
+    self.server = Server(self.path, machines={'jb':self.lattice}, workers=2)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    self.client = Client(self.path, timeout=10.0)
+
+  def tearDown(self):
+    self.client.close()
+    self.server.shutdown()
+    self.thread.join()
+    os.rmdir(self.dir)
+
+  def test_propagate(self):
+    C, M = self.client, Machine(self.lattice)
+    self.assertEqual(C.ping(), 'pong')
+    self.assertEqual(C.machines(), {'jb':{'sim_type':'MomentMatrix', 'elements':len(M)}})
+
+    S = M.allocState({})
+    M.propagate(S)
+    S2 = C.propagate('jb')
+    NT.assert_equal(S2.state, S.state)
+    NT.assert_equal(S2.moment0, S.moment0)
+    self.assertEqual(S2.IonEk, S.IonEk)
+
+    # initial values from a State, and observe
+    S = M.allocState({})
+    M.propagate(S, 0, 3)
+    I = M.allocState({})
+    I.assign(S)
+    obs = M.propagate(S, 3, observe=[5, 7])
+    S2, obs2 = C.propagate('jb', state=I, start=3, observe=[5, 7])
+    NT.assert_equal(S2.state, S.state)
+    self.assertEqual([i for i, _S in obs2], [5, 7])
+    NT.assert_equal(obs2[1][1].state, obs[1][1].state)
+
+  def test_reconfigure(self):
+    C, M = self.client, Machine(self.lattice)
+    C.propagate('jb') # leaves an idle clone on the server
+
+    M.reconfigure(2, {'L':0.5})
+    C.reconfigure('jb', 2, {'L':0.5})
+    self.assertEqual(C.conf('jb')['elements'][2]['L'], 0.5)
+
+    S = M.allocState({})
+    M.propagate(S)
+    NT.assert_equal(C.propagate('jb').state, S.state)
+
+  def test_scan(self):
+    C, M = self.client, Machine(self.lattice)
+    grid = [(2, 'L', numpy.linspace(0.1, 0.3, 3))]
+    NT.assert_equal(C.scan('jb', grid, observe=[4, 6]), scan(M, grid, observe=[4, 6], processes=0))
+
+  def test_load(self):
+    C = self.client
+    N = C.load('vec', {'sim_type':'Vector', 'elements':[
+                  {'name':'d', 'type':'drift', 'L':1.0},
+                  {'name':'q', 'type':'quadrupole', 'L':1.0, 'K':0.5},
+               ]})
+    self.assertEqual(N, 2)
+    self.assertEqual(sorted(C.machines()), ['jb', 'vec'])
+    S = C.propagate('vec', config={'initial':numpy.ones(6)})
+    self.assertEqual(S.state.shape, (6,))
+
+    C.unload('vec')
+    self.assertEqual(sorted(C.machines()), ['jb'])
+
+  def test_errors(self):
+    C = self.client
+    try:
+      C.propagate('nosuch')
+      self.fail("expected RemoteError")
+    except RemoteError as e:
+      self.assertEqual(e.type, 'KeyError')
+    self.assertRaises(RemoteError, C.reconfigure, 'jb', 'nosuch', {'L':1.0})
+    self.assertRaises(RemoteError, C._call, 'nosuch')
+    # connection still usable
+    self.assertEqual(C.ping(), 'pong')
+
+  def test_concurrent(self):
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    M.propagate(S)
+
+    results = []
+    def run():
+      with Client(self.path, timeout=10.0) as C:
+        for i in range(10):
+          results.append(C.propagate('jb').state)
+    T = [threading.Thread(target=run) for i in range(4)]
+    [t.start() for t in T]
+    [t.join() for t in T]
+    self.assertEqual(len(results), 40)
+    for R in results:
+      NT.assert_equal(R, S.state)
+
+  def test_overlap(self):
+    "propagate requests release the GIL, so they run alongside each other and other threads"
+    elements = []
+    for i in range(100):
+      # a source without particles ends a group of combined transfer matrices
+      elements += [{'name':'d%d'%i, 'type':'drift', 'L':0.1}, {'name':'s%d'%i, 'type':'source'}]
+    self.client.load('ens', {'sim_type':'Ensemble', 'elements':elements})
+
+    results, errors = [], []
+    def run():
+      try:
+        with Client(self.path, timeout=10.0) as C:
+          results.append(C.propagate('ens', config={'count':100000}))
+      except Exception as e:
+        errors.append(e)
+    T = [threading.Thread(target=run) for i in range(2)]
+
+    ticks = [time.time()]
+    [t.start() for t in T]
+    while any(t.is_alive() for t in T):
+      time.sleep(0.001)
+      ticks.append(time.time())
+    [t.join() for t in T]
+
+    self.assertEqual(errors, [])
+    self.assertEqual(len(results), 2)
+    for R in results:
+      self.assertEqual(R.state.shape, (100000, 7))
+      self.assertTrue((R.state==0).all())
+
+    # this thread kept running while the requests were processed
+    self.assertLess(numpy.diff(ticks).max(), (ticks[-1]-ticks[0])/4)
+    # and both requests needed a Machine at the same time
+    self.assertEqual(len(self.server._entry('ens').idle), 2)
+
+  def test_ensemble(self):
+    conf = {'sim_type':'Ensemble', 'elements':[
+              {'name':'d', 'type':'drift', 'L':1.0},
+              {'name':'q', 'type':'quadrupole', 'L':1.0, 'K':0.5},
+           ]}
+    C, M = self.client, Machine(conf)
+    C.load('ens', conf)
+    P = numpy.random.RandomState(1).randn(10, 7)
+
+    S = M.allocState({'particles':P})
+    obs = M.propagate(S, observe=[0])
+    S2, obs2 = C.propagate('ens', config={'particles':P}, observe=[0])
+    NT.assert_equal(S2.state, S.state)
+    NT.assert_equal(obs2[0][1].state, obs[0][1].state)
@@ -0,0 +1,187 @@
+from __future__ import print_function
+
+import os
+import unittest
+import numpy
+from numpy import testing as NT
+
+from .. import Machine
+from ..stripper import charge_distribution, propagate_charge_states
+from ..rfcavity import phase_cavities
+from .test_rfcavity import fieldmap
+
+IonEs = 931.49432e6
+
+datadir = os.path.dirname(__file__)
+
+def baron(IonEk, Q):
+  "Transcription of ChargeStripper() from src/main.cpp"
+  beta = numpy.sqrt(1-(IonEs/(IonEk+IonEs))**2)
+  Q1 = 92*(1-numpy.exp(-83.275*(beta/92**0.447)))
+  Qa = Q1*(1-numpy.exp(-12.905+0.2124*92-0.00122*92**2))
+  Y = Q1/92
+  d = numpy.sqrt(Q1*(0.07535+0.19*Y-0.2654*Y**2))
+  return 1/numpy.sqrt(2*numpy.pi)/d*numpy.exp(-0.5*(Q-Qa)**2/d**2)
+
+class TestModel(unittest.TestCase):
+  def test_default(self):
+    R = charge_distribution(16.623e6)
+    NT.assert_allclose(R['charges'], numpy.arange(76, 81)/238.0)
+    self.assertAlmostEqual(R['IonZ'], 78/238.0)
+    self.assertAlmostEqual(R['IonEk'], 16.348e6, 2)
+    self.assertAlmostEqual(R['sigma'], 0.10681e6*3*0.2/numpy.sqrt(3), 2)
+    NT.assert_allclose(R['fractions'], baron(16.623e6, numpy.arange(76, 81)))
+    # most of the beam is in the default states
+    self.assertTrue(0.5<R['fractions'].sum()<1.0)
+
+  def test_batch(self):
+    thick = numpy.linspace(1, 5, 9)[:,None]
+    R = charge_distribution([16e6, 17e6, 18e6], thickness=thick, variation=10.0,
+                            config={'Stripper_IonChargeStates':numpy.arange(70, 86)/238.0})
+    self.assertEqual(R['IonEk'].shape, (9, 3))
+    self.assertEqual(R['fractions'].shape, (9, 3, 16))
+    NT.assert_allclose(R['IonEk'][4], 16.348e6+(numpy.asarray([16e6, 17e6, 18e6])-16.623e6)*1.00547, rtol=1e-12)
+    NT.assert_allclose(numpy.diff(R['IonEk'][:,0]), -0.10681e6*0.5, rtol=1e-9)
+    NT.assert_allclose(R['sigma'][:,0], 0.10681e6*thick[:,0]*0.1/numpy.sqrt(3), rtol=1e-12)
+    # charge distribution depends only on energy
+    NT.assert_allclose(R['fractions'][0], R['fractions'][8])
+    NT.assert_allclose(R['fractions'].sum(axis=-1), 1.0, rtol=1e-2)
+
+  def test_badconfig(self):
+    self.assertRaises(ValueError, charge_distribution, 16e6, config={'StripperPara':[1.0, 2.0]})
+
+class TestElement(unittest.TestCase):
+  lattice = {
+    'sim_type':'MomentMatrix',
+    'elements':[
+      {'name':'S', 'type':'source', 'initial':numpy.identity(7)*1e-2, 'moment0':numpy.arange(7.0)*1e-3,
+       'IonZ':33/238.0, 'IonEs':IonEs, 'IonEk':16.623e6, 'IonW':IonEs+16.623e6},
+      {'name':'d1', 'type':'drift', 'L':0.1},
+      {'name':'foil', 'type':'stripper', 'thickness':4.0, 'charge_model':1},
+      {'name':'d2', 'type':'drift', 'L':0.2},
+    ],
+  }
+
+  def test_advance(self):
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    M.propagate(S, 0, 2)
+    before = S.state.copy()
+    M.propagate(S, 2, 1)
+
+    a, sigma = 1.00547, 0.10681*4*0.2/numpy.sqrt(3) # [MeV/u]
+    self.assertAlmostEqual(S.IonZ, 78/238.0)
+    self.assertAlmostEqual(S.IonEk, 16.348e6-0.10681e6, 2)
+    self.assertAlmostEqual(S.IonW, S.IonEk+IonEs, 2)
+    self.assertAlmostEqual(S.moment0[5], 5e-3*a)
+    self.assertAlmostEqual(S.state[5,5], before[5,5]*a*a+sigma**2)
+    NT.assert_allclose(S.state[:5,:5], before[:5,:5])
+
+  def test_errors(self):
+    "propagate_errors() passes through the stripper"
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    state, _moment0, _deltas = M.propagate_errors(S, [(1, 'L', 0.0)], 2)
+    M.propagate(S)
+    NT.assert_allclose(state[0,0], S.state)
+
+  def test_sensitivity(self):
+    "Derivatives include the straggling added by the stripper"
+    knobs = [(2, 'thickness'), (1, 'L'), (3, 'L')]
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    dS, dm = M.sensitivity(S, knobs, observe=[3])
+
+    S2 = M.allocState({})
+    M.propagate(S2)
+    NT.assert_allclose(S.state, S2.state)
+    self.assertEqual(S.IonEk, S2.IonEk)
+
+    for j, (idx, param) in enumerate(knobs):
+      val = self.lattice['elements'][idx][param]
+      h = 1e-6*max(1.0, abs(val))
+      P, N = M.allocState({}), M.allocState({})
+      M.reconfigure(idx, {param:val+h})
+      M.propagate(P)
+      M.reconfigure(idx, {param:val-h})
+      M.propagate(N)
+      M.reconfigure(idx, {param:val})
+      NT.assert_allclose(dS[0,j], (P.state-N.state)/(2*h), rtol=1e-5, atol=1e-9)
+      NT.assert_allclose(dm[0,j], (P.moment0-N.moment0)/(2*h), rtol=1e-5, atol=1e-9)
+    self.assertNotEqual(dS[0,0,5,5], 0.0)
+
+  def test_match(self):
+    "Recover the thickness from the energy spread after the stripper"
+    M = Machine(self.lattice)
+    S = M.allocState({})
+    M.propagate(S)
+    target = S.state[5,5]
+
+    M.reconfigure(2, {'thickness':3.0})
+    R = M.match(M.allocState({}), [(2, 'thickness')], [(3, (5,5), target)])
+    self.assertAlmostEqual(R['x'][0], 4.0, 5)
+    self.assertLess(R['cost'], 1e-20)
+
+  def test_charge_states(self):
+    R = propagate_charge_states(self.lattice, stripper='foil')
+    self.assertEqual(R['index'], 2)
+    self.assertEqual(len(R['states']), 5)
+    NT.assert_allclose(R['fractions'], charge_distribution(16.623e6)['fractions'])
+    for Z, S in zip(R['charges'], R['states']):
+      self.assertEqual(S.IonZ, Z)
+      self.assertAlmostEqual(S.IonEk, 16.348e6-0.10681e6, 2)
+
+  def test_disabled(self):
+    "Without charge_model the stripper doesn't change the State"
+    elements = [dict(E) for E in self.lattice['elements']]
+    del elements[2]['charge_model']
+    M = Machine(dict(self.lattice, elements=elements))
+    S = M.allocState({})
+    M.propagate(S, 0, 2)
+    IonEk, IonZ, state = S.IonEk, S.IonZ, S.state.copy()
+    M.propagate(S, 2, 1)
+    self.assertEqual(S.IonEk, IonEk)
+    self.assertEqual(S.IonZ, IonZ)
+    NT.assert_equal(S.state, state)
+
+    self.assertRaises(ValueError, propagate_charge_states, M)
+
+  def imp(self, stype, **extra):
+    "IMP lattice with the stripper replaced by an element of type 'stype'"
+    with open(os.path.join(datadir, 'latticeout_IMP_withPV_consolidate.lat'), 'rb') as F:
+      conf = Machine(F.read()).conf()
+    idx = [i for i, E in enumerate(conf['elements']) if E['type']=='stripper'][0]
+    conf['elements'][idx]['type'] = stype
+    for K, V in extra.items():
+      conf['elements'][idx][K] = V
+    return idx, Machine(conf)
+
+  def test_imp(self):
+    "The stripper of the IMP lattice doesn't set charge_model, so results are as with a marker"
+    idx, M = self.imp('stripper')
+    _idx, M2 = self.imp('marker')
+    _idx, M3 = self.imp('stripper', charge_model=1.0)
+    self.assertEqual(M2.conf()['elements'][idx]['type'], 'marker')
+
+    S, S2, S3 = M.allocState({}), M2.allocState({}), M3.allocState({})
+    obs = M.propagate(S, observe=[idx])
+    M2.propagate(S2)
+    M3.propagate(S3)
+    self.assertEqual(obs[0][1].IonEk, 0.5e6)
+    self.assertEqual(obs[0][1].IonZ, S2.IonZ)
+    self.assertEqual(S.IonEk, S2.IonEk)
+    NT.assert_equal(S.state, S2.state)
+    NT.assert_equal(S.moment0, S2.moment0)
+
+    # the comparison would see an enabled stripper
+    self.assertNotEqual(S3.IonEk, S2.IonEk)
+    self.assertFalse(numpy.array_equal(S3.state, S2.state))
+
+  def test_imp_phase(self):
+    "phase_cavities() also treats the stripper as a marker without charge_model"
+    maps = dict((T, fieldmap()) for T in ('0.041QWR', '0.085QWR'))
+    R = [phase_cavities(self.imp(T, **E)[1], maps, nphase=36)
+         for T, E in [('stripper', {}), ('marker', {}), ('stripper', {'charge_model':1.0})]]
+    for K in ('phase', 'crest', 'IonW_in', 'IonW_out'):
+      NT.assert_array_equal(R[0][K], R[1][K])
+    self.assertFalse(numpy.array_equal(R[2]['IonW_in'], R[1]['IonW_in']))
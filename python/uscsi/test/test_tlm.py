@@ -0,0 +1,102 @@
+from __future__ import print_function
+
+import os
+import unittest
+import tempfile
+import numpy
+from numpy import testing as NT
+
+from .. import Machine, GLPSParser, load_tlm
+from . import BadBool
+
+# excerpt of cavity_model/LS1.dat, with a continuation line
+flat = """# s kind name L aper ...
+0.000000 drift Dt0000 0.072000 0.020000 
+0.072000 rfcavity LS1_CA01:CAV1_D1127 0.240000 0.017000 80.500000 0.640000 -35.000000
+0.312000 mark Mrk000 0.000000 -23.000000 
+0.312000 Solenoid Sol000 0.100000 0.020000 &
+  5.340000
+
+0.412000 drift Dt0000 0.076123 0.020000
+0.488123 quadpole FS1_CSS:QH_D2194 0.250000 0.025000 3.459800
+0.738123 dipole FS1_CSS:DH_D2163 0.060000 0.020000 -1.000000 0.190370 400.000000 0.000000 -5.000000
+0.798123 combquad Q2 0.250000 0.025000 -3.459800
+"""
+
+# as translated by cavity_model/get_lat.py
+glps = """
+sim_type = "MomentMatrix";
+dt0000_1: drift, L = 0.072000, aper = 0.020000;
+ls1_ca01_cav1_d1127_1: rfcavity, cavtype = "0.041QWR", L = 0.240000, f = 80.500000e6, phi = -35.000000, scl_fac = 0.640000, aper = 0.017000;
+mrk000_1: marker;
+sol000_1: solenoid, L = 0.100000, B = 5.340000, aper = 0.020000;
+dt0000_2: drift, L = 0.076123, aper = 0.020000;
+fs1_css_qh_d2194_1: quadrupole, L = 0.250000, B2 = 3.459800, aper = 0.025000;
+fs1_css_dh_d2163_1: sbend, L = 0.060000, phi = -1.000000, phi1 = 0.000000, phi2 = -5.000000, bg = 0.190370, aper = 0.020000;
+q2_2: quadrupole, L = 0.250000, B2 = -3.459800, aper = 0.025000;
+cell: LINE = (dt0000_1, ls1_ca01_cav1_d1127_1, mrk000_1, sol000_1, dt0000_2, fs1_css_qh_d2194_1, fs1_css_dh_d2163_1, q2_2);
+USE: cell;
+"""
+
+class TestTLM(unittest.TestCase):
+  def setUp(self):
+    self.files = []
+
+  def tearDown(self):
+    for name in self.files:
+      os.remove(name)
+
+  def write(self, text):
+    fd, name = tempfile.mkstemp(suffix='.dat')
+    self.files.append(name)
+    with os.fdopen(fd, 'w') as F:
+      F.write(text)
+    return name
+
+  def test_glps(self):
+    "Same as translating with get_lat.py then parsing"
+    C = load_tlm(self.write(flat)).todict()
+    G = GLPSParser().parse(glps)
+    self.assertEqual(C['name'], 'cell')
+    self.assertEqual(C['sim_type'], 'MomentMatrix')
+    self.assertEqual(len(C['elements']), 8)
+    for E, X in zip(C['elements'], G['elements']):
+      self.assertEqual(E, X)
+
+  def test_names(self):
+    C = load_tlm(self.write(flat), {'sim_type':'TransferMatrix', 'IonEs':1.0}, number_names=False)
+    self.assertEqual(C['sim_type'], 'TransferMatrix')
+    self.assertEqual(C['IonEs'], 1.0)
+    self.assertEqual([E['name'] for E in C['elements']][:5],
+                     ['dt0000', 'ls1_ca01_cav1_d1127', 'mrk000', 'sol000', 'dt0000'])
+
+    # any truth value
+    self.assertEqual(load_tlm(self.write(flat), number_names=0).todict()['elements'],
+                     load_tlm(self.write(flat), number_names=False).todict()['elements'])
+    self.assertNotEqual(load_tlm(self.write(flat), number_names=[1]).todict()['elements'],
+                        load_tlm(self.write(flat), number_names=False).todict()['elements'])
+    self.assertRaises(ZeroDivisionError, load_tlm, self.write(flat), number_names=BadBool())
+
+  def test_machine(self):
+    text = '\n'.join(L for L in flat.splitlines() if 'rfcavity' not in L)
+    T = load_tlm(self.write(text), {'sim_type':'TransferMatrix'})
+    G = GLPSParser().parse(glps.replace('MomentMatrix', 'TransferMatrix'))
+    G['elements'] = [E for E in G['elements'] if E['type']!='rfcavity']
+    M1, M2 = Machine(T), Machine(G)
+    self.assertEqual(len(M1), 7)
+    S1, S2 = M1.allocState({}), M2.allocState({})
+    M1.propagate(S1)
+    M2.propagate(S2)
+    NT.assert_array_equal(S1.state, S2.state)
+
+  def test_errors(self):
+    self.assertRaisesRegexp(RuntimeError, ':2: undefined element kind', load_tlm,
+                            self.write('0.0 drift D 1.0 0.02\n0.0 octupole O 1.0 0.02\n'))
+    self.assertRaisesRegexp(RuntimeError, ':1: marker with non zero length', load_tlm,
+                            self.write('0.0 mark M 1.0\n'))
+    self.assertRaisesRegexp(RuntimeError, ':1: drift .* at least 5 columns', load_tlm,
+                            self.write('0.0 drift D 1.0\n'))
+    self.assertRaisesRegexp(RuntimeError, "'x' is not a number", load_tlm,
+                            self.write('0.0 drift D x 0.02\n'))
+    self.assertRaisesRegexp(RuntimeError, 'defines no elements', load_tlm, self.write('# empty\n'))
+    self.assertRaises(RuntimeError, load_tlm, '/no/such/file.dat')
@@ -1,8 +1,13 @@
 
+#include <algorithm>
 #include <list>
 #include <sstream>
 
+#include <time.h>
+
+#include <boost/bind.hpp>
 #include <boost/thread/mutex.hpp>
+#include <boost/thread/thread.hpp>
 
 #include "scsi/base.h"
 #include "scsi/util.h"
@@ -11,6 +16,13 @@ namespace {
 // This mutex guards the global Machine::p_state_infos
 typedef boost::mutex info_mutex_t;
 info_mutex_t info_mutex;
+
+inline unsigned long long nowNS()
+{
+    timespec T;
+    clock_gettime(CLOCK_MONOTONIC, &T);
+    return T.tv_sec*1000000000ull + T.tv_nsec;
+}
 }
 
 StateBase::~StateBase() {}
@@ -41,6 +53,15 @@ void StateBase::assign(const StateBase& other)
     IonW  = other.IonW;
 }
 
+void StateBase::reset(const Config& c)
+{
+    next_elem = 0;
+    IonZ  = c.get<double>("IonZ", 0);
+    IonEs = c.get<double>("IonEs", 0);
+    IonEk = c.get<double>("IonEk", 0);
+    IonW  = c.get<double>("IonW", 0);
+}
+
 bool StateBase::getArray(unsigned idx, ArrayInfo& Info)
 {
     if(idx==0) {
@@ -84,6 +105,13 @@ ElementVoid::ElementVoid(const Config& conf)
     ,p_conf(conf)
 {}
 
+ElementVoid::ElementVoid(const ElementVoid& o)
+    :name(o.name)
+    ,index(o.index)
+    ,p_observe(NULL)
+    ,p_conf(o.p_conf)
+{}
+
 ElementVoid::~ElementVoid() {}
 
 void ElementVoid::show(std::ostream& strm) const
@@ -98,43 +126,23 @@ void ElementVoid::assign(const ElementVoid *other)
     *const_cast<size_t*>(&index) = other->index;
 }
 
-Machine::Machine(const Config& c)
-    :p_elements()
-    ,p_trace(NULL)
-    ,p_info()
+// Build Elements [first, last).  Run by the constructor, maybe in worker threads,
+// and (one Element at a time) by a lazy Machine.
+struct Machine::BuildJob
 {
-    std::string type(c.get<std::string>("sim_type"));
-
-    info_mutex_t::scoped_lock G(info_mutex);
+    element_builder_t * const *builders;
+    const Config *confs;
+    ElementVoid **out;
+    size_t first, last;
 
-    p_state_infos_t::iterator it = p_state_infos.find(type);
-    if(it==p_state_infos.end()) {
-        std::ostringstream msg;
-        msg<<"Unsupport sim_type '"<<type<<"'";
-        throw key_error(msg.str());
-    }
-
-    p_info = it->second;
+    // first error, if any
+    bool failed, missing;
+    std::string message;
 
-    typedef Config::vector_t elements_t;
-    elements_t Es(c.get<elements_t>("elements"));
+    BuildJob() :builders(NULL), confs(NULL), out(NULL), first(0), last(0), failed(false), missing(false) {}
 
-    p_elements_t result;
-    result.reserve(Es.size());
-
-    size_t idx=0;
-    for(elements_t::iterator it=Es.begin(), end=Es.end(); it!=end; ++it)
+    static ElementVoid* build(element_builder_t *builder, const Config& EC, size_t idx)
     {
-        const Config& EC = *it;
-
-        const std::string& etype(EC.get<std::string>("type"));
-
-        state_info::elements_t::iterator eit = p_info.elements.find(etype);
-        if(eit==p_info.elements.end())
-            throw key_error(etype);
-
-        element_builder_t* builder = eit->second;
-
         ElementVoid *E;
         try{
             E = builder->build(EC);
@@ -151,12 +159,208 @@ Machine::Machine(const Config& c)
             throw std::runtime_error(strm.str());
         }
 
-        *const_cast<size_t*>(&E->index) = idx++; // ugly
+        *const_cast<size_t*>(&E->index) = idx; // ugly
+        return E;
+    }
 
-        result.push_back(E);
+    void run()
+    {
+        for(size_t i=first; i<last; i++) {
+            try{
+                out[i] = build(builders[i], confs[i], i);
+            }catch(key_error& e){
+                fail(true, e.what());
+                return;
+            }catch(std::exception& e){
+                fail(false, e.what());
+                return;
+            }
+        }
     }
 
-    G.unlock();
+    void fail(bool m, const char *msg)
+    {
+        failed = true;
+        missing = m;
+        message = msg;
+    }
+
+    void rethrow() const
+    {
+        if(missing)
+            throw key_error(message);
+        else
+            throw std::runtime_error(message);
+    }
+};
+
+struct Machine::LazyElements
+{
+    // guards the entries of p_elements, and confs
+    boost::mutex lock;
+    std::vector<element_builder_t*> builders;
+    // Config of each unbuilt Element.  Cleared once built.
+    Config::vector_t confs;
+
+    // caller must hold lock
+    ElementVoid* get(p_elements_t& elements, size_t i)
+    {
+        ElementVoid *E = elements[i];
+        if(!E) {
+            E = elements[i] = BuildJob::build(builders[i], confs[i], i);
+            confs[i] = Config();
+        }
+        return E;
+    }
+};
+
+Machine::Machine(const Config& c, build_mode_t mode, unsigned nthreads)
+    :p_elements()
+    ,p_trace(NULL)
+    ,p_conf(c)
+    ,p_info(NULL)
+{
+    std::string type(c.get<std::string>("sim_type"));
+
+    typedef Config::vector_t elements_t;
+    elements_t Es(c.get<elements_t>("elements"));
+    const size_t nelem = Es.size();
+
+    std::vector<element_builder_t*> builders(nelem);
+
+    {
+        info_mutex_t::scoped_lock G(info_mutex);
+
+        p_state_infos_t::iterator it = p_state_infos.find(type);
+        if(it==p_state_infos.end()) {
+            std::ostringstream msg;
+            msg<<"Unsupport sim_type '"<<type<<"'";
+            throw key_error(msg.str());
+        }
+
+        p_info = &it->second;
+        p_simtype = type;
+
+        for(size_t idx=0; idx<nelem; idx++)
+        {
+            const Config& EC = Es[idx];
+
+            const std::string& etype(EC.get<std::string>("type"));
+
+            state_info::elements_t::const_iterator eit = p_info->elements.find(etype);
+            if(eit==p_info->elements.end())
+                throw key_error(etype);
+
+            builders[idx] = eit->second;
+
+            if(mode==BuildLazy) {
+                // eager builds check this in ElementVoid::ElementVoid()
+                try{
+                    EC.get<std::string>("name");
+                }catch(std::exception&){
+                    std::ostringstream strm;
+                    strm<<"Error while initializing element "<<idx
+                        <<" '<invalid>' : missing required parameter 'name'";
+                    throw key_error(strm.str());
+                }
+            }
+        }
+    }
+    // Builders are not removed until registeryCleanup(), so they
+    // may be used after releasing info_mutex.
+
+    p_elements_t result(nelem, (ElementVoid*)NULL);
+
+    if(mode==BuildLazy) {
+        p_lazy.reset(new LazyElements);
+        p_lazy->builders.swap(builders);
+        p_lazy->confs.swap(Es);
+        p_elements.swap(result);
+        return;
+    }
+
+    if(nthreads==0) {
+        // worthwhile for long lattices only
+        nthreads = std::min<size_t>(std::max(1u, boost::thread::hardware_concurrency()),
+                                    std::max<size_t>(1u, nelem/1024));
+    }
+    nthreads = std::max<size_t>(1u, std::min<size_t>(nthreads, nelem));
+
+    std::vector<BuildJob> jobs(nthreads);
+    for(size_t j=0; j<nthreads; j++) {
+        jobs[j].builders = nelem ? &builders[0] : NULL;
+        jobs[j].confs = nelem ? &Es[0] : NULL;
+        jobs[j].out = nelem ? &result[0] : NULL;
+        jobs[j].first = (nelem*j)/nthreads;
+        jobs[j].last = (nelem*(j+1))/nthreads;
+    }
+
+    try{
+        if(nthreads==1) {
+            jobs[0].run();
+        } else {
+            boost::thread_group workers;
+            try{
+                for(size_t j=1; j<nthreads; j++)
+                    workers.create_thread(boost::bind(&BuildJob::run, &jobs[j]));
+            }catch(...){
+                workers.join_all();
+                throw;
+            }
+            jobs[0].run();
+            workers.join_all();
+        }
+
+        // report the error from the lowest index
+        for(size_t j=0; j<nthreads; j++) {
+            if(jobs[j].failed)
+                jobs[j].rethrow();
+        }
+    }catch(...){
+        for(p_elements_t::iterator it=result.begin(), end=result.end(); it!=end; ++it)
+            delete *it;
+        throw;
+    }
+
+    p_elements.swap(result);
+}
+
+Machine::Machine(const Machine& O, clone_tag)
+    :p_elements()
+    ,p_simtype(O.p_simtype)
+    ,p_trace(NULL)
+    ,p_conf(O.p_conf)
+    ,p_info(O.p_info)
+{
+    p_elements_t result;
+    result.reserve(O.p_elements.size());
+
+    std::auto_ptr<boost::mutex::scoped_lock> G;
+    if(O.p_lazy.get()) {
+        // unbuilt Elements stay unbuilt
+        G.reset(new boost::mutex::scoped_lock(O.p_lazy->lock));
+        p_lazy.reset(new LazyElements);
+        p_lazy->builders = O.p_lazy->builders;
+        p_lazy->confs = O.p_lazy->confs;
+    }
+
+    try{
+        for(p_elements_t::const_iterator it=O.p_elements.begin(), end=O.p_elements.end(); it!=end; ++it)
+        {
+            const ElementVoid *E = *it;
+            if(!E) {
+                result.push_back(NULL);
+                continue;
+            }
+            const std::string& etype(E->conf().get<std::string>("type"));
+
+            result.push_back(p_findBuilder(etype)->clone(E));
+        }
+    }catch(...){
+        for(p_elements_t::iterator it=result.begin(), end=result.end(); it!=end; ++it)
+            delete *it;
+        throw;
+    }
 
     p_elements.swap(result);
 }
@@ -172,6 +376,14 @@ Machine::~Machine()
 void
 Machine::propagate(StateBase* S, size_t start, size_t max) const
 {
+    if(p_lazy.get())
+        materialize(start, max);
+
+    if(p_profile.get() || p_history.get()) {
+        propagateInstrumented(S, start, max);
+        return;
+    }
+
     const size_t nelem = p_elements.size();
 
     S->next_elem = start;
@@ -187,10 +399,128 @@ Machine::propagate(StateBase* S, size_t start, size_t max) const
     }
 }
 
+// Same as propagate(), with profiling counters and/or history.
+// Kept separate so that the normal loop has no extra branches.
+void
+Machine::propagateInstrumented(StateBase* S, size_t start, size_t max) const
+{
+    const size_t nelem = p_elements.size();
+    Profile *P = p_profile.get();
+    StateHistory *H = p_history.get();
+
+    if(P)
+        P->propagations++;
+
+    try {
+        S->next_elem = start;
+        unsigned long long T0 = P ? nowNS() : 0;
+        for(size_t i=0; S->next_elem<nelem && i<max; i++)
+        {
+            const size_t idx = S->next_elem;
+            ElementVoid* E = p_elements[idx];
+            S->next_elem++;
+            E->advance(*S);
+            if(E->p_observe)
+                E->p_observe->view(E, S);
+
+            if(P) {
+                unsigned long long T1 = nowNS();
+                P->calls[idx]++;
+                P->nsec[idx] += T1-T0;
+            }
+
+            if(H && !H->record(idx, *S)) {
+                std::ostringstream msg;
+                msg<<"NaN or Inf in State after element "<<idx<<" '"<<E->name<<"'";
+                throw nonfinite_error(msg.str(), idx);
+            }
+
+            if(p_trace)
+                (*p_trace) << "After "<< i<< " " << *S;
+
+            if(P)
+                T0 = nowNS(); // don't count history or trace formatting
+        }
+    } catch(...) {
+        if(H && !H->dumpfile.empty()) {
+            try {
+                H->dump(H->dumpfile);
+            } catch(std::exception&) {
+                // keep the original error
+            }
+        }
+        throw;
+    }
+}
+
+void Machine::set_history(size_t depth, bool check_finite, const std::string& dumpfile)
+{
+    if(depth)
+        p_history.reset(new StateHistory(depth, check_finite, dumpfile));
+    else
+        p_history.reset();
+}
+
+Machine::Profile::Profile(size_t nelem)
+    :calls(nelem)
+    ,nsec(nelem)
+    ,builds(nelem)
+{
+    reset();
+}
+
+void Machine::Profile::reset()
+{
+    std::fill(calls.begin(), calls.end(), 0u);
+    std::fill(nsec.begin(), nsec.end(), 0u);
+    std::fill(builds.begin(), builds.end(), 0u);
+    propagations = states = elements = 0;
+}
+
+void Machine::set_profile(bool enable)
+{
+    if(enable)
+        p_profile.reset(new Profile(p_elements.size()));
+    else
+        p_profile.reset();
+}
+
+void Machine::reset_profile()
+{
+    if(p_profile.get())
+        p_profile->reset();
+}
+
 StateBase*
 Machine::allocState(const Config &c) const
 {
-    return (*p_info.builder)(c);
+    if(p_profile.get())
+        p_profile->states++;
+    return (*p_info->builder)(c);
+}
+
+StateBase*
+Machine::allocState(const std::string& simtype, const Config &c)
+{
+    state_builder_t builder;
+    {
+        info_mutex_t::scoped_lock G(info_mutex);
+
+        p_state_infos_t::const_iterator it = p_state_infos.find(simtype);
+        if(it==p_state_infos.end()) {
+            std::ostringstream msg;
+            msg<<"Unsupport sim_type '"<<simtype<<"'";
+            throw key_error(msg.str());
+        }
+        builder = it->second.builder;
+    }
+    return (*builder)(c);
+}
+
+Machine*
+Machine::clone() const
+{
+    return new Machine(*this, clone_tag());
 }
 
 void Machine::reconfigure(size_t idx, const Config& c)
@@ -200,13 +530,88 @@ void Machine::reconfigure(size_t idx, const Config& c)
 
     const std::string& etype(c.get<std::string>("type"));
 
-    state_info::elements_t::iterator eit = p_info.elements.find(etype);
-    if(eit==p_info.elements.end())
-        throw key_error(etype);
-
-    element_builder_t *builder = eit->second;
+    element_builder_t *builder = p_findBuilder(etype);
+
+    if(p_lazy.get()) {
+        boost::mutex::scoped_lock G(p_lazy->lock);
+        if(!p_elements[idx]) {
+            // not built yet, so only the new Config is needed
+            p_elements[idx] = BuildJob::build(builder, c, idx);
+            p_lazy->confs[idx] = Config();
+            if(p_profile.get())
+                p_profile->builds[idx]++;
+            return;
+        }
+    }
 
     builder->rebuild(p_elements[idx], c);
+    if(p_profile.get())
+        p_profile->builds[idx]++;
+    // assign() copies the index of the temporary element
+    *const_cast<size_t*>(&p_elements[idx]->index) = idx; // ugly
+}
+
+ElementVoid* Machine::p_build(size_t i) const
+{
+    boost::mutex::scoped_lock G(p_lazy->lock);
+    return p_lazy->get(const_cast<p_elements_t&>(p_elements), i);
+}
+
+void Machine::materialize(size_t start, size_t max) const
+{
+    if(!p_lazy.get())
+        return;
+    const size_t nelem = p_elements.size();
+    if(start>=nelem)
+        return;
+    const size_t last = max<nelem-start ? start+max : nelem;
+
+    boost::mutex::scoped_lock G(p_lazy->lock);
+    p_elements_t& elements = const_cast<p_elements_t&>(p_elements);
+    for(size_t i=start; i<last; i++)
+        p_lazy->get(elements, i);
+}
+
+bool Machine::isBuilt(size_t i) const
+{
+    if(i>=p_elements.size())
+        throw std::invalid_argument("element index out of range");
+    if(!p_lazy.get())
+        return true;
+    boost::mutex::scoped_lock G(p_lazy->lock);
+    return p_elements[i]!=NULL;
+}
+
+Config Machine::elementConf(size_t i) const
+{
+    if(i>=p_elements.size())
+        throw std::invalid_argument("element index out of range");
+    if(!p_lazy.get())
+        return p_elements[i]->conf();
+    boost::mutex::scoped_lock G(p_lazy->lock);
+    const ElementVoid *E = p_elements[i];
+    return E ? E->conf() : p_lazy->confs[i];
+}
+
+ElementVoid* Machine::buildElement(const Config& c) const
+{
+    const std::string& etype(c.get<std::string>("type"));
+
+    element_builder_t *builder = p_findBuilder(etype);
+
+    if(p_profile.get())
+        p_profile->elements++;
+    return builder->build(c);
+}
+
+Machine::element_builder_t* Machine::p_findBuilder(const std::string& etype) const
+{
+    info_mutex_t::scoped_lock G(info_mutex);
+
+    state_info::elements_t::const_iterator eit = p_info->elements.find(etype);
+    if(eit==p_info->elements.end())
+        throw key_error(etype);
+    return eit->second;
 }
 
 Machine::p_state_infos_t Machine::p_state_infos;
@@ -262,9 +667,8 @@ void Machine::registeryCleanup()
 
 std::ostream& operator<<(std::ostream& strm, const Machine& m)
 {
-    strm<<"sim_type: "<<m.p_info.name<<"\n#Elements: "<<m.p_elements.size()<<"\n";
-    for(Machine::p_elements_t::const_iterator it=m.p_elements.begin(),
-        end=m.p_elements.end(); it!=end; ++it)
+    strm<<"sim_type: "<<m.p_info->name<<"\n#Elements: "<<m.p_elements.size()<<"\n";
+    for(Machine::const_iterator it=m.begin(), end=m.end(); it!=end; ++it)
     {
         (*it)->show(strm);
     }
@@ -0,0 +1,235 @@
+#include <algorithm>
+#include <vector>
+
+#include <string.h>
+
+#include <boost/thread/thread.hpp>
+#include <boost/bind.hpp>
+#include <boost/numeric/ublas/matrix_proxy.hpp>
+
+#include "scsi/ensemble.h"
+
+namespace {
+// Particles are processed in blocks of this many rows
+// (7*256 doubles, 14KB, fit in L1 with the output)
+enum {blocksize=256};
+
+// x' = M * x for rows [first, last) of a [N, ncoord] row major array
+void transformRows(const double *Mp, double *P, size_t first, size_t last)
+{
+    enum {N=EnsembleState::ncoord};
+    double M[N*N];
+    std::copy(Mp, Mp+N*N, M);
+
+    for(size_t b=first; b<last; b+=blocksize) {
+        const size_t bend = std::min(last, b+blocksize);
+        for(size_t r=b; r<bend; r++) {
+            double *x = P+r*N, out[N];
+            for(unsigned i=0; i<N; i++) {
+                double sum = 0.0;
+                for(unsigned j=0; j<N; j++)
+                    sum += M[i*N+j]*x[j];
+                out[i] = sum;
+            }
+            std::copy(out, out+N, x);
+        }
+    }
+}
+
+// Parse particle count and coordinates from Config.
+// Returns false if neither is given.
+bool particleCount(const Config& c, size_t& count, const std::vector<double>** particles)
+{
+    *particles = NULL;
+    count = 0;
+    try{
+        const std::vector<double>& I = c.get<std::vector<double> >("particles");
+        if(I.size()%EnsembleState::ncoord)
+            throw std::invalid_argument("'particles' length must be a multiple of 7");
+        *particles = &I;
+        count = I.size()/EnsembleState::ncoord;
+        return true;
+    }catch(key_error&){
+    }catch(boost::bad_any_cast&){
+        throw std::invalid_argument("'particles' has wrong type (must be vector)");
+    }
+    try{
+        double cnt = c.get<double>("count");
+        if(cnt<0.0)
+            throw std::invalid_argument("'count' must not be negative");
+        count = (size_t)cnt;
+        return true;
+    }catch(key_error&){
+    }catch(boost::bad_any_cast&){
+        throw std::invalid_argument("'count' has wrong type (must be scalar)");
+    }
+    return false;
+}
+}
+
+EnsembleState::EnsembleState(const Config& c)
+    :StateBase(c)
+    ,nthreads(1)
+{
+    const std::vector<double> *particles;
+    size_t N;
+    particleCount(c, N, &particles);
+    state.resize(N, ncoord, false);
+    EnsembleState::reset(c);
+}
+
+EnsembleState::~EnsembleState() {}
+
+void EnsembleState::reset(const Config& c)
+{
+    StateBase::reset(c);
+
+    const std::vector<double> *particles;
+    size_t N;
+    if(particleCount(c, N, &particles) && N!=count())
+        throw std::invalid_argument("reset() can't change the number of particles");
+
+    if(particles)
+        std::copy(particles->begin(), particles->end(), state.data().begin());
+    else
+        std::fill(state.data().begin(), state.data().end(), 0.0);
+
+    double nt = c.get<double>("threads", 1.0);
+    nthreads = nt<1.0 ? 1u : (unsigned)nt;
+}
+
+EnsembleState::EnsembleState(const EnsembleState& o, clone_tag t)
+    :StateBase(o, t)
+    ,state(o.state)
+    ,nthreads(o.nthreads)
+{}
+
+void EnsembleState::assign(const StateBase& other)
+{
+    const EnsembleState *O = dynamic_cast<const EnsembleState*>(&other);
+    if(!O)
+        throw std::invalid_argument("Can't assign State: incompatible types");
+    if(O->count()!=count())
+        throw std::invalid_argument("Can't assign State: number of particles differs");
+    std::copy(O->state.data().begin(), O->state.data().end(), state.data().begin());
+    nthreads = O->nthreads;
+    StateBase::assign(other);
+}
+
+void EnsembleState::show(std::ostream& strm) const
+{
+    strm<<"State: "<<count()<<" particles\n";
+    for(size_t i=0, N=std::min(count(), (size_t)10u); i<N; i++)
+        strm<<"  "<<row(state, i)<<"\n";
+    if(count()>10)
+        strm<<"  ...\n";
+}
+
+bool EnsembleState::getArray(unsigned idx, ArrayInfo& Info) {
+    if(idx==0) {
+        Info.name = "state";
+        Info.ptr = count() ? &state(0,0) : NULL;
+        Info.type = ArrayInfo::Double;
+        Info.ndim = 2;
+        Info.dim[0] = state.size1();
+        Info.dim[1] = state.size2();
+        return true;
+    }
+    return StateBase::getArray(idx-1, Info);
+}
+
+void EnsembleState::transform(const double *M)
+{
+    const size_t N = count();
+    if(N==0)
+        return;
+    double *P = &state(0,0);
+
+    // don't bother with threads for small ensembles
+    unsigned nt = std::min<size_t>(nthreads, N/(4*blocksize));
+
+    if(nt<=1) {
+        transformRows(M, P, 0, N);
+    } else {
+        boost::thread_group workers;
+        const size_t chunk = (N+nt-1)/nt;
+        for(unsigned t=1; t<nt; t++)
+            workers.create_thread(boost::bind(&transformRows, M, P,
+                                              std::min(N, t*chunk), std::min(N, (t+1)*chunk)));
+        transformRows(M, P, 0, std::min(N, chunk));
+        workers.join_all();
+    }
+}
+
+EnsembleElementBase::EnsembleElementBase(const Config& c)
+    :ElementVoid(c)
+    ,transfer(boost::numeric::ublas::identity_matrix<double>(state_t::ncoord))
+{}
+
+EnsembleElementBase::~EnsembleElementBase() {}
+
+void EnsembleElementBase::show(std::ostream& strm) const
+{
+    ElementVoid::show(strm);
+    strm<<"Transfer: "<<transfer<<"\n";
+}
+
+void EnsembleElementBase::advance(StateBase& s) const
+{
+    state_t& ST = static_cast<state_t&>(s);
+    ST.transform(&transfer(0,0));
+}
+
+void propagateEnsemble(const Machine& M,
+                       EnsembleState& S,
+                       size_t start,
+                       size_t max,
+                       bool observers)
+{
+    using namespace boost::numeric::ublas;
+
+    if(observers && M.trace()) {
+        M.propagate(&S, start, max);
+        return;
+    }
+
+    const size_t nelem = M.size();
+    const size_t stop = max>=nelem-std::min(start, nelem) ? nelem : start+max;
+
+    matrix<double> total(EnsembleState::ncoord, EnsembleState::ncoord),
+                   temp(EnsembleState::ncoord, EnsembleState::ncoord);
+    bool pending = false; // 'total' holds the product of elements not yet applied
+
+    S.next_elem = start;
+    for(size_t i=start; i<stop; i++) {
+        const ElementVoid *E = M[i];
+        const EnsembleElementBase *EE = dynamic_cast<const EnsembleElementBase*>(E);
+        S.next_elem = i+1;
+
+        if(!EE || strcmp(E->type_name(), "source")==0) {
+            // not a pure transfer matrix
+            if(pending)
+                S.transform(&total(0,0));
+            pending = false;
+            E->advance(S);
+
+        } else if(!pending) {
+            total = EE->transfer;
+            pending = true;
+
+        } else {
+            noalias(temp) = prod(EE->transfer, total);
+            total.swap(temp);
+        }
+
+        if(observers && E->observer()) {
+            if(pending)
+                S.transform(&total(0,0));
+            pending = false;
+            E->observer()->view(E, &S);
+        }
+    }
+
+    if(pending)
+        S.transform(&total(0,0));
+}
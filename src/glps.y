@@ -4,6 +4,12 @@
 #include <stdlib.h>
 #include "glps_parser.h"
 
+/* 'file', 'line_list', and friends are right recursive, so the parser stack
+ * grows with the number of entries.  The default limit (10000) is too small
+ * for large generated lattices.
+ */
+#define YYMAXDEPTH 10000000
+
 #undef yyerror
 static inline
 void yyerror (yacc_arg arg, const char* msg)
@@ -0,0 +1,166 @@
+#include <algorithm>
+#include <fstream>
+#include <stdexcept>
+#include <string.h>
+#include <math.h>
+
+#include <boost/cstdint.hpp>
+
+#include "scsi/base.h"
+
+namespace {
+template<typename T>
+void put(std::ostream& strm, T val)
+{
+    strm.write((const char*)&val, sizeof(val));
+}
+}
+
+StateHistory::StateHistory(size_t depth, bool check_finite, const std::string& dumpfile)
+    :depth(depth)
+    ,check_finite(check_finite)
+    ,dumpfile(dumpfile)
+    ,p_width(0)
+    ,p_index(depth)
+    ,p_total(0)
+{
+    if(depth==0)
+        throw std::invalid_argument("StateHistory depth must be greater than zero");
+}
+
+// Looked up on every record(), since a State may be freed and another allocated
+// at the same address, or its arrays may be re-allocated, between calls.
+// Storage is only re-allocated when the fields change.
+void StateHistory::layout(StateBase& S)
+{
+    size_t n = 0, width = 0;
+    bool same = true;
+
+    StateBase::ArrayInfo info;
+    for(unsigned i=0; S.getArray(i, info); i++) {
+        if(info.type!=StateBase::ArrayInfo::Double)
+            continue;
+        size_t count = 1;
+        for(int d=0; d<info.ndim; d++)
+            count *= info.dim[d];
+        if(count==0 || count>maxcount || !info.ptr)
+            continue;
+
+        if(same) {
+            same = n<p_fields.size() && p_fields[n].name==info.name
+                    && p_fields[n].dim.size()==(size_t)info.ndim
+                    && std::equal(p_fields[n].dim.begin(), p_fields[n].dim.end(), info.dim);
+            if(!same)
+                p_fields.resize(n);
+        }
+        if(!same) {
+            Field F;
+            F.name = info.name;
+            F.dim.assign(info.dim, info.dim+info.ndim);
+            F.count = count;
+            p_fields.push_back(F);
+        }
+
+        if(n<p_src.size())
+            p_src[n] = (const double*)info.ptr;
+        else
+            p_src.push_back((const double*)info.ptr);
+        width += count;
+        n++;
+    }
+    if(n!=p_fields.size()) {
+        same = false;
+        p_fields.resize(n);
+    }
+    p_src.resize(n);
+
+    if(!same) {
+        p_width = width;
+        p_values.resize(depth*width);
+        p_total = 0;
+    }
+}
+
+bool StateHistory::record(size_t index, StateBase& S)
+{
+    layout(S);
+
+    const size_t slot = p_total%depth;
+    p_index[slot] = index;
+    double *out = &p_values[slot*p_width];
+
+    bool ok = true;
+    for(size_t f=0; f<p_fields.size(); f++) {
+        const size_t N = p_fields[f].count;
+        const double *in = p_src[f];
+        if(check_finite) {
+            for(size_t i=0; i<N; i++) {
+                out[i] = in[i];
+                ok &= isfinite(in[i])!=0;
+            }
+        } else {
+            memcpy(out, in, N*sizeof(double));
+        }
+        out += N;
+    }
+
+    p_total++;
+    return ok;
+}
+
+void StateHistory::clear()
+{
+    p_total = 0;
+}
+
+void StateHistory::copy(void *raw) const
+{
+    char *out = (char*)raw;
+    const size_t n = size(),
+                 first = p_total<=depth ? 0 : p_total%depth,
+                 vsize = p_width*sizeof(double);
+
+    for(size_t i=0; i<n; i++) {
+        const size_t slot = (first+i)%depth;
+        const boost::uint64_t idx = p_index[slot];
+        memcpy(out, &idx, sizeof(idx));
+        out += sizeof(idx);
+        if(vsize)
+            memcpy(out, &p_values[slot*p_width], vsize);
+        out += vsize;
+    }
+}
+
+void StateHistory::dump(std::ostream& strm) const
+{
+    strm.write("USCSIHST", 8);
+    put<boost::uint32_t>(strm, 1);
+    put<boost::uint32_t>(strm, p_fields.size());
+    put<boost::uint64_t>(strm, size());
+    put<boost::uint64_t>(strm, p_total);
+    for(size_t f=0; f<p_fields.size(); f++) {
+        const Field& F = p_fields[f];
+        put<boost::uint32_t>(strm, F.name.size());
+        strm.write(F.name.c_str(), F.name.size());
+        put<boost::uint32_t>(strm, F.dim.size());
+        for(size_t d=0; d<F.dim.size(); d++)
+            put<boost::uint32_t>(strm, F.dim[d]);
+    }
+
+    std::vector<char> buf(size()*(sizeof(boost::uint64_t)+p_width*sizeof(double)));
+    if(!buf.empty()) {
+        copy(&buf[0]);
+        strm.write(&buf[0], buf.size());
+    }
+}
+
+void StateHistory::dump(const std::string& fname) const
+{
+    std::ofstream strm(fname.c_str(), std::ios::binary|std::ios::trunc);
+    if(!strm.is_open())
+        throw std::runtime_error("Unable to open "+fname);
+    dump(strm);
+    strm.close();
+    if(strm.fail())
+        throw std::runtime_error("Error writing "+fname);
+}
@@ -0,0 +1,1329 @@
+#include <fstream>
+#include <iomanip>
+#include <sstream>
+#include <stdexcept>
+
+#include <math.h>
+
+#include "scsi/config.h"
+#include "scsi/linac.h"
+
+/* Full linac (TLM) model, formerly in main.cpp.
+ *
+ * Phase-space units are [mm, rad, mm, rad, rad, MeV/u].
+ */
+
+namespace {
+// Speed of light [m/s].
+const double C0 = 2.99792458e8;
+const double MtoMM = 1e3;
+const double MeVtoeV = 1e6;
+// Atomic mass unit [MeV/c^2].
+const double AU = 931.49432e6/MeVtoeV;
+// Vacuum permeability.
+const double MU0 = 4e0*M_PI*1e-7;
+// Long. sampling frequency [Hz]; must be set to RF Cavity frequency.
+const double SampleFreq = 80.5e6;
+// Sampling distance [mm].
+const double SampleLambda = C0/SampleFreq*MtoMM;
+
+// Phase space dimension; including vector for orbit/1st moment.
+const int PS_Dim = 7;
+
+// Charge stripper parameters.
+const int    Stripper_n                 = 5;            // Number of charge states.
+const double Stripper_IonZ              = 78e0/238e0,
+             Stripper_IonMass           = 238e0,
+             Stripper_IonProton         = 92e0,
+             Stripper_IonChargeStates[] = {76e0/238e0, 77e0/238e0, 78e0/238e0,
+                                           79e0/238e0, 80e0/238e0},
+             // Energy dependance. Unit for last parmeter ???
+             Stripper_E0Para[]          = {16.348e6/MeVtoeV, 1.00547, -0.10681},
+             // Thickness [microns], thickness variation [%], reference energy [MeV/u].
+             StripperPara[]             = {3e0, 20e0, 16.623e6/MeVtoeV};
+
+typedef MomentElementBase element_t;
+typedef MomentElementBase::state_t state_t;
+typedef MomentElementBase::value_t value_mat;
+
+// Cavity type -> index (cavi), label for TransFacts(), and multipole radius [mm]
+struct cavity_t {
+    const char *name;
+    int label;
+    double Rm;
+};
+const cavity_t cavities[] = {
+    {"0.041QWR", 41, 17e0},
+    {"0.085QWR", 85, 17e0},
+};
+const unsigned ncavities = sizeof(cavities)/sizeof(cavities[0]);
+
+// Transit factors and acceleration of each line of a CavityThinLens, for one pass
+struct TLMLineTab {
+    std::vector<double> s, E0, T, S, Accel;
+
+    void clear()
+    {
+        s.clear(); E0.clear(); T.clear(); S.clear(); Accel.clear();
+    }
+    void set(double s, double E0, double T, double S, double Accel)
+    {
+        this->s.push_back(s); this->E0.push_back(E0); this->T.push_back(T);
+        this->S.push_back(S); this->Accel.push_back(Accel);
+    }
+};
+
+double calGauss(double in, const double Q_ave, const double d)
+{
+    // Gaussian distribution.
+    return 1e0/sqrt(2e0*M_PI)/d*exp(-0.5e0*sqr(in-Q_ave)/sqr(d));
+}
+
+void calStripperCharge(const double IonProton, const double beta,
+                       double &Q_ave, double &d)
+{
+    // Use Baron's formula for carbon foil.
+    double Q_ave1, Y;
+
+    Q_ave1 = IonProton*(1e0-exp(-83.275*(beta/pow(IonProton, 0.447))));
+    Q_ave  = Q_ave1*(1e0-exp(-12.905+0.2124*IonProton-0.00122*sqr(IonProton)));
+    Y      = Q_ave1/IonProton;
+    d      = sqrt(Q_ave1*(0.07535+0.19*Y-0.2654*sqr(Y)));
+}
+
+void ChargeStripper(const double IonMass, const double IonProton, const double beta,
+                    const int nChargeStates, const double IonChargeStates[],
+                    double chargeAmount_Baron[])
+{
+    int    k;
+    double Q_ave, d;
+
+    calStripperCharge(IonProton, beta, Q_ave, d);
+    for (k = 0; k < nChargeStates; k++)
+        chargeAmount_Baron[k] = calGauss(IonChargeStates[k]*IonMass, Q_ave, d);
+}
+
+void EvalGapModel(const double dis, const double IonW0, const double IonEs, const double IonFy0,
+                  const double k, const double IonZ, const double Lambda, const double Ecen,
+                  const double T, const double S, const double Tp, const double Sp, const double V0,
+                  double &IonW_f, double &IonFy_f)
+{
+    double Iongamma_f, IonBeta_f, k_f;
+
+    IonW_f     = IonW0 + IonZ*V0*T*cos(IonFy0+k*Ecen) - IonZ*V0*S*sin(IonFy0+k*Ecen);
+    Iongamma_f = IonW_f/IonEs;
+    IonBeta_f  = sqrt(1e0-1e0/sqr(Iongamma_f));
+    k_f        = 2e0*M_PI/(IonBeta_f*Lambda);
+
+    IonFy_f = IonFy0 + k*Ecen + k_f*(dis-Ecen)
+              + IonZ*V0*k*(Tp*sin(IonFy0+k*Ecen)+Sp*cos(IonFy0+k*Ecen))/(2e0*(IonW0-IonEs));
+}
+
+double GetCavPhase(const int cavi, const double IonEk, const double IonFys,
+                   const double FyAbs, const double multip)
+{
+    /* If the cavity is not at full power, the method gives synchrotron
+     * phase slightly different from the nominal value.                 */
+
+    double Fyc;
+
+    switch (cavi) {
+    case 1:
+        Fyc = 4.394*pow(IonEk, -0.4965) - 4.731;
+        break;
+    case 2:
+        Fyc = 5.428*pow(IonEk, -0.5008) + 1.6;
+        break;
+    case 3:
+        Fyc = 22.35*pow(IonEk, -0.5348) + 2.026;
+        break;
+    case 4:
+        Fyc = 41.43*pow(IonEk, -0.5775) + 2.59839;
+        break;
+    case 5:
+        Fyc = 5.428*pow(IonEk, -0.5008) + 1.6;
+        break;
+    default:
+        throw std::runtime_error("GetCavPhase: undef. cavity type");
+    }
+
+    return IonFys - Fyc - FyAbs*multip;
+}
+
+void GetCavBoost(const CavityFieldMap &CavData, const double IonW0,
+                 const double IonFy0, const double IonK0, const double IonZ,
+                 const double IonEs, const double fRF,
+                 const double EfieldScl, double &IonW, double &IonFy)
+{
+    int    n = CavData.s.size(),
+           k;
+
+    if (n < 2)
+        throw std::runtime_error("GetCavBoost: no field map");
+
+    double dis = CavData.s[n-1] - CavData.s[0],
+           dz  = dis/(n-1),
+           IonLambda, IonK, IonFylast, IonGamma, IonBeta;
+
+    IonLambda = C0/fRF*MtoMM;
+
+    IonFy = IonFy0;
+    IonK  = IonK0;
+    IonW  = IonW0;
+    for (k = 0; k < n-1; k++) {
+        IonFylast = IonFy;
+        IonFy += IonK*dz;
+        IonW  += IonZ*EfieldScl*(CavData.Elong[k]+CavData.Elong[k+1])/(2e0*MeVtoeV)
+                 *cos((IonFylast+IonFy)/2e0)*dz/MtoMM;
+        IonGamma = IonW/IonEs;
+        IonBeta = sqrt(1e0-1e0/sqr(IonGamma));
+        if ((IonW-IonEs) < 0e0) {
+            IonW = IonEs;
+            IonBeta = 0e0;
+        }
+        IonK = 2e0*M_PI/(IonBeta*IonLambda);
+    }
+}
+
+double PwrSeries(const double beta,
+                 const double a0, const double a1, const double a2, const double a3,
+                 const double a4, const double a5, const double a6, const double a7)
+{
+    int    k;
+    double f;
+
+    const int    n   = 8;
+    const double a[] = {a0, a1, a2, a3, a4, a5, a6, a7};
+
+    f = a[0];
+    for (k = 1; k < n; k++)
+        f += a[k]*pow(beta, k);
+
+    return f;
+}
+
+double PwrSeries(const double beta,
+                 const double a0, const double a1, const double a2, const double a3,
+                 const double a4, const double a5, const double a6, const double a7,
+                 const double a8, const double a9)
+{
+    int    k;
+    double f;
+
+    const int    n   = 10;
+    const double a[] = {a0, a1, a2, a3, a4, a5, a6, a7, a8, a9};
+
+    f = a[0];
+    for (k = 1; k < n; k++)
+        f += a[k]*pow(beta, k);
+
+    return f;
+}
+
+void TransFacts(const int cavilabel, double beta, const int gaplabel, const double EfieldScl,
+                double &Ecen, double &T, double &Tp, double &S, double &Sp, double &V0)
+{
+    // Evaluate Electric field center, transit factors [T, T', S, S'] and cavity field.
+    std::ostringstream msg;
+
+    switch (cavilabel) {
+    case 41:
+        if (beta < 0.025 || beta > 0.08) {
+            msg << "GetTransitFac: beta out of Range " << beta;
+            throw std::runtime_error(msg.str());
+        }
+        switch (gaplabel) {
+        case 0:
+            // One gap evaluation.
+            Ecen = 120.0; // [mm].
+            T    = 0.0;
+            Tp   = 0.0;
+            S    = PwrSeries(beta, -4.109, 399.9, -1.269e4, 1.991e5, -1.569e6, 4.957e6, 0.0, 0.0);
+            Sp   = PwrSeries(beta, 61.98, -1.073e4, 4.841e5, 9.284e6, 8.379e7, -2.926e8, 0.0, 0.0);
+            V0   = 0.98477*EfieldScl;
+            break;
+        case 1:
+            // Two gap calculation, first gap.
+            Ecen = 0.0006384*pow(beta, -1.884) + 86.69;
+            T    = PwrSeries(beta, 0.9232, -123.2, 3570, -5.476e4, 4.316e5, -1.377e6, 0.0, 0.0);
+            Tp   = PwrSeries(beta, 1.699, 924.7, -4.062e4, 7.528e5, -6.631e6, 2.277e7, 0.0, 0.0);
+            S    = 0.0;
+            Sp   = PwrSeries(beta, -1.571, 25.59, 806.6, -2.98e4, 3.385e5, -1.335e6, 0.0, 0.0);
+            V0   = 0.492385*EfieldScl;
+            break;
+        case 2:
+            // Two gap calculation, second gap.
+            Ecen = -0.0006384*pow(beta, -1.884) + 33.31;
+            T    = PwrSeries(beta, -0.9232, 123.2, -3570, 5.476e4, -4.316e5, 1.377e6, 0.0, 0.0);
+            Tp   = PwrSeries(beta, -1.699, -924.7, 4.062e4, -7.528e5, 6.631e6, -2.277e7, 0.0, 0.0);
+            S    = 0.0;
+            Sp    = PwrSeries(beta, -1.571, 25.59, 806.6, -2.98e4, 3.385e5, -1.335e6, 0.0, 0.0);
+            V0   = 0.492385*EfieldScl;
+            break;
+        default:
+            msg << "GetTransitFac: undef. number of gaps " << gaplabel;
+            throw std::runtime_error(msg.str());
+        }
+        break;
+    case 85:
+        if (beta < 0.05 || beta > 0.25) {
+            msg << "GetTransitFac: beta out of range " << beta;
+            throw std::runtime_error(msg.str());
+        }
+        switch (gaplabel) {
+          case 0:
+            Ecen = 150.0; // [mm].
+            T    = 0.0;
+            Tp   = 0.0;
+            S    = PwrSeries(beta, -6.811, 343.9, -6385, 6.477e4, -3.914e5, 1.407e6, -2.781e6, 2.326e6);
+            Sp   = PwrSeries(beta, 162.7, -1.631e4, 4.315e5, -5.344e6, 3.691e7, -1.462e8, 3.109e8, -2.755e8);
+            V0   = 1.967715*EfieldScl;
+            break;
+        case 1:
+            Ecen = 0.0002838*pow(beta, -2.13) + 76.5;
+            T    = 0.0009467*pow(beta, -1.855) - 1.002;
+            Tp   = PwrSeries(beta, 24.44, -334, 2468, -1.017e4, 2.195e4, -1.928e4, 0.0, 0.0);
+            S    = 0.0;
+            Sp   = -0.0009751*pow(beta, -1.898) + 0.001568;
+            V0   = 0.9838574*EfieldScl;
+            break;
+        case 2:
+            Ecen = -0.0002838*pow(beta, -2.13) + 73.5;
+            T    = -0.0009467*pow(beta, -1.855) + 1.002;
+            Tp   = PwrSeries(beta,  24.44, 334,  2468, 1.017e4, -2.195e4, 1.928e4, 0.0, 0.0);
+            S    = 0.0;
+            Sp   = -0.0009751*pow(beta, -1.898) + 0.001568;
+            V0   = 0.9838574*EfieldScl;
+            break;
+        default:
+            msg << "GetTransitFac: undef. number of gaps " << gaplabel;
+            throw std::runtime_error(msg.str());
+        }
+        break;
+    default:
+        throw std::runtime_error("GetTransitFac: undef. cavity type");
+    }
+}
+
+void TransitFacMultipole(const int cavi, const std::string &flabel, const double IonK,
+                         double &T, double &S, std::ostream *log)
+{
+
+    if ((cavi == 1) && (IonK < 0.025 || IonK > 0.055)) {
+        throw std::runtime_error("TransitFacMultipole: IonK out of Range");
+    } else if ((cavi == 2) && (IonK < 0.006 || IonK > 0.035)) {
+        if (log)
+            *log << "*** TransitFacMultipole: IonK out of Range" << "\n";
+    }
+
+    if (flabel == "CaviMlp_EFocus1") {
+        switch (cavi) {
+        case 1:
+            T = PwrSeries(IonK, 1.256386e+02, -3.108322e+04, 3.354464e+06, -2.089452e+08, 8.280687e+09, -2.165867e+11,
+                          3.739846e+12, -4.112154e+13, 2.613462e14, -7.316972e14);
+            S = PwrSeries(IonK, 1.394183e+02, -3.299673e+04, 3.438044e+06, -2.070369e+08, 7.942886e+09, -2.013750e+11,
+                         3.374738e+12, -3.605780e+13, 2.229446e+14, -6.079177e+14);
+            break;
+        case 2:
+            T = PwrSeries(IonK, -9.450041e-01, -3.641390e+01, 9.926186e+03, -1.449193e+06, 1.281752e+08, -7.150297e+09,
+                          2.534164e+11, -5.535252e+12, 6.794778e+13, -3.586197e+14);
+            S = PwrSeries(IonK, 9.928055e-02, -5.545119e+01, 1.280168e+04, -1.636888e+06, 1.279801e+08, -6.379800e+09,
+                          2.036575e+11, -4.029152e+12, 4.496323e+13, -2.161712e+14);
+            break;
+        }
+    } else if (flabel == "CaviMlp_EFocus2") {
+        switch (cavi) {
+        case 1:
+            T = PwrSeries(IonK, 1.038803e+00, -9.121320e+00, 8.943931e+02, -5.619149e+04, 2.132552e+06, -5.330725e+07,
+                          8.799404e+08, -9.246033e+09, 5.612073e+10, -1.499544e+11);
+            S = PwrSeries(IonK, 1.305154e-02, -2.585211e+00, 2.696971e+02, -1.488249e+04, 5.095765e+05, -1.154148e+07,
+                          1.714580e+08, -1.604935e+09, 8.570757e+09, -1.983302e+10);
+            break;
+        case 2:
+            T = PwrSeries(IonK, 9.989307e-01, 7.299233e-01, -2.932580e+02, 3.052166e+04, -2.753614e+06, 1.570331e+08,
+                          -5.677804e+09, 1.265012e+11, -1.584238e+12, 8.533351e+12);
+            S = PwrSeries(IonK, -3.040839e-03, 2.016667e+00, -4.313590e+02, 5.855139e+04, -4.873584e+06, 2.605444e+08,
+                          -8.968899e+09, 1.923697e+11, -2.339920e+12, 1.233014e+13);
+            break;
+        }
+    } else if (flabel == "CaviMlp_EDipole") {
+        switch (cavi) {
+        case 1:
+            T = PwrSeries(IonK, -1.005885e+00, 1.526489e+00, -1.047651e+02, 1.125013e+04, -4.669147e+05, 1.255841e+07,
+                          -2.237287e+08, 2.535541e+09, -1.656906e+10, 4.758398e+10);
+            S = PwrSeries(IonK, -2.586200e-02, 5.884367e+00, -6.407538e+02, 3.888964e+04, -1.488484e+06, 3.782592e+07,
+                          -6.361033e+08, 6.817810e+09, -4.227114e+10, 1.155597e+11);
+            break;
+        case 2:
+            T = PwrSeries(IonK, -9.999028e-01, -6.783669e-02, 1.415756e+02, -2.950990e+03, 2.640980e+05, -1.570742e+07,
+                          5.770450e+08, -1.303686e+10, 1.654958e+11, -9.030017e+11);
+            S = PwrSeries(IonK, 2.108581e-04, -3.700608e-01, 2.851611e+01, -3.502994e+03, 2.983061e+05, -1.522679e+07,
+                          4.958029e+08, -1.002040e+10, 1.142835e+11, -5.617061e+11);
+            break;
+        }
+    } else if (flabel == "CaviMlp_EQuad") {
+        switch (cavi) {
+        case 1:
+            T = PwrSeries(IonK, 1.038941e+00, -9.238897e+00, 9.127945e+02, -5.779110e+04, 2.206120e+06, -5.544764e+07,
+                          9.192347e+08, -9.691159e+09, 5.896915e+10, -1.578312e+11);
+            S = PwrSeries(IonK, 1.248096e-01, -2.923507e+01, 3.069331e+03, -1.848380e+05, 7.094882e+06, -1.801113e+08,
+                          3.024208e+09, -3.239241e+10, 2.008767e+11, -5.496217e+11);
+            break;
+        case 2:
+            T = PwrSeries(IonK, 1.000003e+00, -1.015639e-03, -1.215634e+02, 1.720764e+01, 3.921401e+03, 2.674841e+05,
+                          -1.236263e+07, 3.128128e+08, -4.385795e+09, 2.594631e+10);
+            S = PwrSeries(IonK, -1.756250e-05, 2.603597e-01, -2.551122e+00, -4.840638e+01, -2.870201e+04, 1.552398e+06,
+                          -5.135200e+07, 1.075958e+09, -1.277425e+10, 6.540748e+10);
+            break;
+        }
+    } else if (flabel == "CaviMlp_HMono") {
+        switch (cavi) {
+        case 1:
+            T = PwrSeries(IonK, 1.703336e+00, -1.671357e+02, 1.697657e+04, -9.843253e+05, 3.518178e+07, -8.043084e+08,
+                          1.165760e+10, -1.014721e+11, 4.632851e+11, -7.604796e+11);
+            S = PwrSeries(IonK, 1.452657e+01, -3.409550e+03, 3.524921e+05, -2.106663e+07, 8.022856e+08,
+                          -2.019481e+10, 3.360597e+11, -3.565836e+12, 2.189668e+13, -5.930241e+13);
+            break;
+        case 2:
+            T = PwrSeries(IonK, 1.003228e+00, -1.783406e+00, 1.765330e+02, -5.326467e+04, 4.242623e+06, -2.139672e+08,
+                          6.970488e+09, -1.411958e+11, 1.617248e+12, -8.000662e+12);
+            S = PwrSeries(IonK, -1.581533e-03, 1.277444e+00, -2.742508e+02, 3.966879e+04, -3.513478e+06, 1.962939e+08,
+                          -6.991916e+09, 1.539708e+11, -1.910236e+12, 1.021016e+13);
+            break;
+        }
+    } else if (flabel == "CaviMlp_HDipole") {
+        switch (cavi) {
+        case 1:
+            T = PwrSeries(IonK, 6.853803e-01, 7.075414e+01, -7.117391e+03, 3.985674e+05, -1.442888e+07, 3.446369e+08,
+                          -5.420826e+09, 5.414689e+10, -3.116216e+11, 7.869717e+11);
+            S = PwrSeries(IonK, 1.021102e+00, -2.441117e+02, 2.575274e+04, -1.569273e+06, 6.090118e+07, -1.562284e+09,
+                          2.649289e+10, -2.864139e+11, 1.791634e+12, -4.941947e+12);
+            break;
+        case 2:
+            T = PwrSeries(IonK, 1.014129e+00, -8.016304e+00, 1.631339e+03, -2.561826e+05, 2.115355e+07, -1.118723e+09,
+                          3.821029e+10, -8.140248e+11, 9.839613e+12, -5.154137e+13);
+            S = PwrSeries(IonK, -4.688714e-03, 3.299051e+00, -8.101936e+02, 1.163814e+05, -1.017331e+07, 5.607330e+08,
+                          -1.967300e+10, 4.261388e+11, -5.194592e+12, 2.725370e+13);
+            break;
+        }
+    } else if (flabel == "CaviMlp_HQuad") {
+        switch (cavi) {
+        case 1:
+            T = PwrSeries(IonK, -1.997432e+00, 2.439177e+02, -2.613724e+04, 1.627837e+06, -6.429625e+07, 1.676173e+09,
+                          -2.885455e+10, 3.163675e+11, -2.005326e+12, 5.600545e+12);
+            S = PwrSeries(IonK, -2.470704e+00, 5.862902e+02, -6.135071e+04, 3.711527e+06, -1.431267e+08, 3.649414e+09,
+                          -6.153570e+10, 6.617859e+11, -4.119861e+12, 1.131390e+13);
+            break;
+        case 2:
+            T = PwrSeries(IonK, -1.000925e+00, 5.170302e-01, 9.311761e+01, 1.591517e+04, -1.302247e+06, 6.647808e+07,
+                          -2.215417e+09, 4.603390e+10, -5.420873e+11, 2.764042e+12);
+            S = PwrSeries(IonK, 3.119419e-04, -4.540868e-01, 5.433028e+01, -7.571946e+03, 6.792565e+05, -3.728390e+07,
+                          1.299263e+09, -2.793705e+10, 3.377097e+11, -1.755126e+12);
+            break;
+        }
+    } else {
+        throw std::runtime_error("TransitFacMultipole: undef. multipole type "+flabel);
+    }
+}
+
+void GetCavMatParams(const int cavi, const int MpoleLevel, const CavityFieldMap &CavData,
+                     const CavityThinLens &CavTLM, TLMLineTab &tab,
+                     const double beta_tab[], const double gamma_tab[], const double IonK[],
+                     std::ostream *log)
+{
+    // Evaluate time transit factors and acceleration.
+
+    double s, T, S, Accel;
+
+    tab.clear();
+
+    s = CavData.s[0];
+    for (size_t i = 0; i < CavTLM.lines.size(); i++) {
+        const CavityThinLens::Line &L = CavTLM.lines[i];
+        const std::string &Elem = L.Elem;
+
+        T = 0e0, S = 0e0, Accel = 0e0;
+
+        s += L.Length;
+
+        if (Elem == "drift") {
+        } else if (Elem == "EFocus1") {
+            if (s < 0e0) {
+                // First gap. By reflection 1st Gap EFocus1 is 2nd gap EFocus2.
+                TransitFacMultipole(cavi, "CaviMlp_EFocus2", IonK[0], T, S, log);
+                // First gap *1, transverse E field the same.
+                S = -S;
+            } else {
+                // Second gap.
+                TransitFacMultipole(cavi, "CaviMlp_EFocus1", IonK[1], T, S, log);
+            }
+        } else if (Elem == "EFocus2") {
+            if (s < 0e0) {
+                // First gap.
+                TransitFacMultipole(cavi, "CaviMlp_EFocus1", IonK[0], T, S, log);
+                S = -S;
+            } else {
+                // Second gap.
+                TransitFacMultipole(cavi, "CaviMlp_EFocus2", IonK[1], T, S, log);
+            }
+        } else if (Elem == "EDipole") {
+            if (MpoleLevel >= 1) {
+                if (s < 0e0) {
+                    TransitFacMultipole(cavi, "CaviMlp_EDipole", IonK[0], T, S, log);
+                    // First gap *1, transverse E field the same.
+                    S = -S;
+                } else {
+                    // Second gap.
+                    TransitFacMultipole(cavi, "CaviMlp_EDipole", IonK[1], T, S, log);
+                }
+            }
+        } else if (Elem == "EQuad") {
+            if (MpoleLevel >= 2) {
+                if (s < 0e0) {
+                    // First gap.
+                    TransitFacMultipole(cavi, "CaviMlp_EQuad", IonK[0], T, S, log);
+                    S = -S;
+                } else {
+                    // Second Gap
+                    TransitFacMultipole(cavi, "CaviMlp_EQuad", IonK[1], T, S, log);
+                }
+            }
+        } else if (Elem == "HMono") {
+            if (MpoleLevel >= 2) {
+                if (s < 0e0) {
+                    // First gap.
+                    TransitFacMultipole(cavi, "CaviMlp_HMono", IonK[0], T, S, log);
+                    T = -T;
+                } else {
+                    // Second Gap
+                    TransitFacMultipole(cavi, "CaviMlp_HMono", IonK[1], T, S, log);
+                }
+            }
+        } else if (Elem == "HDipole") {
+            if (MpoleLevel >= 1) {
+                if (s < 0e0) {
+                    // First gap.
+                    TransitFacMultipole(cavi, "CaviMlp_HDipole", IonK[0], T, S, log);
+                    T = -T;
+                }  else {
+                    // Second gap.
+                    TransitFacMultipole(cavi, "CaviMlp_HDipole", IonK[1], T, S, log);
+                }
+            }
+        } else if (Elem == "HQuad") {
+            if (MpoleLevel >= 2) {
+                if (s < 0e0) {
+                    // First gap.
+                    TransitFacMultipole(cavi, "CaviMlp_HQuad", IonK[0], T, S, log);
+                    T = -T;
+                } else {
+                    // Second gap.
+                    TransitFacMultipole(cavi, "CaviMlp_HQuad", IonK[1], T, S, log);
+                }
+            }
+        } else if (Elem == "AccGap") {
+            if (s < 0e0) {
+                // First gap.
+                Accel = (beta_tab[0]*gamma_tab[0])/((beta_tab[1]*gamma_tab[1]));
+            } else {
+                // Second gap.
+                Accel = (beta_tab[1]*gamma_tab[1])/((beta_tab[2]*gamma_tab[2]));
+            }
+        } else {
+            throw std::runtime_error("GetCavMatParams: undef. multipole element "+Elem);
+        }
+
+        tab.set(s, L.E0, T, S, Accel);
+    }
+}
+
+void GenCavMat(const int MpoleLevel, const CavityThinLens &CavTLM, const TLMLineTab &tab,
+               const double dis, const double EfieldScl, const double TTF_tab[],
+               const double beta_tab[], const double gamma_tab[], const double Lambda,
+               const double IonZ, const double IonEs, const double IonFys[],
+               const double Rm, value_mat &M)
+{
+    /* RF cavity model, transverse only defocusing.
+     * 2-gap matrix model.                                            */
+
+    int               seg;
+    double            k_s[3];
+    double            Ecens[2], Ts[2], Ss[2], V0s[2], ks[2], L1, L2, L3;
+    double            beta, gamma, kfac, V0, T, S, kfdx, kfdy, dpy, Accel, IonFy;
+    value_mat         Idmat, Mlon_L1, Mlon_K1, Mlon_L2;
+    value_mat         Mlon_K2, Mlon_L3, Mlon, Mtrans, Mprob;
+
+    const double IonA = 1e0;
+
+    using boost::numeric::ublas::prod;
+
+    Idmat = boost::numeric::ublas::identity_matrix<double>(PS_Dim);
+
+    k_s[0] = 2e0*M_PI/(beta_tab[0]*Lambda);
+    k_s[1] = 2e0*M_PI/(beta_tab[1]*Lambda);
+    k_s[2] = 2e0*M_PI/(beta_tab[2]*Lambda);
+
+    // Longitudinal model: Drift-Kick-Drift, dis: total lenghth centered at 0,
+    // Ecens[0] & Ecens[1]: Electric Center position where accel kick applies, Ecens[0] < 0
+    // TTFtab: 2*6 vector, Ecens, T Tp S Sp, V0;
+
+    Ecens[0] = TTF_tab[0];
+    Ts[0]    = TTF_tab[1];
+    Ss[0]    = TTF_tab[3];
+    V0s[0]   = TTF_tab[5];
+    ks[0]    = 0.5*(k_s[0]+k_s[1]);
+    L1       = dis + Ecens[0];       //try change dis/2 to dis 14/12/12
+
+    Mlon_L1 = Idmat;
+    Mlon_K1 = Idmat;
+    // Pay attention, original is -
+    Mlon_L1(4, 5) = -2e0*M_PI/Lambda*(1e0/cube(beta_tab[0]*gamma_tab[0])/IonEs*L1);
+    // Pay attention, original is -k1-k2
+    Mlon_K1(5, 4) = -IonZ*V0s[0]*Ts[0]*sin(IonFys[0]+ks[0]*L1)-IonZ*V0s[0]*Ss[0]*cos(IonFys[0]+ks[0]*L1);
+
+    Ecens[1] = TTF_tab[6];
+    Ts[1]    = TTF_tab[7];
+    Ss[1]    = TTF_tab[9];
+    V0s[1]   = TTF_tab[11];
+    ks[1]    = 0.5*(k_s[1]+k_s[2]);
+    L2       = Ecens[1] - Ecens[0];
+
+    Mlon_L2 = Idmat;
+    Mlon_K2 = Idmat;
+
+    Mlon_L2(4, 5) = -2e0*M_PI/Lambda*(1e0/cube(beta_tab[1]*gamma_tab[1])/IonEs*L2); //Problem is Here!!
+    Mlon_K2(5, 4) = -IonZ*V0s[1]*Ts[1]*sin(IonFys[1]+ks[1]*Ecens[1])-IonZ*V0s[1]*Ss[1]*cos(IonFys[1]+ks[1]*Ecens[1]);
+
+    L3 = dis - Ecens[1]; //try change dis/2 to dis 14/12/12
+
+    Mlon_L3       = Idmat;
+    Mlon_L3(4, 5) = -2e0*M_PI/Lambda*(1e0/cube(beta_tab[2]*gamma_tab[2])/IonEs*L3);
+
+    Mlon = Idmat;
+    Mlon = prod(Mlon_K1, Mlon_L1);
+    Mlon = prod(Mlon_L2, Mlon);
+    Mlon = prod(Mlon_K2, Mlon);
+    Mlon = prod(Mlon_L3, Mlon);
+
+    // Transverse model
+    // Drift-FD-Drift-LongiKick-Drift-FD-Drift-0-Drift-FD-Drift-LongiKick-Drift-FD-Drift
+
+    seg    = 0;
+
+    Mtrans = Idmat;
+    Mprob  = Idmat;
+
+    beta   = beta_tab[0];
+    gamma  = gamma_tab[0];
+    IonFy  = IonFys[0];
+    kfac   = k_s[0];
+
+    V0 = 0e0, T = 0e0, S = 0e0, kfdx = 0e0, kfdy = 0e0, dpy = 0e0;
+
+    for (size_t n = 0; n < CavTLM.lines.size(); n++) {
+        const std::string &Elem = CavTLM.lines[n].Elem;
+        const double Length = CavTLM.lines[n].Length,
+                     s      = tab.s[n];
+
+        Mprob = Idmat;
+        if (Elem == "drift") {
+            IonFy = IonFy + kfac*Length;
+
+            Mprob(0, 1) = Length;
+            Mprob(2, 3) = Length;
+            Mtrans      = prod(Mprob, Mtrans);
+        } else if (Elem == "EFocus1") {
+            V0   = tab.E0[n]*EfieldScl;
+            T    = tab.T[n];
+            S    = tab.S[n];
+            kfdx = IonZ*V0/sqr(beta)/gamma/IonA/AU*(T*cos(IonFy)-S*sin(IonFy))/Rm;
+            kfdy = kfdx;
+
+            Mprob(1, 0) = kfdx;
+            Mprob(3, 2) = kfdy;
+            Mtrans      = prod(Mprob, Mtrans);
+        } else if (Elem == "EFocus2") {
+            V0   = tab.E0[n]*EfieldScl;
+            T    = tab.T[n];
+            S    = tab.S[n];
+            kfdx = IonZ*V0/sqr(beta)/gamma/IonA/AU*(T*cos(IonFy)-S*sin(IonFy))/Rm;
+            kfdy = kfdx;
+
+            Mprob(1, 0) = kfdx;
+            Mprob(3, 2) = kfdy;
+            Mtrans      = prod(Mprob, Mtrans);
+        } else if (Elem == "EDipole") {
+            if (MpoleLevel >= 1) {
+                V0  = tab.E0[n]*EfieldScl;
+                T   = tab.T[n];
+                S   = tab.S[n];
+                dpy = IonZ*V0/sqr(beta)/gamma/IonA/AU*(T*cos(IonFy)-S*sin(IonFy));
+
+                Mprob(3, 6) = dpy;
+                Mtrans      = prod(Mprob, Mtrans);
+            }
+        } else if (Elem == "EQuad") {
+            if (MpoleLevel >= 2) {
+                V0   = tab.E0[n]*EfieldScl;
+                T    = tab.T[n];
+                S    = tab.S[n];
+                kfdx =  IonZ*V0/sqr(beta)/gamma/IonA/AU*(T*cos(IonFy)-S*sin(IonFy))/Rm;
+                kfdy = -kfdx;
+
+                Mprob(1, 0) = kfdx;
+                Mprob(3, 2) = kfdy;
+                Mtrans      = prod(Mprob, Mtrans);
+            }
+        } else if (Elem == "HMono") {
+            if (MpoleLevel >= 2) {
+                V0   = tab.E0[n]*EfieldScl;
+                T    = tab.T[n];
+                S    = tab.S[n];
+                kfdx = -MU0*C0*IonZ*V0/beta/gamma/IonA/AU*(T*cos(IonFy+M_PI/2e0)-S*sin(IonFy+M_PI/2e0))/Rm;
+                kfdy = kfdx;
+
+                Mprob(1, 0) = kfdx;
+                Mprob(3, 2) = kfdy;
+                Mtrans      = prod(Mprob, Mtrans);
+            }
+        } else if (Elem == "HDipole") {
+            if (MpoleLevel >= 1) {
+                V0  = tab.E0[n]*EfieldScl;
+                T   = tab.T[n];
+                S   = tab.S[n];
+                dpy = -MU0*C0*IonZ*V0/beta/gamma/IonA/AU*(T*cos(IonFy+M_PI/2e0)-S*sin(IonFy+M_PI/2e0));
+
+                Mprob(3, 6) = dpy;
+                Mtrans      = prod(Mprob, Mtrans);
+            }
+        } else if (Elem == "HQuad") {
+            if (MpoleLevel >= 2) {
+                if (s < 0e0) {
+                    // First gap.
+                    beta  = (beta_tab[0]+beta_tab[1])/2e0;
+                    gamma = (gamma_tab[0]+gamma_tab[1])/2e0;
+                } else {
+                    beta  = (beta_tab[1]+beta_tab[2])/2e0;
+                    gamma = (gamma_tab[1]+gamma_tab[2])/2e0;
+                }
+                V0   = tab.E0[n]*EfieldScl;
+                T    = tab.T[n];
+                S    = tab.S[n];
+                kfdx = -MU0*C0*IonZ*V0/beta/gamma/IonA/AU*(T*cos(IonFy+M_PI/2e0)-S*sin(IonFy+M_PI/2e0))/Rm;
+                kfdy = -kfdx;
+
+                Mprob(1, 0) = kfdx;
+                Mprob(3, 2) = kfdy;
+                Mtrans      = prod(Mprob, Mtrans);
+            }
+        } else if (Elem == "AccGap") {
+            //IonFy = IonFy + IonZ*V0s[0]*kfac*(TTF_tab[2]*sin(IonFy)
+            //        + TTF_tab[4]*cos(IonFy))/2/((gamma-1)*IonEs); //TTF_tab[2]~Tp
+            seg    = seg + 1;
+            beta   = beta_tab[seg];
+            gamma  = gamma_tab[seg];
+            kfac   = 2e0*M_PI/(beta*Lambda);
+            Accel  = tab.Accel[n];
+
+            Mprob(1, 1) = Accel;
+            Mprob(3, 3) = Accel;
+            Mtrans      = prod(Mprob, Mtrans);
+        } else {
+            throw std::runtime_error("GenCavMat: undef. multipole type "+Elem);
+        }
+    }
+
+    M = Mtrans;
+
+    M(4, 4) = Mlon(4, 4);
+    M(4, 5) = Mlon(4, 5);
+    M(5, 4) = Mlon(5, 4);
+    M(5, 5) = Mlon(5, 5);
+}
+
+void calRFcaviEmitGrowth(const value_mat &matIn, const double ionZ, const double ionEs, double &E0TL,
+                         const double aveBeta, const double aveGama,
+                         const double betaf, const double gamaf, const double fRF, const double ionFys,
+                         const double aveX2i, const double cenX, const double aveY2i, const double cenY, value_mat &matOut)
+{
+    // Evaluate emittance growth.
+    int       k;
+    double    ionLamda, DeltaPhi, kpX, fDeltaPhi, f2DeltaPhi, gPhisDeltaPhi, deltaAveXp2f, XpIncreaseFactor;
+    double    kpY, deltaAveYp2f, YpIncreaseFactor, kpZ, ionK, aveZ2i, deltaAveZp2, longiTransFactor, ZpIncreaseFactor;
+
+    matOut = matIn;
+
+    ionLamda = C0/fRF*MtoMM;
+
+    // for rebuncher, because no acceleration, E0TL would be wrong when cos(ionFys) is devided.
+    if (cos(ionFys) > -0.0001 && cos(ionFys) < 0.0001) E0TL = 0e0;
+    DeltaPhi = sqrt(matIn(4, 4));
+    // ionLamda in m, kpX in 1/mm
+    kpX              = -M_PI*fabs(ionZ)*E0TL/ionEs/sqr(aveBeta*aveGama)/betaf/gamaf/ionLamda;
+    fDeltaPhi        = 15e0/sqr(DeltaPhi)*(3e0/sqr(DeltaPhi)*(sin(DeltaPhi)/DeltaPhi-cos(DeltaPhi))-(sin(DeltaPhi)/DeltaPhi));
+    f2DeltaPhi       = 15e0/sqr(2e0*DeltaPhi)*(3e0/sqr(2e0*DeltaPhi)
+                       *(sin(2e0*DeltaPhi)/(2e0*DeltaPhi)-cos(2e0*DeltaPhi))-(sin(2e0*DeltaPhi)/(2e0*DeltaPhi)));
+    gPhisDeltaPhi    = 0.5e0*(1+(sqr(sin(ionFys))-sqr(cos(ionFys)))*f2DeltaPhi);
+    deltaAveXp2f     = kpX*kpX*(gPhisDeltaPhi-sqr(sin(ionFys)*fDeltaPhi))*(aveX2i+cenX*cenX);
+    XpIncreaseFactor = 1e0;
+
+    if (deltaAveXp2f+matIn(1, 1) > 0e0) XpIncreaseFactor = sqrt((deltaAveXp2f+matIn(1, 1))/matIn(1, 1));
+
+     // ionLamda in m
+    kpY = -M_PI*fabs(ionZ)*E0TL/ionEs/sqr(aveBeta*aveGama)/betaf/gamaf/ionLamda;
+    deltaAveYp2f = sqr(kpY)*(gPhisDeltaPhi-sqr(sin(ionFys)*fDeltaPhi))*(aveY2i+sqr(cenY));
+    YpIncreaseFactor = 1.0;
+    if (deltaAveYp2f+matIn(3, 3)>0) {
+        YpIncreaseFactor = sqrt((deltaAveYp2f+matIn(3, 3))/matIn(3, 3));
+    }
+
+    kpZ = -2e0*kpX*aveGama*aveGama;
+     //unit: 1/mm
+    ionK = 2e0*M_PI/(aveBeta*ionLamda);
+    aveZ2i = DeltaPhi*DeltaPhi/ionK/ionK;
+    deltaAveZp2 = sqr(kpZ*DeltaPhi)*aveZ2i*(cos(ionFys)*cos(ionFys)/8e0+DeltaPhi*sin(ionFys)/576e0);
+    longiTransFactor = 1e0/(aveGama-1e0)/ionEs;
+    ZpIncreaseFactor = 1e0;
+    if (deltaAveZp2+matIn(5, 5)*longiTransFactor*longiTransFactor > 0e0)
+        ZpIncreaseFactor = sqrt((deltaAveZp2+matIn(5, 5)*sqr(longiTransFactor))/(matIn(5, 5)*sqr(longiTransFactor)));
+
+    for (k = 0; k < PS_Dim; k++) {
+        matOut(1, k) *= XpIncreaseFactor;
+        matOut(k, 1) *= XpIncreaseFactor;
+        matOut(3, k) *= YpIncreaseFactor;
+        matOut(k, 3) *= YpIncreaseFactor;
+        matOut(5, k) *= ZpIncreaseFactor;
+        matOut(k, 5) *= ZpIncreaseFactor;
+    }
+}
+
+void readFile(const std::string& fname, CavityFieldMap& map)
+{
+    std::ifstream strm(fname.c_str());
+    if(!strm.is_open())
+        throw std::runtime_error("Failed to open "+fname);
+    try {
+        map.read(strm);
+    } catch(std::runtime_error& e) {
+        throw std::runtime_error(fname+": "+e.what());
+    }
+}
+
+void readFile(const std::string& fname, CavityThinLens& tlm)
+{
+    std::ifstream strm(fname.c_str());
+    if(!strm.is_open())
+        throw std::runtime_error("Failed to open "+fname);
+    try {
+        tlm.read(strm);
+    } catch(std::runtime_error& e) {
+        throw std::runtime_error(fname+": "+e.what());
+    }
+}
+
+} // namespace
+
+void CavityThinLens::read(std::istream& strm)
+{
+    std::string line;
+    size_t lineno = 0;
+    lines.clear();
+    while(std::getline(strm, line)) {
+        lineno++;
+        if(line.empty() || line[0]=='%')
+            continue; // comment
+
+        std::istringstream lstrm(line);
+        Line L;
+        if(!(lstrm >> L.Elem >> L.Name >> L.Length >> L.Aper))
+            continue; // blank
+
+        if(L.Elem!="drift" && L.Elem!="AccGap") {
+            if(!(lstrm >> L.E0)) {
+                std::ostringstream msg;
+                msg<<"line "<<lineno<<": "<<L.Elem<<" '"<<L.Name<<"' has no field";
+                throw std::runtime_error(msg.str());
+            }
+        } else {
+            L.E0 = 0e0;
+        }
+
+        if(L.Elem!="drift" && L.Elem!="EFocus1" && L.Elem!="EFocus2"
+                && L.Elem!="EDipole" && L.Elem!="EQuad" && L.Elem!="HMono"
+                && L.Elem!="HDipole" && L.Elem!="HQuad" && L.Elem!="AccGap") {
+            std::ostringstream msg;
+            msg<<"line "<<lineno<<": undefined thin lens element '"<<L.Elem<<"'";
+            throw std::runtime_error(msg.str());
+        }
+
+        lines.push_back(L);
+    }
+    if(lines.empty())
+        throw std::runtime_error("Thin lens model has no elements");
+}
+
+void LongTab::set(double s, double Ek, double FyAbs, double Beta, double Gamma)
+{
+    this->s.push_back(s); this->Ek.push_back(Ek); this->FyAbs.push_back(FyAbs);
+    this->Beta.push_back(Beta); this->Gamma.push_back(Gamma);
+}
+
+void LongTab::clear()
+{
+    s.clear(); Ek.clear(); FyAbs.clear(); Beta.clear(); Gamma.clear();
+}
+
+void LongTab::show(std::ostream& strm, size_t k) const
+{
+    strm << std::scientific << std::setprecision(10)
+         << std::setw(18) << this->s[k]
+         << std::setw(18) << this->Ek[k]
+         << std::setw(18) << this->FyAbs[k]
+         << std::setw(18) << this->Beta[k]
+         << std::setw(18) << this->Gamma[k] << "\n";
+}
+
+LinacContext::LinacContext()
+    :MpoleLevel(2)
+    ,EmitGrowth(false)
+    ,log(NULL)
+{}
+
+unsigned LinacContext::cavityIndex(const std::string& cavtype)
+{
+    for(unsigned i=0; i<ncavities; i++) {
+        if(cavtype==cavities[i].name)
+            return i;
+    }
+    throw std::invalid_argument("undef. cavity type: "+cavtype);
+}
+
+void LinacContext::loadData(const std::string& homedir)
+{
+    readFile(homedir+"/data/axisData_41.txt", CavData[0]);
+    readFile(homedir+"/data/axisData_85.txt", CavData[1]);
+    readFile(homedir+"/data/Multipole41/thinlenlon_41.txt", CavTLM[0]);
+    readFile(homedir+"/data/Multipole85/thinlenlon_85.txt", CavTLM[1]);
+}
+
+void LinacContext::setCavity(const std::string& cavtype, const CavityFieldMap& map, const CavityThinLens& tlm)
+{
+    unsigned i = cavityIndex(cavtype);
+    CavData[i] = map;
+    CavTLM[i] = tlm;
+}
+
+void LinacContext::propagateLongStripper(size_t n, double &IonZ, const double IonEs,
+                                         double &IonW, double &SampleIonK, double &IonBeta)
+{
+    double IonEk, IonGamma;
+    double chargeAmount_Baron[Stripper_n];
+
+    IonZ = Stripper_IonZ;
+    ChargeStripper(Stripper_IonMass, Stripper_IonProton, IonBeta,
+                   Stripper_n, Stripper_IonChargeStates,
+                   chargeAmount_Baron);
+    // Evaluate change in reference particle energy due to stripper model energy straggling.
+    IonEk      = (longTab.Ek[n-2]-StripperPara[2])*Stripper_E0Para[1] + Stripper_E0Para[0];
+    IonW       = IonEk + IonEs;
+    IonGamma   = IonW/IonEs;
+    IonBeta    = sqrt(1e0-1e0/sqr(IonGamma));
+    SampleIonK = 2e0*M_PI/(IonBeta*SampleLambda);
+
+    longTab.set(longTab.s[n-2], IonEk, longTab.FyAbs[n-2], IonBeta, IonGamma);
+}
+
+void LinacContext::propagateLongRFCav(const Config &conf, size_t n, const double IonZ, const double IonEs,
+                                      double &IonW, double &SampleIonK, double &IonBeta)
+{
+    int         cavi;
+    double      fRF, multip, caviIonK, IonFys, EfieldScl, caviFy, IonFy_i, IonFy_o;
+    double      IonW_o, IonGamma;
+
+    cavi = cavityIndex(conf.get<std::string>("cavtype"))+1;
+
+    fRF       = conf.get<double>("f");
+    multip    = fRF/SampleFreq;
+    caviIonK  = 2e0*M_PI*fRF/(IonBeta*C0)/MtoMM;
+    IonFys    = conf.get<double>("phi")*M_PI/180e0; // Synchrotron phase [rad].
+    EfieldScl = conf.get<double>("scl_fac");       // Electric field scale factor.
+
+    caviFy = GetCavPhase(cavi, IonW-IonEs, IonFys, longTab.FyAbs[n-2], multip);
+
+    IonFy_i = multip*longTab.FyAbs[n-2] + caviFy;
+    CavPhases.push_back(caviFy);
+
+    // For the reference particle, evaluate the change of:
+    // kinetic energy, absolute phase, beta, and gamma.
+    GetCavBoost(CavData[cavi-1], IonW, IonFy_i, caviIonK, IonZ,
+                IonEs, fRF, EfieldScl, IonW_o, IonFy_o);
+    IonW       = IonW_o;
+    IonGamma   = IonW/IonEs;
+    IonBeta    = sqrt(1e0-1e0/sqr(IonGamma));
+    SampleIonK = 2e0*M_PI/(IonBeta*SampleLambda);
+
+    longTab.set(longTab.s[n-2]+conf.get<double>("L"), IonW-IonEs,
+            longTab.FyAbs[n-2]+(IonFy_o-IonFy_i)/multip, IonBeta, IonGamma);
+}
+
+void LinacContext::initLong(const Machine &sim, const double IonZ, std::ostream *table)
+{
+    /* Longitudinal initialization for reference particle.
+     * Evaluate beam energy and cavity loaded phase along the lattice. */
+    size_t n;
+    double IonGamma, IonBeta, SampleIonK;
+    double IonW, IonZ1, IonEs, IonEk;
+
+    longTab.clear();
+    CavPhases.clear();
+
+    Config                   D;
+    std::auto_ptr<StateBase> state(sim.allocState(D));
+    // Propagate through first element.
+    sim.propagate(state.get(), 0, 1);
+
+    IonZ1 = IonZ;
+    IonEs = state->IonEs/MeVtoeV;
+    IonW  = state->IonW/MeVtoeV;
+    IonEk = state->IonEk/MeVtoeV;
+
+    IonGamma   = IonW/IonEs;
+    IonBeta    = sqrt(1e0-1e0/sqr(IonGamma));
+    SampleIonK = 2e0*M_PI/(IonBeta*SampleLambda);
+
+    if (log) {
+        *log << "\n" << "InitLong:" << "\n";
+        *log << std::fixed << std::setprecision(5)
+             << "  IonZ = " << IonZ1
+             << "  IonEs [Mev/u] = " << IonEs << ", IonEk [Mev/u] = " << IonEk
+             << ", IonW [Mev/u] = " << IonW << "\n";
+    }
+
+    n = 1;
+    longTab.set(0e0, IonEk, 0e0, IonBeta, IonGamma);
+
+    // Skip over state.
+    for (size_t i = 1; i < sim.size(); i++) {
+        const ElementVoid* elem   = sim[i];
+        const Config&      conf   = elem->conf();
+        std::string        t_name = elem->type_name(); // C string -> C++ string.
+
+        if (t_name == "marker") {
+        } else if (t_name == "drift" || t_name == "sbend"
+                   || t_name == "quadrupole" || t_name == "solenoid") {
+            n++;
+            longTab.set(longTab.s[n-2]+conf.get<double>("L"), longTab.Ek[n-2],
+                        longTab.FyAbs[n-2]+SampleIonK*conf.get<double>("L")*MtoMM,
+                        longTab.Beta[n-2], longTab.Gamma[n-2]);
+        } else if (t_name == "rfcavity") {
+            n++;
+            propagateLongRFCav(conf, n, IonZ1, IonEs, IonW, SampleIonK, IonBeta);
+        } else if (t_name == "stripper") {
+            // Evaluate change in reference particle energy and multi-charge states, and charge.
+            n++;
+            propagateLongStripper(n, IonZ1, IonEs, IonW, SampleIonK, IonBeta);
+        }
+
+        if (table) {
+            *table << std::setw(15) << std::left << t_name << std::setw(25)
+                   << elem->name << std::internal;
+            longTab.show(*table, n-1);
+        }
+    }
+}
+
+void LinacContext::getCavMat(const unsigned cavi, const int cavilabel, const double Rm,
+                             const double IonZ, const double IonEs, const double EfieldScl, const double IonFyi_s,
+                             const double IonEk_s, const double fRF, value_mat &M) const
+{
+    int    n;
+    double IonLambda, Ecen[2], T[2], Tp[2], S[2], Sp[2], V0[2];
+    double dis, IonW_s[3], IonFy_s[3], gamma_s[3], beta_s[3], IonK_s[3];
+    double IonK[2];
+    TLMLineTab tab;
+
+    if (CavTLM[cavi-1].lines.empty())
+        throw std::runtime_error("GetCavMat: no thin lens model");
+
+    IonLambda  = C0/fRF*MtoMM;
+
+    IonW_s[0]  = IonEk_s + IonEs;
+    IonFy_s[0] = IonFyi_s;
+    gamma_s[0] = IonW_s[0]/IonEs;
+    beta_s[0]  = sqrt(1e0-1e0/sqr(gamma_s[0]));
+    IonK_s[0]  = 2e0*M_PI/(beta_s[0]*IonLambda);
+
+    n   = CavData[cavi-1].s.size();
+    dis = (CavData[cavi-1].s[n-1]-CavData[cavi-1].s[0])/2e0;
+
+    TransFacts(cavilabel, beta_s[0], 1, EfieldScl, Ecen[0], T[0], Tp[0], S[0], Sp[0], V0[0]);
+    EvalGapModel(dis, IonW_s[0], IonEs, IonFy_s[0], IonK_s[0], IonZ, IonLambda,
+                Ecen[0], T[0], S[0], Tp[0], Sp[0], V0[0], IonW_s[1], IonFy_s[1]);
+    gamma_s[1] = IonW_s[1]/IonEs;
+    beta_s[1]  = sqrt(1e0-1e0/sqr(gamma_s[1]));
+    IonK_s[1]  = 2e0*M_PI/(beta_s[1]*IonLambda);
+
+    TransFacts(cavilabel, beta_s[1], 2, EfieldScl, Ecen[1], T[1], Tp[1], S[1], Sp[1], V0[1]);
+    EvalGapModel(dis, IonW_s[1], IonEs, IonFy_s[1], IonK_s[1], IonZ, IonLambda,
+                Ecen[1], T[1], S[1], Tp[1], Sp[1], V0[1], IonW_s[2], IonFy_s[2]);
+    gamma_s[2] = IonW_s[2]/IonEs;
+    beta_s[2]  = sqrt(1e0-1e0/sqr(gamma_s[2]));
+    IonK_s[2]  = 2e0*M_PI/(beta_s[2]*IonLambda);
+
+    Ecen[0] = Ecen[0] - dis;
+
+    double TTF_tab[] = {Ecen[0], T[0], Tp[0], S[0], Sp[0], V0[0], Ecen[1], T[1], Tp[1], S[1], Sp[1], V0[1]};
+    IonK[0] = (IonK_s[0]+IonK_s[1])/2e0;
+    IonK[1] = (IonK_s[1]+IonK_s[2])/2e0;
+
+    GetCavMatParams(cavi, MpoleLevel, CavData[cavi-1], CavTLM[cavi-1], tab, beta_s, gamma_s, IonK, log);
+    GenCavMat(MpoleLevel, CavTLM[cavi-1], tab, dis, EfieldScl, TTF_tab, beta_s, gamma_s, IonLambda,
+              IonZ, IonEs, IonFy_s, Rm, M);
+}
+
+void LinacContext::initRFCav(const Config &conf, const size_t CavCnt,
+                             const double IonZ, const double IonEs, double &IonW, double &EkState,
+                             double &Fy_absState, double &accIonW,
+                             double &beta, double &gamma, double &avebeta, double &avegamma,
+                             value_mat &M) const
+{
+    unsigned    cavi;
+    int         cavilabel, multip;
+    double      Rm, IonFy_i, Ek_i, fRF, CaviIonK, EfieldScl;
+    double      IonW_o, IonFy_o;
+
+    {
+        unsigned i = cavityIndex(conf.get<std::string>("cavtype"));
+        cavi       = i+1;
+        cavilabel  = cavities[i].label;
+        multip     = 1;
+        Rm         = cavities[i].Rm;
+    }
+
+    if (CavCnt > CavPhases.size())
+        throw std::runtime_error("rfcavity without phase.  initLong() must be called first");
+
+    IonFy_i = multip*Fy_absState + CavPhases[CavCnt-1];
+    Ek_i    = EkState;
+    IonW    = EkState + IonEs;
+
+    avebeta    = beta;
+    avegamma   = gamma;
+    fRF        = conf.get<double>("f");
+    CaviIonK   = 2e0*M_PI*fRF/(beta*C0*MtoMM);
+    EfieldScl  = conf.get<double>("scl_fac");         // Electric field scale factor.
+
+    GetCavBoost(CavData[cavi-1], IonW, IonFy_i, CaviIonK, IonZ, IonEs,
+                fRF, EfieldScl, IonW_o, IonFy_o);
+
+    accIonW      = IonW_o - IonW;
+    IonW         = IonW_o;
+    EkState      = IonW - IonEs;
+    IonW         = EkState + IonEs;
+    gamma        = IonW/IonEs;
+    beta         = sqrt(1e0-1e0/sqr(gamma));
+    avebeta      = (avebeta+beta)/2e0;
+    avegamma     = (avegamma+gamma)/2e0;
+    Fy_absState += (IonFy_o-IonFy_i)/multip;
+
+    getCavMat(cavi, cavilabel, Rm, IonZ, IonEs, EfieldScl, IonFy_i, Ek_i, fRF, M);
+}
+
+// One charge state propagated by LinacContext::propagate()
+struct LinacContext::Tracker
+{
+    Machine *sim;
+    boost::shared_ptr<StateBase> state;
+    state_t *StatePtr;
+    size_t n, CavCnt;
+    double s, IonZ, IonEs, EkState, Fy_absState;
+
+    // Scale matrix element for Charge State and propagate through element i.
+    void scaleAndPropagate(const LinacContext& ctx, size_t i)
+    {
+        double             IonW, L = 0e0, beta, gamma, avebeta, avegamma;
+        double             SampleionK, R56, Brho, K;
+        double             accIonW, x0[2], x2[2], ionFys, E0TL;
+        element_t          *ElemPtr;
+        value_mat          M;
+
+        ElementVoid*  elem   = (*sim)[i];
+        const Config& conf   = elem->conf();
+        std::string   t_name = elem->type_name(); // C string -> C++ string.
+
+        ElemPtr = dynamic_cast<element_t *>(elem);
+        if (!ElemPtr)
+            throw std::invalid_argument("Machine must have sim_type MomentMatrix");
+
+        if (t_name != "marker") {
+            L = conf.get<double>("L")*MtoMM;
+            s += L;
+        }
+
+        gamma      = (EkState+IonEs)/IonEs;
+        beta       = sqrt(1e0-1e0/sqr(gamma));
+        SampleionK = 2e0*M_PI/(beta*SampleLambda);
+
+        // Evaluate momentum compaction.
+        R56 = -2e0*M_PI/(SampleLambda*IonEs*cube(beta*gamma))*L;
+
+        if (t_name == "marker") {
+        } else if (t_name == "drift" || t_name == "sbend") {
+            n++;
+            Fy_absState += SampleionK*L;
+            ElemPtr->transfer(state_t::PS_S, state_t::PS_PS) = R56;
+        } else if (t_name == "quadrupole" || t_name == "solenoid") {
+            n++;
+            Brho = beta*(EkState+IonEs)*MeVtoeV/(C0*IonZ);
+            // Scale B field.
+            if (t_name == "quadrupole")
+                K = conf.get<double>("B2")/Brho;
+            else
+                K = conf.get<double>("B")/(2e0*Brho);
+
+            Config newconf(conf);
+            newconf.set<double>("K", K);
+            sim->reconfigure(i, newconf);
+            // Re-initialize after re-allocation.
+            elem = (*sim)[i];
+            ElemPtr = dynamic_cast<element_t *>(elem);
+
+            ElemPtr->transfer(state_t::PS_S, state_t::PS_PS) = R56;
+
+            Fy_absState += SampleionK*L;
+        } else if (t_name == "rfcavity") {
+            n++, CavCnt++;
+            ctx.initRFCav(conf, CavCnt, IonZ, IonEs, IonW, EkState, Fy_absState, accIonW,
+                          beta, gamma, avebeta, avegamma, M);
+            ElemPtr->transfer = M;
+
+            // Get state at entrance.
+            x0[0]  = StatePtr->moment0[state_t::PS_X];
+            x0[1]  = StatePtr->moment0[state_t::PS_Y];
+            x2[0]  = StatePtr->state(0, 0);
+            x2[1]  = StatePtr->state(2, 2);
+            ionFys = conf.get<double>("phi")/180e0*M_PI;
+            E0TL   = accIonW/cos(ionFys)/IonZ;
+
+            elem->advance(*state);
+
+            // Inconsistency in TLM; orbit at entrace should be used to evaluate emittance growth.
+
+            if (n > ctx.longTab.size())
+                throw std::runtime_error("Lattice does not match LongTab.  initLong() must be called first");
+            StatePtr->moment0[state_t::PS_S]  = Fy_absState - ctx.longTab.FyAbs[n-1];
+            StatePtr->moment0[state_t::PS_PS] = EkState - ctx.longTab.Ek[n-1];
+
+            if (ctx.EmitGrowth) {
+                calRFcaviEmitGrowth(StatePtr->state, IonZ, IonEs,
+                                    E0TL, avebeta, avegamma, beta, gamma, conf.get<double>("f"), ionFys,
+                                    x2[0], x0[0], x2[1], x0[1], M);
+                StatePtr->state = M;
+            }
+        }
+
+        if (t_name != "rfcavity") elem->advance(*state);
+    }
+};
+
+void LinacContext::propagate(const std::vector<Machine*>& sims,
+                             const std::vector<double>& IonZ,
+                             const std::vector<double>& NChg,
+                             const std::vector<MomentState::vector_t>& Mom1,
+                             const std::vector<MomentState::matrix_t>& Mom2,
+                             LinacTrack& out) const
+{
+    // Evaluate transport matrices for given beam initial conditions.
+    const size_t nChgState = sims.size();
+    if (nChgState==0 || IonZ.size()!=nChgState || NChg.size()!=nChgState
+            || Mom1.size()!=nChgState || Mom2.size()!=nChgState)
+        throw std::invalid_argument("Need the same number of Machines, IonZ, NChg, and initial moments");
+
+    const size_t nelem = sims[0]->size();
+    for (size_t k = 1; k < nChgState; k++) {
+        if (sims[k]->size() != nelem)
+            throw std::invalid_argument("Machines must have the same number of elements");
+        for (size_t j = 0; j < k; j++)
+            if (sims[j] == sims[k])
+                throw std::invalid_argument("Each charge state needs its own Machine");
+    }
+
+    std::vector<Tracker> T(nChgState);
+    Config D;
+
+    if (log)
+        *log << "\nInitLattice:\n";
+
+    for (size_t k = 0; k < nChgState; k++) {
+        Tracker& C = T[k];
+        C.sim = sims[k];
+        C.s = 0e0, C.CavCnt = 0, C.n = 1;
+
+        C.state.reset(C.sim->allocState(D));
+        C.StatePtr = dynamic_cast<state_t*>(C.state.get());
+        if (!C.StatePtr)
+            throw std::invalid_argument("Machine must have sim_type MomentMatrix");
+        // Propagate through first element (beam initial conditions).
+        C.sim->propagate(C.state.get(), 0, 1);
+
+        double IonEk = C.state->IonEk/MeVtoeV,
+               IonW  = C.state->IonW/MeVtoeV;
+        C.IonZ  = IonZ[k];
+        C.IonEs = C.state->IonEs/MeVtoeV;
+
+        // Define initial conditions.
+        C.Fy_absState = Mom1[k][state_t::PS_S];
+        C.EkState     = IonEk + Mom1[k][state_t::PS_PS];
+
+        // Initialize state.
+        C.StatePtr->moment0 = Mom1[k];
+        C.StatePtr->state   = Mom2[k];
+
+        if (log)
+            *log << std::fixed << std::setprecision(5)
+                 << "  IonZ = " << C.IonZ
+                 << "  IonEs [Mev/u] = " << C.IonEs << ", IonEk [Mev/u] = " << IonEk
+                 << ", IonW [Mev/u] = " << IonW << "\n";
+    }
+
+    const size_t nout = nelem ? nelem-1 : 0;
+    out.s.resize(nout);
+    out.CenofChg.resize(nout*PS_Dim);
+    out.BeamRMS.resize(nout*PS_Dim*PS_Dim);
+
+    double Ntot = 0e0;
+    for (size_t k = 0; k < nChgState; k++)
+        Ntot += NChg[k];
+
+    // Skip over state.
+    for (size_t i = 1; i < nelem; i++) {
+        double *CenofChg = &out.CenofChg[(i-1)*PS_Dim],
+               *BeamRMS  = &out.BeamRMS[(i-1)*PS_Dim*PS_Dim];
+
+        for (size_t k = 0; k < nChgState; k++)
+            T[k].scaleAndPropagate(*this, i);
+
+        out.s[i-1] = T[0].s*1e-3;
+
+        for (int j = 0; j < PS_Dim; j++) {
+            CenofChg[j] = 0e0;
+            for (size_t k = 0; k < nChgState; k++)
+                CenofChg[j] += NChg[k]*T[k].StatePtr->moment0[j];
+            CenofChg[j] /= Ntot;
+        }
+
+        for (int j = 0; j < PS_Dim; j++)
+            for (int l = 0; l < PS_Dim; l++) {
+                double val = 0e0;
+                for (size_t k = 0; k < nChgState; k++)
+                    val += NChg[k]*(T[k].StatePtr->state(j, l)
+                                    +(T[k].StatePtr->moment0[j]-CenofChg[j])*(T[k].StatePtr->moment0[l]-CenofChg[l]));
+                // RMS size on the diagonal, second moments elsewhere.
+                BeamRMS[j*PS_Dim+l] = (j == l)? sqrt(val/Ntot) : val/Ntot;
+            }
+    }
+
+    out.states.resize(nChgState);
+    for (size_t k = 0; k < nChgState; k++)
+        out.states[k].reset(T[k].StatePtr->clone());
+}
@@ -4,6 +4,8 @@
 
 #include "scsi/linear.h"
 #include "scsi/moment.h"
+#include "scsi/ensemble.h"
+#include "scsi/stripper.h"
 #include "scsi/state/vector.h"
 #include "scsi/state/matrix.h"
 
@@ -12,15 +14,26 @@
 #if false
     // Use [m, rad, m, rad, rad, eV/u].
     #define MtoMM 1e0
+    #define MeVtoeV 1e0
 #else
     // Use [mm, rad, mm, rad, rad, MeV/u].
     #define MtoMM 1e3
+    #define MeVtoeV 1e6
 #endif
 
 MatrixState::MatrixState(const Config& c)
     :StateBase(c)
     ,state(boost::numeric::ublas::identity_matrix<double>(6))
 {
+    MatrixState::reset(c);
+}
+
+MatrixState::~MatrixState() {}
+
+void MatrixState::reset(const Config& c)
+{
+    StateBase::reset(c);
+    state = boost::numeric::ublas::identity_matrix<double>(6);
     try{
         const std::vector<double>& I = c.get<std::vector<double> >("initial");
         if(I.size()>state.data().size())
@@ -33,8 +46,6 @@ MatrixState::MatrixState(const Config& c)
     }
 }
 
-MatrixState::~MatrixState() {}
-
 MatrixState::MatrixState(const MatrixState& o, clone_tag t)
     :StateBase(o, t)
     ,state(o.state)
@@ -71,6 +82,15 @@ VectorState::VectorState(const Config& c)
     :StateBase(c)
     ,state(6, 0.0)
 {
+    VectorState::reset(c);
+}
+
+VectorState::~VectorState() {}
+
+void VectorState::reset(const Config& c)
+{
+    StateBase::reset(c);
+    std::fill(state.begin(), state.end(), 0.0);
     try{
         const std::vector<double>& I = c.get<std::vector<double> >("initial");
         if(I.size()>state.size())
@@ -81,8 +101,6 @@ VectorState::VectorState(const Config& c)
     }
 }
 
-VectorState::~VectorState() {}
-
 VectorState::VectorState(const VectorState& o, clone_tag t)
     :StateBase(o, t)
     ,state(o.state)
@@ -160,6 +178,53 @@ void Get2by2Matrix(const double L, const double K, const unsigned ind, typename
     }
 }
 
+// Derivatives of Get2by2Matrix() with respect to K (dK) and L (dL)
+template<typename Base>
+void Get2by2Deriv(const double L, const double K, const unsigned ind,
+                  typename Base::value_t &dK, typename Base::value_t &dL)
+{
+    // M = [[C, S], [-K*S, C]]
+    // with C = cos(sqrt(K)*L), S = sin(sqrt(K)*L)/sqrt(K)  (or cosh/sinh when K<0)
+    double C, S, dSdK;
+
+    if (K > 0e0) {
+        double sqrtK = sqrt(K);
+        C = ::cos(sqrtK*L);
+        S = ::sin(sqrtK*L)/sqrtK;
+    } else if (K < 0e0) {
+        double sqrtK = sqrt(-K);
+        C = ::cosh(sqrtK*L);
+        S = ::sinh(sqrtK*L)/sqrtK;
+    } else {
+        C = 1e0;
+        S = L;
+    }
+
+    if (fabs(K)*sqr(L) > 1e-4)
+        dSdK = (L*C - S)/(2e0*K);
+    else
+        dSdK = -cube(L)/6e0 + K*sqr(L)*cube(L)/60e0; // series expansion about K=0
+
+    dK(ind, ind) = dK(ind+1, ind+1) = -L*S/2e0;
+    dK(ind, ind+1)   = dSdK;
+    dK(ind+1, ind)   = -S - K*dSdK;
+
+    dL(ind, ind) = dL(ind+1, ind+1) = -K*S;
+    dL(ind, ind+1)   = C;
+    dL(ind+1, ind)   = -K*C;
+}
+
+// Start the transfer matrix of the first 'l' of an element of length 'L' (both [mm]).
+// The momentum compaction term of 'T' (eg. set by the linac model) is linear in the length.
+template<typename Base>
+void InitPartial(const typename Base::value_t& T, const double l, const double L, typename Base::value_t &M)
+{
+    typedef typename Base::state_t state_t;
+    M = boost::numeric::ublas::identity_matrix<double>(T.size1());
+    if (L != 0e0)
+        M(state_t::PS_S, state_t::PS_PS) = T(state_t::PS_S, state_t::PS_PS)*l/L;
+}
+
 template<typename Base>
 struct ElementSource : public Base
 {
@@ -168,6 +233,11 @@ struct ElementSource : public Base
     ElementSource(const Config& c)
         :base_t(c), istate(c)
     {}
+    ElementSource(const ElementSource& o)
+        :base_t(o), istate(o.conf())
+    {
+        istate.assign(o.istate);
+    }
 
     virtual void advance(StateBase& s) const
     {
@@ -190,6 +260,16 @@ struct ElementSource : public Base
     virtual const char* type_name() const {return "source";}
 };
 
+// An Ensemble source without "particles" (or "count") leaves the particles unchanged,
+// so that a lattice written for another sim_type can be used.
+template<>
+void ElementSource<EnsembleElementBase>::advance(StateBase& s) const
+{
+    state_t& ST = static_cast<state_t&>(s);
+    if(istate.count()!=0)
+        ST.assign(istate);
+}
+
 template<typename Base>
 struct ElementMark : public Base
 {
@@ -226,6 +306,25 @@ struct ElementDrift : public Base
     }
     virtual ~ElementDrift() {}
 
+    virtual bool dtransfer(const std::string& name, typename base_t::value_t& dM) const
+    {
+        if(name!="L")
+            return false;
+        dM = boost::numeric::ublas::zero_matrix<double>(this->transfer.size1(), this->transfer.size2());
+        dM(state_t::PS_X, state_t::PS_PX) = MtoMM;
+        dM(state_t::PS_Y, state_t::PS_PY) = MtoMM;
+        return true;
+    }
+
+    virtual bool partialTransfer(double l, typename base_t::value_t& M) const
+    {
+        l *= MtoMM;
+        InitPartial<Base>(this->transfer, l, this->conf().template get<double>("L")*MtoMM, M);
+        M(state_t::PS_X, state_t::PS_PX) = l;
+        M(state_t::PS_Y, state_t::PS_PY) = l;
+        return true;
+    }
+
     virtual const char* type_name() const {return "drift";}
 };
 
@@ -254,6 +353,21 @@ struct ElementSBend : public Base
     }
     virtual ~ElementSBend() {}
 
+    virtual bool partialTransfer(double l, typename base_t::value_t& M) const
+    {
+        // Same curvature and gradient over the whole length
+        double L   = this->conf().template get<double>("L")*MtoMM,
+               phi = this->conf().template get<double>("phi"),
+               rho = L/phi,
+               K   = this->conf().template get<double>("K", 0e0)/sqr(MtoMM);
+
+        l *= MtoMM;
+        InitPartial<Base>(this->transfer, l, L, M);
+        Get2by2Matrix<Base>(l, K + 1e0/sqr(rho), (unsigned)state_t::PS_X, M);
+        Get2by2Matrix<Base>(l, -K, (unsigned)state_t::PS_Y, M);
+        return true;
+    }
+
     virtual const char* type_name() const {return "sbend";}
 };
 
@@ -280,9 +394,77 @@ struct ElementQuad : public Base
     }
     virtual ~ElementQuad() {}
 
+    virtual bool dtransfer(const std::string& name, typename base_t::value_t& dM) const
+    {
+        if(name!="K" && name!="L")
+            return false;
+
+        double L = this->conf().template get<double>("L")*MtoMM,
+               K = this->conf().template get<double>("K", 0e0)/sqr(MtoMM);
+
+        typename base_t::value_t dK(boost::numeric::ublas::zero_matrix<double>(this->transfer.size1(), this->transfer.size2())),
+                                 dL(dK), dKy(dK);
+
+        // Horizontal plane.
+        Get2by2Deriv<Base>(L,  K, (unsigned)state_t::PS_X, dK, dL);
+        // Vertical plane, d/dK M(-K) = -M'(-K)
+        Get2by2Deriv<Base>(L, -K, (unsigned)state_t::PS_Y, dKy, dL);
+
+        if(name=="K") {
+            // Convert to [1/m^2]
+            dM = (dK - dKy)/sqr(MtoMM);
+        } else {
+            // Convert to [m]
+            dM = dL*MtoMM;
+        }
+        return true;
+    }
+
+    virtual bool partialTransfer(double l, typename base_t::value_t& M) const
+    {
+        double K = this->conf().template get<double>("K", 0e0)/sqr(MtoMM);
+
+        l *= MtoMM;
+        InitPartial<Base>(this->transfer, l, this->conf().template get<double>("L")*MtoMM, M);
+        Get2by2Matrix<Base>(l,  K, (unsigned)state_t::PS_X, M);
+        Get2by2Matrix<Base>(l, -K, (unsigned)state_t::PS_Y, M);
+        return true;
+    }
+
     virtual const char* type_name() const {return "quadrupole";}
 };
 
+// Fill the Solenoid transport matrix from its (K dependent) terms
+// c2 = cos(KL)^2, sc = sin(KL)*cos(KL), scK = sc/K, s2K = sin(KL)^2/K, Ksc = K*sc, Ks2 = K*sin(KL)^2
+template<typename Base>
+void SetSolMatrix(const double c2, const double sc, const double scK, const double s2K,
+                  const double Ksc, const double Ks2, typename Base::value_t &M)
+{
+    typedef typename Base::state_t state_t;
+
+    M(state_t::PS_X, state_t::PS_X)
+            = M(state_t::PS_PX, state_t::PS_PX)
+            = M(state_t::PS_Y, state_t::PS_Y)
+            = M(state_t::PS_PY, state_t::PS_PY)
+            = c2;
+
+    M(state_t::PS_X, state_t::PS_PX) = scK;
+    M(state_t::PS_X, state_t::PS_Y) = sc;
+    M(state_t::PS_X, state_t::PS_PY) = s2K;
+
+    M(state_t::PS_PX, state_t::PS_X) = -Ksc;
+    M(state_t::PS_PX, state_t::PS_Y) = -Ks2;
+    M(state_t::PS_PX, state_t::PS_PY) = sc;
+
+    M(state_t::PS_Y, state_t::PS_X) = -sc;
+    M(state_t::PS_Y, state_t::PS_PX) = -s2K;
+    M(state_t::PS_Y, state_t::PS_PY) = scK;
+
+    M(state_t::PS_PY, state_t::PS_X) = Ks2;
+    M(state_t::PS_PY, state_t::PS_PX) = -sc;
+    M(state_t::PS_PY, state_t::PS_Y) = -Ksc;
+}
+
 template<typename Base>
 struct ElementSolenoid : public Base
 {
@@ -298,39 +480,11 @@ struct ElementSolenoid : public Base
                C = ::cos(K*L),
                S = ::sin(K*L);
 
-        this->transfer(state_t::PS_X, state_t::PS_X)
-                = this->transfer(state_t::PS_PX, state_t::PS_PX)
-                = this->transfer(state_t::PS_Y, state_t::PS_Y)
-                = this->transfer(state_t::PS_PY, state_t::PS_PY)
-                = sqr(C);
-
-        if (K != 0e0)
-            this->transfer(state_t::PS_X, state_t::PS_PX) = S*C/K;
-        else
-            this->transfer(state_t::PS_X, state_t::PS_PX) = L;
-        this->transfer(state_t::PS_X, state_t::PS_Y) = S*C;
-        if (K != 0e0)
-            this->transfer(state_t::PS_X, state_t::PS_PY) = sqr(S)/K;
-        else
-            this->transfer(state_t::PS_X, state_t::PS_PY) = 0e0;
-
-        this->transfer(state_t::PS_PX, state_t::PS_X) = -K*S*C;
-        this->transfer(state_t::PS_PX, state_t::PS_Y) = -K*sqr(S);
-        this->transfer(state_t::PS_PX, state_t::PS_PY) = S*C;
-
-        this->transfer(state_t::PS_Y, state_t::PS_X) = -S*C;
-        if (K != 0e0)
-            this->transfer(state_t::PS_Y, state_t::PS_PX) = -sqr(S)/K;
-        else
-            this->transfer(state_t::PS_Y, state_t::PS_PX) = 0e0;
-        if (K != 0e0)
-            this->transfer(state_t::PS_Y, state_t::PS_PY) = S*C/K;
-        else
-            this->transfer(state_t::PS_Y, state_t::PS_PY) = L;
-
-        this->transfer(state_t::PS_PY, state_t::PS_X) = K*sqr(S);
-        this->transfer(state_t::PS_PY, state_t::PS_PX) = -S*C;
-        this->transfer(state_t::PS_PY, state_t::PS_Y) = -K*S*C;
+        SetSolMatrix<Base>(sqr(C), S*C,
+                           K != 0e0 ? S*C/K : L,
+                           K != 0e0 ? sqr(S)/K : 0e0,
+                           K*S*C, K*sqr(S),
+                           this->transfer);
 
         // Longitudinal plane.
         // For total path length.
@@ -338,6 +492,54 @@ struct ElementSolenoid : public Base
     }
     virtual ~ElementSolenoid() {}
 
+    virtual bool dtransfer(const std::string& name, typename base_t::value_t& dM) const
+    {
+        if(name!="K")
+            return false;
+
+        double L = this->conf().template get<double>("L")*MtoMM,
+               K = this->conf().template get<double>("K", 0e0)/MtoMM,
+               C = ::cos(K*L),
+               S = ::sin(K*L),
+               C2S2 = sqr(C)-sqr(S), // cos(2KL)
+               dscK, ds2K;
+
+        if (fabs(K*L) > 1e-4) {
+            dscK = L*C2S2/K - S*C/sqr(K);
+            ds2K = (2e0*K*L*S*C - sqr(S))/sqr(K);
+        } else {
+            // series expansion about K=0
+            dscK = -4e0*K*cube(L)/3e0;
+            ds2K = sqr(L) - sqr(K)*sqr(sqr(L));
+        }
+
+        dM = boost::numeric::ublas::zero_matrix<double>(this->transfer.size1(), this->transfer.size2());
+        SetSolMatrix<Base>(-2e0*L*S*C, L*C2S2, dscK, ds2K,
+                           S*C + K*L*C2S2, sqr(S) + 2e0*K*L*S*C,
+                           dM);
+        // Convert to [1/m]
+        dM /= MtoMM;
+        return true;
+    }
+
+    virtual bool partialTransfer(double l, typename base_t::value_t& M) const
+    {
+        double K = this->conf().template get<double>("K", 0e0)/MtoMM,
+               C, S;
+
+        l *= MtoMM;
+        C = ::cos(K*l);
+        S = ::sin(K*l);
+
+        InitPartial<Base>(this->transfer, l, this->conf().template get<double>("L")*MtoMM, M);
+        SetSolMatrix<Base>(sqr(C), S*C,
+                           K != 0e0 ? S*C/K : l,
+                           K != 0e0 ? sqr(S)/K : 0e0,
+                           K*S*C, K*sqr(S),
+                           M);
+        return true;
+    }
+
     virtual const char* type_name() const {return "solenoid";}
 };
 
@@ -379,6 +581,65 @@ struct ElementStripper : public Base
     virtual const char* type_name() const {return "stripper";}
 };
 
+// With "charge_model" set, the moment stripper changes the reference charge and energy,
+// scales the energy deviation, and adds the energy spread from thickness variation.
+// Otherwise it is a marker, as before the model was added.
+template<>
+struct ElementStripper<MomentElementBase> : public MomentElementBase
+{
+    typedef MomentElementBase base_t;
+    typedef base_t::state_t state_t;
+    ElementStripper(const Config& c)
+        :base_t(c), model(c), enabled(c.get<double>("charge_model", 0e0)!=0e0)
+    {
+        if(enabled)
+            transfer(state_t::PS_PS, state_t::PS_PS) = model.E0Para[1];
+    }
+    virtual ~ElementStripper() {}
+
+    virtual void advance(StateBase& s) const;
+
+    virtual void assign(const ElementVoid *other)
+    {
+        const ElementStripper *O = static_cast<const ElementStripper*>(other);
+        model = O->model;
+        enabled = O->enabled;
+        base_t::assign(other);
+    }
+
+    StripperModel model;
+    bool enabled; // "charge_model" is set
+
+    virtual const char* type_name() const {return "stripper";}
+};
+
+void ElementStripper<MomentElementBase>::advance(StateBase& s) const
+{
+    if(!enabled) {
+        base_t::advance(s);
+        return;
+    }
+
+    state_t& ST = static_cast<state_t&>(s);
+    const double a = model.E0Para[1];
+
+    // transfer is diagonal, no scratch space needed
+    ST.moment0[state_t::PS_PS] *= a;
+    for(unsigned i=0; i<state_t::maxsize; i++) {
+        ST.state(state_t::PS_PS, i) *= a;
+        ST.state(i, state_t::PS_PS) *= a;
+    }
+
+    double Ek, sigma;
+    std::vector<double> fractions(model.IonChargeStates.size());
+    model.evaluate(1, ST.IonEs, &ST.IonEk, NULL, NULL, &Ek, &sigma, &fractions[0]);
+
+    ST.state(state_t::PS_PS, state_t::PS_PS) += (sigma/MeVtoeV)*(sigma/MeVtoeV);
+    ST.IonZ  = model.IonZ;
+    ST.IonEk = Ek;
+    ST.IonW  = Ek+ST.IonEs;
+}
+
 template<typename Base>
 struct ElementEDipole : public Base
 {
@@ -421,44 +682,55 @@ void registerLinear()
     Machine::registerState<VectorState>("Vector");
     Machine::registerState<MatrixState>("TransferMatrix");
     Machine::registerState<MomentState>("MomentMatrix");
+    Machine::registerState<EnsembleState>("Ensemble");
 
     Machine::registerElement<ElementSource<LinearElementBase<VectorState>   > >("Vector",         "source");
     Machine::registerElement<ElementSource<LinearElementBase<MatrixState>   > >("TransferMatrix", "source");
     Machine::registerElement<ElementSource<MomentElementBase>                 >("MomentMatrix",   "source");
+    Machine::registerElement<ElementSource<EnsembleElementBase>               >("Ensemble",       "source");
 
     Machine::registerElement<ElementMark<LinearElementBase<VectorState>     > >("Vector",         "marker");
     Machine::registerElement<ElementMark<LinearElementBase<MatrixState>     > >("TransferMatrix", "marker");
     Machine::registerElement<ElementMark<MomentElementBase>                   >("MomentMatrix",   "marker");
+    Machine::registerElement<ElementMark<EnsembleElementBase>                 >("Ensemble",       "marker");
 
     Machine::registerElement<ElementDrift<LinearElementBase<VectorState>    > >("Vector",         "drift");
     Machine::registerElement<ElementDrift<LinearElementBase<MatrixState>    > >("TransferMatrix", "drift");
     Machine::registerElement<ElementDrift<MomentElementBase>                  >("MomentMatrix",   "drift");
+    Machine::registerElement<ElementDrift<EnsembleElementBase>                >("Ensemble",       "drift");
 
     Machine::registerElement<ElementSBend<LinearElementBase<VectorState>    > >("Vector",         "sbend");
     Machine::registerElement<ElementSBend<LinearElementBase<MatrixState>    > >("TransferMatrix", "sbend");
     Machine::registerElement<ElementSBend<MomentElementBase>                  >("MomentMatrix",   "sbend");
+    Machine::registerElement<ElementSBend<EnsembleElementBase>                >("Ensemble",       "sbend");
 
     Machine::registerElement<ElementQuad<LinearElementBase<VectorState>     > >("Vector",         "quadrupole");
     Machine::registerElement<ElementQuad<LinearElementBase<MatrixState>     > >("TransferMatrix", "quadrupole");
     Machine::registerElement<ElementQuad<MomentElementBase>                   >("MomentMatrix",   "quadrupole");
+    Machine::registerElement<ElementQuad<EnsembleElementBase>                 >("Ensemble",       "quadrupole");
 
     Machine::registerElement<ElementSolenoid<LinearElementBase<VectorState> > >("Vector",         "solenoid");
     Machine::registerElement<ElementSolenoid<LinearElementBase<MatrixState> > >("TransferMatrix", "solenoid");
     Machine::registerElement<ElementSolenoid<MomentElementBase>               >("MomentMatrix",   "solenoid");
+    Machine::registerElement<ElementSolenoid<EnsembleElementBase>             >("Ensemble",       "solenoid");
 
     Machine::registerElement<ElementRFCavity<LinearElementBase<VectorState> > >("Vector",         "rfcavity");
     Machine::registerElement<ElementRFCavity<LinearElementBase<MatrixState> > >("TransferMatrix", "rfcavity");
     Machine::registerElement<ElementRFCavity<MomentElementBase>               >("MomentMatrix",   "rfcavity");
+    Machine::registerElement<ElementRFCavity<EnsembleElementBase>             >("Ensemble",       "rfcavity");
 
     Machine::registerElement<ElementStripper<LinearElementBase<VectorState> > >("Vector",         "stripper");
     Machine::registerElement<ElementStripper<LinearElementBase<MatrixState> > >("TransferMatrix", "stripper");
     Machine::registerElement<ElementStripper<MomentElementBase>               >("MomentMatrix",   "stripper");
+    Machine::registerElement<ElementStripper<EnsembleElementBase>             >("Ensemble",       "stripper");
 
     Machine::registerElement<ElementEDipole<LinearElementBase<VectorState>  > >("Vector",         "edipole");
     Machine::registerElement<ElementEDipole<LinearElementBase<MatrixState>  > >("TransferMatrix", "edipole");
     Machine::registerElement<ElementEDipole<MomentElementBase>                >("MomentMatrix",   "edipole");
+    Machine::registerElement<ElementEDipole<EnsembleElementBase>              >("Ensemble",       "edipole");
 
     Machine::registerElement<ElementGeneric<LinearElementBase<VectorState>  > >("Vector",         "generic");
     Machine::registerElement<ElementGeneric<LinearElementBase<MatrixState>  > >("TransferMatrix", "generic");
     Machine::registerElement<ElementGeneric<MomentElementBase>                >("MomentMatrix",   "generic");
+    Machine::registerElement<ElementGeneric<EnsembleElementBase>              >("Ensemble",       "generic");
 }
@@ -1,4 +1,17 @@
 
+#include <algorithm>
+#include <memory>
+#include <sstream>
+
+#include <string.h>
+
+#include <boost/thread/thread.hpp>
+#include <boost/bind.hpp>
+#include <boost/random/mersenne_twister.hpp>
+#include <boost/random/normal_distribution.hpp>
+#include <boost/random/uniform_real.hpp>
+#include <boost/random/variate_generator.hpp>
+
 #include "scsi/moment.h"
 
 MomentState::MomentState(const Config& c)
@@ -6,6 +19,17 @@ MomentState::MomentState(const Config& c)
     ,moment0(maxsize, 0.0)
     ,state(boost::numeric::ublas::identity_matrix<double>(maxsize))
 {
+    MomentState::reset(c);
+}
+
+MomentState::~MomentState() {}
+
+void MomentState::reset(const Config& c)
+{
+    StateBase::reset(c);
+    std::fill(moment0.begin(), moment0.end(), 0.0);
+    state = boost::numeric::ublas::identity_matrix<double>(maxsize);
+
     try{
         const std::vector<double>& I = c.get<std::vector<double> >("moment0");
         if(I.size()>moment0.size())
@@ -29,8 +53,6 @@ MomentState::MomentState(const Config& c)
     }
 }
 
-MomentState::~MomentState() {}
-
 MomentState::MomentState(const MomentState& o, clone_tag t)
     :StateBase(o, t)
     ,moment0(o.moment0)
@@ -75,7 +97,6 @@ bool MomentState::getArray(unsigned idx, ArrayInfo& Info) {
 MomentElementBase::MomentElementBase(const Config& c)
     :ElementVoid(c)
     ,transfer(boost::numeric::ublas::identity_matrix<double>(state_t::maxsize))
-    ,scratch(state_t::maxsize, state_t::maxsize)
 {}
 
 MomentElementBase::~MomentElementBase() {}
@@ -95,10 +116,757 @@ void MomentElementBase::advance(StateBase& s) const
 
     ST.moment0 = prod(transfer, ST.moment0);
 
+    // bounded storage, so no allocation.  Local so that an Element may be
+    // advance()'d by several threads at once.
+    state_t::matrix_t scratch(state_t::maxsize, state_t::maxsize);
     noalias(scratch) = prod(transfer, ST.state);
     noalias(ST.state) = prod(scratch, trans(transfer));
 }
 
+namespace {
+// Copies of an Element built with param +- step.  Used for parameters without dtransfer().
+// The derivative is taken through advance() so that terms added by an advance()
+// override (eg. stripper straggling) are included.
+struct NumericKnob {
+    std::auto_ptr<ElementVoid> plus, minus;
+    double step;
+
+    NumericKnob(const Machine& M, const MomentElementBase *E, const std::string& param)
+    {
+        double val = E->conf().get<double>(param, 0.0);
+        step = 1e-6*std::max(1.0, fabs(val));
+
+        Config C(E->conf());
+        C.set<double>(param, val+step);
+        plus.reset(M.buildElement(C));
+        C.set<double>(param, val-step);
+        minus.reset(M.buildElement(C));
+    }
+
+    // add d(advance(S))/d(param) to dS and dm
+    void apply(const MomentState& S, MomentState::matrix_t& dS, MomentState::vector_t& dm) const
+    {
+        std::auto_ptr<MomentState> P(S.clone()), N(S.clone());
+        plus->advance(*P);
+        minus->advance(*N);
+        dS += (P->state-N->state)/(2.0*step);
+        dm += (P->moment0-N->moment0)/(2.0*step);
+    }
+};
+}
+
+void propagateSensitivity(const Machine& M,
+                          MomentState& S,
+                          const std::vector<SensitivityKnob>& knobs,
+                          const std::vector<size_t>& observe,
+                          std::vector<MomentState::matrix_t>& dstate,
+                          std::vector<MomentState::vector_t>& dmoment0,
+                          std::vector<MomentState::matrix_t>* ostate,
+                          std::vector<MomentState::vector_t>* omoment0)
+{
+    using namespace boost::numeric::ublas;
+    typedef MomentState::matrix_t matrix_t;
+    typedef MomentState::vector_t vector_t;
+    typedef MomentElementBase::value_t value_t;
+
+    const size_t nelem = M.size(), nknob = knobs.size();
+
+    std::vector<const MomentElementBase*> elements(nelem);
+    for(size_t i=0; i<nelem; i++) {
+        elements[i] = dynamic_cast<const MomentElementBase*>(M[i]);
+        if(!elements[i])
+            throw std::invalid_argument("propagateSensitivity() requires a MomentMatrix Machine");
+    }
+
+    // d(transfer)/d(knob) for each knob, or copies for numeric differentiation
+    std::vector<value_t> dT(nknob);
+    std::vector<boost::shared_ptr<NumericKnob> > numeric(nknob);
+    for(size_t j=0; j<nknob; j++) {
+        const SensitivityKnob& K = knobs[j];
+        if(K.index>=nelem)
+            throw std::invalid_argument("knob element index out of range");
+        const MomentElementBase *E = elements[K.index];
+        if(strcmp(E->type_name(), "source")==0)
+            throw std::invalid_argument("knob can't select a source element");
+
+        if(!E->dtransfer(K.param, dT[j]))
+            numeric[j].reset(new NumericKnob(M, E, K.param));
+    }
+
+    std::vector<std::vector<size_t> > obsslot(nelem);
+    for(size_t i=0; i<observe.size(); i++) {
+        if(observe[i]>=nelem)
+            throw std::invalid_argument("observed element index out of range");
+        obsslot[observe[i]].push_back(i);
+    }
+
+    dstate.resize(observe.size()*nknob);
+    dmoment0.resize(observe.size()*nknob);
+    if(ostate)
+        ostate->resize(observe.size());
+    if(omoment0)
+        omoment0->resize(observe.size());
+
+    // derivatives of the current state for each knob
+    std::vector<matrix_t> dS(nknob, zero_matrix<double>(MomentState::maxsize));
+    std::vector<vector_t> dm(nknob, zero_vector<double>(MomentState::maxsize));
+    matrix_t scratch(MomentState::maxsize, MomentState::maxsize),
+             TS(MomentState::maxsize, MomentState::maxsize); // transfer * state (before advance)
+    vector_t temp(MomentState::maxsize);
+
+    for(size_t i=0; i<nelem; i++) {
+        const MomentElementBase *E = elements[i];
+        const value_t& T = E->transfer;
+
+        if(strcmp(E->type_name(), "source")==0) {
+            // replaces the state, so no dependence on earlier knobs
+            for(size_t j=0; j<nknob; j++) {
+                dS[j].clear();
+                dm[j].clear();
+            }
+        } else {
+            noalias(TS) = prod(T, S.state);
+
+            for(size_t j=0; j<nknob; j++) {
+                noalias(scratch) = prod(T, dS[j]);
+                noalias(dS[j]) = prod(scratch, trans(T));
+                noalias(temp) = prod(T, dm[j]);
+                dm[j] = temp;
+
+                if(knobs[j].index!=i)
+                    continue;
+                if(numeric[j]) {
+                    numeric[j]->apply(S, dS[j], dm[j]);
+                    continue;
+                }
+                // d(T S T^t) = dT S T^t + T S dT^t
+                noalias(scratch) = prod(TS, trans(dT[j]));
+                dS[j] += scratch;
+                noalias(scratch) = prod(dT[j], S.state);
+                dS[j] += prod(scratch, trans(T));
+                dm[j] += prod(dT[j], S.moment0);
+            }
+        }
+
+        S.next_elem = i+1;
+        E->advance(S);
+
+        for(size_t n=0; n<obsslot[i].size(); n++) {
+            size_t slot = obsslot[i][n];
+            if(ostate)
+                (*ostate)[slot] = S.state;
+            if(omoment0)
+                (*omoment0)[slot] = S.moment0;
+            for(size_t j=0; j<nknob; j++) {
+                dstate[slot*nknob+j] = dS[j];
+                dmoment0[slot*nknob+j] = dm[j];
+            }
+        }
+    }
+}
+
+namespace {
+struct MatchEval {
+    Machine& M;
+    const MomentState& initial;
+    const std::vector<SensitivityKnob>& knobs;
+    const std::vector<MatchTarget>& targets;
+
+    std::vector<size_t> observe;
+    std::vector<size_t> slot; // observe[slot[k]] for target k
+    std::auto_ptr<MomentState> S;
+
+    std::vector<MomentState::matrix_t> dstate, ostate;
+    std::vector<MomentState::vector_t> dmoment0, omoment0;
+
+    MatchEval(Machine& M, const MomentState& initial,
+              const std::vector<SensitivityKnob>& knobs,
+              const std::vector<MatchTarget>& targets)
+        :M(M), initial(initial), knobs(knobs), targets(targets)
+        ,S(initial.clone())
+    {
+        slot.resize(targets.size());
+        for(size_t k=0; k<targets.size(); k++) {
+            const MatchTarget& T = targets[k];
+            if(T.row>=MomentState::maxsize || T.col>=MomentState::maxsize)
+                throw std::invalid_argument("match target row/col out of range");
+            std::vector<size_t>::const_iterator it = std::find(observe.begin(), observe.end(), T.index);
+            slot[k] = it-observe.begin();
+            if(it==observe.end())
+                observe.push_back(T.index);
+        }
+    }
+
+    void set(const std::vector<double>& x)
+    {
+        for(size_t j=0; j<knobs.size(); j++) {
+            Config C(M[knobs[j].index]->conf());
+            C.set<double>(knobs[j].param, x[j]);
+            M.reconfigure(knobs[j].index, C);
+        }
+    }
+
+    // residual and jacobian at x
+    double eval(const std::vector<double>& x,
+                boost::numeric::ublas::vector<double>& r,
+                boost::numeric::ublas::matrix<double>& J)
+    {
+        set(x);
+        S->assign(initial);
+        propagateSensitivity(M, *S, knobs, observe, dstate, dmoment0, &ostate, &omoment0);
+
+        const size_t nknob = knobs.size();
+        double cost = 0.0;
+        for(size_t k=0; k<targets.size(); k++) {
+            const MatchTarget& T = targets[k];
+            size_t s = slot[k];
+            double actual = T.moment0 ? omoment0[s](T.row) : ostate[s](T.row, T.col);
+            r(k) = T.weight*(actual-T.value);
+            cost += r(k)*r(k);
+            for(size_t j=0; j<nknob; j++) {
+                size_t n = s*nknob+j;
+                J(k, j) = T.weight*(T.moment0 ? dmoment0[n](T.row) : dstate[n](T.row, T.col));
+            }
+        }
+        return cost;
+    }
+};
+}
+
+namespace {
+/* Solve the damped least squares problem
+ *   min |J*step + r|^2 + lambda*|D*step|^2
+ * by Householder QR of the augmented matrix [J; sqrt(lambda)*D].
+ * This avoids forming J^T*J, which squares the condition number.
+ * Returns false if the augmented matrix is singular.
+ */
+bool dampedStep(const boost::numeric::ublas::matrix<double>& J,
+                const boost::numeric::ublas::vector<double>& r,
+                const std::vector<double>& D,
+                double lambda,
+                boost::numeric::ublas::vector<double>& step)
+{
+    const size_t m = J.size1(), n = J.size2(), N = m+n;
+    boost::numeric::ublas::matrix<double> A(N, n);
+    boost::numeric::ublas::vector<double> b(N);
+
+    const double sl = sqrt(lambda);
+    for(size_t i=0; i<m; i++) {
+        for(size_t j=0; j<n; j++)
+            A(i,j) = J(i,j);
+        b(i) = -r(i);
+    }
+    for(size_t i=0; i<n; i++) {
+        for(size_t j=0; j<n; j++)
+            A(m+i,j) = i==j ? sl*D[j] : 0.0;
+        b(m+i) = 0.0;
+    }
+
+    for(size_t k=0; k<n; k++) {
+        double alpha = 0.0;
+        for(size_t i=k; i<N; i++)
+            alpha += A(i,k)*A(i,k);
+        alpha = sqrt(alpha);
+        if(alpha==0.0)
+            return false;
+        if(A(k,k)>0.0)
+            alpha = -alpha;
+
+        // Householder vector v = A(k:,k) - alpha*e_k, stored in place
+        A(k,k) -= alpha;
+        double vnorm2 = 0.0;
+        for(size_t i=k; i<N; i++)
+            vnorm2 += A(i,k)*A(i,k);
+
+        for(size_t j=k+1; j<n; j++) {
+            double s = 0.0;
+            for(size_t i=k; i<N; i++)
+                s += A(i,k)*A(i,j);
+            s *= 2.0/vnorm2;
+            for(size_t i=k; i<N; i++)
+                A(i,j) -= s*A(i,k);
+        }
+        {
+            double s = 0.0;
+            for(size_t i=k; i<N; i++)
+                s += A(i,k)*b(i);
+            s *= 2.0/vnorm2;
+            for(size_t i=k; i<N; i++)
+                b(i) -= s*A(i,k);
+        }
+        A(k,k) = alpha; // R(k,k)
+    }
+
+    // back substitution with R
+    step.resize(n);
+    for(size_t k=n; k>0; k--) {
+        size_t i = k-1;
+        double s = b(i);
+        for(size_t j=i+1; j<n; j++)
+            s -= A(i,j)*step(j);
+        step(i) = s/A(i,i);
+    }
+    return true;
+}
+}
+
+double matchMoments(Machine& M,
+                    const MomentState& initial,
+                    const std::vector<SensitivityKnob>& knobs,
+                    const std::vector<MatchTarget>& targets,
+                    std::vector<double>& values,
+                    unsigned maxiter,
+                    double tol,
+                    unsigned *niter)
+{
+    using namespace boost::numeric::ublas;
+    typedef boost::numeric::ublas::vector<double> vector_t;
+    typedef boost::numeric::ublas::matrix<double> matrix_t;
+
+    const size_t nknob = knobs.size(), ntarget = targets.size();
+    if(nknob==0 || ntarget==0)
+        throw std::invalid_argument("match requires at least one knob and one target");
+
+    MatchEval E(M, initial, knobs, targets);
+
+    std::vector<double> x(nknob), xtrial(nknob);
+    for(size_t j=0; j<nknob; j++) {
+        if(knobs[j].index>=M.size())
+            throw std::invalid_argument("knob element index out of range");
+        x[j] = M[knobs[j].index]->conf().get<double>(knobs[j].param, 0.0);
+    }
+
+    vector_t r(ntarget), rtrial(ntarget), step(nknob);
+    matrix_t J(ntarget, nknob), Jtrial(ntarget, nknob);
+    std::vector<double> D(nknob, 0.0);
+
+    double cost = E.eval(x, r, J),
+           lambda = 1e-7;
+    unsigned iter;
+
+    for(iter=0; iter<maxiter; iter++) {
+        // scale by the largest column norm seen so far (as MINPACK)
+        double maxD = 0.0;
+        for(size_t j=0; j<nknob; j++) {
+            double cnorm = 0.0;
+            for(size_t k=0; k<ntarget; k++)
+                cnorm += J(k,j)*J(k,j);
+            D[j] = std::max(D[j], sqrt(cnorm));
+            maxD = std::max(maxD, D[j]);
+        }
+        if(maxD==0.0)
+            break; // no knob has any effect
+        for(size_t j=0; j<nknob; j++)
+            D[j] = std::max(D[j], 1e-6*maxD);
+
+        bool accepted = false, converged = false;
+
+        while(!accepted && lambda<1e16) {
+            if(!dampedStep(J, r, D, lambda, step)) {
+                lambda *= 10.0;
+                continue; // singular
+            }
+
+            double xnorm = 0.0;
+            for(size_t j=0; j<nknob; j++) {
+                xtrial[j] = x[j]+step(j);
+                xnorm = std::max(xnorm, fabs(x[j]));
+            }
+
+            double trial = E.eval(xtrial, rtrial, Jtrial);
+
+            if(trial<=cost) {
+                converged = cost-trial <= tol*cost || norm_inf(step) <= tol*(xnorm+tol);
+                x.swap(xtrial);
+                r.swap(rtrial);
+                J.swap(Jtrial);
+                cost = trial;
+                lambda = std::max(lambda/10.0, 1e-12);
+                accepted = true;
+            } else {
+                lambda *= 10.0;
+            }
+        }
+
+        if(!accepted || converged) {
+            iter++;
+            break;
+        }
+    }
+
+    // leave Machine configured with the best values
+    E.set(x);
+
+    values = x;
+    if(niter)
+        *niter = iter;
+    return cost;
+}
+
+namespace {
+// An error may only perturb a scalar parameter which the element Config has
+bool hasScalar(const Config& C, const std::string& name)
+{
+    try{
+        C.get<double>(name);
+        return true;
+    } catch(boost::bad_get&) {
+    } catch(key_error&) {
+    }
+    return false;
+}
+
+// Transfer matrices for propagateErrors()
+struct ErrorMachine {
+    typedef MomentState::matrix_t matrix_t;
+    typedef MomentState::vector_t vector_t;
+
+    const Machine& M;
+    const MomentState& initial;
+    size_t nseeds;
+    // transfer matrix of each element, or NULL for elements which are advance()'d (sources, strippers)
+    std::vector<const matrix_t*> shared;
+    std::vector<matrix_t> unperturbed;
+    // for perturbed elements, index into 'stacks', otherwise -1
+    std::vector<size_t> stackidx;
+    // nseeds transfer matrices for each perturbed element
+    std::vector<std::vector<matrix_t> > stacks;
+    // element indices to observe, and slot(s) in output
+    std::vector<std::vector<size_t> > obsslot;
+
+    std::vector<matrix_t>& ostate;
+    std::vector<vector_t>& omoment0;
+
+    ErrorMachine(const Machine& M, const MomentState& initial, size_t nseeds,
+                 std::vector<matrix_t>& ostate, std::vector<vector_t>& omoment0)
+        :M(M), initial(initial), nseeds(nseeds)
+        ,shared(M.size(), NULL), unperturbed(M.size())
+        ,stackidx(M.size(), (size_t)-1), obsslot(M.size())
+        ,ostate(ostate), omoment0(omoment0)
+    {}
+
+    // Propagate seeds [first, last)
+    void run(size_t first, size_t last)
+    {
+        using namespace boost::numeric::ublas;
+        std::auto_ptr<MomentState> S(initial.clone());
+        matrix_t scratch(MomentState::maxsize, MomentState::maxsize);
+        vector_t vscratch(MomentState::maxsize);
+
+        for(size_t s=first; s<last; s++) {
+            S->assign(initial);
+
+            for(size_t i=0, N=M.size(); i<N; i++) {
+                const matrix_t *T = stackidx[i]==(size_t)-1 ? shared[i] : &stacks[stackidx[i]][s];
+                S->next_elem = i+1;
+                if(!T) {
+                    M[i]->advance(*S); // source or stripper, doesn't use scratch space
+                } else {
+                    noalias(vscratch) = prod(*T, S->moment0);
+                    S->moment0.swap(vscratch);
+                    noalias(scratch) = prod(*T, S->state);
+                    noalias(S->state) = prod(scratch, trans(*T));
+                }
+
+                for(size_t n=0; n<obsslot[i].size(); n++) {
+                    size_t slot = obsslot[i][n]*nseeds+s;
+                    ostate[slot] = S->state;
+                    omoment0[slot] = S->moment0;
+                }
+            }
+        }
+    }
+};
+}
+
+void propagateErrors(const Machine& M,
+                     const MomentState& initial,
+                     const std::vector<ElementError>& errors,
+                     size_t nseeds,
+                     unsigned long seed,
+                     const std::vector<size_t>& observe,
+                     std::vector<MomentState::matrix_t>& ostate,
+                     std::vector<MomentState::vector_t>& omoment0,
+                     std::vector<double>* deltas,
+                     unsigned nthreads)
+{
+    typedef MomentState::matrix_t matrix_t;
+
+    if(M.simtype()!="MomentMatrix")
+        throw std::invalid_argument("propagateErrors() requires a MomentMatrix Machine");
+
+    const size_t nelem = M.size(), nerr = errors.size();
+
+    ostate.resize(observe.size()*nseeds);
+    omoment0.resize(observe.size()*nseeds);
+
+    ErrorMachine EM(M, initial, nseeds, ostate, omoment0);
+
+    for(size_t i=0; i<observe.size(); i++) {
+        if(observe[i]>=nelem)
+            throw std::invalid_argument("observe element index out of range");
+        EM.obsslot[observe[i]].push_back(i);
+    }
+
+    for(size_t i=0; i<nelem; i++) {
+        const MomentElementBase *E = dynamic_cast<const MomentElementBase*>(M[i]);
+        // sources and strippers do more than apply their transfer matrix
+        if(E && strcmp(E->type_name(), "source")!=0 && strcmp(E->type_name(), "stripper")!=0) {
+            EM.unperturbed[i] = E->transfer;
+            EM.shared[i] = &EM.unperturbed[i];
+        }
+    }
+
+    // group errors by element
+    std::vector<size_t> perturbed; // element index of each stack
+    std::vector<std::vector<size_t> > elemerrs; // errors of each stack
+    for(size_t j=0; j<nerr; j++) {
+        const ElementError& err = errors[j];
+        if(err.index>=nelem)
+            throw std::invalid_argument("error element index out of range");
+        if(!EM.shared[err.index])
+            throw std::invalid_argument("Can't perturb a source or stripper element");
+        if(!hasScalar(M[err.index]->conf(), err.param)) {
+            std::ostringstream msg;
+            msg<<"Element "<<err.index<<" '"<<M[err.index]->name<<"' has no parameter '"<<err.param<<"'";
+            throw std::invalid_argument(msg.str());
+        }
+        size_t& idx = EM.stackidx[err.index];
+        if(idx==(size_t)-1) {
+            idx = perturbed.size();
+            perturbed.push_back(err.index);
+            elemerrs.push_back(std::vector<size_t>());
+        }
+        elemerrs[idx].push_back(j);
+    }
+
+    // draw all random values
+    std::vector<double> delta(nseeds*nerr);
+    {
+        typedef boost::mt19937 rng_t;
+        rng_t rng(seed);
+        boost::variate_generator<rng_t&, boost::normal_distribution<double> > normal(rng, boost::normal_distribution<double>());
+        boost::variate_generator<rng_t&, boost::uniform_real<double> > uniform(rng, boost::uniform_real<double>(-1.0, 1.0));
+
+        for(size_t s=0; s<nseeds; s++) {
+            for(size_t j=0; j<nerr; j++) {
+                const ElementError& err = errors[j];
+                double val = err.dist==ElementError::Uniform ? uniform() : normal();
+                val *= err.sigma;
+                if(err.relative)
+                    val *= M[err.index]->conf().get<double>(err.param, 0.0);
+                delta[s*nerr+j] = val;
+            }
+        }
+    }
+
+    // build perturbed transfer matrices
+    EM.stacks.resize(perturbed.size());
+    for(size_t k=0; k<perturbed.size(); k++) {
+        const ElementVoid *E = M[perturbed[k]];
+        std::vector<matrix_t>& stack = EM.stacks[k];
+        stack.resize(nseeds);
+
+        Config C(E->conf());
+        for(size_t s=0; s<nseeds; s++) {
+            for(size_t n=0; n<elemerrs[k].size(); n++) {
+                const ElementError& err = errors[elemerrs[k][n]];
+                C.set<double>(err.param, E->conf().get<double>(err.param, 0.0) + delta[s*nerr+elemerrs[k][n]]);
+            }
+            std::auto_ptr<ElementVoid> N(M.buildElement(C));
+            const MomentElementBase *NE = dynamic_cast<const MomentElementBase*>(N.get());
+            assert(NE);
+            stack[s] = NE->transfer;
+        }
+    }
+
+    nthreads = std::max(1u, std::min<unsigned>(nthreads, nseeds));
+    if(nthreads==1) {
+        EM.run(0, nseeds);
+    } else {
+        boost::thread_group workers;
+        const size_t chunk = (nseeds+nthreads-1)/nthreads;
+        for(unsigned t=1; t<nthreads; t++)
+            workers.create_thread(boost::bind(&ErrorMachine::run, &EM,
+                                              std::min(nseeds, t*chunk), std::min(nseeds, (t+1)*chunk)));
+        EM.run(0, std::min(nseeds, chunk));
+        workers.join_all();
+    }
+
+    if(deltas)
+        deltas->swap(delta);
+}
+
+double machineLength(const Machine& M)
+{
+    double total = 0.0;
+    for(size_t i=0; i<M.size(); i++)
+        total += M[i]->conf().get<double>("L", 0.0);
+    return total;
+}
+
+namespace {
+void storeSample(const MomentState::vector_t& m, const MomentState::matrix_t& S,
+                 double *moment0, double *state)
+{
+    const size_t N = MomentState::maxsize;
+    std::copy(m.data().begin(), m.data().begin()+N, moment0);
+    std::copy(S.data().begin(), S.data().begin()+N*N, state);
+}
+}
+
+void propagateSampled(const Machine& M,
+                      MomentState& S,
+                      std::vector<double>& spos,
+                      double *moment0,
+                      double *state,
+                      size_t *index)
+{
+    using namespace boost::numeric::ublas;
+    typedef MomentState::matrix_t matrix_t;
+    typedef MomentState::vector_t vector_t;
+    typedef MomentElementBase::value_t value_t;
+
+    const size_t nelem = M.size(), nsamp = spos.size(), N = MomentState::maxsize;
+
+    std::vector<const MomentElementBase*> elements(nelem);
+    for(size_t i=0; i<nelem; i++) {
+        elements[i] = dynamic_cast<const MomentElementBase*>(M[i]);
+        if(!elements[i])
+            throw std::invalid_argument("propagateSampled() requires a MomentMatrix Machine");
+    }
+
+    for(size_t j=0; j<nsamp; j++) {
+        if(!(spos[j]>=0.0) || (j>0 && spos[j]<spos[j-1]))
+            throw std::invalid_argument("sample positions must be non-negative, and in increasing order");
+    }
+    if(nsamp>0 && spos.back()>machineLength(M))
+        throw std::invalid_argument("sample position beyond the last element");
+
+    value_t T;
+    matrix_t scratch(N, N), PS(N, N);
+    vector_t pm(N);
+    double pos = 0.0; // at entrance of element i
+    size_t j = 0; // next sample
+
+    for(size_t i=0; i<nelem; i++) {
+        const MomentElementBase *E = elements[i];
+        const double end = pos + E->conf().get<double>("L", 0.0);
+
+        for(; j<nsamp && spos[j]<end; j++) {
+            const double l = spos[j]-pos;
+            if(index)
+                index[j] = i;
+
+            if(l<=0.0) {
+                // at entrance
+                storeSample(S.moment0, S.state, moment0+j*N, state+j*N*N);
+            } else if(E->partialTransfer(l, T)) {
+                noalias(pm) = prod(T, S.moment0);
+                noalias(scratch) = prod(T, S.state);
+                noalias(PS) = prod(scratch, trans(T));
+                storeSample(pm, PS, moment0+j*N, state+j*N*N);
+            } else {
+                break; // at exit
+            }
+        }
+
+        S.next_elem = i+1;
+        E->advance(S);
+
+        // samples inside an element which can't be divided
+        for(; j<nsamp && spos[j]<end; j++) {
+            spos[j] = end;
+            if(index)
+                index[j] = i;
+            storeSample(S.moment0, S.state, moment0+j*N, state+j*N*N);
+        }
+
+        pos = end;
+    }
+
+    // at the end of the last element
+    for(; j<nsamp; j++) {
+        if(index)
+            index[j] = nelem ? nelem-1 : 0;
+        storeSample(S.moment0, S.state, moment0+j*N, state+j*N*N);
+    }
+}
+
 void registerMoment()
 {
 }
+
+MomentStatsObserver::MomentStatsObserver(const std::vector<size_t>& observe,
+                                         double *centroid, double *moment2,
+                                         double *rms, double *emittance)
+    :weight(1.0)
+    ,wsum(observe.size())
+    ,centroid(centroid), moment2(moment2), rms(rms), emittance(emittance)
+{
+    for(size_t i=0; i<observe.size(); i++) {
+        if(observe[i]>=slot.size())
+            slot.resize(observe[i]+1, (size_t)-1);
+        if(slot[observe[i]]!=(size_t)-1)
+            throw std::invalid_argument("element observed more than once");
+        slot[observe[i]] = i;
+    }
+    clear();
+}
+
+MomentStatsObserver::~MomentStatsObserver() {}
+
+void MomentStatsObserver::clear()
+{
+    const size_t N = wsum.size();
+    std::fill(wsum.begin(), wsum.end(), 0.0);
+    std::fill(centroid, centroid+N*ncoord, 0.0);
+    std::fill(moment2, moment2+N*ncoord*ncoord, 0.0);
+}
+
+void MomentStatsObserver::view(const ElementVoid* elem, const StateBase* state)
+{
+    const MomentState *S = dynamic_cast<const MomentState*>(state);
+    if(elem->index>=slot.size() || slot[elem->index]==(size_t)-1 || !S)
+        return;
+    const size_t row = slot[elem->index];
+    const double w = weight;
+
+    // raw sums of w*m and w*(S+m m^T)
+    double *C = centroid+row*ncoord, *M2 = moment2+row*ncoord*ncoord;
+    const double *m = &S->moment0[0];
+    wsum[row] += w;
+    for(unsigned j=0; j<ncoord; j++) {
+        C[j] += w*m[j];
+        for(unsigned k=0; k<ncoord; k++)
+            M2[j*ncoord+k] += w*(S->state(j,k) + m[j]*m[k]);
+    }
+}
+
+void MomentStatsObserver::finish()
+{
+    for(size_t row=0; row<wsum.size(); row++) {
+        double *C = centroid+row*ncoord, *M2 = moment2+row*ncoord*ncoord;
+        const double W = wsum[row];
+
+        if(W!=0.0) {
+            for(unsigned j=0; j<ncoord; j++)
+                C[j] /= W;
+            for(unsigned j=0; j<ncoord; j++)
+                for(unsigned k=0; k<ncoord; k++)
+                    M2[j*ncoord+k] = M2[j*ncoord+k]/W - C[j]*C[k];
+        }
+
+        if(rms) {
+            for(unsigned j=0; j<nrms; j++)
+                rms[row*nrms+j] = sqrt(std::max(0.0, M2[j*ncoord+j]));
+        }
+        if(emittance) {
+            for(unsigned p=0; p<nplane; p++) {
+                const unsigned a = 2*p, b = 2*p+1;
+                double det = M2[a*ncoord+a]*M2[b*ncoord+b] - M2[a*ncoord+b]*M2[b*ncoord+a];
+                emittance[row*nplane+p] = sqrt(std::max(0.0, det));
+            }
+        }
+    }
+}
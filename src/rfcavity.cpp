@@ -0,0 +1,178 @@
+#include <algorithm>
+#include <stdexcept>
+#include <sstream>
+#include <string>
+
+#include <math.h>
+
+#include "scsi/config.h"
+#include "scsi/rfcavity.h"
+#include "scsi/stripper.h"
+
+namespace {
+// Speed of light [m/s]
+const double C0 = 2.99792458e8;
+// Field map positions are in [mm]
+const double MtoMM = 1e3;
+// Longitudinal sampling frequency [Hz].  Absolute phase is measured at this frequency.
+const double SampleFreq = 80.5e6;
+const double SampleLambda = C0/SampleFreq*MtoMM;
+
+inline double betaOf(double IonW, double IonEs)
+{
+    double gamma = IonW/IonEs;
+    return sqrt(1e0-1e0/(gamma*gamma));
+}
+
+// wrap to [-pi, pi)
+inline double wrapPhase(double phi)
+{
+    phi = fmod(phi+M_PI, 2e0*M_PI);
+    if(phi<0e0)
+        phi += 2e0*M_PI;
+    return phi-M_PI;
+}
+}
+
+void CavityFieldMap::read(std::istream& strm)
+{
+    std::string line;
+    s.clear();
+    Elong.clear();
+    while(std::getline(strm, line)) {
+        std::istringstream lstrm(line);
+        double S, E;
+        if(lstrm>>S>>E) {
+            s.push_back(S);
+            Elong.push_back(E);
+        }
+    }
+    if(s.size()<2)
+        throw std::runtime_error("Field map must have at least two samples");
+}
+
+void cavityBoost(const CavityFieldMap& map,
+                 double fRF, double IonZ, double IonEs, double IonW0,
+                 size_t n, const double *phase, const double *scale,
+                 double *IonW, double *IonFy)
+{
+    const size_t nmap = map.s.size();
+    if(nmap<2 || map.Elong.size()!=nmap)
+        throw std::invalid_argument("Field map must have at least two samples");
+    if(n==0)
+        return;
+
+    const double dz = (map.s[nmap-1]-map.s[0])/(nmap-1), // [mm]
+                 IonLambda = C0/fRF*MtoMM,               // [mm]
+                 IonK0 = 2e0*M_PI/(betaOf(IonW0, IonEs)*IonLambda);
+
+    // all points advance together through the field map
+    std::vector<double> K(n, IonK0);
+    for(size_t j=0; j<n; j++) {
+        IonW[j] = IonW0;
+        IonFy[j] = phase[j];
+    }
+
+    for(size_t k=0; k<nmap-1; k++) {
+        const double dW = IonZ*(map.Elong[k]+map.Elong[k+1])/2e0*dz/MtoMM;
+
+        for(size_t j=0; j<n; j++) {
+            const double Fylast = IonFy[j];
+            IonFy[j] += K[j]*dz;
+            IonW[j]  += scale[j]*dW*cos((Fylast+IonFy[j])/2e0);
+            double beta;
+            if(IonW[j]<IonEs) {
+                IonW[j] = IonEs;
+                beta = 0e0;
+            } else {
+                beta = betaOf(IonW[j], IonEs);
+            }
+            K[j] = 2e0*M_PI/(beta*IonLambda);
+        }
+    }
+}
+
+void phaseCavities(const Machine& M,
+                   const StateBase& ref,
+                   const std::map<std::string, CavityFieldMap>& maps,
+                   std::vector<CavityPhase>& out,
+                   unsigned nphase)
+{
+    if(nphase<3)
+        throw std::invalid_argument("phaseCavities() requires nphase>=3");
+
+    const double IonEs = ref.IonEs;
+    double IonZ = ref.IonZ, IonW = ref.IonW, FyAbs = 0e0;
+
+    std::vector<double> scan_phase(nphase), scan_scale(nphase),
+                        scan_W(nphase), scan_Fy(nphase);
+    for(unsigned i=0; i<nphase; i++)
+        scan_phase[i] = 2e0*M_PI*i/nphase;
+
+    out.clear();
+
+    for(size_t idx=0, N=M.size(); idx<N; idx++) {
+        const ElementVoid *elem = M[idx];
+        const Config& conf = elem->conf();
+        const std::string t_name(elem->type_name());
+
+        if(t_name=="rfcavity") {
+            const std::string& cavtype = conf.get<std::string>("cavtype");
+            std::map<std::string, CavityFieldMap>::const_iterator it = maps.find(cavtype);
+            if(it==maps.end())
+                throw std::invalid_argument("No field map for cavtype '"+cavtype+"'");
+
+            const double fRF = conf.get<double>("f"),
+                         multip = fRF/SampleFreq,
+                         IonFys = conf.get<double>("phi")*M_PI/180e0,
+                         scl = conf.get<double>("scl_fac");
+
+            // scan all input phases at once
+            std::fill(scan_scale.begin(), scan_scale.end(), scl);
+            cavityBoost(it->second, fRF, IonZ, IonEs, IonW,
+                        nphase, &scan_phase[0], &scan_scale[0], &scan_W[0], &scan_Fy[0]);
+
+            unsigned imax = 0;
+            for(unsigned i=1; i<nphase; i++)
+                if(scan_W[i]>scan_W[imax])
+                    imax = i;
+
+            // parabola through the maximum and its (periodic) neighbours
+            const double Wm = scan_W[(imax+nphase-1)%nphase],
+                         W0 = scan_W[imax],
+                         Wp = scan_W[(imax+1)%nphase],
+                         curv = Wm-2e0*W0+Wp;
+            double offset = curv<0e0 ? 0.5*(Wm-Wp)/curv : 0e0;
+
+            CavityPhase res;
+            res.index = idx;
+            res.crest = wrapPhase(scan_phase[imax]+offset*2e0*M_PI/nphase);
+            res.FyAbs = FyAbs;
+            res.IonW_in = IonW;
+
+            double IonFy_i = res.crest+IonFys, IonW_o, IonFy_o;
+            cavityBoost(it->second, fRF, IonZ, IonEs, IonW,
+                        1, &IonFy_i, &scl, &IonW_o, &IonFy_o);
+
+            res.phase = wrapPhase(IonFy_i-multip*FyAbs);
+            res.IonW_out = IonW_o;
+            out.push_back(res);
+
+            IonW = IonW_o;
+            FyAbs += (IonFy_o-IonFy_i)/multip;
+
+        } else if(t_name=="stripper" && conf.get<double>("charge_model", 0e0)!=0e0) {
+            // as ElementStripper<MomentElementBase>.  Otherwise a marker.
+            StripperModel model(conf);
+            double Ek = IonW-IonEs, Ek_out, sigma;
+            std::vector<double> fractions(model.IonChargeStates.size());
+            model.evaluate(1, IonEs, &Ek, NULL, NULL, &Ek_out, &sigma, &fractions[0]);
+            IonZ = model.IonZ;
+            IonW = Ek_out+IonEs;
+
+        } else if(t_name!="source") {
+            const double L = conf.get<double>("L", 0e0);
+            FyAbs += 2e0*M_PI/(betaOf(IonW, IonEs)*SampleLambda)*L*MtoMM;
+        }
+    }
+}
@@ -3,9 +3,11 @@
 
 #include <stdlib.h>
 
+#include <algorithm>
 #include <ostream>
 #include <string>
 #include <map>
+#include <memory>
 #include <vector>
 
 #include <boost/noncopyable.hpp>
@@ -37,6 +39,13 @@ struct StateBase : public boost::noncopyable
 
     virtual void assign(const StateBase& other) =0;
 
+    /** @brief Re-initialize from configuration
+     *
+     * Equivalent to constructing a new State from 'c', but re-uses existing storage.
+     * Derived classes should re-implement, and call StateBase::reset()
+     */
+    virtual void reset(const Config& c);
+
     virtual void show(std::ostream&) const {}
 
     struct ArrayInfo {
@@ -85,7 +94,7 @@ struct Observer : public boost::noncopyable
     virtual void view(const ElementVoid*, const StateBase*) =0;
 };
 
-struct ElementVoid : public boost::noncopyable
+struct ElementVoid
 {
     ElementVoid(const Config& conf);
     virtual ~ElementVoid();
@@ -113,12 +122,116 @@ struct ElementVoid : public boost::noncopyable
     //! Used by Machine::reconfigure()
     //! Assumes other has the same type
     virtual void assign(const ElementVoid* other ) =0;
+protected:
+    //! @internal
+    //! Used by Machine::clone()
+    //! Copies everything except the Observer
+    ElementVoid(const ElementVoid& other);
 private:
+    ElementVoid& operator=(const ElementVoid&); // not implemented
+
     Observer *p_observe;
     Config p_conf;
     friend class Machine;
 };
 
+/** @brief Bounded in-memory history of the States passed through a Machine
+ *
+ * After each Element, the element index and a fixed set of State values are copied
+ * into a ring buffer holding the most recent 'depth' records.
+ * The recorded values are the scalar parameters of StateBase (IonZ, IonEs, IonEk, IonW)
+ * and each array parameter (see StateBase::getArray()) of at most 'maxcount' elements
+ * (eg. "moment0" and "state" of MomentState, but not Ensemble particles).
+ *
+ * The layout of records is found from the first State recorded, and again whenever
+ * a different State is recorded.  A change of layout clears the history.
+ *
+ * Binary dump format, in host byte order
+ * @code
+ *   char magic[8] = "USCSIHST"
+ *   uint32 version = 1
+ *   uint32 nfields
+ *   uint64 count     // number of records which follow
+ *   uint64 total     // number of records ever made
+ *   nfields times:
+ *     uint32 namelen
+ *     char name[namelen]
+ *     uint32 ndim
+ *     uint32 dim[ndim]
+ *   count times, oldest first:
+ *     uint64 index
+ *     double values[width]  // each field in order, C order
+ * @endcode
+ */
+struct StateHistory : public boost::noncopyable
+{
+    enum {maxcount=64};
+
+    /**
+     * @param depth Number of records kept.  Must be greater than zero.
+     * @param check_finite If true, record() checks each value for NaN or Inf.
+     * @param dumpfile If not empty, Machine::propagate() writes this file when an exception is thrown.
+     */
+    StateHistory(size_t depth, bool check_finite=false, const std::string& dumpfile=std::string());
+
+    struct Field {
+        std::string name;
+        std::vector<size_t> dim;
+        size_t count; //!< product of dim
+    };
+    typedef std::vector<Field> fields_t;
+
+    const size_t depth;
+    const bool check_finite;
+    const std::string dumpfile;
+
+    /** @brief Record S after the Element 'index'
+     * @returns false if check_finite and any recorded value is NaN or Inf
+     */
+    bool record(size_t index, StateBase& S);
+
+    //! Discard all records
+    void clear();
+
+    //! Number of records held (at most depth)
+    inline size_t size() const { return std::min<unsigned long long>(p_total, depth); }
+    //! Number of records made since construction or clear()
+    inline unsigned long long total() const { return p_total; }
+    //! Number of values in each record, after the index
+    inline size_t width() const { return p_width; }
+    inline const fields_t& fields() const { return p_fields; }
+
+    /** @brief Copy records, oldest first
+     *
+     * @param out Filled with size() packed records of a uint64 index followed by width() doubles.
+     */
+    void copy(void *out) const;
+
+    //! Write in binary dump format
+    void dump(std::ostream& strm) const;
+    //! Write in binary dump format to a new file
+    void dump(const std::string& fname) const;
+
+private:
+    void layout(StateBase& S);
+
+    fields_t p_fields;
+    size_t p_width;
+    std::vector<const double*> p_src;
+
+    std::vector<unsigned long long> p_index;
+    std::vector<double> p_values;
+    unsigned long long p_total;
+};
+
+//! Thrown by Machine::propagate() when StateHistory::check_finite finds a NaN or Inf
+struct nonfinite_error : public std::runtime_error
+{
+    nonfinite_error(const std::string& s, size_t index) : std::runtime_error(s), index(index) {}
+    //! Index of the Element after which the bad value was found
+    const size_t index;
+};
+
 //std::ostream& operator<<(std::ostream& strm, const ElementVoid& s)
 //{
 //    s.show(strm);
@@ -127,7 +240,34 @@ private:
 
 struct Machine : public boost::noncopyable
 {
-    Machine(const Config& c);
+    //! How the constructor builds Elements
+    enum build_mode_t {
+        //! Build every Element before the constructor returns
+        BuildEager,
+        //! Build each Element when it is first used
+        BuildLazy
+    };
+
+    /** @brief Construct a Machine from a lattice configuration
+     *
+     * The "sim_type", and the "type" and "name" of each element, are always checked here.
+     *
+     * With BuildEager, all Elements are built before returning.
+     * Once the element types have been looked up in the registry, and the registry
+     * lock released, long lattices are built by several threads.
+     *
+     * With BuildLazy, each Element is built on first use, through operator[](), begin(),
+     * propagate(), or reconfigure().  So a Machine which only propagates through a few Elements
+     * of a long lattice only builds those few.  Errors from an Element's Config
+     * (eg. a missing parameter) are thrown by the first use of that Element.
+     * Until then, the entries of p_elements for unbuilt Elements are NULL.
+     *
+     * @param c Lattice configuration, including "sim_type" and "elements"
+     * @param mode Eager or lazy Element construction
+     * @param nthreads With BuildEager, the number of threads used.
+     *        Zero (the default) selects up to one per CPU when the lattice is long enough to benefit.
+     */
+    Machine(const Config& c, build_mode_t mode=BuildEager, unsigned nthreads=0);
     ~Machine();
 
     /** @brief Pass the given bunch State through this Machine.
@@ -150,13 +290,93 @@ struct Machine : public boost::noncopyable
      */
     StateBase* allocState(const Config& c) const;
 
+    /** @brief Allocate (with "operator new") a State object for the named simulation type
+     *
+     * @param simtype Name of a registered simulation type (eg. "Vector")
+     * @param c Configuration describing the initial state
+     * @return A pointer to the new state (never NULL).  The caller takes responsibility for deleteing.
+     * @throws key_error if simtype is not registered
+     */
+    static StateBase* allocState(const std::string& simtype, const Config& c);
+
+    /** @brief Allocate (with "operator new") a copy of this Machine
+     *
+     * The copy has its own Elements, which start with the same configuration
+     * and transfer matrices as this Machine, but does not repeat the Config
+     * lookups done during construction.  Observers, trace stream, profiling, and history are not copied.
+     *
+     * @return A pointer to the new Machine (never NULL).  The caller takes responsibility for deleteing.
+     */
+    Machine* clone() const;
+
     void reconfigure(size_t idx, const Config& c);
 
+    /** @brief Allocate (with "operator new") an Element of this Machine's simulation type
+     *
+     * The new Element is not part of this Machine.
+     *
+     * @param c Element configuration, including "type"
+     * @return A pointer to the new Element (never NULL).  The caller takes responsibility for deleteing.
+     */
+    ElementVoid* buildElement(const Config& c) const;
+
     inline const std::string& simtype() const {return p_simtype;}
 
+    //! The Config given when this Machine was constructed
+    inline const Config& conf() const {return p_conf;}
+
     inline std::ostream* trace() const {return p_trace;}
     void set_trace(std::ostream* v) {p_trace=v;}
 
+    /** @brief Record the recent history of propagate() in a ring buffer
+     *
+     * @param depth Number of records kept.  Zero disables recording (the default).
+     * @param check_finite If true, propagate() stops with nonfinite_error after the first
+     *        Element which leaves a NaN or Inf in a recorded value.
+     *        The State and history are left as they were after that Element.
+     * @param dumpfile If not empty, the history is written to this file when propagate()
+     *        throws an exception (including nonfinite_error).
+     *
+     * Replaces any existing history.  As with profiling, a recording Machine
+     * should not be propagated by several threads at once.
+     */
+    void set_history(size_t depth, bool check_finite=false, const std::string& dumpfile=std::string());
+    //! The current history, or NULL if not recording
+    inline const StateHistory* history() const {return p_history.get();}
+
+    //! Counters kept while profiling is enabled.  See set_profile()
+    struct Profile {
+        Profile(size_t nelem);
+        //! Number of times each Element (by index) was advance()'d by propagate()
+        std::vector<unsigned long long> calls;
+        //! Total time [ns] spent in advance() and the Observer of each Element
+        std::vector<unsigned long long> nsec;
+        //! Number of times each Element was re-built by reconfigure()
+        std::vector<unsigned long long> builds;
+        //! Number of calls to propagate()
+        unsigned long long propagations;
+        //! Number of States allocated by allocState()
+        unsigned long long states;
+        //! Number of Elements allocated by buildElement()
+        unsigned long long elements;
+
+        void reset();
+    };
+
+    /** @brief Enable or disable profiling of propagate()
+     *
+     * While enabled, propagate() counts calls to, and times, each Element.
+     * Timing uses a monotonic clock read before and after each Element.
+     * When disabled (the default) there is no overhead.
+     * Enabling resets all counters.  Counters are not updated atomically,
+     * so a profiled Machine should not be propagated by several threads at once.
+     */
+    void set_profile(bool enable);
+    //! The current counters, or NULL if profiling is not enabled
+    inline const Profile* profile() const {return p_profile.get();}
+    //! Zero all counters (if profiling is enabled)
+    void reset_profile();
+
     typedef std::vector<ElementVoid*> p_elements_t;
     typedef std::map<std::string, ElementVoid*> p_lookup_t;
 
@@ -165,20 +385,49 @@ struct Machine : public boost::noncopyable
     typedef p_elements_t::iterator iterator;
     typedef p_elements_t::const_iterator const_iterator;
 
-    iterator begin() { return p_elements.begin(); }
-    const_iterator begin() const { return p_elements.begin(); }
+    // begin() builds any Elements not yet built
+    iterator begin() { materialize(); return p_elements.begin(); }
+    const_iterator begin() const { materialize(); return p_elements.begin(); }
 
     iterator end() { return p_elements.end(); }
     const_iterator end() const { return p_elements.end(); }
 
-    inline ElementVoid* operator[](size_t i) { return p_elements[i]; }
-    inline const ElementVoid* operator[](size_t i) const { return p_elements[i]; }
+    inline ElementVoid* operator[](size_t i) { return p_lazy.get() ? p_build(i) : p_elements[i]; }
+    inline const ElementVoid* operator[](size_t i) const { return p_lazy.get() ? p_build(i) : p_elements[i]; }
+
+    /** @brief Build Elements of a lazy Machine which have not been built yet
+     *
+     * Does nothing for a Machine constructed with BuildEager.
+     *
+     * @param start The index of the first Element
+     * @param max The maximum number of Elements.  Default is all Elements after start.
+     */
+    void materialize(size_t start=0, size_t max=-1) const;
+    //! Whether the Element at index i has been built
+    bool isBuilt(size_t i) const;
+    /** @brief Config of the Element at index i, without building it
+     *
+     * Same as operator[](i)->conf() for an Element which has already been built
+     */
+    Config elementConf(size_t i) const;
 private:
 //    p_elements_t p_elements;
 //    p_lookup_t p_lookup;
 //    std::string p_simtype;
 //    std::ostream* p_trace;
 
+    struct clone_tag{};
+    Machine(const Machine& o, clone_tag);
+
+    void propagateInstrumented(StateBase* S, size_t start, size_t max) const;
+
+    // Elements of a BuildLazy Machine which haven't been built yet.  NULL for BuildEager
+    struct LazyElements;
+    std::auto_ptr<LazyElements> p_lazy;
+    ElementVoid* p_build(size_t i) const;
+    // Builds a range of Elements, maybe in a worker thread
+    struct BuildJob;
+
     typedef StateBase* (*state_builder_t)(const Config& c);
     template<typename State>
     struct state_builder_impl {
@@ -189,6 +438,7 @@ private:
         virtual ~element_builder_t() {}
         virtual ElementVoid* build(const Config& c) =0;
         virtual void rebuild(ElementVoid *o, const Config& c) =0;
+        virtual ElementVoid* clone(const ElementVoid *o) =0;
     };
     template<typename Element>
     struct element_builder_impl : public element_builder_t {
@@ -203,6 +453,13 @@ private:
                 throw std::runtime_error("reconfigure() can't change element type");
             m->assign(N.get());
         }
+        ElementVoid* clone(const ElementVoid *o)
+        {
+            const Element *m = dynamic_cast<const Element*>(o);
+            if(!m)
+                throw std::logic_error("clone() element type mismatch");
+            return new Element(*m);
+        }
     };
 
     struct state_info {
@@ -221,12 +478,19 @@ private:
 
     static void p_registerElement(const std::string& sname, const char *ename, element_builder_t* b);
 
+    //! Look up the builder of an element type, holding the registry lock.  @throws key_error if unknown
+    element_builder_t* p_findBuilder(const std::string& etype) const;
+
 public:
     p_elements_t p_elements;
     p_lookup_t p_lookup;
     std::string p_simtype;
     std::ostream* p_trace;
-    state_info p_info;
+    std::auto_ptr<Profile> p_profile;
+    std::auto_ptr<StateHistory> p_history;
+    Config p_conf;
+    //! Points to an entry in the global registry, which is never removed before registeryCleanup()
+    const state_info *p_info;
 
     template<typename State>
     static void registerState(const char *name)
@@ -0,0 +1,110 @@
+#ifndef SCSI_ENSEMBLE_H
+#define SCSI_ENSEMBLE_H
+
+#include <ostream>
+#include <math.h>
+
+#include <boost/numeric/ublas/matrix.hpp>
+#include <boost/numeric/ublas/io.hpp>
+
+#include "base.h"
+
+/** @brief Simulation state which is a set of particles
+ *
+ * Each row of 'state' is the phase space vector of one particle.
+ *
+ * Config keys
+ * @li "particles" Initial coordinates.  A flattened [N,7] array.
+ * @li "count" Number of particles, all zeros, when "particles" is not given.
+ * @li "threads" Number of threads to use when advancing through an element.  Default 1.
+ *
+ * The number of particles is fixed when the State is created.
+ * assign() and reset() throw std::invalid_argument if the number differs.
+ */
+struct EnsembleState : public StateBase
+{
+    enum {ncoord=7};
+    enum param_t {
+        PS_X, PS_PX, PS_Y, PS_PY, PS_S, PS_PS
+    };
+
+    EnsembleState(const Config& c);
+    virtual ~EnsembleState();
+
+    typedef boost::numeric::ublas::matrix<double> matrix_t;
+
+    void assign(const StateBase& other);
+    void reset(const Config& c);
+
+    virtual void show(std::ostream& strm) const;
+
+    //! Particle coordinates [count(), ncoord]
+    matrix_t state;
+    //! Number of threads used by EnsembleElementBase::advance()
+    unsigned nthreads;
+
+    inline size_t count() const { return state.size1(); }
+
+    virtual bool getArray(unsigned idx, ArrayInfo& Info);
+
+    virtual EnsembleState* clone() const {
+        return new EnsembleState(*this, clone_tag());
+    }
+
+    /** @brief Apply a transfer matrix to all particles
+     *
+     * x' = M * x for each particle, in blocks, using up to 'nthreads' threads.
+     * @param M A ncoord*ncoord row major matrix
+     */
+    void transform(const double *M);
+
+protected:
+    EnsembleState(const EnsembleState& o, clone_tag);
+};
+
+/** @brief An Element which applies a transfer matrix to each particle of an EnsembleState
+ */
+struct EnsembleElementBase : public ElementVoid
+{
+    typedef EnsembleState state_t;
+
+    EnsembleElementBase(const Config& c);
+    virtual ~EnsembleElementBase();
+
+    virtual void advance(StateBase& s) const;
+
+    virtual void show(std::ostream& strm) const;
+
+    typedef boost::numeric::ublas::matrix<double> value_t;
+
+    value_t transfer;
+
+    virtual void assign(const ElementVoid *other)
+    {
+        const EnsembleElementBase *O = static_cast<const EnsembleElementBase*>(other);
+        transfer = O->transfer;
+        ElementVoid::assign(other);
+    }
+};
+
+/** @brief Propagate an EnsembleState through a Machine
+ *
+ * Equivalent to Machine::propagate(), but consecutive Elements are combined,
+ * and particles pass once through the product of their transfer matrices.
+ * Elements with an Observer, and non-linear Elements (eg. a source), end a group.
+ * Falls back to Machine::propagate() when a trace stream is set.
+ *
+ * @param M A Machine with sim_type Ensemble
+ * @param S The initial state, will be updated with the final state
+ * @param start The index of the first Element the state will pass through
+ * @param max The maximum number of elements through which the state will be passed
+ * @param observers If false, Observers and the trace stream are ignored,
+ *                  so several threads may propagate through M at once.
+ */
+void propagateEnsemble(const Machine& M,
+                       EnsembleState& S,
+                       size_t start=0,
+                       size_t max=-1,
+                       bool observers=true);
+
+#endif // SCSI_ENSEMBLE_H
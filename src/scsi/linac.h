@@ -0,0 +1,179 @@
+#ifndef SCSI_LINAC_H
+#define SCSI_LINAC_H
+
+#include <istream>
+#include <ostream>
+#include <string>
+#include <vector>
+
+#include <boost/shared_ptr.hpp>
+
+#include "base.h"
+#include "moment.h"
+#include "rfcavity.h"
+
+/** @brief Thin lens model of a RF cavity, as in thinlenlon_41.txt
+ *
+ * Each line is "<type> <name> <length> <aperture> [<field>]".
+ * type is one of drift, EFocus1, EFocus2, EDipole, EQuad, HMono, HDipole, HQuad, or AccGap.
+ * Lines starting with '%' are comments.
+ */
+struct CavityThinLens
+{
+    struct Line {
+        std::string Elem, Name;
+        double Length, Aper, E0;
+    };
+    std::vector<Line> lines;
+
+    /** @brief Read a thin lens model
+     *
+     * @throws std::runtime_error for an unknown type, or if no lines can be parsed.
+     */
+    void read(std::istream& strm);
+};
+
+//! Reference particle at the exit of each element, as computed by LinacContext::initLong()
+struct LongTab
+{
+    std::vector<double> s,     //!< Longitudinal position [m]
+                        Ek,    //!< Kinetic energy [MeV/u]
+                        FyAbs, //!< Absolute phase [rad], at 80.5 MHz
+                        Beta,  //!< Relativistic factor beta
+                        Gamma; //!< Relativistic factor gamma
+
+    void set(double s, double Ek, double FyAbs, double Beta, double Gamma);
+    void clear();
+    inline size_t size() const { return s.size(); }
+    //! Print one line of the table, as long_tab.out
+    void show(std::ostream& strm, size_t k) const;
+};
+
+//! Result of LinacContext::propagate()
+struct LinacTrack
+{
+    //! Position after each element (excluding the first) [m]
+    std::vector<double> s;
+    //! Charge weighted centroid after each element, s.size()*7 values
+    std::vector<double> CenofChg;
+    //! Second moments after each element, s.size()*7*7 values.  RMS size on the diagonal
+    std::vector<double> BeamRMS;
+    //! State of each charge state after the last element
+    std::vector<boost::shared_ptr<MomentState> > states;
+};
+
+/** @brief All inputs and results of one full linac (TLM) simulation
+ *
+ * Holds the cavity field maps and thin lens models, the longitudinal
+ * reference orbit (LongTab), and the cavity phases found by initLong().
+ * Nothing is shared between instances, so independent simulations
+ * (eg. different lattices or ion species) may be run concurrently,
+ * with one LinacContext and Machine(s) each.
+ * A single LinacContext must not be used by more than one thread at a time.
+ *
+ * Cavity types are "0.041QWR" and "0.085QWR".
+ *
+ * @code
+ * LinacContext ctx;
+ * ctx.loadData(homedir);
+ * ctx.initLong(sim, IonZ[0]);
+ * ctx.propagate(sims, IonZ, NChg, moment0, state, track);
+ * @endcode
+ */
+class LinacContext
+{
+public:
+    enum {MaxNCav = 5};
+
+    LinacContext();
+
+    /** @brief Read field maps and thin lens models from a data directory
+     *
+     * Reads data/axisData_41.txt, data/axisData_85.txt,
+     * data/Multipole41/thinlenlon_41.txt, and data/Multipole85/thinlenlon_85.txt
+     * under 'homedir'.
+     * @throws std::runtime_error if a file can't be read
+     */
+    void loadData(const std::string& homedir);
+
+    /** @brief Set the field map and thin lens model of a cavity type
+     * @throws std::invalid_argument for an unknown cavity type
+     */
+    void setCavity(const std::string& cavtype, const CavityFieldMap& map, const CavityThinLens& tlm);
+
+    //! On axis field of each cavity type
+    CavityFieldMap CavData[MaxNCav];
+    //! Thin lens model of each cavity type
+    CavityThinLens CavTLM[MaxNCav];
+
+    //! Reference particle after each element.  Filled by initLong()
+    LongTab longTab;
+    //! Phase setting of each rfcavity, in order [rad].  Filled by initLong()
+    std::vector<double> CavPhases;
+
+    /** @brief Multipole level of the cavity model.  Default 2
+     *
+     * 0 only include focusing and defocusing effects,
+     * 1 include dipole terms,
+     * 2 include quadrupole terms.
+     */
+    int MpoleLevel;
+    //! Apply emittance growth in RF cavities.  Default false
+    bool EmitGrowth;
+    //! If not NULL, progress messages are printed here
+    std::ostream *log;
+
+    /** @brief Longitudinal initialization of the reference particle
+     *
+     * Evaluates the beam energy and the phase of each cavity along the lattice.
+     * Replaces longTab and CavPhases.
+     *
+     * @param sim The Machine.  The reference particle is taken from its first element.
+     * @param IonZ Charge to mass ratio of the reference particle
+     * @param table If not NULL, a line is written for each element, as long_tab.out
+     * @throws std::runtime_error for an unknown cavity type, or missing field map
+     */
+    void initLong(const Machine& sim, double IonZ, std::ostream *table=NULL);
+
+    /** @brief Propagate several charge states, with transfer matrices scaled for each
+     *
+     * initLong() must be called first.  Each Machine is modified (quadrupole and solenoid
+     * strengths, and transfer matrices) for its charge state, so each must be a separate copy
+     * of the same lattice (eg. from Machine::clone()).
+     *
+     * @param sims One Machine for each charge state
+     * @param IonZ Charge to mass ratio of each charge state
+     * @param NChg Charge amount of each charge state
+     * @param Mom1 Initial moment0 of each charge state [mm, rad, mm, rad, rad, MeV/u]
+     * @param Mom2 Initial second moments of each charge state
+     * @param out Filled with the statistics of all charge states after each element
+     * @throws std::invalid_argument if the inputs don't have the same lengths
+     */
+    void propagate(const std::vector<Machine*>& sims,
+                   const std::vector<double>& IonZ,
+                   const std::vector<double>& NChg,
+                   const std::vector<MomentState::vector_t>& Mom1,
+                   const std::vector<MomentState::matrix_t>& Mom2,
+                   LinacTrack& out) const;
+
+    //! Index of a cavity type in CavData and CavTLM.  @throws std::invalid_argument if unknown
+    static unsigned cavityIndex(const std::string& cavtype);
+
+private:
+    struct Tracker;
+    friend struct Tracker;
+
+    void propagateLongRFCav(const Config& conf, size_t n, double IonZ, double IonEs,
+                            double& IonW, double& SampleIonK, double& IonBeta);
+    void propagateLongStripper(size_t n, double& IonZ, double IonEs,
+                               double& IonW, double& SampleIonK, double& IonBeta);
+    void getCavMat(unsigned cavi, int cavilabel, double Rm, double IonZ, double IonEs,
+                   double EfieldScl, double IonFyi_s, double IonEk_s, double fRF,
+                   MomentElementBase::value_t& M) const;
+    void initRFCav(const Config& conf, size_t CavCnt, double IonZ, double IonEs,
+                   double& IonW, double& EkState, double& Fy_absState, double& accIonW,
+                   double& beta, double& gamma, double& avebeta, double& avegamma,
+                   MomentElementBase::value_t& M) const;
+};
+
+#endif // SCSI_LINAC_H
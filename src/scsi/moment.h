@@ -2,6 +2,8 @@
 #define SCSI_MOMENT_H
 
 #include <ostream>
+#include <string>
+#include <vector>
 #include <math.h>
 
 #include <boost/numeric/ublas/matrix.hpp>
@@ -31,6 +33,7 @@ struct MomentState : public StateBase
     > matrix_t;
 
     void assign(const StateBase& other);
+    void reset(const Config& c);
 
     virtual void show(std::ostream& strm) const;
 
@@ -66,18 +69,226 @@ struct MomentElementBase : public ElementVoid
     value_t transfer;
     //value_t transferT;
 
+    /** @brief Derivative of 'transfer' with respect to a (scalar) Config parameter
+     *
+     * @param name Name of the parameter (eg. "K")
+     * @param dM Filled in with d(transfer)/d(name) when true is returned
+     * @return true if an analytic derivative is provided, false otherwise
+     */
+    virtual bool dtransfer(const std::string& name, value_t& dM) const { return false; }
+
+    /** @brief Transfer matrix through the first part of a thick element
+     *
+     * @param l Length from the element entrance [m], 0 <= l <= L
+     * @param M Filled in with the transfer matrix of the first 'l' of this element when true is returned
+     * @return true if the element can be divided, false otherwise
+     */
+    virtual bool partialTransfer(double l, value_t& M) const { return false; }
+
     virtual void assign(const ElementVoid *other)
     {
         const MomentElementBase *O = static_cast<const MomentElementBase*>(other);
         transfer = O->transfer;
         ElementVoid::assign(other);
     }
+};
+
+/** @brief Selects an element parameter for propagateSensitivity()
+ */
+struct SensitivityKnob
+{
+    SensitivityKnob() :index(0) {}
+    SensitivityKnob(size_t index, const std::string& param) :index(index), param(param) {}
+    size_t index; //!< Element index in Machine
+    std::string param; //!< Name of a scalar parameter of this Element
+};
+
+/** @brief Propagate a MomentState along with its derivatives with respect to element parameters
+ *
+ * Derivatives are propagated along with the state (forward mode) using d(transfer)/dp
+ * of each knob.  Elements which don't provide MomentElementBase::dtransfer() for a parameter
+ * are differentiated numerically by advance()ing the state through copies with the parameter changed.
+ * No additional propagation is needed.
+ * The state itself is propagated with advance(), so S and the observed values match Machine::propagate().
+ * Derivatives are carried through each element with its transfer matrix, which assumes that
+ * advance() is transfer*S*transfer^t plus terms which don't depend on S (eg. stripper straggling).
+ *
+ * @param M A Machine with sim_type MomentMatrix
+ * @param S The initial state, will be updated with the final state
+ * @param knobs The element parameters
+ * @param observe Element indices after which derivatives are recorded
+ * @param dstate Filled with observe.size()*knobs.size() entries. d(state)/d(knob j) after observe[i] is [i*knobs.size()+j]
+ * @param dmoment0 Filled like dstate, with d(moment0)/d(knob)
+ * @param ostate If not NULL, filled with the state after each observed element
+ * @param omoment0 If not NULL, filled with moment0 after each observed element
+ * @throws std::invalid_argument if M is not a MomentMatrix Machine, or a knob refers to a source element
+ */
+void propagateSensitivity(const Machine& M,
+                          MomentState& S,
+                          const std::vector<SensitivityKnob>& knobs,
+                          const std::vector<size_t>& observe,
+                          std::vector<MomentState::matrix_t>& dstate,
+                          std::vector<MomentState::vector_t>& dmoment0,
+                          std::vector<MomentState::matrix_t>* ostate = NULL,
+                          std::vector<MomentState::vector_t>* omoment0 = NULL);
+
+/** @brief Propagate a MomentState through a Machine, recording it at positions along the lattice
+ *
+ * Positions are measured from the entrance of the first element, adding the "L" of each element.
+ * Inside elements which provide MomentElementBase::partialTransfer() (drift, sbend, quadrupole,
+ * and solenoid) the state is computed with the transfer matrix of the partial length,
+ * so thick elements need not be sliced in the lattice.
+ * Inside other elements the sample is taken at the element exit, and spos[i] is changed to match.
+ * A sample at an element boundary is taken after all elements which end at, or before, this position.
+ *
+ * @param M A Machine with sim_type MomentMatrix
+ * @param S The initial state, will be updated with the final state
+ * @param spos Sample positions [m], in increasing order.  Updated with the actual positions
+ * @param moment0 Filled with spos.size()*7 values, moment0 at each position
+ * @param state Filled with spos.size()*7*7 values, state at each position
+ * @param index If not NULL, filled with spos.size() entries, the index of the element containing each position
+ * @throws std::invalid_argument if M is not a MomentMatrix Machine, or a position is out of order or beyond the last element
+ */
+void propagateSampled(const Machine& M,
+                      MomentState& S,
+                      std::vector<double>& spos,
+                      double *moment0,
+                      double *state,
+                      size_t *index = NULL);
+
+//! Total length of a Machine [m], the sum of "L" of each element
+double machineLength(const Machine& M);
+
+/** @brief A target value for matchMoments()
+ */
+struct MatchTarget
+{
+    MatchTarget() :index(0), row(0), col(0), moment0(false), value(0.0), weight(1.0) {}
+    size_t index; //!< Element index in Machine.  The target applies to the state after this element
+    unsigned row, col; //!< Position in state matrix, or row of moment0
+    bool moment0; //!< Select moment0[row] instead of state(row,col)
+    double value; //!< Desired value
+    double weight; //!< Residual is weight*(actual-value)
+};
+
+/** @brief Levenberg-Marquardt fit of element parameters to target moments
+ *
+ * Each iteration propagates 'initial' through M with propagateSensitivity(),
+ * and changes knob values with Machine::reconfigure().
+ * On return M is configured with the best knob values found.
+ *
+ * @param M A Machine with sim_type MomentMatrix
+ * @param initial The initial state, which is not changed
+ * @param knobs Element parameters to vary.  Starting values are taken from the element Config
+ * @param targets Desired values
+ * @param values Filled in with the best knob values
+ * @param maxiter Maximum number of iterations
+ * @param tol Stop when the relative decrease of the cost, or relative step size, is less than this
+ * @param niter If not NULL, filled with the number of iterations done
+ * @return The final cost sum(residual^2)
+ */
+double matchMoments(Machine& M,
+                    const MomentState& initial,
+                    const std::vector<SensitivityKnob>& knobs,
+                    const std::vector<MatchTarget>& targets,
+                    std::vector<double>& values,
+                    unsigned maxiter = 100,
+                    double tol = 1e-10,
+                    unsigned *niter = NULL);
+
+/** @brief A random error of an element parameter for propagateErrors()
+ */
+struct ElementError
+{
+    enum dist_t {
+        Normal,  //!< Gaussian with standard deviation 'sigma'
+        Uniform, //!< Uniform in [-sigma, sigma]
+    };
+    ElementError() :index(0), sigma(0.0), dist(Normal), relative(false) {}
+    size_t index; //!< Element index in Machine
+    std::string param; //!< Name of a scalar parameter of this Element
+    double sigma; //!< Width of the distribution
+    dist_t dist;
+    bool relative; //!< Error is sigma*value instead of sigma
+};
+
+/** @brief Propagate a MomentState through many randomly perturbed copies of a Machine
+ *
+ * For each seed, every ElementError is applied to the Element parameter,
+ * and transfer matrices of perturbed Elements are computed once.
+ * Then all seeds are propagated, divided between 'nthreads' threads.
+ * The Machine is not changed.
+ *
+ * Random values are drawn for each seed in turn, so the errors
+ * of a seed do not depend on the total number of seeds.
+ *
+ * @param M A Machine with sim_type MomentMatrix
+ * @param initial The initial state
+ * @param errors The element parameters to perturb
+ * @param nseeds Number of random Machines
+ * @param seed Seed of the random number generator
+ * @param observe Element indices after which the state is recorded
+ * @param ostate Filled with observe.size()*nseeds entries.  The state of seed s after observe[i] is [i*nseeds+s]
+ * @param omoment0 Filled like ostate, with moment0
+ * @param deltas If not NULL, filled with nseeds*errors.size() entries.  The change of errors[j] in seed s is [s*errors.size()+j]
+ * @param nthreads Number of threads
+ * @throws std::invalid_argument if M is not a MomentMatrix Machine, an index is out of range,
+ *         or an error names a parameter which is not a number in the element Config
+ */
+void propagateErrors(const Machine& M,
+                     const MomentState& initial,
+                     const std::vector<ElementError>& errors,
+                     size_t nseeds,
+                     unsigned long seed,
+                     const std::vector<size_t>& observe,
+                     std::vector<MomentState::matrix_t>& ostate,
+                     std::vector<MomentState::vector_t>& omoment0,
+                     std::vector<double>* deltas = NULL,
+                     unsigned nthreads = 1);
+
+/** @brief Charge weighted statistics of several MomentStates (eg. charge states) at several elements
+ *
+ * Attach to each observed Element, then propagate each state in turn
+ * with 'weight' set to its charge (or particle count).  Then call finish().
+ * Results are written to caller provided arrays, with one row for each observed Element:
+ *
+ * @li centroid [npoints, 7] Weighted mean of moment0
+ * @li moment2 [npoints, 7, 7] Weighted second moments about the centroid,
+ *     sum(w*(state + (moment0-centroid)(moment0-centroid)^T))/sum(w)
+ * @li rms [npoints, 6] sqrt() of the diagonal of moment2
+ * @li emittance [npoints, 3] sqrt(det()) of the 2x2 blocks of moment2 for the x, y, and longitudinal planes
+ *
+ * Each of these may be NULL except centroid and moment2, which hold the running sums until finish().
+ */
+struct MomentStatsObserver : public Observer
+{
+    enum {ncoord=MomentState::maxsize, nrms=6, nplane=3};
+
+    /**
+     * @param observe Element indices.  Row i of the results is for observe[i]
+     */
+    MomentStatsObserver(const std::vector<size_t>& observe,
+                        double *centroid, double *moment2,
+                        double *rms=NULL, double *emittance=NULL);
+    virtual ~MomentStatsObserver();
+
+    //! Weight of the state(s) being propagated
+    double weight;
+
+    //! Zero results, to begin again with another set of states
+    void clear();
+
+    virtual void view(const ElementVoid* elem, const StateBase* state);
+
+    //! Turn sums into results.  Points which no state passed are zero.
+    void finish();
+
+    inline size_t size() const { return wsum.size(); }
 
 private:
-    // scratch space to avoid temp. allocation in advance()
-    // An Element can't be shared between multiple threads
-    //TODO: non-const advance()
-    mutable state_t::matrix_t scratch;
+    std::vector<size_t> slot; // element index -> row, or -1
+    std::vector<double> wsum;
+    double *centroid, *moment2, *rms, *emittance;
 };
 
 #endif // SCSI_MOMENT_H
@@ -0,0 +1,90 @@
+#ifndef SCSI_RFCAVITY_H
+#define SCSI_RFCAVITY_H
+
+#include <istream>
+#include <map>
+#include <string>
+#include <vector>
+
+#include "base.h"
+
+/** @brief On axis longitudinal electric field of a RF cavity
+ *
+ * Samples must be equally spaced.
+ */
+struct CavityFieldMap
+{
+    //! Longitudinal position [mm]
+    std::vector<double> s;
+    //! Longitudinal electric field [V/m]
+    std::vector<double> Elong;
+
+    /** @brief Read two column (s, Elong) text, as in axisData_41.txt
+     *
+     * @throws std::runtime_error if fewer than two lines can be parsed.
+     */
+    void read(std::istream& strm);
+};
+
+/** @brief Energy gain and exit phase of a RF cavity over a set of input phases
+ *
+ * Equivalent to calling GetCavBoost() for each phase[i], scale[i],
+ * with a single pass over the field map.
+ *
+ * @param map Field map
+ * @param fRF RF frequency [Hz]
+ * @param IonZ Charge to mass ratio
+ * @param IonEs Rest energy [eV/u]
+ * @param IonW0 Total energy at the cavity entrance [eV/u]
+ * @param n Number of points
+ * @param phase Input phases [rad], at the RF frequency, length n
+ * @param scale Field scale factors (aka. "scl_fac"), length n
+ * @param IonW Output total energy [eV/u], length n
+ * @param IonFy Output exit phase [rad], length n
+ */
+void cavityBoost(const CavityFieldMap& map,
+                 double fRF, double IonZ, double IonEs, double IonW0,
+                 size_t n, const double *phase, const double *scale,
+                 double *IonW, double *IonFy);
+
+//! Result of phaseCavities() for one rfcavity element
+struct CavityPhase
+{
+    //! Element index
+    size_t index;
+    //! Cavity phase setting [rad], the input phase less the (scaled) arrival phase.  In [-pi, pi)
+    double phase;
+    //! Input phase of maximum energy gain [rad]
+    double crest;
+    //! Absolute phase of the reference particle at the entrance [rad], at 80.5 MHz
+    double FyAbs;
+    //! Total energy of the reference particle at the entrance and exit [eV/u]
+    double IonW_in, IonW_out;
+};
+
+/** @brief Phase each rfcavity of a Machine in order
+ *
+ * The reference particle is propagated element by element.
+ * For each "rfcavity", the energy gain is computed for 'nphase' input phases
+ * in one pass (see cavityBoost()) to find the crest,
+ * and the cavity is set to the synchronous phase "phi" [deg] from the crest.
+ * The reference particle is then propagated through the phased cavity.
+ *
+ * The field map of a cavity is looked up by its "cavtype".
+ * A "stripper" with "charge_model" set changes the charge and energy of the reference particle (see StripperModel).
+ * Other elements are drifts of length "L" for the reference particle.
+ *
+ * @param M The Machine
+ * @param ref The reference particle at the entrance of the first element.  IonZ, IonEs, and IonW are used.
+ * @param maps Field maps by cavity type
+ * @param out Results, one for each rfcavity
+ * @param nphase Number of input phases scanned in each cavity.
+ * @throws std::invalid_argument if a cavity type has no field map
+ */
+void phaseCavities(const Machine& M,
+                   const StateBase& ref,
+                   const std::map<std::string, CavityFieldMap>& maps,
+                   std::vector<CavityPhase>& out,
+                   unsigned nphase=360);
+
+#endif // SCSI_RFCAVITY_H
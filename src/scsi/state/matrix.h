@@ -21,6 +21,7 @@ struct MatrixState : public StateBase
     virtual ~MatrixState();
 
     void assign(const StateBase& other);
+    void reset(const Config& c);
 
     typedef boost::numeric::ublas::matrix<double,
                     boost::numeric::ublas::row_major,
@@ -21,6 +21,7 @@ struct VectorState : public StateBase
     virtual ~VectorState();
 
     virtual void assign(const StateBase& other);
+    virtual void reset(const Config& c);
 
     typedef boost::numeric::ublas::vector<double,
                     boost::numeric::ublas::bounded_array<double, maxsize>
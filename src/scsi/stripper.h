@@ -0,0 +1,62 @@
+#ifndef SCSI_STRIPPER_H
+#define SCSI_STRIPPER_H
+
+#include <vector>
+
+#include "config.h"
+
+/** @brief Charge stripper foil model
+ *
+ * The charge state distribution is from Baron's formula for a carbon foil.
+ * The outgoing energy is a linear fit around a reference energy and thickness,
+ * and a variation of the foil thickness gives an energy spread.
+ *
+ * Config keys.  Defaults are for 238U on a 3 um carbon foil.
+ * @li "Stripper_IonMass" Mass number of the ion.  Default 238
+ * @li "Stripper_IonProton" Atomic number of the ion.  Default 92
+ * @li "Stripper_IonChargeStates" Charge to mass ratio of each outgoing charge state.  Default [76, 77, 78, 79, 80]/238
+ * @li "Stripper_IonZ" Charge to mass ratio of the state which continues through the lattice.  Default 78/238
+ * @li "Stripper_E0Para" [outgoing energy at reference [eV/u], slope, thickness dependence [eV/u/um]].
+ *     Default [16.348e6, 1.00547, -0.10681e6]
+ * @li "StripperPara" [reference thickness [um], thickness variation [%], reference energy [eV/u]].
+ *     Default [3, 20, 16.623e6]
+ * @li "thickness" Foil thickness [um].  Default is the reference thickness.
+ *
+ * The stripper element of the MomentMatrix sim_type applies this model only when
+ * "charge_model" is set to a non-zero value.  Otherwise it leaves the State unchanged.
+ */
+struct StripperModel
+{
+    StripperModel(const Config& c);
+
+    double IonMass, IonProton, IonZ;
+    std::vector<double> IonChargeStates;
+    double E0Para[3];
+    double thickness_ref, thickness_var, Ek_ref;
+    double thickness;
+
+    /** @brief Mean charge and width of the charge state distribution (Baron's formula)
+     *
+     * @param beta Velocity of the incoming ion
+     * @param Q_ave Filled with the mean charge
+     * @param d Filled with the width (sigma) of the distribution
+     */
+    void charge(double beta, double& Q_ave, double& d) const;
+
+    /** @brief Evaluate the model at many points
+     *
+     * @param n Number of points
+     * @param IonEs Rest energy [eV/u]
+     * @param IonEk Kinetic energy of the incoming ion [eV/u], length n
+     * @param thickness Foil thickness [um], length n.  If NULL, this->thickness is used
+     * @param variation Thickness variation [%], length n.  If NULL, this->thickness_var is used
+     * @param IonEk_out Filled with the outgoing kinetic energy [eV/u], length n
+     * @param sigma Filled with the energy spread (RMS) from thickness variation [eV/u], length n
+     * @param fractions Filled with the fraction of each charge state, [n, IonChargeStates.size()]
+     */
+    void evaluate(size_t n, double IonEs,
+                  const double *IonEk, const double *thickness, const double *variation,
+                  double *IonEk_out, double *sigma, double *fractions) const;
+};
+
+#endif // SCSI_STRIPPER_H
@@ -0,0 +1,63 @@
+#ifndef SCSI_TLM_H
+#define SCSI_TLM_H
+
+#include <istream>
+#include <string>
+
+#include "config.h"
+
+/** @brief Reader for TLM flat lattice files
+ *
+ * Builds a Config like translating with python/cavity_model/get_lat.py
+ * and then parsing the resulting GLPS file, but in one pass without the intermediate text.
+ *
+ * Each line of a flat file is "<s> <kind> <name> <L> <aper> ...".
+ * Lines ending with '&' are continued on the next line.
+ * Blank lines and lines starting with '#' are ignored.
+ *
+ * @li mark -> marker
+ * @li drift -> drift (L, aper)
+ * @li dipole -> sbend (L, aper, phi, bg, phi1, phi2)
+ * @li solenoid -> solenoid (L, aper, B)
+ * @li quadpole, combquad -> quadrupole (L, aper, B2)
+ * @li rfcavity -> rfcavity (L, aper, f, scl_fac, phi, cavtype="0.041QWR")
+ * @li ebend -> edipole (L, aper, phi, beta, spher, ver, x_frng, y_frng, asym_fac)
+ * @li equad -> equad (L, aper, V, radius)
+ *
+ * As with get_lat.py, element names are lower cased, the first ':' is replaced with '_',
+ * and (if number_names is set) "_<n>" is appended, counting each element kind separately.
+ *
+ * Differences from get_lat.py
+ * @li ebend columns follow the layout documented in the get_lat.py header.
+ *     The hor/ver flag is stored as "ver", and x_frng, y_frng, asym_fac are read from the following columns.
+ *     get_lat.py drops the flag, and reads these three one column early.
+ * @li ebend and equad names are numbered like other kinds.
+ *     get_lat.py always appends "_<n>" to them, and with numbering also appends
+ *     the rfcavity count and advances their counter by two.
+ * @li Comment lines may be indented.
+ * The top level Config has sim_type="MomentMatrix" and name="cell",
+ * which may be overridden, or added to, with setVar().
+ */
+class TLMParser
+{
+    Config::values_t vars;
+public:
+    TLMParser();
+
+    //! Append "_<n>" to element names.  Default true
+    bool number_names;
+
+    void setVar(const std::string& name, const Config::value_t& v);
+
+    /** Parse a flat file
+     *
+     * @param strm Input stream
+     * @param fname Name used in error messages
+     * @throws std::runtime_error for a malformed line or unknown element kind
+     */
+    Config *parse(std::istream& strm, const std::string& fname="<string>");
+    Config *parse(const std::string& s);
+    Config *parse_file(const char *fname);
+};
+
+#endif // SCSI_TLM_H
@@ -0,0 +1,87 @@
+#include <algorithm>
+#include <sstream>
+#include <stdexcept>
+#include <string>
+
+#include <math.h>
+
+#include "scsi/stripper.h"
+
+namespace {
+inline double sqr(double x) { return x*x; }
+
+void getVector(const Config& c, const std::string& name, double *out, size_t n)
+{
+    std::vector<double> def(out, out+n);
+    const std::vector<double>& V = c.get<std::vector<double> >(name, def);
+    if(V.size()!=n) {
+        std::ostringstream msg;
+        msg<<name<<" must have "<<n<<" elements";
+        throw std::invalid_argument(msg.str());
+    }
+    std::copy(V.begin(), V.end(), out);
+}
+}
+
+StripperModel::StripperModel(const Config& c)
+    :IonMass(c.get<double>("Stripper_IonMass", 238e0))
+    ,IonProton(c.get<double>("Stripper_IonProton", 92e0))
+    ,IonZ(c.get<double>("Stripper_IonZ", 78e0/IonMass))
+{
+    std::vector<double> def(5);
+    for(size_t i=0; i<def.size(); i++)
+        def[i] = (76e0+i)/IonMass;
+    IonChargeStates = c.get<std::vector<double> >("Stripper_IonChargeStates", def);
+    if(IonChargeStates.empty())
+        throw std::invalid_argument("Stripper_IonChargeStates must not be empty");
+
+    E0Para[0] = 16.348e6;
+    E0Para[1] = 1.00547;
+    E0Para[2] = -0.10681e6;
+    getVector(c, "Stripper_E0Para", E0Para, 3);
+
+    double para[3] = {3e0, 20e0, 16.623e6};
+    getVector(c, "StripperPara", para, 3);
+    thickness_ref = para[0];
+    thickness_var = para[1];
+    Ek_ref        = para[2];
+
+    thickness = c.get<double>("thickness", thickness_ref);
+}
+
+void StripperModel::charge(double beta, double& Q_ave, double& d) const
+{
+    // Baron's formula for carbon foil.
+    double Q_ave1 = IonProton*(1e0-exp(-83.275*(beta/pow(IonProton, 0.447)))),
+           Y      = Q_ave1/IonProton;
+    Q_ave = Q_ave1*(1e0-exp(-12.905+0.2124*IonProton-0.00122*sqr(IonProton)));
+    d     = sqrt(Q_ave1*(0.07535+0.19*Y-0.2654*sqr(Y)));
+}
+
+void StripperModel::evaluate(size_t n, double IonEs,
+                             const double *IonEk, const double *thick, const double *variation,
+                             double *IonEk_out, double *sigma, double *fractions) const
+{
+    const size_t nstates = IonChargeStates.size();
+    std::vector<double> Q(nstates);
+    for(size_t k=0; k<nstates; k++)
+        Q[k] = IonChargeStates[k]*IonMass;
+
+    for(size_t i=0; i<n; i++) {
+        const double t = thick ? thick[i] : thickness,
+                     var = variation ? variation[i] : thickness_var,
+                     gamma = (IonEk[i]+IonEs)/IonEs,
+                     beta = sqrt(1e0-1e0/sqr(gamma));
+
+        IonEk_out[i] = E0Para[0] + (IonEk[i]-Ek_ref)*E0Para[1] + (t-thickness_ref)*E0Para[2];
+        // thickness uniform in t*(1 +- var/100)
+        sigma[i] = fabs(E0Para[2])*t*var/100e0/sqrt(3e0);
+
+        double Q_ave, d;
+        charge(beta, Q_ave, d);
+        const double norm = 1e0/(sqrt(2e0*M_PI)*d), scale = -0.5e0/sqr(d);
+        double *F = fractions+i*nstates;
+        for(size_t k=0; k<nstates; k++)
+            F[k] = norm*exp(scale*sqr(Q[k]-Q_ave));
+    }
+}
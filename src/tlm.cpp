@@ -0,0 +1,218 @@
+#include <fstream>
+#include <sstream>
+#include <stdexcept>
+#include <vector>
+
+#include <ctype.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "scsi/tlm.h"
+
+namespace {
+
+struct column_t {
+    const char *name; // Config key
+    unsigned index;   // token index, including the leading 's' and kind
+    const char *exponent; // appended before conversion (eg. MHz -> Hz)
+};
+
+struct kind_t {
+    const char *kind;  // TLM element kind
+    const char *etype; // element type
+    unsigned counter;  // kinds with the same counter share numbering
+    const column_t *columns;
+    const char *cavtype;
+};
+
+#define COLS(NAME) static const column_t NAME[]
+COLS(mark_cols) = {{NULL, 0, NULL}};
+COLS(drift_cols) = {{"L", 3, ""}, {"aper", 4, ""}, {NULL, 0, NULL}};
+COLS(sbend_cols) = {{"L", 3, ""}, {"aper", 4, ""}, {"phi", 5, ""}, {"bg", 6, ""},
+                    {"phi1", 8, ""}, {"phi2", 9, ""}, {NULL, 0, NULL}};
+COLS(sol_cols) = {{"L", 3, ""}, {"aper", 4, ""}, {"B", 5, ""}, {NULL, 0, NULL}};
+COLS(quad_cols) = {{"L", 3, ""}, {"aper", 4, ""}, {"B2", 5, ""}, {NULL, 0, NULL}};
+COLS(cav_cols) = {{"L", 3, ""}, {"aper", 4, ""}, {"f", 5, "e6"}, {"scl_fac", 6, ""},
+                  {"phi", 7, ""}, {NULL, 0, NULL}};
+COLS(ebend_cols) = {{"L", 3, ""}, {"aper", 4, ""}, {"phi", 5, ""}, {"beta", 6, ""},
+                    {"spher", 7, ""}, {"ver", 8, ""}, {"x_frng", 9, ""}, {"y_frng", 10, ""},
+                    {"asym_fac", 11, ""}, {NULL, 0, NULL}};
+COLS(equad_cols) = {{"L", 3, ""}, {"aper", 4, ""}, {"V", 5, ""}, {"radius", 6, ""}, {NULL, 0, NULL}};
+#undef COLS
+
+// TLM -> GLPS, as tlm2tracy in get_lat.py
+static const kind_t kinds[] = {
+    {"mark",     "marker",     0, mark_cols,  NULL},
+    {"drift",    "drift",      1, drift_cols, NULL},
+    {"dipole",   "sbend",      2, sbend_cols, NULL},
+    {"solenoid", "solenoid",   3, sol_cols,   NULL},
+    {"quadpole", "quadrupole", 4, quad_cols,  NULL},
+    {"combquad", "quadrupole", 4, quad_cols,  NULL},
+    {"rfcavity", "rfcavity",   5, cav_cols,   "0.041QWR"},
+    {"ebend",    "edipole",    6, ebend_cols, NULL},
+    {"equad",    "equad",      7, equad_cols, NULL},
+};
+static const size_t nkinds = sizeof(kinds)/sizeof(kinds[0]);
+static const unsigned ncounters = 8;
+
+struct tlm_error : public std::runtime_error
+{
+    static std::string format(const std::string& fname, size_t lineno, const std::string& msg)
+    {
+        std::ostringstream strm;
+        strm<<fname<<":"<<lineno<<": "<<msg;
+        return strm.str();
+    }
+    tlm_error(const std::string& fname, size_t lineno, const std::string& msg)
+        :std::runtime_error(format(fname, lineno, msg))
+    {}
+};
+
+void tokenize(const std::string& line, std::vector<std::string>& tokens)
+{
+    tokens.clear();
+    size_t i=0, N=line.size();
+    while(true) {
+        while(i<N && isspace((unsigned char)line[i])) i++;
+        if(i==N) break;
+        size_t start = i;
+        while(i<N && !isspace((unsigned char)line[i])) i++;
+        tokens.push_back(line.substr(start, i-start));
+    }
+}
+
+// strip trailing '\r' (DOS line endings)
+void chomp(std::string& line)
+{
+    size_t N = line.size();
+    while(N && line[N-1]=='\r') N--;
+    line.resize(N);
+}
+
+} // namespace
+
+TLMParser::TLMParser()
+    :number_names(true)
+{}
+
+void
+TLMParser::setVar(const std::string& name, const Config::value_t& v)
+{
+    vars[name] = v;
+}
+
+Config*
+TLMParser::parse(std::istream& strm, const std::string& fname)
+{
+    std::auto_ptr<Config> ret(new Config);
+    ret->set<std::string>("sim_type", "MomentMatrix");
+    for(Config::values_t::const_iterator it=vars.begin(), end=vars.end(); it!=end; ++it)
+        ret->setAny(it->first, it->second);
+
+    Config::vector_t elements;
+    std::vector<std::string> tokens;
+    unsigned counters[ncounters] = {0,};
+    std::string line, cont;
+    size_t lineno = 0;
+
+    while(std::getline(strm, line)) {
+        lineno++;
+        chomp(line);
+        size_t first = lineno;
+        while(!line.empty() && line[line.size()-1]=='&') {
+            // continuation
+            line.resize(line.size()-1);
+            if(!std::getline(strm, cont))
+                throw tlm_error(fname, lineno, "continuation at end of file");
+            lineno++;
+            chomp(cont);
+            line += cont;
+        }
+
+        for(size_t i=0, N=line.size(); i<N; i++)
+            line[i] = tolower((unsigned char)line[i]);
+
+        tokenize(line, tokens);
+        if(tokens.empty() || tokens[0][0]=='#')
+            continue; // blank or comment
+        if(tokens.size()<3)
+            throw tlm_error(fname, first, "expected '<s> <kind> <name> ...'");
+
+        const kind_t *K = NULL;
+        for(size_t i=0; i<nkinds; i++) {
+            if(tokens[1]==kinds[i].kind) {
+                K = &kinds[i];
+                break;
+            }
+        }
+        if(!K)
+            throw tlm_error(fname, first, "undefined element kind '"+tokens[1]+"'");
+
+        std::string name(tokens[2]);
+        {
+            size_t sep = name.find(':');
+            if(sep!=name.npos)
+                name[sep] = '_';
+        }
+        if(number_names) {
+            std::ostringstream strm;
+            strm<<name<<"_"<<++counters[K->counter];
+            name = strm.str();
+        }
+
+        Config next(ret->new_scope()); // inherit global scope
+
+        for(const column_t *C = K->columns; C->name; C++) {
+            if(C->index>=tokens.size()) {
+                std::ostringstream strm;
+                strm<<tokens[1]<<" '"<<tokens[2]<<"' expects at least "<<(C->index+1)<<" columns";
+                throw tlm_error(fname, first, strm.str());
+            }
+            std::string tok(tokens[C->index]);
+            tok += C->exponent;
+            char *end = NULL;
+            double val = strtod(tok.c_str(), &end);
+            if(end==tok.c_str() || *end!='\0')
+                throw tlm_error(fname, first, "'"+tokens[C->index]+"' is not a number");
+            next.set<double>(C->name, val);
+        }
+
+        if(strcmp(K->etype, "marker")==0 && (tokens.size()<4 || strtod(tokens[3].c_str(), NULL)!=0.0))
+            throw tlm_error(fname, first, "marker with non zero length");
+
+        if(K->cavtype)
+            next.set<std::string>("cavtype", K->cavtype);
+        next.set<std::string>("type", K->etype);
+        next.set<std::string>("name", name);
+
+        elements.push_back(Config());
+        elements.back().swap(next);
+    }
+
+    if(strm.bad())
+        throw std::runtime_error("Error reading "+fname);
+    if(elements.empty())
+        throw std::runtime_error(fname+" defines no elements");
+
+    if(vars.find("name")==vars.end())
+        ret->set<std::string>("name", "cell");
+    ret->swap<Config::vector_t>("elements", elements);
+
+    return ret.release();
+}
+
+Config*
+TLMParser::parse(const std::string& s)
+{
+    std::istringstream strm(s);
+    return parse(strm);
+}
+
+Config*
+TLMParser::parse_file(const char *fname)
+{
+    std::ifstream strm(fname);
+    if(!strm.is_open())
+        throw std::runtime_error(std::string("Failed to open ")+fname);
+    return parse(strm, fname);
+}
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""Time propagation of a particle Ensemble through the IMP lattice
+
+$ PYTHONPATH=... python tools/bench_ensemble.py [count] [threads]
+"""
+from __future__ import print_function
+
+import sys, os, time
+
+import numpy
+
+from uscsi import Machine, GLPSParser
+
+datadir = os.path.join(os.path.dirname(__file__), '..', 'python', 'uscsi', 'test')
+
+def main(count=1000000, threads=1):
+    with open(os.path.join(datadir, 'latticeout_IMP_withPV_consolidate.lat'), 'rb') as F:
+        conf = GLPSParser().parse(F.read())
+    conf['sim_type'] = 'Ensemble'
+    M = Machine(conf)
+
+    P = numpy.random.randn(count, 7)
+    P[:,6] = 1.0
+    S = M.allocState({'particles':P, 'threads':threads})
+
+    T0 = time.time()
+    M.propagate(S)
+    T1 = time.time()
+    print('%d particles, %d elements, %d threads'%(count, len(M), threads))
+    print('propagate()          %8.3f s'%(T1-T0))
+
+    # every element observed, so each is applied separately
+    S.assign(M.allocState({'particles':P, 'threads':threads}))
+    T0 = time.time()
+    for i in range(len(M)):
+        M.propagate(S, i, 1)
+    T1 = time.time()
+    print('element by element   %8.3f s'%(T1-T0))
+
+if __name__=='__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Compare Machine.match() with a scipy.optimize.leastsq loop
+
+Solenoid strengths in moment_jb_2.lat are perturbed, then fit
+to recover the beam envelope at the end of the lattice.
+
+$ PYTHONPATH=... python tools/bench_match.py [repeat]
+"""
+from __future__ import print_function
+
+import sys, os, time
+
+import numpy
+
+from uscsi import Machine
+
+try:
+    from scipy.optimize import leastsq
+except ImportError:
+    leastsq = None
+
+datadir = os.path.join(os.path.dirname(__file__), '..', 'python', 'uscsi', 'test')
+
+def main(repeat=10):
+    with open(os.path.join(datadir, 'moment_jb_2.lat'), 'rb') as F:
+        M = Machine(F.read())
+
+    sols = [i for i, E in enumerate(M.conf()['elements']) if E['type']=='solenoid']
+    knobs = [(i, 'K') for i in sols]
+    last = len(M)-1
+
+    goal = numpy.linspace(0.8, 1.2, len(sols))
+    for i, K in zip(sols, goal):
+        M.reconfigure(i, {'K':K})
+
+    S = M.allocState({})
+    M.propagate(S)
+    targets = [(last, (0,0), S.state[0,0]), (last, (2,2), S.state[2,2]),
+               (last, (0,1), S.state[0,1]), (last, (2,3), S.state[2,3])]
+    start = goal*0.9
+
+    def reset():
+        for i, K in zip(sols, start):
+            M.reconfigure(i, {'K':K})
+
+    T0 = time.time()
+    for n in range(repeat):
+        reset()
+        R = M.match(M.allocState({}), knobs, targets)
+    Tnative = (time.time()-T0)/repeat
+    print('match()  %8.3f ms  cost %.3g  iterations %d  error %.3g'%(
+          Tnative*1e3, R['cost'], R['iterations'], numpy.abs(R['x']-goal).max()))
+
+    if leastsq is None:
+        print('scipy not available')
+        return
+
+    S = M.allocState({})
+    def resid(x):
+        for i, K in zip(sols, x):
+            M.reconfigure(i, {'K':K})
+        S.assign(S0)
+        M.propagate(S)
+        return [S.state[T[1]]-T[2] for T in targets]
+    S0 = M.allocState({})
+
+    T0 = time.time()
+    for n in range(repeat):
+        reset()
+        x, _ier = leastsq(resid, start)
+    Tscipy = (time.time()-T0)/repeat
+    cost = (numpy.asarray(resid(x))**2).sum()
+    print('leastsq  %8.3f ms  cost %.3g  error %.3g'%(
+          Tscipy*1e3, cost, numpy.abs(x-goal).max()))
+    print('speedup  %.1fx'%(Tscipy/Tnative))
+
+if __name__=='__main__':
+    main(*map(int, sys.argv[1:]))
@@ -1,20 +1,457 @@
-
+#include <algorithm>
 #include <iostream>
+#include <fstream>
+#include <sstream>
 #include <list>
+#include <limits>
+#include <stdexcept>
+
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <time.h>
 
+#include <boost/bind.hpp>
+#include <boost/cstdint.hpp>
 #include <boost/numeric/ublas/io.hpp>
+#include <boost/thread/thread.hpp>
 
 #include <scsi/base.h>
 #include <scsi/state/vector.h>
 #include <scsi/state/matrix.h>
 
+namespace {
+
+void usage(const char *exe)
+{
+    std::cerr<<"Usage: "<<exe<<" [lattice.lat]\n"
+               "       "<<exe<<" -i <states.npy> [options] <lattice.lat>\n"
+               "       "<<exe<<" -L <lattice.lat>\n"
+               "\n"
+               "Without -i, propagate one default State with trace output.\n"
+               "\n"
+               " -L              Print the layout of a State array and exit\n"
+               " -i <file>       Batch mode.  Initial States, as an array [N, width] of float64\n"
+               "                 in .npy format, or raw native doubles (other extensions)\n"
+               " -o <file>       Write States at observation points as [N, nobs, width]\n"
+               "                 .npy or raw doubles.  Default is no output.\n"
+               " -O <elem>       Observe the State after this element (index or name).\n"
+               "                 May be repeated.  Default is the last element.\n"
+               " -p <file>       Per-run parameters, as an array [N, nparam] (.npy or raw)\n"
+               " -P <elem:key>   Element parameter set from the next column of -p.  May be repeated.\n"
+               " -s <index>      First element.  Default 0, or 1 to skip a leading source element.\n"
+               " -j <threads>    Number of threads.  Default is the number of CPUs\n"
+               " -h              Show this message\n";
+}
+
+double now()
+{
+    timespec T;
+    clock_gettime(CLOCK_MONOTONIC, &T);
+    return T.tv_sec + 1e-9*T.tv_nsec;
+}
+
+// Flattened view of all double arrays of a State.  Same layout as python State.to_array()
+struct StateLayout
+{
+    std::vector<StateBase::ArrayInfo> infos;
+    size_t width;
+
+    explicit StateLayout(StateBase& S) :width(0)
+    {
+        StateBase::ArrayInfo info;
+        for(unsigned i=0; S.getArray(i, info); i++) {
+            if(info.type!=StateBase::ArrayInfo::Double)
+                continue;
+            infos.push_back(info);
+            width += count(info);
+        }
+    }
+
+    static size_t count(const StateBase::ArrayInfo& info)
+    {
+        size_t N = 1;
+        for(int d=0; d<info.ndim; d++)
+            N *= info.dim[d];
+        return N;
+    }
+
+    // ArrayInfo pointers are specific to one State
+    static void pack(StateBase& S, double *out)
+    {
+        StateBase::ArrayInfo info;
+        for(unsigned i=0; S.getArray(i, info); i++) {
+            if(info.type!=StateBase::ArrayInfo::Double)
+                continue;
+            const size_t N = count(info);
+            std::copy((const double*)info.ptr, (const double*)info.ptr+N, out);
+            out += N;
+        }
+    }
+
+    static void unpack(StateBase& S, const double *in)
+    {
+        StateBase::ArrayInfo info;
+        for(unsigned i=0; S.getArray(i, info); i++) {
+            if(info.type!=StateBase::ArrayInfo::Double)
+                continue;
+            const size_t N = count(info);
+            std::copy(in, in+N, (double*)info.ptr);
+            in += N;
+        }
+    }
+
+    void show(std::ostream& strm) const
+    {
+        size_t offset = 0;
+        strm<<"# name offset shape\n";
+        for(size_t i=0; i<infos.size(); i++) {
+            strm<<infos[i].name<<" "<<offset<<" (";
+            for(int d=0; d<infos[i].ndim; d++)
+                strm<<(d ? ", " : "")<<infos[i].dim[d];
+            strm<<")\n";
+            offset += count(infos[i]);
+        }
+        strm<<"# width "<<width<<"\n";
+    }
+};
+
+bool endswith(const std::string& s, const char *suffix)
+{
+    size_t N = strlen(suffix);
+    return s.size()>=N && s.compare(s.size()-N, N, suffix)==0;
+}
+
+bool littleendian()
+{
+    const boost::uint16_t val = 1;
+    return *(const char*)&val==1;
+}
+
+/* Read a 1-d or 2-d array of doubles.
+ * .npy files must be C order little endian float64 ('<f8').
+ * Other files are raw native doubles with 'width' columns.
+ */
+void readArray(const std::string& fname, size_t width, std::vector<double>& out, size_t& rows)
+{
+    std::ifstream strm(fname.c_str(), std::ios::binary);
+    if(!strm.is_open())
+        throw std::runtime_error("Failed to open "+fname);
+
+    size_t cols = width;
+    if(endswith(fname, ".npy")) {
+        char magic[8];
+        if(!strm.read(magic, 8) || memcmp(magic, "\x93NUMPY", 6)!=0)
+            throw std::runtime_error(fname+" is not a .npy file");
+
+        size_t hlen;
+        if(magic[6]==1) {
+            unsigned char L[2];
+            strm.read((char*)L, 2);
+            hlen = L[0] | (size_t(L[1])<<8);
+        } else {
+            unsigned char L[4];
+            strm.read((char*)L, 4);
+            hlen = L[0] | (size_t(L[1])<<8) | (size_t(L[2])<<16) | (size_t(L[3])<<24);
+        }
+        std::string header(hlen, '\0');
+        if(!strm.read(&header[0], hlen))
+            throw std::runtime_error(fname+" truncated .npy header");
+
+        if(!littleendian() || header.find("'descr': '<f8'")==header.npos)
+            throw std::runtime_error(fname+" must contain little endian float64 ('<f8')");
+        if(header.find("'fortran_order': False")==header.npos)
+            throw std::runtime_error(fname+" must be in C order");
+
+        size_t start = header.find("'shape': (");
+        size_t end = header.find(')', start);
+        if(start==header.npos || end==header.npos)
+            throw std::runtime_error(fname+" has no shape");
+        std::vector<size_t> shape;
+        std::istringstream S(header.substr(start+10, end-start-10));
+        std::string tok;
+        while(std::getline(S, tok, ',')) {
+            if(tok.find_first_not_of(' ')==tok.npos)
+                continue;
+            shape.push_back(strtoul(tok.c_str(), NULL, 10));
+        }
+        if(shape.size()==1) {
+            rows = 1;
+            cols = shape[0];
+        } else if(shape.size()==2) {
+            rows = shape[0];
+            cols = shape[1];
+        } else {
+            throw std::runtime_error(fname+" must be a 1-d or 2-d array");
+        }
+        if(width && cols!=width) {
+            std::ostringstream msg;
+            msg<<fname<<" has "<<cols<<" columns, expected "<<width;
+            throw std::runtime_error(msg.str());
+        }
+
+    } else {
+        std::streampos pos = strm.tellg();
+        strm.seekg(0, std::ios::end);
+        size_t nbytes = strm.tellg()-pos;
+        strm.seekg(pos);
+        if(width==0 || nbytes%(width*sizeof(double)))
+            throw std::runtime_error(fname+" size is not a whole number of rows");
+        rows = nbytes/(width*sizeof(double));
+    }
+
+    out.resize(rows*cols);
+    if(!out.empty() && !strm.read((char*)&out[0], out.size()*sizeof(double)))
+        throw std::runtime_error(fname+" is truncated");
+}
+
+void writeArray(const std::string& fname, const std::vector<size_t>& shape, const std::vector<double>& data)
+{
+    std::ofstream strm(fname.c_str(), std::ios::binary|std::ios::trunc);
+    if(!strm.is_open())
+        throw std::runtime_error("Failed to open "+fname);
+
+    if(endswith(fname, ".npy")) {
+        std::ostringstream H;
+        H<<"{'descr': '"<<(littleendian() ? '<' : '>')<<"f8', 'fortran_order': False, 'shape': (";
+        for(size_t i=0; i<shape.size(); i++)
+            H<<shape[i]<<", ";
+        H<<"), }";
+        std::string header(H.str());
+        // pad so that data is 64 byte aligned
+        header.append(63-(10+header.size())%64, ' ');
+        header += '\n';
+
+        strm.write("\x93NUMPY\x01\x00", 8);
+        const unsigned char L[2] = {(unsigned char)(header.size()&0xff), (unsigned char)(header.size()>>8)};
+        strm.write((const char*)L, 2);
+        strm.write(header.c_str(), header.size());
+    }
+    if(!data.empty())
+        strm.write((const char*)&data[0], data.size()*sizeof(double));
+    if(!strm.good())
+        throw std::runtime_error("Error writing "+fname);
+}
+
+size_t findElement(const Machine& sim, const std::string& name)
+{
+    char *end = NULL;
+    unsigned long idx = strtoul(name.c_str(), &end, 10);
+    if(!name.empty() && *end=='\0') {
+        if(idx>=sim.size())
+            throw std::runtime_error("element index out of range: "+name);
+        return idx;
+    }
+    for(size_t i=0, N=sim.size(); i<N; i++) {
+        if(sim.elementConf(i).get<std::string>("name", "")==name)
+            return i;
+    }
+    throw std::runtime_error("No element named '"+name+"'");
+}
+
+struct Param {
+    size_t index;
+    std::string key;
+};
+
+struct Batch
+{
+    const Machine *sim;
+    size_t nruns, width, start;
+    const std::vector<size_t> *observe; // sorted
+    const std::vector<Param> *params;
+    const double *input, *pvalues;
+    double *output; // may be NULL
+
+    size_t first, last;
+    size_t failed;
+    std::string error;
+
+    Batch() :sim(NULL), nruns(0), width(0), start(0), observe(NULL), params(NULL),
+        input(NULL), pvalues(NULL), output(NULL), first(0), last(0), failed(0) {}
+
+    void run()
+    {
+        // propagate() without observers or trace is thread safe, but reconfigure() is not
+        std::auto_ptr<Machine> copy;
+        Machine *M = const_cast<Machine*>(sim);
+        if(!params->empty()) {
+            copy.reset(sim->clone());
+            M = copy.get();
+        }
+
+        Config D;
+        std::auto_ptr<StateBase> S(M->allocState(D));
+        const size_t nobs = observe->size(), nparam = params->size();
+
+        for(size_t n=first; n<last; n++) {
+            double *out = output ? output+n*nobs*width : NULL;
+            try {
+                for(size_t k=0; k<nparam; k++) {
+                    const Param& P = (*params)[k];
+                    Config C(M->elementConf(P.index));
+                    C.set<double>(P.key, pvalues[n*nparam+k]);
+                    M->reconfigure(P.index, C);
+                }
+
+                StateLayout::unpack(*S, input+n*width);
+
+                size_t next = start;
+                for(size_t k=0; k<nobs; k++) {
+                    const size_t idx = (*observe)[k];
+                    if(idx>=next)
+                        M->propagate(S.get(), next, idx+1-next);
+                    next = idx+1;
+                    if(out)
+                        StateLayout::pack(*S, out+k*width);
+                }
+            } catch(std::exception& e) {
+                if(!failed++) {
+                    std::ostringstream msg;
+                    msg<<"State "<<n<<": "<<e.what();
+                    error = msg.str();
+                }
+                if(out)
+                    std::fill(out, out+nobs*width, std::numeric_limits<double>::quiet_NaN());
+            }
+        }
+    }
+};
+
+int batch(const Machine& sim, const std::string& infile, const std::string& outfile,
+          const std::vector<std::string>& obsnames, const std::string& pfile,
+          const std::vector<std::string>& pnames, long start, unsigned nthreads)
+{
+    Config D;
+    std::auto_ptr<StateBase> S(sim.allocState(D));
+    StateLayout layout(*S);
+
+    if(start<0)
+        start = sim.size() && sim.elementConf(0).get<std::string>("type", "")=="source" ? 1 : 0;
+
+    std::vector<size_t> observe;
+    for(size_t i=0; i<obsnames.size(); i++)
+        observe.push_back(findElement(sim, obsnames[i]));
+    if(observe.empty() && sim.size())
+        observe.push_back(sim.size()-1);
+    std::sort(observe.begin(), observe.end());
+    observe.erase(std::unique(observe.begin(), observe.end()), observe.end());
+
+    std::vector<Param> params;
+    for(size_t i=0; i<pnames.size(); i++) {
+        size_t sep = pnames[i].rfind(':');
+        if(sep==pnames[i].npos)
+            throw std::runtime_error("-P expects <element>:<parameter>, not "+pnames[i]);
+        Param P;
+        P.index = findElement(sim, pnames[i].substr(0, sep));
+        P.key = pnames[i].substr(sep+1);
+        params.push_back(P);
+    }
+
+    std::vector<double> input, pvalues, output;
+    size_t nruns = 0, prows = 0;
+    readArray(infile, layout.width, input, nruns);
+    if(!params.empty()) {
+        readArray(pfile, params.size(), pvalues, prows);
+        if(prows!=nruns)
+            throw std::runtime_error("-p must have one row for each initial State");
+    } else if(!pfile.empty()) {
+        throw std::runtime_error("-p requires -P");
+    }
+
+    if(!outfile.empty())
+        output.resize(nruns*observe.size()*layout.width);
+
+    if(nthreads==0)
+        nthreads = std::max(1u, boost::thread::hardware_concurrency());
+    nthreads = std::max<size_t>(1u, std::min<size_t>(nthreads, nruns));
+
+    std::vector<Batch> jobs(nthreads);
+    for(size_t t=0; t<nthreads; t++) {
+        Batch& B = jobs[t];
+        B.sim = &sim;
+        B.nruns = nruns;
+        B.width = layout.width;
+        B.start = start;
+        B.observe = &observe;
+        B.params = &params;
+        B.input = input.empty() ? NULL : &input[0];
+        B.pvalues = pvalues.empty() ? NULL : &pvalues[0];
+        B.output = output.empty() ? NULL : &output[0];
+        B.first = (nruns*t)/nthreads;
+        B.last = (nruns*(t+1))/nthreads;
+    }
+
+    const double T0 = now();
+    if(nthreads==1) {
+        jobs[0].run();
+    } else {
+        boost::thread_group workers;
+        for(size_t t=1; t<nthreads; t++)
+            workers.create_thread(boost::bind(&Batch::run, &jobs[t]));
+        jobs[0].run();
+        workers.join_all();
+    }
+    const double T1 = now();
+
+    size_t failed = 0;
+    for(size_t t=0; t<nthreads; t++) {
+        if(jobs[t].failed && !failed)
+            std::cerr<<"Error: "<<jobs[t].error<<"\n";
+        failed += jobs[t].failed;
+    }
+
+    if(!outfile.empty()) {
+        std::vector<size_t> shape(3);
+        shape[0] = nruns;
+        shape[1] = observe.size();
+        shape[2] = layout.width;
+        writeArray(outfile, shape, output);
+    }
+
+    std::cerr<<nruns<<" States in "<<(T1-T0)<<" s on "<<nthreads<<" threads: "
+             <<(T1>T0 ? nruns/(T1-T0) : 0.0)<<" States/s";
+    if(failed)
+        std::cerr<<", "<<failed<<" failed";
+    std::cerr<<"\n";
+
+    return failed ? 1 : 0;
+}
+
+} // namespace
+
 int main(int argc, char *argv[])
 {
+    std::string infile, outfile, pfile;
+    std::vector<std::string> observe, params;
+    long start = -1;
+    unsigned nthreads = 0;
+    bool showlayout = false;
+
+    int opt;
+    while((opt=getopt(argc, argv, "hLi:o:O:p:P:s:j:"))!=-1) {
+        switch(opt) {
+        case 'h': usage(argv[0]); return 0;
+        case 'L': showlayout = true; break;
+        case 'i': infile = optarg; break;
+        case 'o': outfile = optarg; break;
+        case 'O': observe.push_back(optarg); break;
+        case 'p': pfile = optarg; break;
+        case 'P': params.push_back(optarg); break;
+        case 's': start = strtol(optarg, NULL, 10); break;
+        case 'j': nthreads = strtoul(optarg, NULL, 10); break;
+        default:
+            usage(argv[0]);
+            return 2;
+        }
+    }
+    const bool batchmode = !infile.empty() || showlayout;
+
     FILE *in = stdin;
-    if(argc>1) {
-        in = fopen(argv[1], "r");
+    if(optind<argc) {
+        in = fopen(argv[optind], "r");
         if(!in) {
-            fprintf(stderr, "Failed to open %s\n", argv[1]);
+            fprintf(stderr, "Failed to open %s\n", argv[optind]);
             return 2;
         }
     }
@@ -28,10 +465,13 @@ int main(int argc, char *argv[])
         fclose(in);
         return 1;
     }
+    fclose(in);
 
-    std::cout<<"# Reduced lattice\n";
-    GLPSPrint(std::cout, *conf);
-    std::cout<<"\n";
+    if(!batchmode) {
+        std::cout<<"# Reduced lattice\n";
+        GLPSPrint(std::cout, *conf);
+        std::cout<<"\n";
+    }
 
     // register state and element types
     registerLinear();
@@ -39,6 +479,17 @@ int main(int argc, char *argv[])
 
     try {
         Machine sim(*conf);
+
+        if(showlayout) {
+            Config D;
+            std::auto_ptr<StateBase> state(sim.allocState(D));
+            StateLayout(*state).show(std::cout);
+            return 0;
+
+        } else if(batchmode) {
+            return batch(sim, infile, outfile, observe, pfile, params, start, nthreads);
+        }
+
         sim.set_trace(&std::cout);
 
         std::cout<<"# Machine configuration\n"<<sim<<"\n\n";
@@ -50,11 +501,8 @@ int main(int argc, char *argv[])
         std::cout << "\n# Final " << *state << "\n";
     }catch(std::exception& e){
         std::cerr<<"Simulation error: "<<e.what()<<"\n";
-        fclose(in);
         return 1;
     }
 
-    fclose(in);
-
     return 0;
 }